@@ -0,0 +1,173 @@
+"""Additive increase / multiplicative decrease (AIMD) controller for the
+number of transfers that are allowed to be in flight at the same time.
+
+The window grows by one every time a window's worth of transfers complete
+without the latency per MB climbing above the best seen so far by more than
+LATENCY_FACTOR, and is halved when the object store throttles us (503
+SlowDown).  Latency is compared per MB rather than per transfer, otherwise
+a run of large files looks like congestion and a run of small files looks
+like spare capacity.  The same container can then use whatever bandwidth is
+available to it, whether that's on a laptop or on a large pod.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_INITIAL_WINDOW = 10
+DEFAULT_MIN_WINDOW = 1
+DEFAULT_MAX_WINDOW = 64
+
+# stop growing the window when the latency per MB of a round is more than
+# this many times the best round
+LATENCY_FACTOR = 2.0
+# every transfer counts as at least this many bytes when latency is divided
+# by size, so the fixed cost of a request doesn't make a round of small (or
+# zero byte) files look congested
+MIN_LATENCY_BYTES = 1024 * 1024
+# number of seconds of completed transfers used to calculate throughput
+THROUGHPUT_WINDOW_SECONDS = 30
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial=DEFAULT_INITIAL_WINDOW,
+                 minimum=DEFAULT_MIN_WINDOW, maximum=DEFAULT_MAX_WINDOW,
+                 latencyFactor=LATENCY_FACTOR):
+        """[summary]
+
+        :param initial: number of transfers in flight to start with
+        :type initial: int, optional
+        :param minimum: the window is never shrunk below this
+        :type minimum: int, optional
+        :param maximum: the window never grows above this, should match the
+                        number of threads in the pool
+        :type maximum: int, optional
+        :param latencyFactor: the window stops growing once the latency per
+                              MB exceeds the best round by this factor
+        :type latencyFactor: float, optional
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = max(minimum, min(initial, maximum))
+        self.latencyFactor = latencyFactor
+        self.lock = threading.Lock()
+
+        # stats for the current round, a round ends when a window's worth
+        # of transfers have completed
+        self.roundCompleted = 0
+        self.roundLatency = 0.0
+        self.roundBytes = 0
+        # best seconds per MB of a round
+        self.bestLatency = None
+        # a throttle only shrinks the window once per round, otherwise all
+        # of the transfers that were in flight when the object store
+        # started throttling would collapse the window to the minimum
+        self.throttledThisRound = False
+
+        self.throttles = 0
+        self.errors = 0
+        # (time completed, bytes) of the recently completed transfers
+        self.recent = collections.deque()
+
+    def getWindow(self):
+        """
+        :return: number of transfers that should currently be in flight
+        :rtype: int
+        """
+        return self.window
+
+    def recordSuccess(self, latency, numBytes=0):
+        """records a transfer that completed
+
+        :param latency: number of seconds the transfer took
+        :type latency: float
+        :param numBytes: number of bytes that were transferred
+        :type numBytes: int, optional
+        """
+        with self.lock:
+            now = time.time()
+            self.recent.append((now, numBytes))
+            self._trimRecent(now)
+            self.roundCompleted += 1
+            self.roundLatency += latency
+            self.roundBytes += max(numBytes or 0, MIN_LATENCY_BYTES)
+            if self.roundCompleted >= self.window:
+                self._endRound()
+
+    def recordThrottle(self):
+        """records that the object store asked us to slow down, halves the
+        window if it hasn't already been cut this round
+        """
+        with self.lock:
+            self.throttles += 1
+            if self.throttledThisRound:
+                return
+            self.throttledThisRound = True
+            newWindow = max(self.minimum, self.window // 2)
+            LOGGER.info(
+                f"throttled by the object store, concurrency: {self.window}"
+                + f" -> {newWindow}"
+            )
+            self.window = newWindow
+
+    def recordError(self):
+        """records a transfer that failed for a reason other than
+        throttling, doesn't change the window
+        """
+        with self.lock:
+            self.errors += 1
+
+    def _endRound(self):
+        avgLatency = self.roundLatency / (self.roundBytes / (1024 * 1024))
+        if self.bestLatency is None or avgLatency < self.bestLatency:
+            self.bestLatency = avgLatency
+
+        # a throttle during the round has already shrunk the window
+        if not self.throttledThisRound:
+            if avgLatency > self.bestLatency * self.latencyFactor:
+                self.window = max(self.minimum, self.window - 1)
+            elif self.window < self.maximum:
+                self.window += 1
+        LOGGER.debug(
+            f"round latency: {avgLatency:.3f}s/MB, best: "
+            + f"{self.bestLatency:.3f}s/MB, concurrency: {self.window}"
+        )
+        self.roundCompleted = 0
+        self.roundLatency = 0.0
+        self.roundBytes = 0
+        self.throttledThisRound = False
+
+    def _trimRecent(self, now):
+        while (
+            self.recent
+            and now - self.recent[0][0] > THROUGHPUT_WINDOW_SECONDS
+        ):
+            self.recent.popleft()
+
+    def getThroughput(self):
+        """
+        :return: bytes per second over the last THROUGHPUT_WINDOW_SECONDS
+        :rtype: float
+        """
+        with self.lock:
+            now = time.time()
+            self._trimRecent(now)
+            if not self.recent:
+                return 0.0
+            elapsed = max(now - self.recent[0][0], 1.0)
+            return sum(numBytes for _, numBytes in self.recent) / elapsed
+
+    def getStatusMessage(self):
+        """
+        :return: the current concurrency and throughput formatted for the
+                 progress log
+        :rtype: str
+        """
+        mbPerSec = self.getThroughput() / (1024 * 1024)
+        return (
+            f"concurrency: {self.window}, throughput: {mbPerSec:.1f} MB/s, "
+            + f"throttled: {self.throttles}"
+        )
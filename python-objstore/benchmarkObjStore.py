@@ -0,0 +1,543 @@
+"""Measures the throughput of ObjectStoreUtil and ConsolidateStorage against
+a local S3 server.
+
+Starts a local MinIO server (needs the minio binary on the path) or an in
+process moto server (needs moto from requirements-dev.txt), fills a source
+bucket with synthetic WRF files, and then times each of the operations at
+each of the concurrency levels:
+
+* list    - listing the bucket, split into the same shards as the diff
+* get     - ObjectStoreUtil.getObject
+* put     - ObjectStoreUtil.putObject
+* acl     - ObjectStoreUtil.setPublicPermissions
+* diff    - objStoreDiff.BucketDiff of the source and an empty bucket
+* move    - ConsolidateStorage.moveFilesAsync into an empty bucket
+
+The results (objects/s, MB/s, p50 / p99 latency and the peak RSS of the
+process) are written to a json file, which can be passed back in with
+--compare to see how a change affected them.
+
+    python benchmarkObjStore.py --server moto --objects 200 \\
+        --sizes lognormal:2MB:1.0 --concurrency 1,8,32 --output bench.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+LOGGER = logging.getLogger(__name__)
+
+OPERATIONS = ["list", "get", "put", "acl", "diff", "move"]
+
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+SRC_BUCKET = "bench-src"
+INDEX_FILE = "wrf_fileindex.csv"
+ACCESS_KEY = "benchmark"
+SECRET_KEY = "benchmark-secret"
+
+# seconds to wait for the local server to start
+SERVER_START_TIMEOUT = 30
+
+
+def parseSize(value):
+    """converts a size like 512KB or 16MB into bytes
+
+    :rtype: int
+    """
+    value = value.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(value)
+
+
+def getSizeFunction(spec, rand):
+    """builds a function that returns object sizes from a distribution
+    description:
+
+    * fixed:<size>
+    * uniform:<min size>:<max size>
+    * lognormal:<median size>:<sigma>
+
+    :param spec: the distribution description
+    :type spec: str
+    :param rand: random number generator
+    :type rand: random.Random
+    :raises ValueError: if the description can't be parsed
+    :return: function that returns a size in bytes
+    :rtype: function
+    """
+    parts = spec.split(":")
+    if parts[0] == "fixed" and len(parts) == 2:
+        size = parseSize(parts[1])
+        return lambda: size
+    if parts[0] == "uniform" and len(parts) == 3:
+        low, high = parseSize(parts[1]), parseSize(parts[2])
+        return lambda: rand.randint(low, high)
+    if parts[0] == "lognormal" and len(parts) == 3:
+        median, sigma = parseSize(parts[1]), float(parts[2])
+        return lambda: int(median * rand.lognormvariate(0, sigma))
+    msg = f"unable to parse the size distribution: {spec}"
+    raise ValueError(msg)
+
+
+def getWRFNames(numObjects, rand):
+    """names in the same format as the WRF files, for example
+    x002y012x011y021.201901.10x10.m3d.7z
+    """
+    names = set()
+    while len(names) < numObjects:
+        i = rand.randrange(2, 467, 10)
+        j = rand.randrange(2, 416, 10)
+        month = f"{rand.randint(2010, 2022)}{rand.randint(1, 12):02d}"
+        names.add(f"x{i:03d}y{j:03d}x{i + 9:03d}y{j + 9:03d}."
+                  f"{month}.10x10.m3d.7z")
+    return sorted(names)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def getPeakRss():
+    """
+    :return: the peak resident memory of the process so far in MB
+    :rtype: float
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macos bytes
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def getFreePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalS3Server:
+    def __init__(self, kind, workDir, minioBinary="minio"):
+        """[summary]
+
+        :param kind: 'minio' or 'moto'
+        :type kind: str
+        :param workDir: directory for the minio data
+        :type workDir: str
+        :param minioBinary: path to the minio server binary
+        :type minioBinary: str, optional
+        """
+        self.kind = kind
+        self.workDir = workDir
+        self.minioBinary = minioBinary
+        self.host = f"127.0.0.1:{getFreePort()}"
+        self.process = None
+        self.motoServer = None
+
+    def start(self):
+        if self.kind == "minio":
+            env = dict(os.environ, MINIO_ROOT_USER=ACCESS_KEY,
+                       MINIO_ROOT_PASSWORD=SECRET_KEY)
+            self.process = subprocess.Popen(
+                [self.minioBinary, "server", "--quiet", "--address",
+                 self.host, os.path.join(self.workDir, "minio")],
+                env=env, stdout=subprocess.DEVNULL,
+            )
+            self.waitForServer(f"http://{self.host}/minio/health/live")
+        elif self.kind == "moto":
+            # only needed for the benchmark, see requirements-dev.txt
+            from moto.server import ThreadedMotoServer
+
+            hostName, port = self.host.split(":")
+            self.motoServer = ThreadedMotoServer(
+                ip_address=hostName, port=int(port), verbose=False)
+            self.motoServer.start()
+            self.waitForServer(f"http://{self.host}/")
+        else:
+            msg = f"unknown server type: {self.kind}"
+            raise ValueError(msg)
+        LOGGER.info(f"started {self.kind} on {self.host}")
+
+    def waitForServer(self, url):
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                urllib.request.urlopen(url, timeout=1)
+                return
+            except urllib.error.HTTPError:
+                # the server is up, it just didn't like the request
+                return
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.motoServer is not None:
+            self.motoServer.stop()
+
+
+class Benchmark:
+    def __init__(self, host, workDir, numObjects, sizeSpec,
+                 concurrencyLevels, seed=0):
+        """[summary]
+
+        :param host: host:port of the local s3 server
+        :type host: str
+        :param workDir: directory for downloaded files, inventories and
+                        journals
+        :type workDir: str
+        :param numObjects: number of objects in the source bucket
+        :type numObjects: int
+        :param sizeSpec: size distribution of the objects, see
+                         getSizeFunction
+        :type sizeSpec: str
+        :param concurrencyLevels: numbers of threads the operations are run
+                                  with
+        :type concurrencyLevels: list
+        :param seed: seed for the object names and sizes
+        :type seed: int, optional
+        """
+        self.host = host
+        self.workDir = workDir
+        self.numObjects = numObjects
+        self.sizeSpec = sizeSpec
+        self.concurrencyLevels = concurrencyLevels
+        self.rand = random.Random(seed)
+        self.results = []
+
+        # the repo modules read their config from the environment when they
+        # are imported
+        os.environ.update({
+            "OBJ_STORE_HOST": host,
+            "OBJ_STORE_USER": ACCESS_KEY,
+            "OBJ_STORE_SECRET": SECRET_KEY,
+            "OBJ_STORE_BUCKET": "bench-dest",
+            "OBJ_STORE_TST_HOST": host,
+            "OBJ_STORE_TST_USER": ACCESS_KEY,
+            "OBJ_STORE_TST_SECRET": SECRET_KEY,
+            "OBJ_STORE_TST_BUCKET": SRC_BUCKET,
+            "OBJ_STORE_SECURE": "false",
+            "TMP_FOLDER": os.path.join(workDir, "tmp"),
+            "INDEX_FILE": INDEX_FILE,
+            "TEST_OBJ_NAME": INDEX_FILE,
+        })
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        os.makedirs(os.environ["TMP_FOLDER"], exist_ok=True)
+
+        import constants
+        import objStoreClients
+        import objStoreDiff
+        import objStoreUtil
+
+        # same pool size as ConsolidateStorage uses, so the clients shared
+        # with it are big enough
+        objStoreClients.setPoolSize(
+            max(concurrencyLevels + [constants.MAX_CONCURRENCY])
+            + constants.MAX_PART_REQUESTS + objStoreDiff.DEFAULT_LIST_WORKERS
+        )
+
+        self.objStoreUtil = objStoreUtil
+        self.srcUtil = self.getUtil(SRC_BUCKET)
+        self.objectSizes = {}
+
+    def getUtil(self, bucket):
+        objUtil = self.objStoreUtil.ObjectStoreUtil(
+            objStoreHost=self.host, objStoreUser=ACCESS_KEY,
+            objStoreSecret=SECRET_KEY, objStoreBucket=bucket,
+            tmpfolder=os.environ["TMP_FOLDER"], secure=False,
+        )
+        objUtil.createBotoClient()
+        return objUtil
+
+    def createBucket(self, bucket):
+        objUtil = self.getUtil(bucket)
+        if not objUtil.minIoClient.bucket_exists(bucket):
+            objUtil.minIoClient.make_bucket(bucket)
+        return objUtil
+
+    def seed(self, concurrency):
+        """fills the source bucket with the synthetic WRF files"""
+        self.createBucket(SRC_BUCKET)
+        sizeFunction = getSizeFunction(self.sizeSpec, self.rand)
+        names = getWRFNames(self.numObjects, self.rand)
+        self.objectSizes = {name: max(1, sizeFunction()) for name in names}
+        block = os.urandom(max(self.objectSizes.values()))
+
+        def putSeed(name):
+            size = self.objectSizes[name]
+            # a unique prefix so no two objects have the same content
+            body = os.urandom(16) + block[:max(0, size - 16)]
+            self.srcUtil.botoClient.put_object(
+                Bucket=SRC_BUCKET, Key=name, Body=body[:size])
+            return size
+
+        result = self.timeOperation("seed", concurrency, names, putSeed)
+        LOGGER.info(f"seeded {len(names)} objects, "
+                    f"{result['bytes'] / 1024 ** 2:.1f}MB")
+
+    def timeOperation(self, operation, concurrency, items, func):
+        """runs func on each item on a pool of threads, timing each call
+
+        :param func: called with each item, returns the number of bytes it
+                     moved, or a tuple of the number of objects and bytes
+                     when an item covers more than one object
+        :type func: function
+        :return: the result
+        :rtype: dict
+        """
+        latencies = []
+        numObjects = 0
+        numBytes = 0
+        errors = 0
+
+        def timed(item):
+            start = time.perf_counter()
+            counts = func(item)
+            if not isinstance(counts, tuple):
+                counts = (1, counts or 0)
+            return time.perf_counter() - start, counts
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            futures = [executor.submit(timed, item) for item in items]
+            for fut in concurrent.futures.as_completed(futures):
+                try:
+                    latency, (itemObjects, itemBytes) = fut.result()
+                except Exception as err:
+                    errors += 1
+                    LOGGER.debug(f"{operation} error: {err}")
+                    continue
+                latencies.append(latency)
+                numObjects += itemObjects
+                numBytes += itemBytes
+        elapsed = time.perf_counter() - start
+        return self.recordResult(operation, concurrency, numObjects,
+                                 numBytes, elapsed, latencies, errors)
+
+    def recordResult(self, operation, concurrency, numObjects, numBytes,
+                     elapsed, latencies, errors=0):
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        result = {
+            "operation": operation,
+            "concurrency": concurrency,
+            "objects": numObjects,
+            "bytes": numBytes,
+            "errors": errors,
+            "seconds": round(elapsed, 4),
+            "objects_per_sec": round(numObjects / elapsed, 2),
+            "mb_per_sec": round(numBytes / 1024 ** 2 / elapsed, 2),
+            "p50_ms": None if p50 is None else round(p50 * 1000, 2),
+            "p99_ms": None if p99 is None else round(p99 * 1000, 2),
+            "peak_rss_mb": round(getPeakRss(), 1),
+        }
+        if operation != "seed":
+            self.results.append(result)
+        latency = ""
+        if latencies:
+            latency = f" p50 {result['p50_ms']}ms p99 {result['p99_ms']}ms"
+        LOGGER.info(
+            f"{operation:<5} c={concurrency:<3} "
+            f"{result['objects_per_sec']:>9.1f} obj/s "
+            f"{result['mb_per_sec']:>8.1f} MB/s{latency} errors {errors}"
+        )
+        return result
+
+    def benchList(self, concurrency):
+        import objStoreDiff
+
+        def listRange(keyRange):
+            count = sum(1 for _ in self.srcUtil.listObjectRange(*keyRange))
+            return count, 0
+
+        self.timeOperation("list", concurrency, objStoreDiff.getKeyRanges(),
+                           listRange)
+
+    def benchGet(self, concurrency):
+        getDir = os.path.join(self.workDir, "get")
+        os.makedirs(getDir, exist_ok=True)
+
+        def get(name):
+            self.srcUtil.getObject(name, os.path.join(getDir, name))
+            return self.objectSizes[name]
+
+        self.timeOperation("get", concurrency, list(self.objectSizes), get)
+
+    def benchPut(self, concurrency):
+        bucket = f"bench-put-{concurrency}"
+        putUtil = self.createBucket(bucket)
+        getDir = os.path.join(self.workDir, "get")
+        if not os.path.exists(getDir):
+            self.benchGet(concurrency)
+
+        def put(name):
+            putUtil.putObject(name, os.path.join(getDir, name))
+            return self.objectSizes[name]
+
+        self.timeOperation("put", concurrency, list(self.objectSizes), put)
+
+    def benchAcl(self, concurrency):
+        self.timeOperation("acl", concurrency, list(self.objectSizes),
+                           self.srcUtil.setPublicPermissions)
+
+    def benchDiff(self, concurrency):
+        import objStoreDiff
+
+        destUtil = self.createBucket(f"bench-diff-{concurrency}")
+        diff = objStoreDiff.BucketDiff(self.srcUtil, destUtil,
+                                       maxWorkers=concurrency)
+        start = time.perf_counter()
+        numObjects = sum(1 for _ in diff.iterDiff())
+        self.recordResult("diff", concurrency, numObjects, 0,
+                          time.perf_counter() - start, [])
+
+    def benchMove(self, concurrency):
+        import constants
+        import consolidate_objstores
+
+        bucket = f"bench-move-{concurrency}"
+        self.createBucket(bucket)
+        # each level gets its own destination, inventories and journal
+        constants.OBJ_STORE_BUCKET = bucket
+        constants.TMP_FOLDER = os.path.join(self.workDir, f"move-{bucket}")
+        os.makedirs(constants.TMP_FOLDER, exist_ok=True)
+        with open(os.path.join(constants.TMP_FOLDER, INDEX_FILE), "w"):
+            pass
+
+        cons = consolidate_objstores.ConsolidateStorage()
+        latencies = []
+        moveFile = cons.moveFile
+
+        def timedMove(srcFile):
+            start = time.perf_counter()
+            numBytes = moveFile(srcFile)
+            latencies.append(time.perf_counter() - start)
+            return numBytes
+
+        cons.moveFile = timedMove
+        start = time.perf_counter()
+        failed = cons.moveFilesAsync(maxConcurrency=concurrency)
+        elapsed = time.perf_counter() - start
+        moved = [name for name in self.objectSizes if name not in failed]
+        self.recordResult(
+            "move", concurrency, len(moved),
+            sum(self.objectSizes[name] for name in moved), elapsed,
+            latencies, len(failed))
+
+    def run(self, operations):
+        self.seed(max(self.concurrencyLevels))
+        for operation in operations:
+            benchFunction = getattr(self, "bench" + operation.capitalize())
+            for concurrency in self.concurrencyLevels:
+                benchFunction(concurrency)
+        return self.results
+
+
+def compareResults(previous, current):
+    """logs the change in objects/s between two benchmark runs"""
+    previousResults = {
+        (result["operation"], result["concurrency"]): result
+        for result in previous["results"]
+    }
+    for result in current["results"]:
+        key = (result["operation"], result["concurrency"])
+        if key not in previousResults:
+            continue
+        before = previousResults[key]["objects_per_sec"]
+        after = result["objects_per_sec"]
+        change = (after - before) / before * 100 if before else 0
+        LOGGER.info(f"{key[0]:<5} c={key[1]:<3} {before:>9.1f} -> "
+                    f"{after:>9.1f} obj/s ({change:+.1f}%)")
+
+
+if __name__ == '__main__':
+    # only the benchmark's own messages, the per file messages from the
+    # code being measured would swamp them
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s - %(message)s')
+    LOGGER.setLevel(logging.INFO)
+    # moto's http server logs every request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        description='benchmarks the object store code against a local s3 '
+                    'server')
+    parser.add_argument('--server', choices=['minio', 'moto'],
+                        default='moto', help='local s3 server to start')
+    parser.add_argument('--minio-binary', default='minio',
+                        help='path to the minio server binary')
+    parser.add_argument('--objects', type=int, default=100,
+                        help='number of objects in the source bucket')
+    parser.add_argument('--sizes', default='lognormal:1MB:1.0',
+                        help='object size distribution: fixed:<size>, '
+                             'uniform:<min>:<max> or lognormal:<median>:'
+                             '<sigma>, sizes like 512KB or 16MB')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated operations to time')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the object names and sizes')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='json file the results are written to')
+    parser.add_argument('--compare',
+                        help='json file from an earlier run to compare to')
+    args = parser.parse_args()
+
+    operations = args.operations.split(',')
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"unknown operations: {sorted(unknown)}")
+    concurrencyLevels = [int(level) for level in args.concurrency.split(',')]
+
+    workDir = tempfile.mkdtemp(prefix='objstore-bench-')
+    server = LocalS3Server(args.server, workDir, args.minio_binary)
+    server.start()
+    try:
+        benchmark = Benchmark(server.host, workDir, args.objects, args.sizes,
+                              concurrencyLevels, seed=args.seed)
+        results = benchmark.run(operations)
+    finally:
+        server.stop()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "server": args.server,
+            "objects": args.objects,
+            "sizes": args.sizes,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    LOGGER.info(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as fh:
+            compareResults(json.load(fh), report)
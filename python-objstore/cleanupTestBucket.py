@@ -0,0 +1,394 @@
+"""Deletes the objects from the test bucket that have been consolidated.
+
+The objects to delete are the ones the transfer journal(s) of the
+consolidation show as verified by their etag or a checksum (not the ones
+where only the size was checked).  Before a batch is deleted its key range
+is listed in both buckets, and an object is only deleted when both buckets
+still have it with the etags it was verified with, so an object that changed
+on either side since it was verified is kept.  They are removed with S3
+multi-object deletes of up to 1000 objects on a pool of threads, at a
+limited number of objects per second.  Every object that is looked at gets a
+line in a tombstone report (tombstones.<time>.jsonl) with its size, etag and
+what happened to it, and deleted objects are recorded as source-deleted in
+the journal so they are not looked at again.
+
+Don't run this while a consolidation that uses the same journals is
+running.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import heapq
+import itertools
+import json
+import logging
+import operator
+import os
+import threading
+import time
+
+import constants
+import consolidateShards
+import objStoreDiff
+import objStoreInventory
+import objStoreUtil
+import objStoreVerify
+import transferJournal
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+# tombstone statuses
+DELETED = "deleted"
+DRY_RUN = "dry-run"
+SKIPPED = "skipped"
+ERROR = "error"
+
+# verification methods that compare the content, objects where only the size
+# was compared are never deleted
+CONTENT_METHODS = [objStoreVerify.METHOD_ETAG, objStoreVerify.METHOD_CHECKSUM]
+
+
+class RateLimiter:
+    """spaces out work so that no more than rate units are done per second,
+    shared by all the threads"""
+
+    def __init__(self, rate=None):
+        """[summary]
+
+        :param rate: units per second, None for no limit
+        :type rate: float, optional
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.nextStart = time.monotonic()
+
+    def acquire(self, amount=1):
+        """blocks until amount units can be done"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.nextStart)
+            self.nextStart = start + amount / self.rate
+        time.sleep(max(0, start - now))
+
+
+class SourceCleanup:
+    def __init__(self, srcObjStoreUtil, destObjStoreUtil, srcInventory,
+                 journals, batchSize=objStoreUtil.MAX_DELETE_BATCH,
+                 maxWorkers=DEFAULT_WORKERS, maxRate=None, dryRun=False,
+                 reportDir=None):
+        """[summary]
+
+        :param srcObjStoreUtil: util for the bucket the objects are deleted
+                                from
+        :type srcObjStoreUtil: objStoreUtil.ObjectStoreUtil
+        :param destObjStoreUtil: util for the bucket the objects were moved
+                                 to, objects it doesn't have with the
+                                 verified etag are not deleted
+        :type destObjStoreUtil: objStoreUtil.ObjectStoreUtil
+        :param srcInventory: inventory of the bucket the objects are deleted
+                             from, the deleted objects are removed from it
+        :type srcInventory: objStoreInventory.BucketInventory
+        :param journals: transfer journals of the consolidation
+        :type journals: list
+        :param batchSize: objects per delete request, at most
+                          objStoreUtil.MAX_DELETE_BATCH
+        :type batchSize: int, optional
+        :param maxWorkers: number of delete requests sent at the same time
+        :type maxWorkers: int, optional
+        :param maxRate: max objects deleted per second, None for no limit
+        :type maxRate: float, optional
+        :param dryRun: write the report without deleting anything
+        :type dryRun: bool, optional
+        :param reportDir: folder the tombstone report is written to,
+                          defaults to the tmp folder of srcObjStoreUtil
+        :type reportDir: str, optional
+        """
+        self.srcObjStoreUtil = srcObjStoreUtil
+        self.destObjStoreUtil = destObjStoreUtil
+        self.srcInventory = srcInventory
+        self.journals = journals
+        self.batchSize = min(batchSize, objStoreUtil.MAX_DELETE_BATCH)
+        self.maxWorkers = maxWorkers
+        self.rateLimiter = RateLimiter(maxRate)
+        self.dryRun = dryRun
+        self.reportDir = reportDir or srcObjStoreUtil.tmpfolder
+        self.counts = collections.Counter()
+
+    def getCandidates(self):
+        """
+        :yield: a tombstone for every verified object in name order, with
+                the status SKIPPED if it wasn't verified by its etag or a
+                checksum
+        :rtype: dict
+        """
+        journalKeys = [
+            [(key, journal)
+             for key in sorted(journal.getKeys(transferJournal.VERIFIED))]
+            for journal in self.journals
+        ]
+        for key, journal in heapq.merge(*journalKeys,
+                                        key=operator.itemgetter(0)):
+            details = journal.getVerifiedDetails(key)
+            tombstone = {"key": key, "journal": journal.journalFile,
+                         "etag": details.get("etag"),
+                         "destEtag": details.get("destEtag")}
+            if details.get("method") not in CONTENT_METHODS:
+                tombstone["status"] = SKIPPED
+                tombstone["reason"] = \
+                    f"verified by {details.get('method')}, not the content"
+            elif not details.get("etag") or not details.get("destEtag"):
+                tombstone["status"] = SKIPPED
+                tombstone["reason"] = "no verified etags in the journal"
+            yield tombstone
+
+    def listRange(self, objUtil, keys, startAfter, endKey):
+        """
+        :param keys: names of the objects to keep from the listing
+        :type keys: set
+        :return: the objects in a bucket with names in keys and startAfter <
+                 name <= endKey by name, listed now rather than taken from an
+                 inventory that could be out of date
+        :rtype: dict
+        """
+        return {
+            obj.object_name: obj
+            for obj in objUtil.listObjectRange(startAfter, endKey)
+            if obj.object_name in keys
+        }
+
+    def checkBatch(self, batch, startAfter):
+        """lists the key range of a batch in both buckets and marks the
+        objects that are missing from either, or whose etag in either isn't
+        the one it was verified with, as SKIPPED
+
+        :param batch: tombstones of the objects to delete, in name order
+        :type batch: list
+        :param startAfter: the last name of the batch before, the range
+                           listed is startAfter < name <= the last name of
+                           this batch
+        :type startAfter: str
+        :return: the tombstones of the objects that can be deleted
+        :rtype: list
+        """
+        keys = set(tombstone["key"] for tombstone in batch)
+        endKey = batch[-1]["key"]
+        srcObjects = self.listRange(self.srcObjStoreUtil, keys, startAfter,
+                                    endKey)
+        destObjects = self.listRange(self.destObjStoreUtil, keys, startAfter,
+                                     endKey)
+        checked = []
+        for tombstone in batch:
+            key = tombstone["key"]
+            srcObject = srcObjects.get(key)
+            destObject = destObjects.get(key)
+            reason = None
+            if srcObject is None:
+                reason = "not in the source bucket"
+            elif destObject is None:
+                reason = "not in the destination bucket"
+            else:
+                tombstone["size"] = srcObject.size
+                srcEtag = objStoreDiff.normalizeEtag(srcObject.etag)
+                destEtag = objStoreDiff.normalizeEtag(destObject.etag)
+                if srcEtag != tombstone["etag"]:
+                    reason = f"source etag {srcEtag} isn't the verified " + \
+                        f"etag {tombstone['etag']}"
+                elif destEtag != tombstone["destEtag"]:
+                    reason = f"destination etag {destEtag} isn't the " + \
+                        f"verified etag {tombstone['destEtag']}"
+                elif destObject.size != srcObject.size:
+                    reason = f"destination size {destObject.size} differs"
+            if reason:
+                tombstone.update(status=SKIPPED, reason=reason,
+                                 time=time.time())
+            else:
+                checked.append(tombstone)
+        return checked
+
+    def deleteBatch(self, batch, startAfter=None):
+        """checks and deletes a batch of objects, runs on the worker threads
+
+        :param batch: tombstones of the objects to delete, in name order
+        :type batch: list
+        :param startAfter: the last name of the batch before
+        :type startAfter: str, optional
+        :return: the tombstones with the status filled in
+        :rtype: list
+        """
+        try:
+            checked = self.checkBatch(batch, startAfter)
+        except Exception as err:
+            LOGGER.error(f"unable to check a batch of {len(batch)}: {err}")
+            now = time.time()
+            for tombstone in batch:
+                tombstone.update(status=ERROR, time=now, error=repr(err))
+            return batch
+        now = time.time()
+        if self.dryRun:
+            for tombstone in checked:
+                tombstone.update(status=DRY_RUN, time=now)
+            return batch
+        if not checked:
+            return batch
+        self.rateLimiter.acquire(len(checked))
+        try:
+            deleted, errors = self.srcObjStoreUtil.deleteObjects(
+                [tombstone["key"] for tombstone in checked]
+            )
+        except Exception as err:
+            LOGGER.error(f"unable to delete a batch of {len(checked)}: {err}")
+            deleted, errors = [], {}
+            for tombstone in checked:
+                errors[tombstone["key"]] = repr(err)
+        deleted = set(deleted)
+        now = time.time()
+        for tombstone in checked:
+            key = tombstone["key"]
+            if key in deleted:
+                tombstone.update(status=DELETED, time=now)
+            else:
+                tombstone.update(status=ERROR, time=now,
+                                 error=errors.get(key, "not deleted"))
+        return batch
+
+    def recordBatch(self, batch, reportFh):
+        """writes the tombstones to the report and updates the journals and
+        inventory for the deleted objects
+        """
+        journals = {journal.journalFile: journal for journal in self.journals}
+        deletedKeys = []
+        for tombstone in batch:
+            self.counts[tombstone["status"]] += 1
+            reportFh.write(json.dumps(tombstone) + "\n")
+            if tombstone["status"] == SKIPPED:
+                LOGGER.warning(f"not deleting {tombstone['key']}: "
+                               f"{tombstone['reason']}")
+            elif tombstone["status"] == DELETED:
+                journals[tombstone["journal"]].record(
+                    tombstone["key"], transferJournal.SOURCE_DELETED
+                )
+                deletedKeys.append(tombstone["key"])
+        if deletedKeys:
+            self.srcInventory.removeObjects(deletedKeys)
+
+    def run(self, limit=None):
+        """deletes the verified objects from the source bucket
+
+        :param limit: only look at this many objects
+        :type limit: int, optional
+        :return: number of objects by tombstone status
+        :rtype: dict
+        """
+        reportFile = os.path.join(
+            self.reportDir,
+            f"tombstones.{time.strftime('%Y%m%dT%H%M%S')}.jsonl"
+        )
+        candidates = itertools.islice(self.getCandidates(), limit)
+        start = time.time()
+
+        with open(reportFile, "w") as reportFh, \
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.maxWorkers) as executor:
+            futures = set()
+            batch = []
+            # the batches cover consecutive key ranges, each is listed from
+            # the last key of the one before
+            startAfter = None
+
+            def waitForBatches(maxPending):
+                while len(futures) > maxPending:
+                    done, _ = concurrent.futures.wait(
+                        futures,
+                        return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for fut in done:
+                        futures.remove(fut)
+                        self.recordBatch(fut.result(), reportFh)
+
+            for tombstone in candidates:
+                if tombstone.get("status") == SKIPPED:
+                    self.recordBatch([tombstone], reportFh)
+                    continue
+                batch.append(tombstone)
+                if len(batch) >= self.batchSize:
+                    futures.add(executor.submit(self.deleteBatch, batch,
+                                                startAfter))
+                    startAfter = batch[-1]["key"]
+                    batch = []
+                    waitForBatches(self.maxWorkers * 2)
+            if batch:
+                futures.add(executor.submit(self.deleteBatch, batch,
+                                            startAfter))
+            waitForBatches(0)
+
+        for journal in self.journals:
+            journal.sync()
+        elapsed = max(time.time() - start, 0.001)
+        LOGGER.info(
+            f"{'dry run, ' if self.dryRun else ''}{dict(self.counts)} in "
+            + f"{elapsed:.1f}s, tombstones written to {reportFile}"
+        )
+        return dict(self.counts)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='deletes the objects that have been consolidated and '
+                    'verified from the test bucket')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='write the tombstone report without deleting')
+    parser.add_argument('--journal', action='append', default=None,
+                        help='transfer journal to take the verified objects '
+                             'from, can be repeated, defaults to all the '
+                             'journals in TMP_FOLDER')
+    parser.add_argument('--batch-size', type=int,
+                        default=objStoreUtil.MAX_DELETE_BATCH,
+                        help='objects per delete request, max 1000')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='delete requests sent at the same time')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='max objects deleted per second')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='only look at this many objects')
+    parser.add_argument('--report-dir', default=constants.TMP_FOLDER,
+                        help='folder the tombstone report is written to')
+    args = parser.parse_args()
+
+    journalFiles = args.journal or sorted(glob.glob(os.path.join(
+        constants.TMP_FOLDER, f"{consolidateShards.JOURNAL_PREFIX}*.jsonl")))
+    if not journalFiles:
+        parser.error(f"no transfer journals in {constants.TMP_FOLDER}")
+
+    srcObjStoreUtil = objStoreUtil.ObjectStoreUtil(
+        objStoreHost=constants.OBJ_STORE_HOST,
+        objStoreUser=constants.OBJ_STORE_TST_USER,
+        objStoreSecret=constants.OBJ_STORE_TST_SECRET,
+        objStoreBucket=constants.OBJ_STORE_TST_BUCKET,
+        tmpfolder=constants.TMP_FOLDER
+    )
+    destObjStoreUtil = objStoreUtil.ObjectStoreUtil(
+        tmpfolder=constants.TMP_FOLDER)
+    cleanup = SourceCleanup(
+        srcObjStoreUtil,
+        destObjStoreUtil,
+        objStoreInventory.BucketInventory(srcObjStoreUtil),
+        [transferJournal.TransferJournal(journalFile)
+         for journalFile in journalFiles],
+        batchSize=args.batch_size,
+        maxWorkers=args.workers,
+        maxRate=args.max_rate,
+        dryRun=args.dry_run,
+        reportDir=args.report_dir,
+    )
+    cleanup.run(limit=args.limit)
+    for journal in cleanup.journals:
+        journal.close()
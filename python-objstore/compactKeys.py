@@ -0,0 +1,307 @@
+"""Compact, sorted set of object names with their size, etag and last
+modified time.
+
+A python str, int and tuple per object adds up to a few hundred bytes, so a
+listing of ten million objects held in lists or dicts needs gigabytes.  The
+set keeps the names front coded in blocks: the first name of every block is
+kept as a str (for the binary search), the rest only as the length of the
+prefix they share with the name before them and the bytes that differ.  WRF
+names share most of their prefix with their neighbours, so a name costs a
+little over ten bytes.  Sizes, times and etags go in arrays, the etag as the
+16 bytes of its md5 plus the number of parts for multipart etags.  A set
+of names only (fromKeys) doesn't keep the arrays at all.
+
+Names have to be added in sorted order, which is the order object stores and
+the inventory list them in.
+"""
+
+import array
+import bisect
+import datetime
+
+BLOCK_SIZE = 32
+# part count for etags that aren't an md5, these are kept in a dict
+OTHER_ETAG = 0xFFFF
+# part count for objects that weren't given an etag
+NO_ETAG = 0xFFFE
+# size / last modified of an object that wasn't given one
+UNKNOWN = -1
+
+
+class ObjectRecord:
+    """name, size, etag and last modified time of an object, with the same
+    fields as objStoreInventory.InventoryRecord
+    """
+
+    __slots__ = ("object_name", "size", "etag", "last_modified")
+
+    def __init__(self, object_name, size=None, etag=None,
+                 last_modified=None):
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def __repr__(self):
+        return (f"ObjectRecord({self.object_name!r}, {self.size!r}, "
+                + f"{self.etag!r}, {self.last_modified!r})")
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectRecord) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+
+def toTimestamp(lastModified):
+    if isinstance(lastModified, datetime.datetime):
+        return lastModified.timestamp()
+    return lastModified
+
+
+def sharedPrefixLength(first, second):
+    """number of leading bytes two names have in common"""
+    limit = min(len(first), len(second))
+    # the first differing byte is the highest set byte of the xor
+    diff = int.from_bytes(first[:limit], "big") ^ \
+        int.from_bytes(second[:limit], "big")
+    return limit - (diff.bit_length() + 7) // 8
+
+
+def writeVarint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def readVarint(buf, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class CompactKeySet:
+    def __init__(self, blockSize=BLOCK_SIZE, withMetadata=True):
+        """[summary]
+
+        :param blockSize: number of names per front coded block, larger
+                          blocks use less memory and make lookups slower
+        :type blockSize: int, optional
+        :param withMetadata: keep the size, etag and last modified time of
+                             each object, if false the set only holds names
+        :type withMetadata: bool, optional
+        """
+        self.blockSize = blockSize
+        self.withMetadata = withMetadata
+        # first name of each block, and where the block starts in data
+        self.blockKeys = []
+        self.blockOffsets = array.array("Q")
+        self.data = bytearray()
+        self.sizes = array.array("q")
+        self.lastModified = array.array("d")
+        self.etagDigests = bytearray()
+        self.partCounts = array.array("H")
+        self.otherEtags = {}
+        self.lastKey = None
+        self.count = 0
+
+    @classmethod
+    def fromRecords(cls, records, blockSize=BLOCK_SIZE):
+        """builds a set from records sorted by name, for example the ones
+        yielded by listObjectRange
+
+        :param records: objects with object_name, size, etag and
+                        last_modified attributes
+        :type records: iterable
+        :rtype: CompactKeySet
+        """
+        keySet = cls(blockSize)
+        for record in records:
+            keySet.add(record.object_name, record.size, record.etag,
+                       record.last_modified)
+        return keySet
+
+    @classmethod
+    def fromKeys(cls, keys, blockSize=BLOCK_SIZE):
+        """builds a set of names only from names in sorted order
+
+        :rtype: CompactKeySet
+        """
+        keySet = cls(blockSize, withMetadata=False)
+        for key in keys:
+            keySet.add(key)
+        return keySet
+
+    def add(self, key, size=None, etag=None, lastModified=None):
+        """adds an object, its name has to sort after the last one added
+
+        :raises ValueError: if the name isn't after the last one, or a
+                            size, etag or time is given to a set of names
+                            only
+        """
+        if self.lastKey is not None and key <= self.lastKey:
+            msg = f"keys have to be added in sorted order, {key} is not " + \
+                f"after {self.lastKey}"
+            raise ValueError(msg)
+        if not self.withMetadata and (
+            size is not None or etag or lastModified is not None
+        ):
+            msg = f"{key} has a size, etag or time but the set only " + \
+                "holds names"
+            raise ValueError(msg)
+        encoded = key.encode("utf-8")
+        if self.count % self.blockSize == 0:
+            self.blockKeys.append(key)
+            self.blockOffsets.append(len(self.data))
+            shared = 0
+        else:
+            shared = sharedPrefixLength(self.lastEncoded, encoded)
+        writeVarint(self.data, shared)
+        writeVarint(self.data, len(encoded) - shared)
+        self.data += encoded[shared:]
+        self.lastKey = key
+        self.lastEncoded = encoded
+
+        if self.withMetadata:
+            self.sizes.append(UNKNOWN if size is None else size)
+            lastModified = toTimestamp(lastModified)
+            self.lastModified.append(
+                UNKNOWN if lastModified is None else lastModified)
+            self.addEtag(etag)
+        self.count += 1
+
+    def addEtag(self, etag):
+        if not etag:
+            self.etagDigests += bytes(16)
+            self.partCounts.append(NO_ETAG)
+            return
+        etag = etag.strip('"')
+        md5, _, parts = etag.partition("-")
+        try:
+            if len(md5) != 32 or (parts and not 0 < int(parts) < NO_ETAG):
+                raise ValueError(etag)
+            self.etagDigests += bytes.fromhex(md5)
+            self.partCounts.append(int(parts) if parts else 0)
+        except ValueError:
+            self.etagDigests += bytes(16)
+            self.partCounts.append(OTHER_ETAG)
+            self.otherEtags[self.count] = etag
+
+    def getEtag(self, index):
+        partCount = self.partCounts[index]
+        if partCount == NO_ETAG:
+            return None
+        if partCount == OTHER_ETAG:
+            return self.otherEtags[index]
+        md5 = self.etagDigests[index * 16:index * 16 + 16].hex()
+        if partCount:
+            return f"{md5}-{partCount}"
+        return md5
+
+    def getRecord(self, index, key):
+        if not self.withMetadata:
+            return ObjectRecord(key)
+        size = self.sizes[index]
+        lastModified = self.lastModified[index]
+        return ObjectRecord(
+            key,
+            None if size == UNKNOWN else size,
+            self.getEtag(index),
+            None if lastModified == UNKNOWN else lastModified,
+        )
+
+    def iterBlock(self, blockIndex):
+        """
+        :yield: the index and name of each object in a block
+        :rtype: tuple
+        """
+        position = self.blockOffsets[blockIndex]
+        index = blockIndex * self.blockSize
+        end = min(index + self.blockSize, self.count)
+        previous = b""
+        while index < end:
+            shared, position = readVarint(self.data, position)
+            length, position = readVarint(self.data, position)
+            encoded = previous[:shared] + self.data[position:position + length]
+            position += length
+            previous = bytes(encoded)
+            yield index, previous.decode("utf-8")
+            index += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """the name at a position in the set, in sorted order"""
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("key set index out of range")
+        for position, key in self.iterBlock(index // self.blockSize):
+            if position == index:
+                return key
+
+    def __iter__(self):
+        for blockIndex in range(len(self.blockKeys)):
+            for _, key in self.iterBlock(blockIndex):
+                yield key
+
+    def records(self):
+        """
+        :yield: the objects in name order
+        :rtype: ObjectRecord
+        """
+        for blockIndex in range(len(self.blockKeys)):
+            for index, key in self.iterBlock(blockIndex):
+                yield self.getRecord(index, key)
+
+    def find(self, key):
+        """
+        :return: the position of a name in the set, None if it isn't in it
+        :rtype: int
+        """
+        blockIndex = bisect.bisect_right(self.blockKeys, key) - 1
+        if blockIndex < 0:
+            return None
+        for index, blockKey in self.iterBlock(blockIndex):
+            if blockKey == key:
+                return index
+            if blockKey > key:
+                break
+        return None
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def get(self, key):
+        """
+        :return: the record of an object, None if it isn't in the set
+        :rtype: ObjectRecord
+        """
+        index = self.find(key)
+        if index is None:
+            return None
+        return self.getRecord(index, key)
+
+    def getMemoryUsage(self):
+        """
+        :return: approximate number of bytes used by the set
+        :rtype: int
+        """
+        blockKeyBytes = sum(len(key) + 49 for key in self.blockKeys)
+        return (
+            blockKeyBytes
+            + len(self.data)
+            + self.blockOffsets.itemsize * len(self.blockOffsets)
+            + self.sizes.itemsize * len(self.sizes)
+            + self.lastModified.itemsize * len(self.lastModified)
+            + len(self.etagDigests)
+            + self.partCounts.itemsize * len(self.partCounts)
+        )
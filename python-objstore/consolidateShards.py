@@ -0,0 +1,393 @@
+"""Splits the consolidation into shards that run as separate processes or
+pods.
+
+Every shard is given to consolidate_objstores.py as --shard i/N (i counts
+from 0) and moves only the keys that belong to it, with its own transfer
+journal and report in TMP_FOLDER.  The key space is split one of two ways:
+
+* range - each shard gets a contiguous range of keys and only lists that
+          part of the buckets.  By default the ranges are cut on the
+          diff's shard boundaries (objStoreDiff.DEFAULT_SHARD_BOUNDARIES),
+          a plan made from the source inventory cuts them so each shard
+          gets the same number of objects.
+* hash  - keys are assigned by a hash of their name, which balances any
+          bucket, but every shard lists the whole of both buckets.
+
+This module is also the coordinator:
+
+    python consolidateShards.py plan --shards 4
+    python consolidateShards.py run --shards 4 --plan shard_plan.json
+    python consolidateShards.py merge
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import compactKeys
+import objStoreDiff
+
+LOGGER = logging.getLogger(__name__)
+
+RANGE = "range"
+HASH = "hash"
+MODES = [RANGE, HASH]
+
+JOURNAL_PREFIX = "transfer_journal"
+REPORT_PREFIX = "consolidate_report"
+DEFAULT_PLAN_FILE = "shard_plan.json"
+
+CONSOLIDATE_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "consolidate_objstores.py"
+)
+
+
+def parseShard(shard):
+    """parses a shard description in the format i/N
+
+    :param shard: the description, for example 0/4
+    :type shard: str
+    :raises ValueError: if the description isn't valid
+    :return: the index and the number of shards
+    :rtype: tuple
+    """
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError:
+        msg = f"shard should be in the format i/N, got: {shard}"
+        raise ValueError(msg)
+    if count < 1 or not 0 <= index < count:
+        msg = f"shard index should be from 0 to {count - 1}, got: {shard}"
+        raise ValueError(msg)
+    return index, count
+
+
+def hashShard(key, count):
+    """the shard a key belongs to in hash mode.  Uses md5 rather than
+    hash() which is different in every python process.
+
+    :rtype: int
+    """
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def getRangeBoundaries(count, boundaries=None):
+    """cuts the key space into count ranges on a subset of the diff's shard
+    boundaries, each range gets the same number of diff shards
+
+    :param count: number of ranges
+    :type count: int
+    :param boundaries: the diff's shard boundaries, defaults to
+                       objStoreDiff.DEFAULT_SHARD_BOUNDARIES
+    :type boundaries: list, optional
+    :raises ValueError: if there are more ranges than diff shards
+    :return: the count - 1 keys the ranges are cut on
+    :rtype: list
+    """
+    if boundaries is None:
+        boundaries = objStoreDiff.DEFAULT_SHARD_BOUNDARIES
+    boundaries = sorted(boundaries)
+    numRanges = len(boundaries) + 1
+    if count > numRanges:
+        msg = f"can't split {numRanges} key ranges into {count} shards, " + \
+            "use a shard plan or hash mode"
+        raise ValueError(msg)
+    return [boundaries[round(i * numRanges / count) - 1]
+            for i in range(1, count)]
+
+
+def planBoundaries(keys, count):
+    """cuts the key space into count ranges that hold the same number of
+    keys
+
+    :param keys: sorted names of the objects
+    :type keys: list, compactKeys.CompactKeySet
+    :param count: number of ranges
+    :type count: int
+    :raises ValueError: if there are fewer objects than ranges
+    :return: the count - 1 keys the ranges are cut on
+    :rtype: list
+    """
+    if len(keys) < count:
+        msg = f"can't split {len(keys)} objects into {count} shards"
+        raise ValueError(msg)
+    return [keys[i * len(keys) // count - 1] for i in range(1, count)]
+
+
+def writePlan(planFile, count, boundaries):
+    with open(planFile, "w") as fh:
+        json.dump({"mode": RANGE, "count": count, "boundaries": boundaries,
+                   "created": time.time()}, fh, indent=2)
+
+
+def readPlan(planFile, count):
+    """
+    :raises ValueError: if the plan was made for a different number of
+                        shards
+    :return: the boundaries in the plan
+    :rtype: list
+    """
+    with open(planFile) as fh:
+        plan = json.load(fh)
+    if plan["count"] != count or len(plan["boundaries"]) != count - 1:
+        msg = f"the shard plan {planFile} is for {plan['count']} shards, " + \
+            f"not {count}"
+        raise ValueError(msg)
+    return plan["boundaries"]
+
+
+class ShardSpec:
+    def __init__(self, index=0, count=1, mode=RANGE, boundaries=None):
+        """[summary]
+
+        :param index: the shard, from 0 to count - 1
+        :type index: int, optional
+        :param count: number of shards, the default of 1 is the whole bucket
+        :type count: int, optional
+        :param mode: RANGE or HASH
+        :type mode: str, optional
+        :param boundaries: keys the range shards are cut on, defaults to
+                           getRangeBoundaries(count)
+        :type boundaries: list, optional
+        """
+        if mode not in MODES:
+            msg = f"unknown shard mode: {mode}, expecting one of {MODES}"
+            raise ValueError(msg)
+        self.index = index
+        self.count = count
+        self.mode = mode
+        self.boundaries = boundaries
+        if self.boundaries is None and mode == RANGE:
+            self.boundaries = getRangeBoundaries(count)
+
+    @classmethod
+    def fromArgs(cls, shard=None, mode=RANGE, planFile=None):
+        """
+        :param shard: i/N, None for the whole bucket
+        :type shard: str, optional
+        :param mode: RANGE or HASH
+        :type mode: str, optional
+        :param planFile: shard plan made by the plan command, for range mode
+        :type planFile: str, optional
+        :rtype: ShardSpec
+        """
+        if shard is None:
+            return cls()
+        index, count = parseShard(shard)
+        boundaries = None
+        if planFile is not None and mode == RANGE:
+            boundaries = readPlan(planFile, count)
+        return cls(index, count, mode, boundaries)
+
+    def isSharded(self):
+        return self.count > 1
+
+    def getFileName(self, prefix, extension):
+        """names the per shard files, the whole bucket keeps the unsharded
+        names so existing journals are picked up
+
+        :rtype: str
+        """
+        if not self.isSharded():
+            return f"{prefix}.{extension}"
+        return f"{prefix}.shard-{self.index}-of-{self.count}.{extension}"
+
+    def getKeyRange(self):
+        """
+        :return: the (startAfter, endKey) range of a range shard, None when
+                 the shard has to look at the whole bucket
+        :rtype: tuple
+        """
+        if not self.isSharded() or self.mode != RANGE:
+            return None
+        return objStoreDiff.getKeyRanges(self.boundaries)[self.index]
+
+    def contains(self, key):
+        if not self.isSharded():
+            return True
+        if self.mode == HASH:
+            return hashShard(key, self.count) == self.index
+        startAfter, endKey = self.getKeyRange()
+        return (startAfter is None or key > startAfter) and \
+            (endKey is None or key <= endKey)
+
+    def toDict(self):
+        return {"index": self.index, "count": self.count, "mode": self.mode,
+                "keyRange": self.getKeyRange()}
+
+    def __str__(self):
+        return f"{self.index}/{self.count} ({self.mode})"
+
+
+def readReports(reportDir):
+    reports = []
+    for reportFile in sorted(glob.glob(
+            os.path.join(reportDir, f"{REPORT_PREFIX}.shard-*.json"))):
+        with open(reportFile) as fh:
+            reports.append(json.load(fh))
+    return reports
+
+
+def mergeReports(reports):
+    """combines the reports written by the shards of a run
+
+    :param reports: the reports, as written by
+                    ConsolidateStorage.writeReport
+    :type reports: list
+    :raises ValueError: if the reports are from runs with different numbers
+                        of shards
+    :return: the totals, the shards that have no report (missing) and the
+             names of all the files that failed
+    :rtype: dict
+    """
+    counts = {report["shard"]["count"] for report in reports}
+    if len(counts) > 1:
+        msg = "the reports are from runs with different numbers of " + \
+            f"shards: {sorted(counts)}"
+        raise ValueError(msg)
+    count = counts.pop() if counts else 0
+    merged = {
+        "count": count,
+        "shards": sorted(report["shard"]["index"] for report in reports),
+        "started": min((report["started"] for report in reports),
+                       default=None),
+        "finished": max((report["finished"] for report in reports),
+                        default=None),
+        "states": {},
+        "diff": {},
+        "verification": {},
+        "failed": [],
+    }
+    merged["missing"] = sorted(set(range(count)) - set(merged["shards"]))
+    for report in reports:
+        for section in ("states", "diff", "verification"):
+            for name, value in report[section].items():
+                merged[section][name] = merged[section].get(name, 0) + value
+        merged["failed"].extend(report["failed"])
+    return merged
+
+
+def getInventories():
+    """the source and destination bucket inventories, imported here so the
+    merge command doesn't need the object store env vars
+    """
+    import constants
+    import objStoreInventory
+    import objStoreUtil
+
+    srcInventory = objStoreInventory.BucketInventory(
+        objStoreUtil.ObjectStoreUtil(
+            objStoreHost=constants.OBJ_STORE_HOST,
+            objStoreUser=constants.OBJ_STORE_TST_USER,
+            objStoreSecret=constants.OBJ_STORE_TST_SECRET,
+            objStoreBucket=constants.OBJ_STORE_TST_BUCKET,
+            tmpfolder=constants.TMP_FOLDER
+        )
+    )
+    destInventory = objStoreInventory.BucketInventory(
+        objStoreUtil.ObjectStoreUtil(tmpfolder=constants.TMP_FOLDER)
+    )
+    return srcInventory, destInventory
+
+
+def runShards(count, mode, planFile=None, reportDir=None, extraArgs=None):
+    """runs every shard as a separate process on this machine and waits for
+    them to finish.  The inventories are refreshed first so the processes,
+    which share TMP_FOLDER, don't all list the buckets.
+
+    :return: the exit codes of the shards
+    :rtype: list
+    """
+    for inventory in getInventories():
+        inventory.refresh()
+    processes = []
+    for index in range(count):
+        cmd = [sys.executable, CONSOLIDATE_SCRIPT, "--shard",
+               f"{index}/{count}", "--shard-mode", mode]
+        if planFile:
+            cmd += ["--shard-plan", planFile]
+        if reportDir:
+            cmd += ["--report-dir", reportDir]
+        cmd += extraArgs or []
+        LOGGER.info(f"starting shard {index}/{count}")
+        processes.append(subprocess.Popen(cmd))
+    return [process.wait() for process in processes]
+
+
+def logMerged(merged):
+    LOGGER.info(
+        f"shards reported: {len(merged['shards'])}/{merged['count']}, "
+        + f"states: {merged['states']}, diff: {merged['diff']}, "
+        + f"verification: {merged['verification']}, "
+        + f"failed: {len(merged['failed'])}"
+    )
+    if merged["missing"]:
+        LOGGER.error(f"no report from shards: {merged['missing']}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='plans, runs and merges the reports of a sharded '
+                    'consolidation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    planParser = subparsers.add_parser(
+        'plan', help='cut the source bucket into ranges of the same size')
+    planParser.add_argument('--shards', type=int, required=True)
+    planParser.add_argument('--output', default=DEFAULT_PLAN_FILE)
+
+    runParser = subparsers.add_parser(
+        'run', help='run the shards as processes on this machine')
+    runParser.add_argument('--shards', type=int, required=True)
+    runParser.add_argument('--mode', choices=MODES, default=RANGE)
+    runParser.add_argument('--plan', default=None,
+                           help='shard plan made by the plan command')
+    runParser.add_argument('--report-dir', default=None)
+    runParser.add_argument('extra', nargs=argparse.REMAINDER,
+                           help='arguments passed on to the shards')
+
+    mergeParser = subparsers.add_parser(
+        'merge', help='combine the reports of the shards')
+    mergeParser.add_argument('--report-dir', default=None,
+                             help='defaults to TMP_FOLDER')
+    mergeParser.add_argument('--output', default=None,
+                             help='json file for the merged report')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        srcInventory, _ = getInventories()
+        keys = compactKeys.CompactKeySet.fromRecords(
+            srcInventory.listObjectRange())
+        boundaries = planBoundaries(keys, args.shards)
+        writePlan(args.output, args.shards, boundaries)
+        LOGGER.info(f"{len(keys)} objects cut on {boundaries}")
+    elif args.command == 'run':
+        extra = [arg for arg in args.extra if arg != '--']
+        exitCodes = runShards(args.shards, args.mode, args.plan,
+                              args.report_dir, extra)
+        reportDir = args.report_dir or os.environ['TMP_FOLDER']
+        logMerged(mergeReports(readReports(reportDir)))
+        for shard, exitCode in enumerate(exitCodes):
+            # negative for a shard killed by a signal, -9 for an oom kill
+            if exitCode:
+                LOGGER.error(f"shard {shard} exited with {exitCode}")
+        sys.exit(1 if any(exitCodes) else 0)
+    else:
+        reportDir = args.report_dir or os.environ['TMP_FOLDER']
+        merged = mergeReports(readReports(reportDir))
+        logMerged(merged)
+        if args.output:
+            with open(args.output, 'w') as fh:
+                json.dump(merged, fh, indent=2)
+        if merged['missing'] or merged['failed']:
+            sys.exit(1)
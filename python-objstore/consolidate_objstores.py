@@ -6,29 +6,90 @@ This script will:
         namespace.
 """
 
+import argparse
+import asyncio
+import collections
 import csv
-import json
 import logging
 import os
 import sys
 import re
 import concurrent.futures
+import heapq
 import itertools
+import json
+import random
+import time
 
+import adaptiveConcurrency
+import compactKeys
+import consolidateShards
 import constants
+import lazyModules
+import objStoreAsync
+import objStoreCache
+import objStoreClients
+import objStoreDiff
+import objStoreInventory
+import objStoreMetrics
 import objStoreUtil
+import objStoreVerify
+import streamBuffers
+import syncDaemon
+import transferJournal
+import transferScheduler
 
 LOGGER = logging.getLogger()
 
+botocore = lazyModules.LazyModule("botocore")
+
+# number of times a file is retried before it's marked as failed, and the
+# base number of seconds to wait between retries, doubles with each retry
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2
+
 
 class ConsolidateStorage:
 
-    def __init__(self, csvFile=None):
+    def __init__(self, csvFile=None, shard=None, scheduler=None):
+        """[summary]
+
+        :param csvFile: the index file
+        :type csvFile: str, optional
+        :param shard: the part of the buckets this process moves, defaults
+                      to all of it
+        :type shard: consolidateShards.ShardSpec, optional
+        :param scheduler: decides the order the files are moved in, defaults
+                          to the TRANSFER_SCHEDULE policies
+        :type scheduler: transferScheduler.TransferScheduler, optional
+        """
+        self.shard = shard
+        if self.shard is None:
+            self.shard = consolidateShards.ShardSpec()
+        self.scheduler = scheduler
+        if self.scheduler is None:
+            self.scheduler = transferScheduler.TransferScheduler(
+                transferScheduler.getPolicies(
+                    constants.TRANSFER_SCHEDULE,
+                    transferScheduler.parseDateRanges(
+                        constants.TRANSFER_PRIORITY_DATES)
+                ),
+                getSize=self.getSourceSize,
+                queueSize=constants.TRANSFER_QUEUE_SIZE,
+            )
         self.csvFile = constants.INDEX_FILE
         if csvFile is None or not os.path.exists(csvFile):
             self.csvFile = os.path.join(constants.TMP_FOLDER, constants.INDEX_FILE)
         LOGGER.debug(f"csv file being used: {self.csvFile}")
 
+        # every thread that moves files or parts of files, or lists the
+        # buckets needs its own connection, size the shared connection pools
+        # to match
+        objStoreClients.setPoolSize(
+            constants.MAX_CONCURRENCY + constants.MAX_PART_REQUESTS
+            + objStoreDiff.DEFAULT_LIST_WORKERS
+        )
+
         self.srcObjStoreUtil = objStoreUtil.ObjectStoreUtil(
             objStoreHost=constants.OBJ_STORE_HOST,
             objStoreUser=constants.OBJ_STORE_TST_USER,
@@ -42,21 +103,68 @@ class ConsolidateStorage:
             objStoreUser=constants.OBJ_STORE_USER,
             objStoreSecret=constants.OBJ_STORE_SECRET,
             objStoreBucket=constants.OBJ_STORE_BUCKET,
-            tmpfolder=constants.TMP_FOLDER
+            tmpfolder=constants.TMP_FOLDER,
+            publicOnUpload=True
+        )
+
+        # server side copies are attempted first, if the object store refuses
+        # them this gets flipped and the files are moved through the tmp
+        # folder instead
+        self.serverSideCopy = True
+
+        # local inventories of the buckets, only the parts of the buckets
+        # that have not been listed within constants.INVENTORY_TTL get
+        # listed again, speeds up restarts
+        self.srcInventory = objStoreInventory.BucketInventory(
+            self.srcObjStoreUtil
+        )
+        self.destInventory = objStoreInventory.BucketInventory(
+            self.destObjStoreUtil
+        )
+        LOGGER.debug(f"inventory dir: {constants.TMP_FOLDER}")
+
+        # memory used to stream files between the buckets when the object
+        # store won't do a server side copy
+        self.bufferPool = streamBuffers.BufferPool(
+            bufferSize=constants.STREAM_PART_SIZE,
+            memoryBudget=constants.STREAM_MEMORY_BUDGET
         )
 
-        # cache for file lists - used to speed up debugging
-        self.srcCacheFile = os.path.join(constants.TMP_FOLDER, 'srcfiles.json')
-        self.destCacheFile = os.path.join(constants.TMP_FOLDER, 'destfiles.json')
-        LOGGER.debug(f"cache dir: {constants.TMP_FOLDER}")
+        # per file record of how far the move got, lets a restarted run pick
+        # up where the last one stopped
+        self.journal = transferJournal.TransferJournal(
+            os.path.join(constants.TMP_FOLDER, self.shard.getFileName(
+                consolidateShards.JOURNAL_PREFIX, 'jsonl'))
+        )
+        # what the diff of this shard found
+        self.diffCounts = collections.Counter()
+
+        # checks the moved files against the source files
+        self.verifier = objStoreVerify.ObjectVerifier(
+            self.srcObjStoreUtil, self.destObjStoreUtil,
+            policy=constants.VERIFY_POLICY,
+            sampleRate=constants.VERIFY_SAMPLE_RATE
+        )
 
         self.getCsvFile()
 
     def getCsvFile(self):
-        if not os.path.exists(self.csvFile):
-            bareCsvFileName = os.path.basename(self.csvFile)
-            LOGGER.info(f"retrieving the csv file: {bareCsvFileName}")
-            self.destObjStoreUtil.getObject(bareCsvFileName, self.csvFile)
+        """gets the index file through the object cache, which only
+        downloads it if it changed since the cached copy.  An existing
+        local copy is used if the index can't be fetched.
+        """
+        bareCsvFileName = os.path.basename(self.csvFile)
+        LOGGER.info(f"retrieving the csv file: {bareCsvFileName}")
+        try:
+            objStoreCache.ObjectCache().getObject(
+                self.destObjStoreUtil, bareCsvFileName, self.csvFile
+            )
+        except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as err:
+            if not os.path.exists(self.csvFile):
+                raise
+            LOGGER.warning("unable to get the csv file, the diff uses the "
+                           + f"local copy which may be out of date: {err}")
 
     def consolidate(self):
         # bucketRegexStr = f'^.*{constants.OBJ_STORE_BUCKET}$'
@@ -85,148 +193,627 @@ class ConsolidateStorage:
 
     def getFileLists(self, cache=False):
         """mostly used for debugging, gets a list of source and
-        destination files and then caches the results to files in the
-        data folder.  Caching only takes place is the cache variable is
-        set to true
-        """
-
-        if cache and os.path.exists(self.srcCacheFile):
-            with open(self.srcCacheFile, 'r') as fh:
-                srcFiles = json.load(fh)
-        else:
-            LOGGER.info("getting the source file list")
-            srcFiles = self.srcObjStoreUtil.listObjects(returnFileNamesOnly=True)
-            if cache:
-                with open(self.srcCacheFile, 'w') as fh:
-                    json.dump(srcFiles, fh)
-        if cache and os.path.exists(self.destCacheFile):
-            with open(self.destCacheFile, 'r') as fh:
-                destFiles = json.load(fh)
-        else:
-            LOGGER.info("getting the destination file list")
-            destFiles = self.destObjStoreUtil.listObjects(returnFileNamesOnly=True)
-            if cache:
-                with open(self.destCacheFile, 'w') as fh:
-                    json.dump(destFiles, fh)
+        destination files from the bucket inventories.  If cache is false
+        the inventories are refreshed from the buckets first, otherwise only
+        the stale parts of them are.
+
+        :return: the source and destination objects, sorted by name
+        :rtype: tuple of compactKeys.CompactKeySet
+        """
+        LOGGER.info("getting the source file list")
+        if not cache:
+            self.srcInventory.refresh(force=True)
+        srcFiles = compactKeys.CompactKeySet.fromRecords(
+            self.srcInventory.listObjectRange())
+        LOGGER.info("getting the destination file list")
+        if not cache:
+            self.destInventory.refresh(force=True)
+        destFiles = compactKeys.CompactKeySet.fromRecords(
+            self.destInventory.listObjectRange())
         return srcFiles, destFiles
 
+    def getFilesToMove(self, keyRange=None):
+        """diffs the source and destination buckets and yields the names of
+        the files that need to be moved.  Files are yielded as soon as the
+        shard they belong to has been diffed, so the transfers can start
+        before the whole bucket has been listed.
+
+        :param keyRange: only diff this (startAfter, endKey) range, defaults
+                         to the key range of this process's shard
+        :type keyRange: tuple, optional
+        :yield: names of the files that are missing from the destination or
+                are different from the source
+        :rtype: str
+        """
+        diff = objStoreDiff.BucketDiff(
+            self.srcInventory, self.destInventory,
+            keyRange=keyRange or self.shard.getKeyRange()
+        )
+        for entry in diff.iterDiff():
+            if not self.shard.contains(entry.key):
+                continue
+            self.diffCounts[entry.status] += 1
+            if entry.status == objStoreDiff.MISSING:
+                LOGGER.debug(f"only in destination: {entry.key}")
+                continue
+            if entry.status == objStoreDiff.MISMATCH:
+                LOGGER.info(f"size / etag mismatch, recopying: {entry.key}")
+                # the source was overwritten after it was moved, stops the
+                # journal from skipping it as already moved
+                self.journal.record(entry.key, transferJournal.MISMATCH)
+            yield entry.key
+        LOGGER.info(
+            f"new files: {self.diffCounts[objStoreDiff.NEW]}, "
+            + f"mismatched: {self.diffCounts[objStoreDiff.MISMATCH]}, "
+            + "only in destination: "
+            + f"{self.diffCounts[objStoreDiff.MISSING]}"
+        )
+
+    def getSourceSize(self, srcFile):
+        srcRecord = self.srcInventory.getObject(srcFile)
+        if srcRecord is None:
+            return None
+        return srcRecord.size
+
+    def getPendingFiles(self, files=None):
+        """the files that still need to be moved, in the order the
+        scheduler puts them in
+
+        :param files: names of the files to move, defaults to the files
+                      that the diff of the buckets finds
+        :type files: list, optional
+        :return: iterator of the file names
+        :rtype: iterator
+        """
+        files2MoveIter = self.getFilesToMove()
+        if files is not None:
+            files2MoveIter = iter(files)
+        pending = (
+            file2Move for file2Move in files2MoveIter
+            if not self.journal.isComplete(file2Move)
+        )
+        return self.scheduler.schedule(pending)
+
     def moveFiles(self):
         """pulls the file down that is described by the bucket / filename
         combination, and copies it to the destination.
+        """
+        for srcFile in self.getFilesToMove():
+            self.moveFile(srcFile)
+        self.journal.sync()
 
-        :param bucketname: [description]
-        :type bucketname: [type]
-        :param filename: [description]
-        :type filename: [type]
+    def moveFile(self, srcFile):
+        """copies the file from the source bucket to the destination bucket
+        and makes it public.  Uses a server side copy when possible, and
+        falls back to downloading and uploading the file if the object store
+        refuses the copy.
+
+        :param srcFile: name of the object to move
+        :type srcFile: str
+        :return: number of bytes that were moved
+        :rtype: int
+        """
+        state = self.journal.getState(srcFile)
+        if state in transferJournal.COMPLETE_STATES:
+            LOGGER.debug(f"already moved: {srcFile}")
+            return 0
+
+        aclSet = False
+        partDigests = None
+        if self.serverSideCopy and state != transferJournal.COPIED:
+            try:
+                LOGGER.debug(f"copying the file: {srcFile}")
+                self.destObjStoreUtil.copyObject(
+                    srcFile, constants.OBJ_STORE_TST_BUCKET,
+                    objectSize=self.getSourceSize(srcFile), public=True
+                )
+                LOGGER.info(f"copied with public permissions {srcFile}")
+                aclSet = True
+            except objStoreUtil.CopyRefusedError as err:
+                LOGGER.warning(
+                    f"{err}, falling back to streaming the files"
+                )
+                self.serverSideCopy = False
+        if not aclSet and state != transferJournal.COPIED:
+            partDigests = self.moveFileStreamed(srcFile)
+            self.journal.record(srcFile, transferJournal.COPIED)
+            # the upload includes the public-read acl when publicOnUpload
+            # is set on the destination
+            aclSet = self.destObjStoreUtil.publicOnUpload
+        if not aclSet:
+            self.destObjStoreUtil.setPublicPermissions(srcFile)
+            LOGGER.info(f"set permissions on {srcFile}")
+        self.journal.record(srcFile, transferJournal.ACL_SET)
+
+        # keep the destination inventory current so the file isn't picked
+        # up again by the next run
+        srcRecord = self.srcInventory.getObject(srcFile)
+        if srcRecord is None:
+            return 0
+        self.destInventory.recordObject(
+            srcFile, srcRecord.size, srcRecord.etag, public=True
+        )
+        self.verifyFile(srcFile, partDigests)
+        return srcRecord.size
+
+    def verifyFile(self, srcFile, partDigests=None):
+        """checks the file in the destination against the source file and
+        records the result in the journal.  A file that doesn't match is
+        recorded as a mismatch so that it gets moved again.
+
+        :param srcFile: name of the object to check
+        :type srcFile: str
+        :param partDigests: md5 digests of the parts the file was streamed
+                            in, saves downloading it to check it
+        :type partDigests: list, optional
+        :raises objStoreVerify.VerificationError: if the files don't match
         """
-        srcFiles, destFiles = self.getFileLists()
+        if not self.verifier.isEnabled():
+            return
+        self.recordVerifyResult(
+            srcFile, self.verifier.verify(srcFile, partDigests))
+
+    def recordVerifyResult(self, srcFile, result):
+        """records the result of a verification in the journal, with the
+        etags of the source and destination files that matched.  A file
+        whose size was the only thing checked is recorded as unverified.
+
+        :raises objStoreVerify.VerificationError: if the files don't match
+        """
+        if result.status == objStoreVerify.MATCH:
+            self.journal.record(srcFile, transferJournal.VERIFIED,
+                                method=result.method, etag=result.etag,
+                                destEtag=result.destEtag)
+            return
+        if result.status == objStoreVerify.SIZE_ONLY:
+            self.journal.record(srcFile, transferJournal.UNVERIFIED,
+                                method=result.method)
+            return
+        self.journal.record(srcFile, transferJournal.MISMATCH,
+                            method=result.method, detail=result.detail)
+        raise objStoreVerify.VerificationError(
+            f"{srcFile} doesn't match the source: {result.detail}"
+        )
+
+    def verifyFiles(self, maxWorkers=None):
+        """checks the files that earlier runs moved but didn't verify, or
+        only checked the size of
+
+        :param maxWorkers: number of files checked at the same time, defaults
+                           to constants.MAX_CONCURRENCY
+        :type maxWorkers: int, optional
+        :return: names of the files that don't match the source
+        :rtype: list
+        """
+        if maxWorkers is None:
+            maxWorkers = constants.MAX_CONCURRENCY
+        srcFiles = self.journal.getKeys(transferJournal.ACL_SET) + \
+            self.journal.getKeys(transferJournal.UNVERIFIED)
+        LOGGER.info(f"verifying {len(srcFiles)} files")
+        mismatched = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=maxWorkers) as executor:
+            futures = {
+                executor.submit(self.verifyFile, srcFile): srcFile
+                for srcFile in srcFiles
+            }
+            for fut in concurrent.futures.as_completed(futures):
+                try:
+                    fut.result()
+                except objStoreVerify.VerificationError as err:
+                    LOGGER.warning(f"{err}")
+                    mismatched.append(futures[fut])
+                except Exception as err:
+                    LOGGER.error(f"error verifying {futures[fut]}: {err}")
+        self.journal.sync()
+        LOGGER.info(f"verification: {self.verifier.getStatusMessage()}")
+        return mismatched
+
+    def timedMoveFile(self, srcFile, controller):
+        """moves a file and reports how long it took, how many bytes were
+        moved, and whether the object store throttled us to the concurrency
+        controller
+
+        :param srcFile: name of the object to move
+        :type srcFile: str
+        :param controller: the controller that sets the concurrency
+        :type controller: adaptiveConcurrency.AdaptiveConcurrency
+        """
+        start = time.time()
         try:
-            #srcFiles = self.srcObjStoreUtil.listObjects(returnFileNamesOnly=True)
-            #destFiles = self.destObjStoreUtil.listObjects(returnFileNamesOnly=True)
-            for srcFile in srcFiles:
-                if srcFile not in destFiles:
-                    self.moveFile(srcFile)
-        except:
-            LOGGER.warning("error detected, caching file copy status")
-            self.cacheSrcDest(srcFiles, destFiles)
+            numBytes = self.moveFile(srcFile)
+        except Exception as err:
+            if objStoreUtil.isThrottleError(err):
+                controller.recordThrottle()
+            else:
+                controller.recordError()
             raise
-
-    def moveFile(self, srcFile):
-        tmpPath = os.path.join(constants.TMP_FOLDER, srcFile)
-        if os.path.exists(tmpPath):
-            os.remove(tmpPath)
-        LOGGER.debug(f"getting the file: {srcFile}")
-        self.srcObjStoreUtil.getObject(srcFile, tmpPath)
-        LOGGER.debug(f"putting the file: {srcFile}")
-        self.destObjStoreUtil.putObject(srcFile, tmpPath)
-        #srcFiles.remove(srcFile)
-        #destFiles.append(srcFile)
-        self.destObjStoreUtil.setPublicPermissions(srcFile)
-        LOGGER.info(f"moved and set permissions on {srcFile}")
-        # remove the temp file
-        if os.path.exists(tmpPath):
-            os.remove(tmpPath)
+        controller.recordSuccess(time.time() - start, numBytes)
+
+    def moveFileStreamed(self, srcFile):
+        """streams the file from the source bucket to the destination
+        through the in memory buffer pool, nothing is written to disk.  A
+        file that was uploaded in parts is streamed with the same part size
+        when it fits in a buffer, so the copy gets the same etag.
+
+        :param srcFile: name of the object to move
+        :type srcFile: str
+        :return: the md5 digests of the parts the file was uploaded in
+        :rtype: list
+        """
+        LOGGER.debug(f"streaming the file: {srcFile}")
+        # with the size, large files go straight to the parallel parts
+        srcRecord = self.srcInventory.getObject(srcFile)
+        objectSize = partSize = None
+        if srcRecord is not None:
+            objectSize = srcRecord.size
+            partCount = objStoreVerify.getPartCount(srcRecord.etag)
+            if partCount:
+                partSizes = self.verifier.getPartSizes(srcFile, objectSize,
+                                                       partCount)
+                if len(partSizes) == 1:
+                    partSize = partSizes[0]
+        partDigests = []
+        self.destObjStoreUtil.streamObject(
+            self.srcObjStoreUtil, srcFile, bufferPool=self.bufferPool,
+            objectSize=objectSize, partSize=partSize, partDigests=partDigests
+        )
+        LOGGER.info(f"moved {srcFile}")
+        return partDigests
 
     def makePublic(self, srcFile):
         self.destObjStoreUtil.setPublicPermissions(srcFile)
 
-    def moveFilesAsync(self):
-        """
+    def moveFilesAsync(self, maxConcurrency=None, files=None):
+        """moves the files on a pool of threads.  Files that fail are retried
+        with an exponential backoff, and after MAX_RETRIES attempts they are
+        recorded as failed in the journal and the run carries on.
+
+        The number of files in flight is set by an AIMD controller that
+        grows it while latency holds steady and halves it when the object
+        store throttles us.  New files are started in the order set by the
+        scheduler (transferScheduler).
 
         https://alexwlchan.net/2019/10/adventures-with-concurrent-futures/
-        """
-        srcFiles, destFiles = self.getFileLists()
-        LOGGER.info(f"file to move: {len(srcFiles)}")
-        LOGGER.info(f"files in destination: {len(destFiles)}")
 
+        :param maxConcurrency: upper limit on the number of files in flight,
+                               defaults to constants.MAX_CONCURRENCY
+        :type maxConcurrency: int, optional
+        :param files: names of the files to move, defaults to the files
+                      that the diff of the buckets finds
+        :type files: list, optional
+        :return: names of the files that could not be moved
+        :rtype: list
+        """
+        if maxConcurrency is None:
+            maxConcurrency = constants.MAX_CONCURRENCY
+        controller = adaptiveConcurrency.AdaptiveConcurrency(
+            maximum=maxConcurrency
+        )
         self.srcObjStoreUtil.createBotoClient()
         self.destObjStoreUtil.createBotoClient()
-
-        CONCURRENT_TASKS_BUNDLE = 10
-        #MAX_WORKERS = 10
-
-        files2Move = []
-        for srcFile in srcFiles:
-            if srcFile not in destFiles:
-                files2Move.append(srcFile)
-        LOGGER.info(f"files to be moved: {len(files2Move)}")
-
-        files2MoveIter = iter(files2Move)
+        self.srcObjStoreUtil.addThrottleListener(controller.recordThrottle)
+        self.destObjStoreUtil.addThrottleListener(controller.recordThrottle)
+        try:
+            return self.runMoveLoop(controller, maxConcurrency, files)
+        finally:
+            # the sync daemon calls this again with a new controller for
+            # every cycle
+            self.srcObjStoreUtil.removeThrottleListener(
+                controller.recordThrottle)
+            self.destObjStoreUtil.removeThrottleListener(
+                controller.recordThrottle)
+
+    def runMoveLoop(self, controller, maxConcurrency, files):
+        """the loop of moveFilesAsync, moves the files with the concurrency
+        set by controller
+
+        :return: names of the files that could not be moved
+        :rtype: list
+        """
+        files2MoveIter = self.getPendingFiles(files)
 
         completed = 0
 
         # creating a pointer to the method that will be called by the various
         # threads
-        method = self.moveFile
+        method = self.timedMoveFile
         #method = self.makePublic
 
         # self.destObjStoreUtil.setPublicPermissions(srcFile)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENT_TASKS_BUNDLE) as executor:
+        # files that failed, waiting to be retried, heap of
+        # (time to retry, file name)
+        retryQueue = []
+        attempts = {}
+        failed = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
             futures = {}
-            cnt = 0
-            for file2Move in itertools.islice(files2MoveIter, CONCURRENT_TASKS_BUNDLE):
-                fut = executor.submit(method, file2Move)
+
+            def submit(file2Move):
+                self.journal.record(file2Move, transferJournal.QUEUED)
+                fut = executor.submit(method, file2Move, controller)
                 futures[fut] = file2Move
-                cnt += 1
-            LOGGER.info(f'stack size: {cnt}')
 
-            while futures:
+            for file2Move in self.skipCompleted(files2MoveIter, controller.getWindow()):
+                submit(file2Move)
+            LOGGER.info(f'stack size: {len(futures)}')
+
+            while futures or retryQueue:
+                timeout = None
+                if retryQueue:
+                    timeout = max(0, retryQueue[0][0] - time.time())
                 done, _ = concurrent.futures.wait(
-                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    futures, timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED
                 )
                 completed += len(done)
-                if not completed % 100:
+                if done and not completed % 100:
                     LOGGER.info(
-                        f"total completed: {completed} of {len(files2Move)} (pkgs in loop: {len(done)})"
+                        f"total completed: {completed} (pkgs in loop: {len(done)}), "
+                        + controller.getStatusMessage()
                     )
                 for fut in done:
-                    futures.pop(fut)
-                    # you can retrieve the original task using: futures.pop(fut)
-                    # can add error catching and re-add to executor here
-                    data = fut.result()
-                for file2Move in itertools.islice(files2MoveIter, len(done)):
-                    # LOGGER.debug(f"adding: {pkgName} to the queue")
-                    # adding the package name to the url, as a param
-                    fut = executor.submit(method, file2Move)
-                    futures[fut] = file2Move
+                    file2Move = futures.pop(fut)
+                    try:
+                        fut.result()
+                    except Exception as err:
+                        attempts[file2Move] = attempts.get(file2Move, 0) + 1
+                        if attempts[file2Move] > MAX_RETRIES:
+                            LOGGER.error(f"giving up on {file2Move}: {err}")
+                            self.journal.record(
+                                file2Move, transferJournal.FAILED,
+                                error=repr(err)
+                            )
+                            failed.append(file2Move)
+                            continue
+                        delay = RETRY_BACKOFF * 2 ** (attempts[file2Move] - 1)
+                        delay += random.uniform(0, RETRY_BACKOFF)
+                        LOGGER.warning(
+                            f"error moving {file2Move}, attempt "
+                            + f"{attempts[file2Move]}, retrying in "
+                            + f"{delay:.1f}s: {err}"
+                        )
+                        heapq.heappush(retryQueue, (time.time() + delay, file2Move))
+
+                # retries that are due go first, then new files
+                while (
+                    retryQueue
+                    and retryQueue[0][0] <= time.time()
+                    and len(futures) < controller.getWindow()
+                ):
+                    submit(heapq.heappop(retryQueue)[1])
+                freeSlots = max(0, controller.getWindow() - len(futures))
+                for file2Move in self.skipCompleted(files2MoveIter, freeSlots):
+                    submit(file2Move)
+
+        self.journal.sync()
+        LOGGER.info(f"total completed: {completed}, {controller.getStatusMessage()}")
+        LOGGER.info(f"connection stats: {objStoreClients.getStats()}")
+        if self.verifier.isEnabled():
+            LOGGER.info(f"verification: {self.verifier.getStatusMessage()}")
+        if failed:
+            LOGGER.error(
+                f"{len(failed)} files could not be moved, they are recorded "
+                + f"as failed in {self.journal.journalFile}"
+            )
+        return failed
+
+    def moveFilesAio(self, maxConcurrency=None, files=None):
+        """moves the files with the asyncio engine (objStoreAsync), the copy,
+        acl and verification requests for every file in flight share one
+        event loop instead of a thread each.  Streamed moves (when the
+        object store refuses server side copies) and checksum verification
+        still run on threads.
+
+        :param maxConcurrency: number of files in flight, defaults to
+                               constants.ASYNC_MAX_CONCURRENCY
+        :type maxConcurrency: int, optional
+        :param files: names of the files to move, defaults to the files
+                      that the diff of the buckets finds
+        :type files: list, optional
+        :return: names of the files that could not be moved
+        :rtype: list
+        """
+        if maxConcurrency is None:
+            maxConcurrency = constants.ASYNC_MAX_CONCURRENCY
+        return asyncio.run(self.moveFilesCoro(maxConcurrency, files))
+
+    async def moveFilesCoro(self, maxConcurrency, files=None):
+        srcStore = objStoreAsync.AsyncObjectStore(
+            objStoreHost=constants.OBJ_STORE_HOST,
+            objStoreUser=constants.OBJ_STORE_TST_USER,
+            objStoreSecret=constants.OBJ_STORE_TST_SECRET,
+            objStoreBucket=constants.OBJ_STORE_TST_BUCKET,
+            maxConcurrency=maxConcurrency
+        )
+        destStore = objStoreAsync.AsyncObjectStore(
+            objStoreHost=constants.OBJ_STORE_HOST,
+            objStoreUser=constants.OBJ_STORE_USER,
+            objStoreSecret=constants.OBJ_STORE_SECRET,
+            objStoreBucket=constants.OBJ_STORE_BUCKET,
+            publicOnUpload=True,
+            maxConcurrency=maxConcurrency
+        )
+        pending = self.getPendingFiles(files)
+        failed = []
+        completed = 0
+        start = time.time()
+
+        async def move(file2Move):
+            nonlocal completed
+            self.journal.record(file2Move, transferJournal.QUEUED)
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    await self.moveFileCoro(srcStore, destStore, file2Move)
+                    break
+                except Exception as err:
+                    if attempt > MAX_RETRIES:
+                        LOGGER.error(f"giving up on {file2Move}: {err}")
+                        self.journal.record(
+                            file2Move, transferJournal.FAILED,
+                            error=repr(err)
+                        )
+                        failed.append(file2Move)
+                        break
+                    delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+                    delay += random.uniform(0, RETRY_BACKOFF)
+                    LOGGER.warning(
+                        f"error moving {file2Move}, attempt {attempt}, "
+                        + f"retrying in {delay:.1f}s: {err}"
+                    )
+                    await asyncio.sleep(delay)
+            completed += 1
+            if not completed % 100:
+                LOGGER.info(
+                    f"total completed: {completed}, "
+                    + f"{completed / (time.time() - start):.1f} files/s"
+                )
 
+        async with srcStore, destStore:
+            await objStoreAsync.forEach(
+                objStoreAsync.iterInExecutor(pending), move, maxConcurrency
+            )
+
+        self.journal.sync()
+        LOGGER.info(f"total completed: {completed}")
+        if self.verifier.isEnabled():
+            LOGGER.info(f"verification: {self.verifier.getStatusMessage()}")
+        if failed:
+            LOGGER.error(
+                f"{len(failed)} files could not be moved, they are recorded "
+                + f"as failed in {self.journal.journalFile}"
+            )
+        return failed
+
+    async def moveFileCoro(self, srcStore, destStore, srcFile):
+        """the asyncio version of moveFile
+
+        :param srcStore: the source bucket
+        :type srcStore: objStoreAsync.AsyncObjectStore
+        :param destStore: the destination bucket
+        :type destStore: objStoreAsync.AsyncObjectStore
+        :param srcFile: name of the object to move
+        :type srcFile: str
+        """
+        state = self.journal.getState(srcFile)
+        if state in transferJournal.COMPLETE_STATES:
+            LOGGER.debug(f"already moved: {srcFile}")
+            return
+        loop = asyncio.get_running_loop()
+
+        aclSet = False
+        partDigests = None
+        if self.serverSideCopy and state != transferJournal.COPIED:
+            try:
+                LOGGER.debug(f"copying the file: {srcFile}")
+                await destStore.copyObject(
+                    srcFile, constants.OBJ_STORE_TST_BUCKET,
+                    objectSize=self.getSourceSize(srcFile), public=True
+                )
+                LOGGER.info(f"copied with public permissions {srcFile}")
+                aclSet = True
+            except objStoreUtil.CopyRefusedError as err:
+                LOGGER.warning(
+                    f"{err}, falling back to streaming the files"
+                )
+                self.serverSideCopy = False
+        if not aclSet and state != transferJournal.COPIED:
+            # the memory used by streamed moves is bounded by the buffer
+            # pool, they stay on the threads
+            partDigests = await loop.run_in_executor(
+                None, self.moveFileStreamed, srcFile)
+            self.journal.record(srcFile, transferJournal.COPIED)
+            aclSet = destStore.publicOnUpload
+        if not aclSet:
+            await destStore.setPublicPermissions(srcFile)
+            LOGGER.info(f"set permissions on {srcFile}")
+        self.journal.record(srcFile, transferJournal.ACL_SET)
+
+        srcRecord = self.srcInventory.getObject(srcFile)
+        if srcRecord is None:
+            return
+        self.destInventory.recordObject(
+            srcFile, srcRecord.size, srcRecord.etag, public=True
+        )
+        if not self.verifier.isEnabled():
+            return
+        srcHead, destHead = await asyncio.gather(
+            srcStore.headObject(srcFile), destStore.headObject(srcFile)
+        )
+        result = self.verifier.compareHeads(
+            srcFile, srcHead["ContentLength"], srcHead["ETag"],
+            destHead["ContentLength"], destHead["ETag"]
+        )
+        if partDigests and (result is None or
+                            result.status == objStoreVerify.SIZE_ONLY):
+            result = self.verifier.verifyDigests(
+                srcFile, srcHead["ETag"], partDigests,
+                destHead["ETag"]) or result
+        if result is None:
+            result = await loop.run_in_executor(
+                None, self.verifier.verifyChecksum, srcFile,
+                srcHead["ContentLength"],
+                objStoreDiff.normalizeEtag(srcHead["ETag"]), destHead["ETag"]
+            )
+        self.verifier.recordResult(result)
+        self.recordVerifyResult(srcFile, result)
+
+    def skipCompleted(self, files2MoveIter, numFiles):
+        """takes the next numFiles files from the iterator, skipping the
+        ones that the journal says have already been moved
+
+        :param files2MoveIter: iterator of the file names to move
+        :type files2MoveIter: iterator
+        :param numFiles: max number of file names to return
+        :type numFiles: int
+        :return: the next files to move
+        :rtype: list
+        """
+        pending = (
+            file2Move for file2Move in files2MoveIter
+            if not self.journal.isComplete(file2Move)
+        )
+        return list(itertools.islice(pending, numFiles))
+
+    def writeReport(self, reportDir, started, failed):
+        """writes a json summary of the run of this shard, the coordinator
+        (consolidateShards.py merge) combines the reports of all the shards
+
+        :param reportDir: folder the report is written to
+        :type reportDir: str
+        :param started: time the run started
+        :type started: float
+        :param failed: names of the files that could not be moved
+        :type failed: list
+        :return: path to the report
+        :rtype: str
+        """
+        report = {
+            "shard": self.shard.toDict(),
+            "started": started,
+            "finished": time.time(),
+            "states": self.journal.getCounts(),
+            "diff": dict(self.diffCounts),
+            "verification": self.verifier.getCounts(),
+            "failed": failed,
+        }
+        reportFile = os.path.join(reportDir, self.shard.getFileName(
+            consolidateShards.REPORT_PREFIX, 'json'))
+        tmpFile = reportFile + '.tmp'
+        with open(tmpFile, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        os.replace(tmpFile, reportFile)
+        LOGGER.info(f"wrote the report for shard {self.shard} to {reportFile}")
+        return reportFile
 
     def publishFile(self, fileName):
         LOGGER.debug(f"publishing filename: {fileName}")
         self.destObjStoreUtil.setPublicPermissions(fileName)
 
-    def cacheSrcDest(self, srcFiles, destFiles):
-        """getting a file list from source and destination can be time
-        consuming, so maintaining a cache (mostly for debugging).  This
-        method is typically called after an exception is raise and it re
-        writes the data structs for src and dest to the json files.
-        """
-        with open(self.srcCacheFile, 'w') as fh:
-            json.dump(srcFiles, fh)
-        with open(self.destCacheFile, 'w') as fh:
-            json.dump(destFiles, fh)
-
 
 if __name__ == '__main__':
     #LOGGER.setLevel(logging.DEBUG)
@@ -250,6 +837,77 @@ if __name__ == '__main__':
     utilLog = logging.getLogger('objStoreUtil')
     utilLog.setLevel(logging.INFO)
 
-    cons = ConsolidateStorage()
+    parser = argparse.ArgumentParser(
+        description='moves the files from the test bucket to prod')
+    parser.add_argument(
+        '--verify-existing', action='store_true',
+        help='verify the files moved by earlier runs, and move the ones '
+             'that do not match again')
+    parser.add_argument(
+        '--engine', choices=objStoreAsync.ENGINES,
+        default=constants.OBJ_STORE_ENGINE,
+        help='move the files on a pool of threads, or with asyncio')
+    parser.add_argument(
+        '--shard', default=None,
+        help='only move the files in shard i of N, in the format i/N')
+    parser.add_argument(
+        '--shard-mode', choices=consolidateShards.MODES,
+        default=consolidateShards.RANGE,
+        help='split the keys into contiguous ranges, or by a hash')
+    parser.add_argument(
+        '--shard-plan', default=None,
+        help='ranges made by "consolidateShards.py plan", for range mode')
+    parser.add_argument(
+        '--report-dir', default=constants.TMP_FOLDER,
+        help='folder the json report of the run is written to')
+    parser.add_argument(
+        '--schedule', default=constants.TRANSFER_SCHEDULE,
+        help='order to move the files in, comma separated list of: '
+             + ', '.join(transferScheduler.POLICIES))
+    parser.add_argument(
+        '--priority-dates', default=constants.TRANSFER_PRIORITY_DATES,
+        help='months that recent-first moves first, for example '
+             '2021-2022,201901-201906')
+    parser.add_argument(
+        '--sync', action='store_true',
+        help='keep running and move new files as they show up, every '
+             'SYNC_INTERVAL seconds')
+    args = parser.parse_args()
+
+    objStoreMetrics.startFromConfig(
+        constants.METRICS_PORT, constants.METRICS_FILE,
+        constants.METRICS_INTERVAL
+    )
+    shard = consolidateShards.ShardSpec.fromArgs(
+        args.shard, args.shard_mode, args.shard_plan)
+    try:
+        policies = transferScheduler.getPolicies(
+            args.schedule,
+            transferScheduler.parseDateRanges(args.priority_dates))
+    except ValueError as err:
+        parser.error(str(err))
+    started = time.time()
+    cons = ConsolidateStorage(shard=shard)
+    cons.scheduler = transferScheduler.TransferScheduler(
+        policies, getSize=cons.getSourceSize,
+        queueSize=constants.TRANSFER_QUEUE_SIZE)
     #cons.consolidate()
-    cons.moveFilesAsync()
+    moveFiles = cons.moveFilesAsync
+    if args.engine == objStoreAsync.ENGINE_ASYNCIO:
+        moveFiles = cons.moveFilesAio
+    if args.sync:
+        daemon = syncDaemon.SyncDaemon(
+            cons, moveFiles=moveFiles, interval=constants.SYNC_INTERVAL,
+            jitter=constants.SYNC_JITTER, maxLag=constants.SYNC_MAX_LAG)
+        daemon.startHealthServer(constants.SYNC_HEALTH_PORT)
+        daemon.run()
+        failed = []
+    elif args.verify_existing:
+        mismatched = cons.verifyFiles()
+        failed = moveFiles(files=mismatched)
+    else:
+        failed = moveFiles()
+    cons.writeReport(args.report_dir, started, failed)
+    cons.journal.close()
+    if constants.METRICS_FILE:
+        objStoreMetrics.writeSnapshot(constants.METRICS_FILE)
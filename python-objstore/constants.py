@@ -1,27 +1,127 @@
 """ Declaring constants used by the archive script. """
 
 import os
-import dotenv
 
 envPath = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(envPath):
+    import dotenv
     print("loading dot env...")
     dotenv.load_dotenv()
 
-#OBJ_STORE_ROOT_DIR = os.environ['OBJ_STORE_ROOT_DIR']
-OBJ_STORE_BUCKET = os.environ['OBJ_STORE_BUCKET']
-OBJ_STORE_SECRET = os.environ['OBJ_STORE_SECRET']
-OBJ_STORE_USER = os.environ['OBJ_STORE_USER']
-OBJ_STORE_HOST = os.environ['OBJ_STORE_HOST']
-#OBJ_STORE_ACCESS_KEY = os.environ['OBJ_STORE_ACCESS_KEY']
-#OBJ_STORE_SECRET_KEY = os.environ['OBJ_STORE_SECRET_KEY']
-TEST_OBJ_NAME = os.environ['TEST_OBJ_NAME']
-INDEX_FILE = os.environ['INDEX_FILE']
-
-# bucket description of test bucket
-OBJ_STORE_TST_BUCKET = os.environ['OBJ_STORE_TST_BUCKET']
-OBJ_STORE_TST_SECRET = os.environ['OBJ_STORE_TST_SECRET']
-OBJ_STORE_TST_USER = os.environ['OBJ_STORE_TST_USER']
-OBJ_STORE_TST_HOST = os.environ['OBJ_STORE_TST_HOST']
-
-TMP_FOLDER=os.environ['TMP_FOLDER']
\ No newline at end of file
+# settings without a default.  These are read from the environment the first
+# time they are used (see __getattr__ below) rather than on import, so a
+# command only needs the ones it uses.
+#
+# OBJ_STORE_BUCKET, OBJ_STORE_SECRET, OBJ_STORE_USER, OBJ_STORE_HOST:
+#     the prod bucket
+# OBJ_STORE_TST_BUCKET, OBJ_STORE_TST_SECRET, OBJ_STORE_TST_USER,
+# OBJ_STORE_TST_HOST: the test bucket
+# TEST_OBJ_NAME, INDEX_FILE, TMP_FOLDER
+PROD_BUCKET_VARS = ['OBJ_STORE_BUCKET', 'OBJ_STORE_SECRET', 'OBJ_STORE_USER',
+                    'OBJ_STORE_HOST']
+TST_BUCKET_VARS = ['OBJ_STORE_TST_BUCKET', 'OBJ_STORE_TST_SECRET',
+                   'OBJ_STORE_TST_USER', 'OBJ_STORE_TST_HOST']
+REQUIRED_VARS = PROD_BUCKET_VARS + TST_BUCKET_VARS + [
+    'TEST_OBJ_NAME', 'INDEX_FILE', 'TMP_FOLDER']
+
+
+class MissingConfigError(AttributeError):
+    """raised when a setting without a default isn't in the environment"""
+
+
+def require(*names):
+    """checks that settings without a default are in the environment, so a
+    command can fail up front rather than part way through
+
+    :raises MissingConfigError: naming every one that is missing
+    """
+    missing = [name for name in names if name not in os.environ]
+    if missing:
+        msg = f"missing environment variables: {', '.join(missing)}, " + \
+            "set them or add them to the .env file"
+        raise MissingConfigError(msg)
+
+
+def __getattr__(name):
+    if name in REQUIRED_VARS:
+        require(name)
+        value = os.environ[name]
+    elif name == 'OBJECT_CACHE_DIR':
+        value = os.environ.get('OBJECT_CACHE_DIR') or \
+            os.path.join(__getattr__('TMP_FOLDER'), 'objcache')
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # only looked up once, after that it's a plain module attribute
+    globals()[name] = value
+    return value
+
+
+# set to false to talk to the object store over http, for a local s3 server
+OBJ_STORE_SECURE = os.environ.get(
+    'OBJ_STORE_SECURE', 'true').lower() != 'false'
+
+# read through cache of downloaded objects (objStoreCache), the folder it's
+# kept in (OBJECT_CACHE_DIR, defaults to TMP_FOLDER/objcache) and the most
+# bytes of objects it keeps
+OBJECT_CACHE_BYTES = int(os.environ.get('OBJECT_CACHE_BYTES', 2 * 1024 ** 3))
+
+# number of seconds that the bucket inventory (objStoreInventory) trusts
+# a listing of the bucket for
+INVENTORY_TTL = int(os.environ.get('INVENTORY_TTL', 24 * 60 * 60))
+
+# upper limit on the number of files the consolidation script moves at the
+# same time, the actual number is adjusted at run time
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 64))
+
+# part size and total memory used to stream objects between buckets
+STREAM_PART_SIZE = int(os.environ.get('STREAM_PART_SIZE', 16 * 1024 ** 2))
+STREAM_MEMORY_BUDGET = int(
+    os.environ.get('STREAM_MEMORY_BUDGET', 256 * 1024 ** 2))
+
+# objects larger than two parts are downloaded / uploaded by ObjectStoreUtil
+# in parts of TRANSFER_PART_SIZE bytes (streamed objects use
+# STREAM_PART_SIZE), PART_PARALLELISM parts of an object at a time and
+# MAX_PART_REQUESTS parts in all, on a thread pool shared by every object
+TRANSFER_PART_SIZE = int(
+    os.environ.get('TRANSFER_PART_SIZE', 16 * 1024 ** 2))
+PART_PARALLELISM = int(os.environ.get('PART_PARALLELISM', 8))
+MAX_PART_REQUESTS = int(os.environ.get('MAX_PART_REQUESTS', 64))
+
+# lat / lon of the WRF grid cells, in the consolidated bucket
+DOMAIN_FILE = os.environ.get('DOMAIN_FILE', 'domaininfo_bcwrf.csv')
+
+# how moved files are checked against the source (objStoreVerify), one of
+# sample, full or off, and the fraction of the files that are downloaded to
+# recalculate their etag with the sample policy
+VERIFY_POLICY = os.environ.get('VERIFY_POLICY', 'sample')
+VERIFY_SAMPLE_RATE = float(os.environ.get('VERIFY_SAMPLE_RATE', 0.05))
+
+# metrics for the object store calls (objStoreMetrics), served in the
+# prometheus format on METRICS_PORT and / or written to METRICS_FILE every
+# METRICS_INTERVAL seconds, both off by default
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_INTERVAL = int(os.environ.get('METRICS_INTERVAL', 60))
+
+# engine the consolidation and publish scripts use to talk to the object
+# store, threads or asyncio (objStoreAsync), and the max number of requests
+# the asyncio engine keeps in flight
+OBJ_STORE_ENGINE = os.environ.get('OBJ_STORE_ENGINE', 'threads')
+ASYNC_MAX_CONCURRENCY = int(os.environ.get('ASYNC_MAX_CONCURRENCY', 256))
+
+# order the consolidation moves files in (transferScheduler), a comma
+# separated list of listing, largest-first, recent-first and fair, the months
+# that recent-first moves first (for example 2021-2022,201901) and the number
+# of files the scheduler reads ahead to pick from once it's up to speed
+TRANSFER_SCHEDULE = os.environ.get('TRANSFER_SCHEDULE', 'largest-first')
+TRANSFER_PRIORITY_DATES = os.environ.get('TRANSFER_PRIORITY_DATES', '')
+TRANSFER_QUEUE_SIZE = int(os.environ.get('TRANSFER_QUEUE_SIZE', 10000))
+
+# consolidate_objstores.py --sync: seconds between the start of each sync
+# cycle, the fraction of it that is randomly added / taken away, the lag
+# after which the health check fails (defaults to 3 intervals) and the port
+# the health check is served on
+SYNC_INTERVAL = int(os.environ.get('SYNC_INTERVAL', 300))
+SYNC_JITTER = float(os.environ.get('SYNC_JITTER', 0.2))
+SYNC_MAX_LAG = int(os.environ.get('SYNC_MAX_LAG', 0)) or None
+SYNC_HEALTH_PORT = int(os.environ.get('SYNC_HEALTH_PORT', 8080))
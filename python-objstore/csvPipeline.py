@@ -0,0 +1,207 @@
+"""Streaming, parallel transforms of large csv files.
+
+The source file is read in chunks of whole records, each chunk is parsed
+with the csv module and projected down to the requested columns in a
+process pool, and the results are written out in the same order as they
+were read.  Only a few chunks per worker are in flight at any time, so
+memory use doesn't depend on the size of the file.
+
+Files ending in .gz are read / written with gzip, and files ending in .zst
+with zstandard if it is installed.
+
+    csvPipeline.projectColumns('wrf_fileindex.csv', 'wrf_fileindex_v2.csv',
+                               ['filename', 'I0', 'J0', 'I1', 'J1'])
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import gzip
+import io
+import logging
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = logging.getLogger(__name__)
+
+# number of records in each chunk that is handed to a worker
+CHUNK_ROWS = 50000
+
+# chunks waiting for or being processed by each worker
+CHUNKS_PER_WORKER = 2
+
+WRITE_BUFFER_SIZE = 1024 ** 2
+
+
+def openCsv(csvFile, mode):
+    """opens a csv file for reading ('r') or writing ('w') in text mode,
+    the compression is picked from the file extension
+
+    :param csvFile: path to the file
+    :type csvFile: str
+    :param mode: 'r' or 'w'
+    :type mode: str
+    :raises ValueError: if the file is zstandard compressed and the
+                        zstandard package isn't installed
+    :return: the file object
+    :rtype: io.TextIOBase
+    """
+    if csvFile.endswith(".gz"):
+        # level 6 is much faster to write than the default of 9 and not
+        # much bigger
+        return gzip.open(csvFile, mode + "t", compresslevel=6, newline="")
+    if csvFile.endswith(".zst"):
+        if zstandard is None:
+            msg = "the zstandard package is required to read / write " + \
+                f"{csvFile}"
+            raise ValueError(msg)
+        return zstandard.open(csvFile, mode + "t", newline="")
+    return open(csvFile, mode, newline="", buffering=WRITE_BUFFER_SIZE)
+
+
+def readChunks(fh, chunkRows=CHUNK_ROWS):
+    """splits the lines of a csv file into chunks of whole records.  A
+    quoted field can span lines, so a chunk only ends on a line where all
+    the quotes have been closed.
+
+    :param fh: the file, positioned after the header
+    :type fh: io.TextIOBase
+    :param chunkRows: number of lines in each chunk
+    :type chunkRows: int
+    :yield: the text of the chunk
+    :rtype: str
+    """
+    lines = []
+    quotes = 0
+    for line in fh:
+        lines.append(line)
+        quotes += line.count('"')
+        if len(lines) >= chunkRows and quotes % 2 == 0:
+            yield "".join(lines)
+            lines = []
+            quotes = 0
+    if lines:
+        yield "".join(lines)
+
+
+def transformChunk(text, positions):
+    """parses a chunk of csv records and writes out the columns at the
+    positions.  Runs in the worker processes.
+
+    :param text: csv records
+    :type text: str
+    :param positions: index of the columns to keep, in output order
+    :type positions: list
+    :return: the number of records and the csv text for them
+    :rtype: tuple
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    rows = 0
+    for record in csv.reader(io.StringIO(text, newline="")):
+        if not record:
+            continue
+        writer.writerow([record[position] for position in positions])
+        rows += 1
+    return rows, output.getvalue()
+
+
+def getPositions(header, columns):
+    """the index of each of the columns in the header
+
+    :raises ValueError: if a column isn't in the header
+    :rtype: list
+    """
+    missing = [column for column in columns if column not in header]
+    if missing:
+        msg = f"columns {missing} are not in the csv header: {header}"
+        raise ValueError(msg)
+    return [header.index(column) for column in columns]
+
+
+def writeParallel(chunks, positions, fhWrite, maxWorkers):
+    """transforms the chunks in a process pool and writes the results in
+    the order the chunks were read
+
+    :return: number of records written
+    :rtype: int
+    """
+    rows = 0
+    with concurrent.futures.ProcessPoolExecutor(maxWorkers) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(transformChunk, chunk, positions))
+            if len(pending) >= maxWorkers * CHUNKS_PER_WORKER:
+                chunkRowCount, text = pending.popleft().result()
+                fhWrite.write(text)
+                rows += chunkRowCount
+        while pending:
+            chunkRowCount, text = pending.popleft().result()
+            fhWrite.write(text)
+            rows += chunkRowCount
+    return rows
+
+
+def projectColumns(srcFile, destFile, columns, header=False,
+                   chunkRows=CHUNK_ROWS, maxWorkers=None):
+    """copies the columns from a csv file with a header into a new csv
+    file, in the order they are listed in columns
+
+    :param srcFile: the csv file to read, has to have a header
+    :type srcFile: str
+    :param destFile: the csv file to write
+    :type destFile: str
+    :param columns: names of the columns to copy
+    :type columns: list
+    :param header: write a header to the new file
+    :type header: bool, optional
+    :param chunkRows: number of records handed to a worker at a time
+    :type chunkRows: int, optional
+    :param maxWorkers: number of worker processes, defaults to the number of
+                       cpus, 1 does the work in this process
+    :type maxWorkers: int, optional
+    :return: number of records written
+    :rtype: int
+    """
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    rows = 0
+    with openCsv(srcFile, "r") as fhRead, openCsv(destFile, "w") as fhWrite:
+        positions = getPositions(next(csv.reader(fhRead)), columns)
+        if header:
+            csv.writer(fhWrite, lineterminator="\n").writerow(columns)
+
+        chunks = readChunks(fhRead, chunkRows)
+        if maxWorkers == 1:
+            for chunk in chunks:
+                chunkRowCount, text = transformChunk(chunk, positions)
+                fhWrite.write(text)
+                rows += chunkRowCount
+        else:
+            rows = writeParallel(chunks, positions, fhWrite, maxWorkers)
+    LOGGER.info(f"wrote {rows} records to {destFile}")
+    return rows
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='copies columns from one csv file to another')
+    parser.add_argument('srcFile', help='csv file with a header')
+    parser.add_argument('destFile',
+                        help='csv file to write, .gz / .zst are compressed')
+    parser.add_argument('--columns', required=True,
+                        help='comma separated names of the columns to copy')
+    parser.add_argument('--header', action='store_true',
+                        help='write a header to the new file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args()
+
+    projectColumns(args.srcFile, args.destFile, args.columns.split(','),
+                   header=args.header, maxWorkers=args.workers)
@@ -0,0 +1,66 @@
+"""Stand ins for modules that are only imported when they are first used.
+
+boto3, minio and aiohttp take a few hundred milliseconds to import, which is
+most of the start up time of a short command (presigning a url, reading the
+index).  Modules that only use them inside functions bind them with:
+
+    boto3 = lazyModules.LazyModule("boto3")
+
+and the import happens on the first attribute lookup.  Submodules that the
+package doesn't import itself (botocore.exceptions, minio.error) are
+imported on lookup too, so code can keep using the full dotted names.
+"""
+
+import importlib
+import threading
+
+_importLock = threading.RLock()
+
+
+class LazyModule:
+    def __init__(self, name):
+        """[summary]
+
+        :param name: name of the module, as it would be given to import
+        :type name: str
+        """
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def load(self):
+        """
+        :return: the module, imported the first time this is called
+        :rtype: module
+        """
+        module = self.__dict__["_module"]
+        if module is None:
+            with _importLock:
+                module = self.__dict__["_module"]
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    self.__dict__["_module"] = module
+        return module
+
+    def isLoaded(self):
+        return self.__dict__["_module"] is not None
+
+    def __getattr__(self, attr):
+        module = self.load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            if attr.startswith("__"):
+                raise
+        # a submodule the package doesn't import itself
+        with _importLock:
+            return importlib.import_module(f"{self._name}.{attr}")
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+    def __dir__(self):
+        return dir(self.load())
+
+    def __repr__(self):
+        state = "loaded" if self.isLoaded() else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
@@ -0,0 +1,631 @@
+"""Asyncio engine for the object store calls.
+
+An alternative to running the blocking minio / boto calls on a pool of
+threads.  The S3 requests are sent with aiohttp and signed with botocore's
+SigV4 signer, so a single event loop can keep thousands of requests in
+flight without a thread (and its stack) for each one.  The number of
+requests in flight is capped with a semaphore.
+
+    async with objStoreAsync.AsyncObjectStore(maxConcurrency=500) as store:
+        async for obj in store.listObjectRange('x00', 'x01'):
+            await store.setPublicPermissions(obj.object_name)
+
+aiobotocore pins its own version of botocore, which doesn't match the
+boto3 version in requirements.txt, so it isn't used.
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import random
+import ssl
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+import constants
+import lazyModules
+import objStoreMetrics
+import objStoreUtil
+
+LOGGER = logging.getLogger(__name__)
+
+aiohttp = lazyModules.LazyModule("aiohttp")
+botocore = lazyModules.LazyModule("botocore")
+certifi = lazyModules.LazyModule("certifi")
+yarl = lazyModules.LazyModule("yarl")
+
+# the engines the consolidation and publish scripts can run on
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = [ENGINE_THREADS, ENGINE_ASYNCIO]
+
+DEFAULT_CONCURRENCY = 256
+# region used to sign the requests, the object store ignores it
+DEFAULT_REGION = "us-east-1"
+
+# attempts made at a request that fails with a connection error, a 5xx or
+# a throttling error, and the base of the exponential backoff in seconds
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 0.2
+MAX_BACKOFF = 20
+
+CONNECT_TIMEOUT = 60
+READ_TIMEOUT = 300
+READ_SIZE = 1024 ** 2
+# max keys returned by each page of a listing
+LIST_PAGE_SIZE = 1000
+
+PUBLIC_READ = "public-read"
+ALL_USERS_URI = "http://acs.amazonaws.com/groups/global/AllUsers"
+
+# an object in a listing, has the same attributes as the minio objects that
+# ObjectStoreUtil.listObjectRange yields
+ObjectInfo = collections.namedtuple(
+    "ObjectInfo", ["object_name", "size", "etag", "last_modified"]
+)
+
+
+class AsyncObjectStoreError(Exception):
+    """an error response from the object store"""
+
+    def __init__(self, status, code, message, key=None):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.key = key
+        super().__init__(f"{status} {code}: {message} ({key})")
+
+
+def isThrottleError(err):
+    """
+    :return: true if the error is the object store throttling requests
+    :rtype: bool
+    """
+    if isinstance(err, AsyncObjectStoreError):
+        return err.code in objStoreUtil.THROTTLE_CODES or err.status == 503
+    return objStoreUtil.isThrottleError(err)
+
+
+def isCopyRefused(err):
+    """
+    :return: true if the object store won't do a server side copy for us
+    :rtype: bool
+    """
+    return err.code in objStoreUtil.COPY_REFUSED_CODES or err.status == 403
+
+
+def isRetryable(err):
+    if isinstance(err, AsyncObjectStoreError):
+        return err.status >= 500 or isThrottleError(err)
+    return isinstance(err, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def parseXml(body):
+    """parses an xml response and removes the S3 namespace from the tags so
+    elements can be found by their plain names
+
+    :rtype: xml.etree.ElementTree.Element
+    """
+    root = ElementTree.fromstring(body)
+    for elem in root.iter():
+        elem.tag = elem.tag.split("}", 1)[-1]
+    return root
+
+
+def parseError(status, body, key=None):
+    """
+    :return: the exception for an error response
+    :rtype: AsyncObjectStoreError
+    """
+    code = str(status)
+    message = ""
+    if body:
+        try:
+            root = parseXml(body)
+            code = root.findtext("Code") or code
+            message = root.findtext("Message") or ""
+        except ElementTree.ParseError:
+            message = body[:200].decode("utf-8", "replace")
+    return AsyncObjectStoreError(status, code, message, key)
+
+
+def parseTimestamp(text):
+    return datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+
+
+def objectKey(args, kwargs):
+    key = kwargs.get("key", args[1] if len(args) > 1 else None)
+    return {"objstore.key": key}
+
+
+def returnedBytes(args, kwargs, result):
+    return result
+
+
+def bodyBytes(args, kwargs, result):
+    return len(result)
+
+
+async def iterInExecutor(iterator, batchSize=100):
+    """turns a blocking iterator (a bucket diff, a sqlite query) into an
+    async generator by reading it in batches on the default thread pool
+
+    :param iterator: the blocking iterator
+    :type iterator: iterator
+    :param batchSize: number of items read by each call to the thread pool
+    :type batchSize: int, optional
+    :yield: the items of the iterator
+    """
+    loop = asyncio.get_running_loop()
+
+    def nextBatch():
+        batch = []
+        for item in iterator:
+            batch.append(item)
+            if len(batch) >= batchSize:
+                break
+        return batch
+
+    while True:
+        batch = await loop.run_in_executor(None, nextBatch)
+        if not batch:
+            return
+        for item in batch:
+            yield item
+
+
+async def forEach(items, func, concurrency):
+    """awaits func(item) for every item with up to concurrency calls
+    running at the same time.  func is expected to deal with its own
+    errors, any exception it raises stops the run.
+
+    :param items: the items to process
+    :type items: async iterator
+    :param func: coroutine function that processes an item
+    :type func: callable
+    :param concurrency: number of items processed at the same time
+    :type concurrency: int
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def produce():
+        async for item in items:
+            await queue.put(item)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await func(item)
+
+    tasks = [asyncio.ensure_future(produce())]
+    tasks += [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class AsyncObjectStore:
+    def __init__(self, objStoreHost=None, objStoreUser=None,
+                 objStoreSecret=None, objStoreBucket=None,
+                 publicOnUpload=False, secure=None,
+                 maxConcurrency=DEFAULT_CONCURRENCY, region=DEFAULT_REGION):
+        """[summary]
+
+        :param objStoreHost: object store host, defaults to
+                             constants.OBJ_STORE_HOST
+        :type objStoreHost: str, optional
+        :param objStoreUser: access key id, defaults to
+                             constants.OBJ_STORE_USER
+        :type objStoreUser: str, optional
+        :param objStoreSecret: secret access key, defaults to
+                               constants.OBJ_STORE_SECRET
+        :type objStoreSecret: str, optional
+        :param objStoreBucket: bucket the calls go to, defaults to
+                               constants.OBJ_STORE_BUCKET
+        :type objStoreBucket: str, optional
+        :param publicOnUpload: create objects uploaded with putObject with
+                               the public-read acl
+        :type publicOnUpload: bool, optional
+        :param secure: connect with https, defaults to
+                       constants.OBJ_STORE_SECURE
+        :type secure: bool, optional
+        :param maxConcurrency: max number of requests in flight, also the
+                               size of the connection pool
+        :type maxConcurrency: int, optional
+        :param region: region the requests are signed for
+        :type region: str, optional
+        """
+        self.objStoreHost = objStoreHost or constants.OBJ_STORE_HOST
+        self.objStoreUser = objStoreUser or constants.OBJ_STORE_USER
+        self.objStoreSecret = objStoreSecret or constants.OBJ_STORE_SECRET
+        self.objStoreBucket = objStoreBucket or constants.OBJ_STORE_BUCKET
+        self.publicOnUpload = publicOnUpload
+        self.secure = secure
+        if self.secure is None:
+            self.secure = constants.OBJ_STORE_SECURE
+        self.maxConcurrency = maxConcurrency
+        self.scheme = "https" if self.secure else "http"
+
+        self.signer = botocore.auth.S3SigV4Auth(
+            botocore.credentials.Credentials(
+                self.objStoreUser, self.objStoreSecret
+            ),
+            "s3",
+            region,
+        )
+        # created in open(), they have to be created inside the event loop
+        self.session = None
+        self.semaphore = None
+        # functions called without any arguments when a request is
+        # throttled, same as ObjectStoreUtil.addThrottleListener
+        self.throttleListeners = []
+
+    async def open(self):
+        if self.session is not None:
+            return
+        sslContext = False
+        if self.secure:
+            sslContext = ssl.create_default_context(
+                cafile=os.environ.get("SSL_CERT_FILE") or certifi.where()
+            )
+        connector = aiohttp.TCPConnector(
+            limit=self.maxConcurrency, ssl=sslContext
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+            # the object store doesn't set cookies, and the session cookie
+            # jar isn't free with thousands of requests
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+        self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def addThrottleListener(self, listener):
+        self.throttleListeners.append(listener)
+
+    def getUrl(self, bucket, key=None, params=None):
+        """builds the path style url for a bucket / object, the key and the
+        query string are quoted the way SigV4 expects them to be
+
+        :rtype: str
+        """
+        url = f"{self.scheme}://{self.objStoreHost}/{bucket}"
+        if key is not None:
+            url += "/" + urllib.parse.quote(key, safe="/~")
+        if params:
+            url += "?" + urllib.parse.urlencode(
+                sorted(params.items()), quote_via=urllib.parse.quote,
+                safe="~"
+            )
+        return url
+
+    def signHeaders(self, method, url, headers, data):
+        request = botocore.awsrequest.AWSRequest(
+            method=method, url=url, headers=headers, data=data
+        )
+        self.signer.add_auth(request)
+        return dict(request.headers.items())
+
+    async def request(self, apiName, method, key=None, params=None,
+                      headers=None, data=b"", bucket=None, handler=None):
+        """sends a signed request, retrying connection errors, server errors
+        and throttling with an exponential backoff
+
+        :param apiName: name of the S3 api call, used for the metrics
+        :type apiName: str
+        :param method: http method
+        :type method: str
+        :param key: name of the object, None for bucket requests
+        :type key: str, optional
+        :param params: query string parameters
+        :type params: dict, optional
+        :param headers: extra headers to send
+        :type headers: dict, optional
+        :param data: body of the request
+        :type data: bytes, optional
+        :param bucket: the bucket, defaults to the bucket of this object
+        :type bucket: str, optional
+        :param handler: coroutine function that gets the response when it
+                        succeeds and returns the result, by default the
+                        result is the status, headers and body
+        :type handler: callable, optional
+        :raises AsyncObjectStoreError: if the object store returns an error
+        """
+        if self.session is None:
+            await self.open()
+        url = self.getUrl(bucket or self.objStoreBucket, key, params)
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                attempt += 1
+                signedHeaders = self.signHeaders(
+                    method, url, dict(headers or {}), data
+                )
+                try:
+                    async with self.session.request(
+                        method, yarl.URL(url, encoded=True),
+                        headers=signedHeaders, data=data or None
+                    ) as resp:
+                        if resp.status < 300:
+                            if handler is not None:
+                                return await handler(resp)
+                            return resp.status, resp.headers, \
+                                await resp.read()
+                        err = parseError(resp.status, await resp.read(), key)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as \
+                        clientErr:
+                    err = clientErr
+                if isThrottleError(err):
+                    objStoreMetrics.REGISTRY.recordThrottle(apiName)
+                    for listener in self.throttleListeners:
+                        listener()
+                if attempt >= MAX_ATTEMPTS or not isRetryable(err):
+                    raise err
+                objStoreMetrics.REGISTRY.recordRetries(apiName, 1)
+                delay = min(MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt)
+                LOGGER.debug(f"{apiName} {key} failed, retrying in "
+                             f"{delay:.1f}s: {err}")
+                await asyncio.sleep(random.uniform(0, delay))
+
+    @objStoreMetrics.instrument(getAttributes=objectKey)
+    async def listObjectRange(self, startAfter=None, endKey=None,
+                              prefix=None):
+        """lists the objects in the bucket whose names fall in the range
+        startAfter < name <= endKey, a page at a time
+
+        :param startAfter: objects with names after this key are listed
+        :type startAfter: str, optional
+        :param endKey: last key to include in the listing
+        :type endKey: str, optional
+        :param prefix: only list objects whose names start with this
+        :type prefix: str, optional
+        :yield: the objects in the range
+        :rtype: ObjectInfo
+        """
+        params = {"list-type": "2", "max-keys": str(LIST_PAGE_SIZE)}
+        if startAfter:
+            params["start-after"] = startAfter
+        if prefix:
+            params["prefix"] = prefix
+        while True:
+            _, _, body = await self.request("ListObjectsV2", "GET",
+                                            params=params)
+            root = parseXml(body)
+            for contents in root.iter("Contents"):
+                name = contents.findtext("Key")
+                if endKey is not None and name > endKey:
+                    return
+                yield ObjectInfo(
+                    name,
+                    int(contents.findtext("Size")),
+                    contents.findtext("ETag"),
+                    parseTimestamp(contents.findtext("LastModified")),
+                )
+            token = root.findtext("NextContinuationToken")
+            if root.findtext("IsTruncated") != "true" or not token:
+                return
+            params.pop("start-after", None)
+            params["continuation-token"] = token
+
+    @objStoreMetrics.instrument(getAttributes=objectKey)
+    async def headObject(self, key, bucket=None):
+        """
+        :return: the size and etag of the object, as ContentLength and ETag
+                 to match boto's head_object
+        :rtype: dict
+        """
+        _, headers, _ = await self.request("HeadObject", "HEAD", key,
+                                           bucket=bucket)
+        return {
+            "ContentLength": int(headers.get("Content-Length", 0)),
+            "ETag": headers.get("ETag"),
+        }
+
+    @objStoreMetrics.instrument(getBytes=returnedBytes,
+                                getAttributes=objectKey)
+    async def getObject(self, key, localPath, bucket=None):
+        """downloads an object to a local file
+
+        :return: the number of bytes written
+        :rtype: int
+        """
+
+        async def download(resp):
+            numBytes = 0
+            with open(localPath, "wb") as fh:
+                async for chunk in resp.content.iter_chunked(READ_SIZE):
+                    fh.write(chunk)
+                    numBytes += len(chunk)
+            return numBytes
+
+        return await self.request("GetObject", "GET", key, bucket=bucket,
+                                  handler=download)
+
+    @objStoreMetrics.instrument(getBytes=bodyBytes, getAttributes=objectKey)
+    async def getObjectBytes(self, key, bucket=None):
+        _, _, body = await self.request("GetObject", "GET", key,
+                                        bucket=bucket)
+        return body
+
+    @objStoreMetrics.instrument(getBytes=returnedBytes,
+                                getAttributes=objectKey)
+    async def putObject(self, key, localPath=None, data=None, public=None,
+                        bucket=None):
+        """uploads a local file, or bytes, to an object with a single put
+
+        :param key: name of the object
+        :type key: str
+        :param localPath: the file to upload
+        :type localPath: str, optional
+        :param data: the content to upload when localPath isn't given
+        :type data: bytes, optional
+        :param public: create the object with the public-read acl, defaults
+                       to publicOnUpload
+        :type public: bool, optional
+        :return: the number of bytes uploaded
+        :rtype: int
+        """
+        if public is None:
+            public = self.publicOnUpload
+        if localPath is not None:
+            loop = asyncio.get_running_loop()
+            with open(localPath, "rb") as fh:
+                data = await loop.run_in_executor(None, fh.read)
+        headers = {}
+        if public:
+            headers["x-amz-acl"] = PUBLIC_READ
+        await self.request("PutObject", "PUT", key, headers=headers,
+                           data=data, bucket=bucket)
+        return len(data)
+
+    @objStoreMetrics.instrument(getBytes=returnedBytes,
+                                getAttributes=objectKey)
+    async def copyObject(self, srcObject, srcBucket, destObject=None,
+                         objectSize=None, public=True):
+        """server side copy of an object into the bucket of this object,
+        objects larger than objStoreUtil.MAX_SINGLE_COPY_SIZE are copied in
+        parts
+
+        :param srcObject: name of the object in the source bucket
+        :type srcObject: str
+        :param srcBucket: the bucket that the object is copied from
+        :type srcBucket: str
+        :param destObject: name of the new object, defaults to srcObject
+        :type destObject: str, optional
+        :param objectSize: size of the source object, if not provided it is
+                           retrieved with a head request
+        :type objectSize: int, optional
+        :param public: create the new object with the public-read acl
+        :type public: bool, optional
+        :raises objStoreUtil.CopyRefusedError: if the object store will not
+                                               do the copy
+        :return: the number of bytes copied
+        :rtype: int
+        """
+        if destObject is None:
+            destObject = srcObject
+        headers = {
+            "x-amz-copy-source": urllib.parse.quote(
+                f"{srcBucket}/{srcObject}", safe="/~")
+        }
+        if public:
+            headers["x-amz-acl"] = PUBLIC_READ
+        try:
+            if objectSize is None:
+                head = await self.headObject(srcObject, bucket=srcBucket)
+                objectSize = head["ContentLength"]
+            if objectSize > objStoreUtil.MAX_SINGLE_COPY_SIZE:
+                await self.multipartCopy(destObject, headers, objectSize)
+                return objectSize
+            _, _, body = await self.request("CopyObject", "PUT", destObject,
+                                            headers=headers)
+            # a copy can fail after the 200 has been sent, the error is then
+            # in the body
+            if b"<Error>" in body:
+                raise parseError(200, body, destObject)
+        except AsyncObjectStoreError as err:
+            if isCopyRefused(err):
+                msg = (
+                    f"server side copy of {srcBucket}/{srcObject} refused "
+                    + f"with the error code: {err.code}"
+                )
+                raise objStoreUtil.CopyRefusedError(msg) from err
+            raise
+        return objectSize
+
+    async def multipartCopy(self, destObject, headers, objectSize):
+        """copies a large object with UploadPartCopy requests, all the parts
+        are copied at the same time.  The upload is aborted if a part fails.
+        """
+        createHeaders = {
+            name: value for name, value in headers.items()
+            if name == "x-amz-acl"
+        }
+        _, _, body = await self.request(
+            "CreateMultipartUpload", "POST", destObject,
+            params={"uploads": ""}, headers=createHeaders
+        )
+        uploadId = parseXml(body).findtext("UploadId")
+        copySource = headers["x-amz-copy-source"]
+
+        async def copyPart(partNumber, start):
+            end = min(start + objStoreUtil.COPY_PART_SIZE, objectSize) - 1
+            _, _, partBody = await self.request(
+                "UploadPartCopy", "PUT", destObject,
+                params={"partNumber": str(partNumber), "uploadId": uploadId},
+                headers={"x-amz-copy-source": copySource,
+                         "x-amz-copy-source-range": f"bytes={start}-{end}"},
+            )
+            return parseXml(partBody).findtext("ETag")
+
+        starts = range(0, objectSize, objStoreUtil.COPY_PART_SIZE)
+        try:
+            etags = await asyncio.gather(*[
+                copyPart(partNumber, start)
+                for partNumber, start in enumerate(starts, 1)
+            ])
+            parts = "".join(
+                f"<Part><PartNumber>{partNumber}</PartNumber>"
+                f"<ETag>{etag}</ETag></Part>"
+                for partNumber, etag in enumerate(etags, 1)
+            )
+            await self.request(
+                "CompleteMultipartUpload", "POST", destObject,
+                params={"uploadId": uploadId},
+                data=f"<CompleteMultipartUpload>{parts}"
+                     "</CompleteMultipartUpload>".encode("utf-8"),
+            )
+        except Exception:
+            LOGGER.warning(f"aborting multipart copy of {destObject}")
+            await self.request("AbortMultipartUpload", "DELETE", destObject,
+                               params={"uploadId": uploadId})
+            raise
+        LOGGER.debug(f"copied {destObject} in {len(etags)} parts")
+
+    @objStoreMetrics.instrument(getAttributes=objectKey)
+    async def getPublicPermission(self, key, bucket=None):
+        """
+        :return: the permission granted to everyone (AllUsers) on the
+                 object, None if the object isn't public
+        :rtype: str
+        """
+        _, _, body = await self.request("GetObjectAcl", "GET", key,
+                                        params={"acl": ""}, bucket=bucket)
+        permissions = [
+            grant.findtext("Permission")
+            for grant in parseXml(body).iter("Grant")
+            if (grant.findtext("Grantee/URI") or "").lower()
+            == ALL_USERS_URI.lower()
+        ]
+        if len(permissions) > 1:
+            msg = f"expecting a single public permission on {key}, found " + \
+                f"{permissions}"
+            raise ValueError(msg)
+        return permissions[0] if permissions else None
+
+    @objStoreMetrics.instrument(getAttributes=objectKey)
+    async def setPublicPermissions(self, key, bucket=None):
+        await self.request("PutObjectAcl", "PUT", key, params={"acl": ""},
+                           headers={"x-amz-acl": PUBLIC_READ}, bucket=bucket)
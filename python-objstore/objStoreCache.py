@@ -0,0 +1,413 @@
+"""Read through disk cache for objects downloaded from the object store.
+
+Objects are kept in a folder under TMP_FOLDER, one file per object, with a
+sqlite index of the bucket, name, etag, size and last use of each one.  Every
+get sends a conditional GET (If-None-Match with the cached etag), so an
+object that hasn't changed costs a 304 instead of a download, and one that
+has changed is downloaded again and replaces the old copy.  When the cached
+files add up to more than the byte budget the least recently used ones are
+deleted.
+
+The cache can be shared by several processes: a lock per object (striped
+over a fixed number of lock files) stops two processes from downloading the
+same object at the same time, and the index is only changed while holding
+the lock on the whole cache.  That lock is only held for the index updates,
+files are copied and deleted after it is released: a cached file is opened
+while the index is locked so it can still be read if another process evicts
+it, and a hit on an object that was evicted since its entry was read falls
+back to downloading it.  The locks use fcntl, on platforms without it they
+only work within a process.
+
+    cache = objStoreCache.ObjectCache()
+    cache.getObject(objUtil, 'wrf_fileindex.csv', '/tmp/wrf_fileindex.csv')
+"""
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import constants
+import lazyModules
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+botocore = lazyModules.LazyModule("botocore")
+
+# number of lock files the per object locks are spread over
+LOCK_STRIPES = 64
+READ_SIZE = 1024 ** 2
+
+# outcomes of a get, also the names of the statistics
+HIT = "hits"
+MISS = "misses"
+STALE = "stale"
+EVICTED = "evictions"
+BYPASS = "bypassed"
+BYTES_DOWNLOADED = "bytes_downloaded"
+BYTES_SAVED = "bytes_saved"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    bucket TEXT,
+    key TEXT,
+    etag TEXT,
+    size INTEGER,
+    file_name TEXT,
+    last_access REAL,
+    PRIMARY KEY (bucket, key)
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["bucket", "key", "etag", "size", "file_name",
+                   "last_access"]
+)
+
+# the file locks are taken by the threads of a process one at a time, so
+# they still work between threads where fcntl isn't available
+_threadLocks = collections.defaultdict(threading.Lock)
+_threadLocksLock = threading.Lock()
+
+
+@contextlib.contextmanager
+def lockFile(lockPath):
+    """exclusive lock on a file, between threads and processes"""
+    with _threadLocksLock:
+        threadLock = _threadLocks[lockPath]
+    with threadLock, open(lockPath, "a") as fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def isNotModified(err):
+    status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    code = err.response.get("Error", {}).get("Code")
+    return status == 304 or code in ("304", "NotModified")
+
+
+class ObjectCache:
+    def __init__(self, cacheDir=None, maxBytes=None):
+        """[summary]
+
+        :param cacheDir: folder the objects and the index are kept in,
+                         defaults to constants.OBJECT_CACHE_DIR
+        :type cacheDir: str, optional
+        :param maxBytes: most bytes of objects to keep, defaults to
+                         constants.OBJECT_CACHE_BYTES.  Objects larger than
+                         this aren't cached.
+        :type maxBytes: int, optional
+        """
+        if cacheDir is None:
+            cacheDir = constants.OBJECT_CACHE_DIR
+        if maxBytes is None:
+            maxBytes = constants.OBJECT_CACHE_BYTES
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.objectDir = os.path.join(cacheDir, "objects")
+        self.lockDir = os.path.join(cacheDir, "locks")
+        os.makedirs(self.objectDir, exist_ok=True)
+        os.makedirs(self.lockDir, exist_ok=True)
+        self.indexLock = os.path.join(self.lockDir, "index.lock")
+        self.dbFile = os.path.join(cacheDir, "index.sqlite")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.dbFile, timeout=60,
+                                    check_same_thread=False)
+        with lockFile(self.indexLock):
+            self.conn.executescript(SCHEMA)
+        # statistics of this process, the index keeps the totals
+        self.stats = collections.Counter()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def getCacheKey(self, objUtil, bucketName, objectName):
+        bucket = f"{objUtil.objStoreHost}/{bucketName}"
+        digest = hashlib.sha1(
+            f"{bucket}\0{objectName}".encode("utf-8")
+        ).hexdigest()
+        return bucket, digest
+
+    def getEntry(self, bucket, objectName):
+        """
+        :return: the cached entry of an object, None if it isn't cached
+        :rtype: CacheEntry
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT bucket, key, etag, size, file_name, last_access "
+                + "FROM entries WHERE bucket = ? AND key = ?",
+                (bucket, objectName)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(*row)
+        if not os.path.exists(os.path.join(self.objectDir, entry.file_name)):
+            return None
+        return entry
+
+    def getObject(self, objUtil, objectName, localPath, bucketName=None):
+        """copies an object to a local file, from the cache if the object
+        hasn't changed since it was cached, otherwise from the object store
+
+        :param objUtil: the ObjectStoreUtil used to talk to the object store
+        :type objUtil: objStoreUtil.ObjectStoreUtil
+        :param objectName: name of the object
+        :type objectName: str
+        :param localPath: file to copy the object to
+        :type localPath: str
+        :param bucketName: the bucket, defaults to the bucket of objUtil
+        :type bucketName: str, optional
+        :return: how the object was served, HIT, MISS, STALE or BYPASS
+        :rtype: str
+        """
+        if not bucketName:
+            bucketName = objUtil.objStoreBucket
+        bucket, digest = self.getCacheKey(objUtil, bucketName, objectName)
+        stripe = int(digest[:8], 16) % LOCK_STRIPES
+        with lockFile(os.path.join(self.lockDir, f"{stripe}.lock")):
+            entry = self.getEntry(bucket, objectName)
+            objUtil.createBotoClient()
+            resp = None
+            if entry is not None:
+                try:
+                    resp = objUtil.botoClient.get_object(
+                        Bucket=bucketName, Key=objectName,
+                        IfNoneMatch=f'"{entry.etag}"'
+                    )
+                except botocore.exceptions.ClientError as err:
+                    if not isNotModified(err):
+                        raise
+                    if self.copyCached(bucket, objectName, entry, localPath):
+                        self.recordStats({HIT: 1, BYTES_SAVED: entry.size})
+                        LOGGER.debug(
+                            f"{objectName} unchanged, served from the cache")
+                        return HIT
+                    LOGGER.debug(f"{objectName} was evicted by another "
+                                 + "process, downloading it")
+                    entry = None
+            if resp is None:
+                resp = objUtil.botoClient.get_object(
+                    Bucket=bucketName, Key=objectName
+                )
+
+            outcome = MISS if entry is None else STALE
+            etag = resp["ETag"].strip('"')
+            size = resp["ContentLength"]
+            if size > self.maxBytes:
+                # too big to keep, goes straight to the local file
+                self.writeBody(resp["Body"], localPath)
+                self.recordStats({BYPASS: 1, BYTES_DOWNLOADED: size})
+                return BYPASS
+            fileName = f"{digest}.{hashlib.sha1(etag.encode()).hexdigest()}"
+            tmpPath = self.writeBody(resp["Body"])
+            try:
+                with open(tmpPath, "rb") as fh:
+                    self.copyToLocal(fh, localPath)
+            except Exception:
+                os.remove(tmpPath)
+                raise
+            with lockFile(self.indexLock), self.lock:
+                os.replace(tmpPath, os.path.join(self.objectDir, fileName))
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO entries (bucket, key, etag, "
+                        + "size, file_name, last_access) "
+                        + "VALUES (?, ?, ?, ?, ?, ?)",
+                        (bucket, objectName, etag, size, fileName,
+                         time.time())
+                    )
+                removed = self.evict()
+            if entry is not None and entry.file_name != fileName:
+                removed.append(entry.file_name)
+            for removedFile in removed:
+                self.removeFile(removedFile)
+            self.recordStats({outcome: 1, BYTES_DOWNLOADED: size})
+            LOGGER.debug(f"{objectName} {outcome}, downloaded {size} bytes")
+            return outcome
+
+    def writeBody(self, body, path=None):
+        """writes a response body to path, or to a new temp file in the
+        cache folder
+
+        :return: the path of the file
+        :rtype: str
+        """
+        if path is None:
+            fd, path = tempfile.mkstemp(dir=self.objectDir, suffix=".tmp")
+            fh = os.fdopen(fd, "wb")
+        else:
+            fh = open(path, "wb")
+        try:
+            with fh:
+                for chunk in body.iter_chunks(READ_SIZE):
+                    fh.write(chunk)
+        except Exception:
+            os.remove(path)
+            raise
+        finally:
+            body.close()
+        return path
+
+    def copyCached(self, bucket, objectName, entry, localPath):
+        """copies a cached object to a local file and marks it as used.  The
+        index is locked to update the entry and open the file, the copy is
+        made after it is unlocked.
+
+        :param entry: the entry of the object
+        :type entry: CacheEntry
+        :return: false if the object was evicted since the entry was read
+        :rtype: bool
+        """
+        with lockFile(self.indexLock), self.lock:
+            with self.conn:
+                updated = self.conn.execute(
+                    "UPDATE entries SET last_access = ? "
+                    + "WHERE bucket = ? AND key = ? AND file_name = ?",
+                    (time.time(), bucket, objectName, entry.file_name)
+                ).rowcount
+            if not updated:
+                return False
+            try:
+                fh = open(os.path.join(self.objectDir, entry.file_name),
+                          "rb")
+            except FileNotFoundError:
+                return False
+        with fh:
+            self.copyToLocal(fh, localPath)
+        return True
+
+    def copyToLocal(self, fh, localPath):
+        """
+        :param fh: the cached file, open for reading
+        :type fh: io.BufferedReader
+        :param localPath: file to copy it to
+        :type localPath: str
+        """
+        localDir = os.path.dirname(localPath)
+        if localDir:
+            os.makedirs(localDir, exist_ok=True)
+        tmpPath = localPath + ".part"
+        with open(tmpPath, "wb") as out:
+            shutil.copyfileobj(fh, out, READ_SIZE)
+        os.replace(tmpPath, localPath)
+
+    def removeFile(self, fileName):
+        try:
+            os.remove(os.path.join(self.objectDir, fileName))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """removes the least recently used objects from the index until the
+        cache is under its byte budget, called with the index locked
+
+        :return: the files of the evicted objects, for the caller to delete
+                 once the index is unlocked
+        :rtype: list
+        """
+        totalBytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if totalBytes <= self.maxBytes:
+            return []
+        evicted = []
+        fileNames = []
+        for bucket, key, size, fileName in self.conn.execute(
+            "SELECT bucket, key, size, file_name FROM entries "
+            + "ORDER BY last_access"
+        ).fetchall():
+            if totalBytes <= self.maxBytes:
+                break
+            evicted.append((bucket, key))
+            fileNames.append(fileName)
+            totalBytes -= size
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM entries WHERE bucket = ? AND key = ?", evicted)
+        self.stats[EVICTED] += len(evicted)
+        self.addTotals({EVICTED: len(evicted)})
+        LOGGER.debug(f"evicted {len(evicted)} objects from the cache")
+        return fileNames
+
+    def recordStats(self, counts):
+        with lockFile(self.indexLock), self.lock:
+            self.stats.update(counts)
+            self.addTotals(counts)
+
+    def addTotals(self, counts):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                + "ON CONFLICT (name) DO UPDATE SET value = value + ?",
+                [(name, value, value) for name, value in counts.items()]
+            )
+
+    def getStats(self):
+        """
+        :return: the statistics of this process, the totals of every process
+                 that has used the cache, and the number of objects and
+                 bytes in it
+        :rtype: dict
+        """
+        with self.lock:
+            totals = dict(self.conn.execute("SELECT name, value FROM stats"))
+            numObjects, numBytes = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {
+            "process": dict(self.stats),
+            "totals": totals,
+            "objects": numObjects,
+            "bytes": numBytes,
+            "max_bytes": self.maxBytes,
+        }
+
+    def clear(self):
+        """deletes every object in the cache"""
+        with lockFile(self.indexLock), self.lock:
+            for (fileName,) in self.conn.execute(
+                "SELECT file_name FROM entries"
+            ).fetchall():
+                self.removeFile(fileName)
+            with self.conn:
+                self.conn.execute("DELETE FROM entries")
+
+
+if __name__ == '__main__':
+    import json
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='shows the statistics of the object cache, or empties it')
+    parser.add_argument('command', choices=['stats', 'clear'])
+    args = parser.parse_args()
+
+    cache = ObjectCache()
+    if args.command == 'clear':
+        cache.clear()
+    print(json.dumps(cache.getStats(), indent=2))
@@ -0,0 +1,211 @@
+"""Shared, thread safe minio and boto3 clients.
+
+Clients are created the first time they are asked for and are then shared by
+every ObjectStoreUtil that uses the same host and credentials, so all the
+threads of a run reuse the same connection pools.  The pools are sized with
+setPoolSize, which should be called with the number of worker threads before
+any clients are created, otherwise threads end up opening connections that
+get discarded ("connection pool is full, discarding connection").
+
+The connection pools count the requests they send and the connections they
+open, getStats returns those counts so connection reuse can be checked.
+"""
+
+import collections
+import datetime
+import logging
+import os
+import threading
+
+import lazyModules
+
+LOGGER = logging.getLogger(__name__)
+
+# the sdks are imported the first time a client is created
+boto3 = lazyModules.LazyModule("boto3")
+botocore = lazyModules.LazyModule("botocore")
+certifi = lazyModules.LazyModule("certifi")
+minio = lazyModules.LazyModule("minio")
+urllib3 = lazyModules.LazyModule("urllib3")
+
+DEFAULT_POOL_SIZE = 10
+# minio's own defaults for its http client
+MINIO_TIMEOUT = datetime.timedelta(minutes=5).seconds
+MINIO_RETRIES = 5
+
+_lock = threading.Lock()
+_poolSize = DEFAULT_POOL_SIZE
+_minioClients = {}
+_botoClients = {}
+_countingPoolClasses = {}
+_stats = collections.defaultdict(collections.Counter)
+
+
+def setPoolSize(poolSize):
+    """sets the number of connections kept open to each host, should be at
+    least the number of threads that use the clients.  Only applies to
+    clients created after it is called.
+
+    :param poolSize: max number of connections per host
+    :type poolSize: int
+    """
+    global _poolSize
+    with _lock:
+        if (_minioClients or _botoClients) and poolSize != _poolSize:
+            LOGGER.warning(
+                "pool size changed after clients were created, existing "
+                + "clients keep their old pool size"
+            )
+        _poolSize = poolSize
+
+
+def getPoolSize():
+    return _poolSize
+
+
+def _recordStat(clientType, statName):
+    with _lock:
+        _stats[clientType][statName] += 1
+
+
+def getStats():
+    """
+    :return: dict of client type ('minio' or 'boto') to a dict with the
+             number of requests sent, the number of connections opened and
+             the number of requests that reused an open connection
+    :rtype: dict
+    """
+    with _lock:
+        stats = {}
+        for clientType, counter in _stats.items():
+            stats[clientType] = {
+                "requests": counter["requests"],
+                "connections": counter["connections"],
+                "reused": max(0, counter["requests"] - counter["connections"]),
+            }
+        return stats
+
+
+def _getCountingPoolClass(baseClass, clientType):
+    """creates (once) a subclass of a urllib3 connection pool class that
+    counts the requests sent and connections opened through it
+
+    :param baseClass: the connection pool class to extend
+    :type baseClass: urllib3.HTTPConnectionPool
+    :param clientType: name the counts are recorded under
+    :type clientType: str
+    :return: the counting connection pool class
+    :rtype: type
+    """
+    key = (baseClass, clientType)
+    if key not in _countingPoolClasses:
+
+        class CountingConnectionPool(baseClass):
+            def _new_conn(self):
+                _recordStat(clientType, "connections")
+                return super()._new_conn()
+
+            def urlopen(self, *args, **kwargs):
+                _recordStat(clientType, "requests")
+                return super().urlopen(*args, **kwargs)
+
+        _countingPoolClasses[key] = CountingConnectionPool
+    return _countingPoolClasses[key]
+
+
+def _countConnections(poolManager, clientType):
+    """swaps the connection pool classes of a pool manager for ones that
+    count requests and connections
+
+    :param poolManager: the pool manager used by a client
+    :type poolManager: urllib3.PoolManager
+    :param clientType: name the counts are recorded under
+    :type clientType: str
+    """
+    poolManager.pool_classes_by_scheme = {
+        scheme: _getCountingPoolClass(poolClass, clientType)
+        for scheme, poolClass in poolManager.pool_classes_by_scheme.items()
+    }
+
+
+def getMinioClient(host, user, secret, secure=True):
+    """gets the shared minio client for a host and set of credentials,
+    creating it if it doesn't exist
+
+    :param host: object store host
+    :type host: str
+    :param user: access key id
+    :type user: str
+    :param secret: secret access key
+    :type secret: str
+    :param secure: use https
+    :type secure: bool, optional
+    :return: the minio client
+    :rtype: minio.Minio
+    """
+    key = (host, user, secret, secure)
+    with _lock:
+        if key not in _minioClients:
+            LOGGER.debug(
+                f"creating minio client for {host}, pool size: {_poolSize}"
+            )
+            httpClient = urllib3.PoolManager(
+                timeout=urllib3.util.Timeout(
+                    connect=MINIO_TIMEOUT, read=MINIO_TIMEOUT
+                ),
+                maxsize=_poolSize,
+                cert_reqs="CERT_REQUIRED",
+                ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+                retries=urllib3.Retry(
+                    total=MINIO_RETRIES,
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+            )
+            _countConnections(httpClient, "minio")
+            _minioClients[key] = minio.Minio(
+                host, user, secret, secure=secure, http_client=httpClient
+            )
+        return _minioClients[key]
+
+
+def getBotoClient(host, user, secret, secure=True):
+    """gets the shared boto3 s3 client for a host and set of credentials,
+    creating it if it doesn't exist.  boto3 clients are thread safe once
+    they are created, but creating them isn't, so creation is done under a
+    lock.
+
+    :param host: object store host
+    :type host: str
+    :param user: access key id
+    :type user: str
+    :param secret: secret access key
+    :type secret: str
+    :param secure: use https
+    :type secure: bool, optional
+    :return: the boto3 client
+    :rtype: botocore.client.S3
+    """
+    key = (host, user, secret, secure)
+    with _lock:
+        if key not in _botoClients:
+            LOGGER.debug(
+                f"creating boto client for {host}, pool size: {_poolSize}"
+            )
+            scheme = "https" if secure else "http"
+            session = boto3.session.Session()
+            client = session.client(
+                service_name="s3",
+                aws_access_key_id=user,
+                aws_secret_access_key=secret,
+                endpoint_url=f"{scheme}://{host}",
+                config=botocore.config.Config(max_pool_connections=_poolSize),
+            )
+            # boto doesn't expose its pool manager, if the internals change
+            # the client still works, it just isn't counted
+            httpSession = getattr(client._endpoint, "http_session", None)
+            poolManager = getattr(httpSession, "_manager", None)
+            if poolManager is not None:
+                _countConnections(poolManager, "boto")
+            _botoClients[key] = client
+        return _botoClients[key]
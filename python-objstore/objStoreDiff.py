@@ -0,0 +1,252 @@
+"""Compares the contents of a source and destination bucket.
+
+The key space is split into ranges (shards) and each shard of each bucket is
+listed on its own thread.  As soon as both sides of a shard have been listed
+the two sorted listings are merged to find the differences, and the results
+are handed to the caller, so transfers can start while the rest of the
+buckets are still being listed.
+
+The listings of a shard are held in a compactKeys.CompactKeySet until it is
+diffed, and only a few more shards than there are listing threads are listed
+ahead of the one being diffed, so memory doesn't grow with the size of the
+buckets.
+"""
+
+import collections
+import concurrent.futures
+import logging
+
+import compactKeys
+
+LOGGER = logging.getLogger(__name__)
+
+# object is in the source bucket but not in the destination
+NEW = "new"
+# object is in the destination bucket but not in the source
+MISSING = "missing"
+# object is in both buckets but the size or etag differ
+MISMATCH = "mismatch"
+
+# WRF object names start with the I coordinate of the tile, for example:
+# x002y012x011y021.201901.10x10.m3d.7z.  Splitting on the first two digits of
+# that coordinate gives shards of roughly the same size.  Objects that do not
+# follow that pattern end up in the first or the last shard.
+DEFAULT_SHARD_BOUNDARIES = [f"x{i:02d}" for i in range(48)]
+
+DEFAULT_LIST_WORKERS = 8
+
+DiffEntry = collections.namedtuple(
+    "DiffEntry", ["key", "status", "size", "etag"]
+)
+
+
+def getKeyRanges(boundaries=None):
+    """converts a sorted list of boundary keys into the key ranges that
+    cover the whole bucket.  Each range is a tuple of (startAfter, endKey)
+    and includes the keys where startAfter < key <= endKey, None is used for
+    the open ends of the first and the last range.
+
+    :param boundaries: sorted list of keys to split the bucket on, defaults
+                       to DEFAULT_SHARD_BOUNDARIES
+    :type boundaries: list, optional
+    :return: list of (startAfter, endKey) tuples
+    :rtype: list
+    """
+    if boundaries is None:
+        boundaries = DEFAULT_SHARD_BOUNDARIES
+    edges = [None] + sorted(boundaries) + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def clipKeyRanges(keyRanges, keyRange):
+    """limits a list of key ranges to the parts of them that fall inside
+    another key range
+
+    :param keyRanges: list of (startAfter, endKey) tuples
+    :type keyRanges: list
+    :param keyRange: the (startAfter, endKey) range to clip them to, None
+                     for either end means no limit
+    :type keyRange: tuple
+    :return: the clipped ranges, ranges that fall outside keyRange are
+             dropped
+    :rtype: list
+    """
+    clipStart, clipEnd = keyRange
+    clipped = []
+    for startAfter, endKey in keyRanges:
+        if clipStart is not None and (startAfter is None
+                                      or startAfter < clipStart):
+            startAfter = clipStart
+        if clipEnd is not None and (endKey is None or endKey > clipEnd):
+            endKey = clipEnd
+        if startAfter is None or endKey is None or startAfter < endKey:
+            clipped.append((startAfter, endKey))
+    return clipped
+
+
+def normalizeEtag(etag):
+    """strips the quotes that some of the api's leave on the etag
+
+    :param etag: input etag
+    :type etag: str
+    :return: the etag without quotes
+    :rtype: str
+    """
+    if etag is None:
+        return None
+    return etag.strip('"')
+
+
+def isMultipartEtag(etag):
+    """multipart uploads get an etag in the format <md5>-<number of parts>,
+    these can't be compared with the md5 etag of an object that was uploaded
+    in a single request
+
+    :param etag: the etag to check
+    :type etag: str
+    :return: true if the etag belongs to a multipart upload
+    :rtype: bool
+    """
+    return etag is not None and "-" in etag
+
+
+class BucketDiff:
+    def __init__(self, srcLister, destLister, boundaries=None,
+                 maxWorkers=DEFAULT_LIST_WORKERS, keyRange=None):
+        """[summary]
+
+        :param srcLister: object that provides the listing of the source
+                          bucket, needs to provide a listObjectRange method,
+                          for example objStoreUtil.ObjectStoreUtil
+        :type srcLister: objStoreUtil.ObjectStoreUtil
+        :param destLister: object that provides the listing of the
+                           destination bucket
+        :type destLister: objStoreUtil.ObjectStoreUtil
+        :param boundaries: keys used to split the buckets into shards,
+                           defaults to DEFAULT_SHARD_BOUNDARIES
+        :type boundaries: list, optional
+        :param maxWorkers: number of threads used to list the shards
+        :type maxWorkers: int, optional
+        :param keyRange: only diff the keys in this (startAfter, endKey)
+                         range, defaults to the whole bucket
+        :type keyRange: tuple, optional
+        """
+        self.srcLister = srcLister
+        self.destLister = destLister
+        self.keyRanges = getKeyRanges(boundaries)
+        if keyRange is not None:
+            self.keyRanges = clipKeyRanges(self.keyRanges, keyRange)
+        self.maxWorkers = maxWorkers
+        # shards listed ahead of the ones being diffed
+        self.maxPending = maxWorkers
+        self.counts = collections.Counter()
+
+    def listRange(self, lister, keyRange):
+        """lists the objects in a key range into a compact key set
+
+        :param lister: the object used to list the bucket
+        :type lister: objStoreUtil.ObjectStoreUtil
+        :param keyRange: tuple of (startAfter, endKey)
+        :type keyRange: tuple
+        :return: the objects in the range, sorted by name
+        :rtype: compactKeys.CompactKeySet
+        """
+        return compactKeys.CompactKeySet.fromRecords(
+            lister.listObjectRange(*keyRange))
+
+    def diffShard(self, srcObjects, destObjects):
+        """compares the listings of the same shard from the two buckets by
+        walking both of them in name order
+
+        :param srcObjects: source listing as returned by listRange, or any
+                           records sorted by name
+        :type srcObjects: compactKeys.CompactKeySet
+        :param destObjects: destination listing as returned by listRange
+        :type destObjects: compactKeys.CompactKeySet
+        :yield: a DiffEntry for every object that is not the same in both
+                buckets
+        :rtype: DiffEntry
+        """
+        if isinstance(srcObjects, compactKeys.CompactKeySet):
+            srcObjects = srcObjects.records()
+        if isinstance(destObjects, compactKeys.CompactKeySet):
+            destObjects = destObjects.records()
+        srcObjects = iter(srcObjects)
+        destObjects = iter(destObjects)
+        src = next(srcObjects, None)
+        dest = next(destObjects, None)
+        while src is not None or dest is not None:
+            if dest is None or (src is not None
+                                and src.object_name < dest.object_name):
+                yield DiffEntry(src.object_name, NEW, src.size,
+                                normalizeEtag(src.etag))
+                src = next(srcObjects, None)
+            elif src is None or dest.object_name < src.object_name:
+                yield DiffEntry(dest.object_name, MISSING, dest.size,
+                                normalizeEtag(dest.etag))
+                dest = next(destObjects, None)
+            else:
+                etag = normalizeEtag(src.etag)
+                destEtag = normalizeEtag(dest.etag)
+                if src.size != dest.size:
+                    yield DiffEntry(src.object_name, MISMATCH, src.size,
+                                    etag)
+                elif (
+                    etag != destEtag
+                    and not isMultipartEtag(etag)
+                    and not isMultipartEtag(destEtag)
+                ):
+                    yield DiffEntry(src.object_name, MISMATCH, src.size,
+                                    etag)
+                src = next(srcObjects, None)
+                dest = next(destObjects, None)
+
+    def iterDiff(self, statuses=None):
+        """lists both buckets one shard at a time on a pool of threads and
+        yields the differences for each shard as soon as both sides of it
+        have been listed.  At most maxPending shards are listed ahead of
+        the ones being diffed.
+
+        :param statuses: the statuses to return, defaults to all of them
+        :type statuses: list, optional
+        :yield: the objects that differ between the buckets
+        :rtype: DiffEntry
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.maxWorkers
+        ) as executor:
+            keyRanges = iter(self.keyRanges)
+            futures = {}
+
+            def submitShard():
+                keyRange = next(keyRanges, None)
+                if keyRange is None:
+                    return
+                for side, lister in (("src", self.srcLister),
+                                     ("dest", self.destLister)):
+                    fut = executor.submit(self.listRange, lister, keyRange)
+                    futures[fut] = (keyRange, side)
+
+            for _ in range(max(1, self.maxPending)):
+                submitShard()
+            listed = {}
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                fut = done.pop()
+                keyRange, side = futures.pop(fut)
+                shard = listed.setdefault(keyRange, {})
+                shard[side] = fut.result()
+                if len(shard) < 2:
+                    continue
+                del listed[keyRange]
+                submitShard()
+                LOGGER.debug(
+                    f"diffing shard {keyRange}, source objects: "
+                    + f"{len(shard['src'])}, destination objects: "
+                    + f"{len(shard['dest'])}"
+                )
+                for entry in self.diffShard(shard["src"], shard["dest"]):
+                    self.counts[entry.status] += 1
+                    if statuses is None or entry.status in statuses:
+                        yield entry
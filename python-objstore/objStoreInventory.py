@@ -0,0 +1,447 @@
+"""Keeps a local inventory of the objects in a bucket.
+
+The inventory is a sqlite database in the tmp folder that holds the name,
+size, etag and last modified time of every object in a bucket.  The bucket
+is split into the same key ranges (shards) that are used by objStoreDiff,
+and each shard remembers when it was last listed.  Only shards that are
+older than the time to live get listed again, and each shard is committed
+as soon as it is listed, so a run that is restarted after a crash only has
+to list the shards that it didn't get to.
+
+Refreshes are incremental in what they write, not in what they list: a
+stale shard is always listed in full, and only when its newest last
+modified time or number of objects changed are its rows in the database
+replaced.  S3 can't say which keys changed without listing them, and a
+listing that started from the last known key of a shard would miss the
+WRF files added in the middle of it (the names start with the tile, not
+the date), as well as overwrites and deletes.
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import constants
+import objStoreDiff
+
+LOGGER = logging.getLogger(__name__)
+
+# rows read from the database at a time when listing, so listing a range
+# doesn't hold the whole range in memory
+LIST_PAGE_SIZE = 1000
+
+InventoryRecord = collections.namedtuple(
+    "InventoryRecord", ["object_name", "size", "etag", "last_modified"]
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER,
+    etag TEXT,
+    last_modified REAL,
+    public INTEGER
+);
+CREATE TABLE IF NOT EXISTS shards (
+    start_after TEXT,
+    end_key TEXT,
+    refreshed REAL,
+    newest REAL,
+    object_count INTEGER,
+    PRIMARY KEY (start_after, end_key)
+);
+"""
+
+
+def rangeWhereClause(startAfter, endKey):
+    """builds the sql where clause that selects the objects in a key range
+
+    :param startAfter: start of the range (exclusive), None for no limit
+    :type startAfter: str
+    :param endKey: end of the range (inclusive), None for no limit
+    :type endKey: str
+    :return: tuple with the where clause and the parameters for it
+    :rtype: tuple
+    """
+    clauses = []
+    params = []
+    if startAfter is not None:
+        clauses.append("key > ?")
+        params.append(startAfter)
+    if endKey is not None:
+        clauses.append("key <= ?")
+        params.append(endKey)
+    if not clauses:
+        return "", params
+    return "WHERE " + " AND ".join(clauses), params
+
+
+def rangesOverlap(range1, range2):
+    """checks if two (startAfter, endKey) key ranges share any keys
+
+    :return: true if the ranges overlap
+    :rtype: bool
+    """
+    start1, end1 = range1
+    start2, end2 = range2
+    startsBefore = start1 is None or end2 is None or start1 < end2
+    endsAfter = end1 is None or start2 is None or end1 > start2
+    return startsBefore and endsAfter
+
+
+class BucketInventory:
+    def __init__(self, objStoreUtil, dbFolder=None, ttl=None,
+                 boundaries=None):
+        """[summary]
+
+        :param objStoreUtil: used to list the bucket when a shard of the
+                             inventory is stale
+        :type objStoreUtil: objStoreUtil.ObjectStoreUtil
+        :param dbFolder: folder where the sqlite database is kept, defaults
+                         to the tmp folder of the objStoreUtil
+        :type dbFolder: str, optional
+        :param ttl: number of seconds before a shard is listed again,
+                    defaults to constants.INVENTORY_TTL
+        :type ttl: int, optional
+        :param boundaries: keys used to split the bucket into shards,
+                           defaults to objStoreDiff.DEFAULT_SHARD_BOUNDARIES
+        :type boundaries: list, optional
+        """
+        self.objStoreUtil = objStoreUtil
+        self.bucket = objStoreUtil.objStoreBucket
+        if dbFolder is None:
+            dbFolder = objStoreUtil.tmpfolder
+        self.ttl = ttl
+        if self.ttl is None:
+            self.ttl = constants.INVENTORY_TTL
+        self.keyRanges = objStoreDiff.getKeyRanges(boundaries)
+
+        self.dbFile = os.path.join(
+            dbFolder, f"inventory_{self.bucket}.sqlite"
+        )
+        LOGGER.debug(f"inventory database: {self.dbFile}")
+        # the connection is shared by the listing threads, the lock
+        # serializes access to it
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.dbFile, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.upgradeSchema()
+
+    def upgradeSchema(self):
+        """adds any columns that are missing from databases created by older
+        versions of this module
+        """
+        columns = [
+            row[1] for row in self.conn.execute("PRAGMA table_info(objects)")
+        ]
+        if "public" not in columns:
+            LOGGER.info(f"adding the public column to {self.dbFile}")
+            with self.conn:
+                self.conn.execute(
+                    "ALTER TABLE objects ADD COLUMN public INTEGER"
+                )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def getShard(self, keyRange):
+        """returns the stored state of a shard
+
+        :param keyRange: tuple of (startAfter, endKey)
+        :type keyRange: tuple
+        :return: tuple of (refreshed, newest, object_count) or None if the
+                 shard has never been listed
+        :rtype: tuple
+        """
+        startAfter, endKey = keyRange
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT refreshed, newest, object_count FROM shards "
+                + "WHERE start_after = ? AND end_key = ?",
+                (startAfter or "", endKey or ""),
+            )
+            return cur.fetchone()
+
+    def isStale(self, keyRange, maxAge=None):
+        """checks to see if a shard needs to be listed again
+
+        :param keyRange: tuple of (startAfter, endKey)
+        :type keyRange: tuple
+        :param maxAge: age in seconds after which the shard is stale,
+                       defaults to the ttl of the inventory
+        :type maxAge: int, optional
+        :return: true if the shard has to be listed again
+        :rtype: bool
+        """
+        if maxAge is None:
+            maxAge = self.ttl
+        shard = self.getShard(keyRange)
+        return shard is None or (time.time() - shard[0]) > maxAge
+
+    def refreshShard(self, keyRange):
+        """lists all the objects in a shard and replaces the contents of the
+        shard in the inventory with them, unless its newest last modified
+        time and number of objects are the ones already stored.  The listing
+        happens outside of the database lock so several shards can be listed
+        at the same time.
+
+        :param keyRange: tuple of (startAfter, endKey)
+        :type keyRange: tuple
+        :return: true if the newest object or number of objects in the
+                 shard changed
+        :rtype: bool
+        """
+        rows = []
+        newest = 0
+        for obj in self.objStoreUtil.listObjectRange(*keyRange):
+            lastModified = obj.last_modified.timestamp()
+            newest = max(newest, lastModified)
+            rows.append((
+                obj.object_name,
+                obj.size,
+                objStoreDiff.normalizeEtag(obj.etag),
+                lastModified,
+            ))
+
+        startAfter, endKey = keyRange
+        where, params = rangeWhereClause(startAfter, endKey)
+        publicWhere = "WHERE public = 1"
+        if where:
+            publicWhere = where + " AND public = 1"
+        with self.lock:
+            previous = self.getShard(keyRange)
+            if previous is not None and previous[1:] == (newest, len(rows)):
+                # nothing was added or overwritten, new objects always get
+                # a newer last modified time, so only the time the shard
+                # was listed needs updating
+                with self.conn:
+                    self.conn.execute(
+                        "UPDATE shards SET refreshed = ? "
+                        + "WHERE start_after = ? AND end_key = ?",
+                        (time.time(), startAfter or "", endKey or ""),
+                    )
+                LOGGER.debug(f"shard {keyRange} of {self.bucket} unchanged")
+                return False
+            # objects that are known to be public stay public as long as they
+            # haven't been overwritten (ie the etag is the same)
+            publicObjects = set(self.conn.execute(
+                f"SELECT key, etag FROM objects {publicWhere}", params
+            ).fetchall())
+            rows = [
+                row + (1 if (row[0], row[2]) in publicObjects else None,)
+                for row in rows
+            ]
+            with self.conn:
+                self.conn.execute(f"DELETE FROM objects {where}", params)
+                self.conn.executemany(
+                    "INSERT INTO objects "
+                    + "(key, size, etag, last_modified, public) "
+                    + "VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO shards (start_after, end_key, "
+                    + "refreshed, newest, object_count) "
+                    + "VALUES (?, ?, ?, ?, ?)",
+                    (startAfter or "", endKey or "", time.time(), newest,
+                     len(rows)),
+                )
+        LOGGER.debug(
+            f"refreshed shard {keyRange} of {self.bucket}: {len(rows)} objects"
+        )
+        return previous is None or previous[1:] != (newest, len(rows))
+
+    def refresh(self, maxAge=None, force=False):
+        """lists any of the shards that are stale
+
+        :param maxAge: age in seconds after which a shard is stale, defaults
+                       to the ttl of the inventory
+        :type maxAge: int, optional
+        :param force: list every shard regardless of its age
+        :type force: bool, optional
+        :return: the key ranges of the shards that changed
+        :rtype: list
+        """
+        changed = []
+        for keyRange in self.keyRanges:
+            if force or self.isStale(keyRange, maxAge):
+                if self.refreshShard(keyRange):
+                    changed.append(keyRange)
+        LOGGER.info(
+            f"inventory of {self.bucket}, changed shards: {len(changed)}"
+        )
+        return changed
+
+    def evict(self, maxAge):
+        """removes the shards and their objects that have not been listed
+        for longer than maxAge seconds, they will be listed again the next
+        time they are used
+
+        :param maxAge: age in seconds
+        :type maxAge: int
+        """
+        for keyRange in self.keyRanges:
+            shard = self.getShard(keyRange)
+            if shard is None or (time.time() - shard[0]) <= maxAge:
+                continue
+            where, params = rangeWhereClause(*keyRange)
+            with self.lock:
+                with self.conn:
+                    self.conn.execute(f"DELETE FROM objects {where}", params)
+                    self.conn.execute(
+                        "DELETE FROM shards "
+                        + "WHERE start_after = ? AND end_key = ?",
+                        (keyRange[0] or "", keyRange[1] or ""),
+                    )
+        with self.lock:
+            self.conn.execute("VACUUM")
+
+    def listObjectRange(self, startAfter=None, endKey=None):
+        """lists the objects in the inventory whose names fall in the range
+        startAfter < name <= endKey, any stale shards that overlap the range
+        are listed from the bucket first.  Has the same signature as
+        ObjectStoreUtil.listObjectRange so it can be used by the diff.
+
+        :param startAfter: start of the range (exclusive)
+        :type startAfter: str, optional
+        :param endKey: end of the range (inclusive)
+        :type endKey: str, optional
+        :yield: records describing the objects
+        :rtype: InventoryRecord
+        """
+        for keyRange in self.keyRanges:
+            if rangesOverlap(keyRange, (startAfter, endKey)) and \
+                    self.isStale(keyRange):
+                self.refreshShard(keyRange)
+
+        yield from self.iterRecords(startAfter, endKey)
+
+    def iterRecords(self, startAfter=None, endKey=None, condition=None):
+        """reads the objects in a key range from the database a page at a
+        time, each page starts after the last key of the one before so the
+        lock isn't held between pages
+
+        :param condition: extra sql condition the objects have to match
+        :type condition: str, optional
+        :yield: records describing the objects
+        :rtype: InventoryRecord
+        """
+        lastKey = startAfter
+        while True:
+            where, params = rangeWhereClause(lastKey, endKey)
+            if condition:
+                where = f"{where} AND {condition}" if where \
+                    else f"WHERE {condition}"
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT key, size, etag, last_modified FROM objects "
+                    + f"{where} ORDER BY key LIMIT ?",
+                    params + [LIST_PAGE_SIZE],
+                ).fetchall()
+            for row in rows:
+                yield InventoryRecord(*row)
+            if len(rows) < LIST_PAGE_SIZE:
+                return
+            lastKey = rows[-1][0]
+
+    def getObject(self, objectName):
+        """gets the inventory record of a single object
+
+        :param objectName: name of the object
+        :type objectName: str
+        :return: the record or None if the object is not in the inventory
+        :rtype: InventoryRecord
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT key, size, etag, last_modified FROM objects "
+                + "WHERE key = ?",
+                (objectName,),
+            ).fetchone()
+        if row is None:
+            return None
+        return InventoryRecord(*row)
+
+    def listNotPublic(self):
+        """lists the objects in the inventory that are not known to be
+        public, refreshing any stale shards first
+
+        :yield: records describing the objects
+        :rtype: InventoryRecord
+        """
+        for keyRange in self.keyRanges:
+            if self.isStale(keyRange):
+                self.refreshShard(keyRange)
+        yield from self.iterRecords(condition="public IS NOT 1")
+
+    def isPublic(self, objectName):
+        """
+        :param objectName: name of the object
+        :type objectName: str
+        :return: true if the object is known to be public
+        :rtype: bool
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT public FROM objects WHERE key = ?", (objectName,)
+            ).fetchone()
+        return row is not None and row[0] == 1
+
+    def markPublic(self, objectNames):
+        """records that objects have been made public
+
+        :param objectNames: names of the objects
+        :type objectNames: list
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE objects SET public = 1 WHERE key = ?",
+                    [(objectName,) for objectName in objectNames],
+                )
+
+    def removeObjects(self, objectNames):
+        """removes objects that we deleted from the bucket ourselves
+
+        :param objectNames: names of the objects
+        :type objectNames: list
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM objects WHERE key = ?",
+                    [(objectName,) for objectName in objectNames],
+                )
+
+    def recordObject(self, objectName, size, etag, lastModified=None,
+                     public=False):
+        """adds or updates an object in the inventory, used to keep the
+        inventory of a bucket current when we write to it ourselves
+
+        :param objectName: name of the object
+        :type objectName: str
+        :param size: size of the object in bytes
+        :type size: int
+        :param etag: etag of the object
+        :type etag: str
+        :param lastModified: last modified time in seconds since the epoch,
+                             defaults to now
+        :type lastModified: float, optional
+        :param public: whether the object was made public
+        :type public: bool, optional
+        """
+        if lastModified is None:
+            lastModified = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO objects "
+                    + "(key, size, etag, last_modified, public) "
+                    + "VALUES (?, ?, ?, ?, ?)",
+                    (objectName, size, objStoreDiff.normalizeEtag(etag),
+                     lastModified, 1 if public else None),
+                )
@@ -0,0 +1,443 @@
+"""Metrics for the calls that ObjectStoreUtil makes to the object store.
+
+Every instrumented call records the number of calls by outcome, the bytes
+moved, a latency histogram and the class of any error.  Retries and
+throttling that boto handles itself are picked up from the boto client's
+events.  The metrics can be served in the prometheus text format (and as
+json) over http, or written to a json file on an interval:
+
+    objStoreMetrics.startHttpServer(9100)
+    objStoreMetrics.startSnapshots('/data/metrics.json', 60)
+
+If the opentelemetry api is installed each call is also wrapped in a span.
+"""
+
+import collections
+import functools
+import http.server
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import types
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+LOGGER = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, float("inf")]
+
+OK = "ok"
+ERROR = "error"
+
+
+def getErrorClass(err):
+    """describes an exception by its class and, for object store errors,
+    the error code, for example ClientError:SlowDown
+
+    :rtype: str
+    """
+    errorClass = type(err).__name__
+    code = getattr(err, "code", None)
+    response = getattr(err, "response", None)
+    if code is None and isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+    if code:
+        errorClass += f":{code}"
+    return errorClass
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.bytes = collections.Counter()
+        self.items = collections.Counter()
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.throttled = collections.Counter()
+        # operation: [count per bucket, sum of latencies]
+        self.latencies = {}
+        self.started = time.time()
+
+    def recordCall(self, operation, latency, numBytes=0, numItems=0,
+                   error=None):
+        """records a call to the object store
+
+        :param operation: name of the call, usually the method name
+        :type operation: str
+        :param latency: seconds the call took
+        :type latency: float
+        :param numBytes: bytes sent or received
+        :type numBytes: int, optional
+        :param numItems: number of objects returned by a listing
+        :type numItems: int, optional
+        :param error: the exception the call raised, if any
+        :type error: Exception, optional
+        """
+        with self.lock:
+            self.calls[(operation, OK if error is None else ERROR)] += 1
+            if numBytes:
+                self.bytes[operation] += numBytes
+            if numItems:
+                self.items[operation] += numItems
+            if error is not None:
+                self.errors[(operation, getErrorClass(error))] += 1
+            if operation not in self.latencies:
+                self.latencies[operation] = [[0] * len(LATENCY_BUCKETS), 0.0]
+            histogram = self.latencies[operation]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += latency
+
+    def recordRetries(self, operation, retries):
+        with self.lock:
+            self.retries[operation] += retries
+
+    def recordThrottle(self, operation):
+        with self.lock:
+            self.throttled[operation] += 1
+
+    def snapshot(self):
+        """
+        :return: the current values of all the metrics
+        :rtype: dict
+        """
+        with self.lock:
+            operations = {}
+            for operation, (counts, total) in self.latencies.items():
+                numCalls = sum(counts)
+                operations[operation] = {
+                    "calls": self.calls[(operation, OK)],
+                    "errors": self.calls[(operation, ERROR)],
+                    "bytes": self.bytes[operation],
+                    "items": self.items[operation],
+                    "latency_sum": round(total, 6),
+                    "latency_avg": round(total / numCalls, 6)
+                    if numCalls else None,
+                    "latency_buckets": dict(
+                        zip([str(bound) for bound in LATENCY_BUCKETS],
+                            counts)),
+                }
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                "operations": operations,
+                "errors": {f"{operation} {errorClass}": count
+                           for (operation, errorClass), count
+                           in self.errors.items()},
+                "retries": dict(self.retries),
+                "throttled": dict(self.throttled),
+            }
+
+    def toPrometheus(self):
+        """
+        :return: the metrics in the prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+
+        def header(name, metricType, description):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metricType}")
+
+        with self.lock:
+            header("objstore_calls_total", "counter",
+                   "object store calls by operation and outcome")
+            for (operation, outcome), count in sorted(self.calls.items()):
+                lines.append(
+                    f'objstore_calls_total{{operation="{operation}",'
+                    f'outcome="{outcome}"}} {count}')
+            header("objstore_bytes_total", "counter",
+                   "bytes sent or received by operation")
+            for operation, count in sorted(self.bytes.items()):
+                lines.append(
+                    f'objstore_bytes_total{{operation="{operation}"}} {count}')
+            header("objstore_listed_objects_total", "counter",
+                   "objects returned by listings")
+            for operation, count in sorted(self.items.items()):
+                lines.append(
+                    f'objstore_listed_objects_total{{operation="{operation}"}}'
+                    f' {count}')
+            header("objstore_errors_total", "counter",
+                   "failed object store calls by error class")
+            for (operation, errorClass), count in sorted(
+                    self.errors.items()):
+                lines.append(
+                    f'objstore_errors_total{{operation="{operation}",'
+                    f'error="{errorClass}"}} {count}')
+            header("objstore_retries_total", "counter",
+                   "requests that boto retried, by s3 api call")
+            for operation, count in sorted(self.retries.items()):
+                lines.append(
+                    f'objstore_retries_total{{operation="{operation}"}} '
+                    f'{count}')
+            header("objstore_throttled_total", "counter",
+                   "requests the object store throttled, by s3 api call")
+            for operation, count in sorted(self.throttled.items()):
+                lines.append(
+                    f'objstore_throttled_total{{operation="{operation}"}} '
+                    f'{count}')
+            header("objstore_call_seconds", "histogram",
+                   "latency of object store calls")
+            for operation, (counts, total) in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(
+                        f'objstore_call_seconds_bucket{{operation='
+                        f'"{operation}",le="{le}"}} {cumulative}')
+                lines.append(
+                    f'objstore_call_seconds_sum{{operation="{operation}"}} '
+                    f'{total}')
+                lines.append(
+                    f'objstore_call_seconds_count{{operation="{operation}"}} '
+                    f'{cumulative}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def getRegistry():
+    return REGISTRY
+
+
+def instrument(operation=None, getBytes=None, getAttributes=None):
+    """decorator that records the metrics for a method that calls the
+    object store.  Methods that return a generator (listings) are timed
+    until the generator is used up, and the number of items it yields is
+    recorded.  Coroutines and async generators are handled the same way.
+
+    :param operation: name to record the calls under, defaults to the name
+                      of the method
+    :type operation: str, optional
+    :param getBytes: called with the args, kwargs and return value of the
+                     method, returns the number of bytes moved
+    :type getBytes: function, optional
+    :param getAttributes: called with the args and kwargs of the method,
+                          returns a dict of attributes for the trace span
+    :type getAttributes: function, optional
+    """
+
+    def decorator(func):
+        name = operation or func.__name__
+
+        def iterate(result, start, span):
+            numItems = 0
+            try:
+                for item in result:
+                    numItems += 1
+                    yield item
+            except Exception as err:
+                REGISTRY.recordCall(name, time.perf_counter() - start,
+                                    numItems=numItems, error=err)
+                endSpan(span, err)
+                raise
+            REGISTRY.recordCall(name, time.perf_counter() - start,
+                                numItems=numItems)
+            endSpan(span)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span = startSpan(name, getAttributes, args, kwargs)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                REGISTRY.recordCall(name, time.perf_counter() - start,
+                                    error=err)
+                endSpan(span, err)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return iterate(result, start, span)
+            numBytes = 0
+            if getBytes is not None:
+                try:
+                    numBytes = getBytes(args, kwargs, result) or 0
+                except Exception as err:
+                    LOGGER.debug(f"unable to count the bytes of {name}: "
+                                 f"{err}")
+            REGISTRY.recordCall(name, time.perf_counter() - start,
+                                numBytes=numBytes)
+            endSpan(span)
+            return result
+
+        @functools.wraps(func)
+        async def asyncWrapper(*args, **kwargs):
+            span = startSpan(name, getAttributes, args, kwargs)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as err:
+                REGISTRY.recordCall(name, time.perf_counter() - start,
+                                    error=err)
+                endSpan(span, err)
+                raise
+            numBytes = 0
+            if getBytes is not None:
+                try:
+                    numBytes = getBytes(args, kwargs, result) or 0
+                except Exception as err:
+                    LOGGER.debug(f"unable to count the bytes of {name}: "
+                                 f"{err}")
+            REGISTRY.recordCall(name, time.perf_counter() - start,
+                                numBytes=numBytes)
+            endSpan(span)
+            return result
+
+        @functools.wraps(func)
+        async def asyncGenWrapper(*args, **kwargs):
+            span = startSpan(name, getAttributes, args, kwargs)
+            start = time.perf_counter()
+            numItems = 0
+            try:
+                async for item in func(*args, **kwargs):
+                    numItems += 1
+                    yield item
+            except Exception as err:
+                REGISTRY.recordCall(name, time.perf_counter() - start,
+                                    numItems=numItems, error=err)
+                endSpan(span, err)
+                raise
+            REGISTRY.recordCall(name, time.perf_counter() - start,
+                                numItems=numItems)
+            endSpan(span)
+
+        if inspect.isasyncgenfunction(func):
+            return asyncGenWrapper
+        if inspect.iscoroutinefunction(func):
+            return asyncWrapper
+        return wrapper
+
+    return decorator
+
+
+def startSpan(name, getAttributes, args, kwargs):
+    if trace is None:
+        return None
+    span = trace.get_tracer(__name__).start_span(f"objstore.{name}")
+    if getAttributes is not None:
+        try:
+            for key, value in getAttributes(args, kwargs).items():
+                if value is not None:
+                    span.set_attribute(key, value)
+        except Exception as err:
+            LOGGER.debug(f"unable to get the span attributes: {err}")
+    return span
+
+
+def endSpan(span, err=None):
+    if span is None:
+        return
+    if err is not None:
+        span.record_exception(err)
+        span.set_status(trace.Status(trace.StatusCode.ERROR, str(err)))
+    span.end()
+
+
+def recordBotoCall(parsed=None, model=None, **kwargs):
+    """boto 'after-call' event handler, records the retries boto made for
+    a request"""
+    if parsed is None or model is None:
+        return
+    retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        REGISTRY.recordRetries(model.name, retries)
+
+
+def watchBotoClient(botoClient):
+    """registers the event handlers that record the retries of a boto
+    client, safe to call more than once for the same client"""
+    botoClient.meta.events.register(
+        "after-call.s3", recordBotoCall, unique_id="objStoreMetrics"
+    )
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(REGISTRY.snapshot()).encode("utf-8")
+            contentType = "application/json"
+        elif self.path.startswith("/metrics"):
+            body = REGISTRY.toPrometheus().encode("utf-8")
+            contentType = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format % args)
+
+
+def startHttpServer(port, host="0.0.0.0"):
+    """serves the metrics on /metrics (prometheus) and /metrics.json from a
+    background thread
+
+    :param port: port to listen on
+    :type port: int
+    :return: the server, call shutdown() on it to stop it
+    :rtype: http.server.ThreadingHTTPServer
+    """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOGGER.info(f"serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def writeSnapshot(snapshotFile):
+    tmpFile = snapshotFile + ".tmp"
+    with open(tmpFile, "w") as fh:
+        json.dump(REGISTRY.snapshot(), fh)
+    os.replace(tmpFile, snapshotFile)
+
+
+def startSnapshots(snapshotFile, interval):
+    """writes the metrics to a json file every interval seconds from a
+    background thread
+
+    :param snapshotFile: path to the json file
+    :type snapshotFile: str
+    :param interval: seconds between snapshots
+    :type interval: float
+    :return: event that stops the snapshots when it is set
+    :rtype: threading.Event
+    """
+    stopEvent = threading.Event()
+
+    def run():
+        while not stopEvent.wait(interval):
+            try:
+                writeSnapshot(snapshotFile)
+            except OSError as err:
+                LOGGER.warning(f"unable to write the metrics: {err}")
+        writeSnapshot(snapshotFile)
+
+    threading.Thread(target=run, daemon=True).start()
+    return stopEvent
+
+
+def startFromConfig(metricsPort=None, snapshotFile=None, interval=60):
+    """starts whichever of the http server and the snapshots are
+    configured, a port / file of None turns that one off
+    """
+    if metricsPort:
+        startHttpServer(metricsPort)
+    if snapshotFile:
+        startSnapshots(snapshotFile, interval)
@@ -0,0 +1,272 @@
+"""Presigns object urls in bulk, without talking to the object store.
+
+The download manifests list hundreds or thousands of WRF files.  Presigning
+them one at a time through minio does a lot of work per url, so the urls are
+signed here with AWS signature v4 (query string auth), reusing the signing
+key (which only changes once a day) and everything else that is the same
+for every url.
+
+Signed urls are cached by bucket, object name and expiry window.  All the
+urls signed in the same window (15 minutes by default) are dated at the
+start of the window and are valid for the requested expiry plus the length
+of the window, so a url handed out from the cache late in the window is
+still valid for at least the requested time.  Once the window has passed the
+cached urls are no longer used and drop out of the cache as it fills up.
+Urls that expire within a window of the 7 day max are signed at the current
+time and not cached, the extra time would take them over the max.
+
+    signer = objStorePresign.UrlSigner(host, user, secret)
+    urls = signer.presignUrls(bucket, objectNames, expires=3600)
+"""
+
+import argparse
+import collections
+import datetime
+import hashlib
+import hmac
+import logging
+import sys
+import threading
+import time
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_REGION = "us-east-1"
+# longest expiry s3 allows for a signature v4 presigned url
+MAX_EXPIRY = 7 * 24 * 60 * 60
+DEFAULT_EXPIRY = 24 * 60 * 60
+DEFAULT_CACHE_WINDOW = 15 * 60
+DEFAULT_CACHE_SIZE = 100000
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+
+class PresignCache:
+    """thread safe least recently used cache of presigned urls"""
+
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE):
+        """[summary]
+
+        :param maxSize: max number of urls to keep
+        :type maxSize: int, optional
+        """
+        self.maxSize = maxSize
+        self.urls = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cacheKey):
+        with self.lock:
+            url = self.urls.get(cacheKey)
+            if url is None:
+                self.misses += 1
+                return None
+            self.urls.move_to_end(cacheKey)
+            self.hits += 1
+            return url
+
+    def put(self, cacheKey, url):
+        with self.lock:
+            self.urls[cacheKey] = url
+            self.urls.move_to_end(cacheKey)
+            while len(self.urls) > self.maxSize:
+                self.urls.popitem(last=False)
+
+    def __len__(self):
+        return len(self.urls)
+
+
+# shared by every signer that isn't given its own cache, the cache keys
+# include the host and access key
+DEFAULT_CACHE = PresignCache()
+
+
+def hmacSha256(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+class UrlSigner:
+    def __init__(self, objStoreHost, objStoreUser, objStoreSecret,
+                 secure=True, region=DEFAULT_REGION, cache=None,
+                 cacheWindow=DEFAULT_CACHE_WINDOW):
+        """[summary]
+
+        :param objStoreHost: object store host, with the port if it isn't
+                             the default one
+        :type objStoreHost: str
+        :param objStoreUser: access key id
+        :type objStoreUser: str
+        :param objStoreSecret: secret access key
+        :type objStoreSecret: str
+        :param secure: sign https urls, otherwise http
+        :type secure: bool, optional
+        :param region: region in the credential scope
+        :type region: str, optional
+        :param cache: cache for the signed urls, defaults to DEFAULT_CACHE
+        :type cache: PresignCache, optional
+        :param cacheWindow: seconds that urls are reused for, 0 signs every
+                            url at the current time and doesn't cache them
+        :type cacheWindow: int, optional
+        """
+        self.objStoreHost = objStoreHost
+        self.objStoreUser = objStoreUser
+        self.objStoreSecret = objStoreSecret
+        self.scheme = "https" if secure else "http"
+        self.region = region
+        self.cache = cache if cache is not None else DEFAULT_CACHE
+        self.cacheWindow = cacheWindow
+        self.signingKeys = {}
+        self.lock = threading.Lock()
+
+    def getSigningKey(self, dateStamp):
+        """
+        :param dateStamp: date of the signature, YYYYMMDD
+        :type dateStamp: str
+        :return: the signing key for the date, derived once per date
+        :rtype: bytes
+        """
+        with self.lock:
+            signingKey = self.signingKeys.get(dateStamp)
+            if signingKey is None:
+                signingKey = hmacSha256(
+                    ("AWS4" + self.objStoreSecret).encode("utf-8"), dateStamp)
+                for part in (self.region, "s3", "aws4_request"):
+                    signingKey = hmacSha256(signingKey, part)
+                # only today's key (and yesterday's around midnight) is used
+                self.signingKeys = {dateStamp: signingKey}
+            return signingKey
+
+    def isWindowed(self, expires):
+        """
+        :return: true if urls with this expiry are dated at the start of the
+                 cache window and reused.  Urls that expire within
+                 cacheWindow of MAX_EXPIRY aren't, as the extra time they
+                 would need to stay valid for the whole window is over the
+                 max
+        :rtype: bool
+        """
+        return bool(self.cacheWindow) and \
+            expires <= MAX_EXPIRY - self.cacheWindow
+
+    def getWindow(self, expires, now=None):
+        """
+        :return: the time the urls signed now are dated at, and the expiry
+                 they are signed with
+        :rtype: tuple
+        """
+        if now is None:
+            now = time.time()
+        if not self.isWindowed(expires):
+            return int(now), expires
+        signedAt = int(now) - int(now) % self.cacheWindow
+        return signedAt, expires + self.cacheWindow
+
+    def presignUrls(self, bucket, objectNames, expires=DEFAULT_EXPIRY,
+                    now=None, method="GET"):
+        """presigns urls for a list of objects
+
+        :param bucket: bucket the objects are in
+        :type bucket: str
+        :param objectNames: names of the objects
+        :type objectNames: list
+        :param expires: seconds that the urls have to stay valid for, at
+                        most MAX_EXPIRY
+        :type expires: int, optional
+        :param now: time to sign the urls at, defaults to the current time
+        :type now: float, optional
+        :param method: http method the urls are for, GET or HEAD
+        :type method: str, optional
+        :raises ValueError: if expires isn't between 1 and MAX_EXPIRY
+        :return: the urls, in the same order as objectNames
+        :rtype: list
+        """
+        if not 0 < expires <= MAX_EXPIRY:
+            msg = f"expires has to be between 1 and {MAX_EXPIRY} seconds, " \
+                f"got {expires}"
+            raise ValueError(msg)
+        signedAt, signedExpires = self.getWindow(expires, now)
+        amzDate = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(signedAt))
+        dateStamp = amzDate[:8]
+        signingKey = self.getSigningKey(dateStamp)
+        scope = f"{dateStamp}/{self.region}/s3/aws4_request"
+
+        # everything but the path is the same for every url
+        query = urllib.parse.urlencode([
+            ("X-Amz-Algorithm", ALGORITHM),
+            ("X-Amz-Credential", f"{self.objStoreUser}/{scope}"),
+            ("X-Amz-Date", amzDate),
+            ("X-Amz-Expires", str(signedExpires)),
+            ("X-Amz-SignedHeaders", "host"),
+        ], quote_via=urllib.parse.quote, safe="-_.~")
+        requestSuffix = f"\n{query}\nhost:{self.objStoreHost}\n\nhost\n" \
+            f"{UNSIGNED_PAYLOAD}"
+        stringPrefix = f"{ALGORITHM}\n{amzDate}\n{scope}\n"
+        urlPrefix = f"{self.scheme}://{self.objStoreHost}"
+        cachePrefix = (self.objStoreHost, self.objStoreUser, method, bucket,
+                       signedAt, signedExpires)
+        useCache = self.isWindowed(expires)
+
+        urls = []
+        for objectName in objectNames:
+            cacheKey = cachePrefix + (objectName,)
+            url = self.cache.get(cacheKey) if useCache else None
+            if url is None:
+                path = "/" + urllib.parse.quote(f"{bucket}/{objectName}",
+                                                safe="/~")
+                canonicalRequest = f"{method}\n{path}{requestSuffix}"
+                stringToSign = stringPrefix + hashlib.sha256(
+                    canonicalRequest.encode("utf-8")).hexdigest()
+                signature = hmac.new(signingKey,
+                                     stringToSign.encode("utf-8"),
+                                     hashlib.sha256).hexdigest()
+                url = f"{urlPrefix}{path}?{query}&X-Amz-Signature={signature}"
+                if useCache:
+                    self.cache.put(cacheKey, url)
+            urls.append(url)
+        return urls
+
+    def presignUrl(self, bucket, objectName, expires=DEFAULT_EXPIRY):
+        return self.presignUrls(bucket, [objectName], expires)[0]
+
+
+def getExpiryTime(url):
+    """
+    :return: when a url signed by UrlSigner expires
+    :rtype: datetime.datetime
+    """
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    signedAt = datetime.datetime.strptime(
+        query["X-Amz-Date"], "%Y%m%dT%H%M%SZ"
+    ).replace(tzinfo=datetime.timezone.utc)
+    return signedAt + datetime.timedelta(seconds=int(query["X-Amz-Expires"]))
+
+
+if __name__ == '__main__':
+    import objStoreUtil
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(
+        description='writes a presigned url for each object name read from '
+                    'a file (or stdin), one per line')
+    parser.add_argument('names', nargs='?', default='-',
+                        help='file with one object name per line')
+    parser.add_argument('--expires', type=int, default=DEFAULT_EXPIRY,
+                        help='seconds the urls stay valid for')
+    parser.add_argument('--bucket', default=None,
+                        help='defaults to OBJ_STORE_BUCKET')
+    args = parser.parse_args()
+
+    namesFh = sys.stdin if args.names == '-' else open(args.names)
+    with namesFh:
+        objectNames = [line.strip() for line in namesFh if line.strip()]
+    start = time.perf_counter()
+    urls = objStoreUtil.ObjectStoreUtil().getPresignedUrls(
+        objectNames, objectBucket=args.bucket, expires=args.expires)
+    sys.stdout.write("".join(url + "\n" for url in urls))
+    LOGGER.info(f"signed {len(urls)} urls in "
+                + f"{(time.perf_counter() - start) * 1000:.1f}ms")
@@ -9,20 +9,319 @@ OBJ_STORE_HOST      - object store host
 
 """
 
+import base64
+import concurrent.futures
+import functools
+import hashlib
 import logging
+import threading
+import weakref
 
-import boto3
-import minio
 import os
 
+import compactKeys
 import constants
+import lazyModules
+import objStoreClients
+import objStoreDiff
+import objStoreMetrics
+import objStorePresign
+import streamBuffers
 
 LOGGER = logging.getLogger(__name__)
 
+botocore = lazyModules.LazyModule("botocore")
+minio = lazyModules.LazyModule("minio")
+
+# largest object that S3 will copy with a single CopyObject request, anything
+# larger has to be copied in parts using UploadPartCopy
+MAX_SINGLE_COPY_SIZE = 5 * 1024 ** 3
+# size of the parts used when an object is copied with UploadPartCopy
+COPY_PART_SIZE = 512 * 1024 ** 2
+# error codes returned by the object store when it will not do a server side
+# copy for us.  Anything else is treated as a real error.  A HEAD response has
+# no body, so a refused HEAD of the source is only recognised by its 403
+# status (see isCopyRefused).
+COPY_REFUSED_CODES = ['AccessDenied', 'NotImplemented', 'InvalidRequest',
+                      'XNotImplemented', 'MethodNotAllowed']
+
+
+# S3 doesn't allow more parts than this in a multipart upload
+MAX_UPLOAD_PARTS = 10000
+
+# max number of objects in a single multi-object delete request
+MAX_DELETE_BATCH = 1000
+
+# max number of objects returned by a single list request
+LIST_PAGE_SIZE = 1000
+
+# size of the reads when a part of an object is downloaded
+READ_SIZE = 1024 ** 2
+
+# error codes the object store uses to tell us to slow down
+THROTTLE_CODES = ['SlowDown', 'Throttling', 'ThrottlingException',
+                  'RequestLimitExceeded', 'TooManyRequests', '503']
+
+# created by getPartExecutor the first time an object is moved in parts
+_partExecutor = None
+_partExecutorLock = threading.Lock()
+
+# the ObjectStoreUtils that use each shared boto client, see watchThrottles.
+# Held weakly so utils that are no longer used drop out
+_clientUtils = {}
+_clientUtilsLock = threading.Lock()
+
+
+def isThrottleError(err):
+    """checks to see if an exception raised by boto or minio is the object
+    store throttling requests
+
+    :param err: the exception to check
+    :type err: Exception
+    :return: true if the error was caused by throttling
+    :rtype: bool
+    """
+    if isinstance(err, botocore.exceptions.ClientError):
+        errCode = err.response.get("Error", {}).get("Code")
+        status = err.response.get("ResponseMetadata", {}).get(
+            "HTTPStatusCode")
+        return errCode in THROTTLE_CODES or status == 503
+    if isinstance(err, minio.error.S3Error):
+        return err.code in THROTTLE_CODES
+    if isinstance(err, minio.error.ServerError):
+        return "503" in str(err)
+    return False
+
+
+def isCopyRefused(err):
+    """
+    :param err: the error raised by a head or copy request
+    :type err: botocore.exceptions.ClientError
+    :return: true if the object store won't do a server side copy for us,
+             either of the requests being forbidden counts
+    :rtype: bool
+    """
+    errCode = err.response.get("Error", {}).get("Code")
+    status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return errCode in COPY_REFUSED_CODES or status == 403
+
+
+def watchThrottles(botoClient, objUtil):
+    """passes the throttles of a shared boto client on to the throttle
+    listeners of objUtil.  The event handler is only registered once per
+    client however many utils use it, so a throttle is only counted once.
+    """
+    with _clientUtilsLock:
+        objUtils = _clientUtils.get(botoClient)
+        if objUtils is None:
+            objUtils = _clientUtils[botoClient] = weakref.WeakSet()
+            botoClient.meta.events.register(
+                "needs-retry.s3",
+                functools.partial(checkThrottled, botoClient),
+                unique_id="objStoreUtil.checkThrottled"
+            )
+        objUtils.add(objUtil)
+
+
+def checkThrottled(botoClient, response=None, **kwargs):
+    """boto event handler that gets called before boto decides whether to
+    retry a request, lets the throttle listeners of the utils that use the
+    client know if the request was throttled.  Always returns None so the
+    retry decision is left to boto.
+    """
+    if response is None:
+        return None
+    httpResponse, parsed = response
+    errCode = parsed.get("Error", {}).get("Code")
+    if errCode in THROTTLE_CODES or httpResponse.status_code == 503:
+        operation = kwargs.get("operation")
+        objStoreMetrics.REGISTRY.recordThrottle(
+            getattr(operation, "name", "unknown"))
+        # a listener added to several utils is only called once
+        listeners = []
+        with _clientUtilsLock:
+            for objUtil in list(_clientUtils.get(botoClient, ())):
+                for listener in objUtil.throttleListeners:
+                    if listener not in listeners:
+                        listeners.append(listener)
+        for listener in listeners:
+            listener()
+    return None
+
+
+def localFileSize(position, name):
+    """builds the function that gives objStoreMetrics the number of bytes a
+    call moved, from the size of the local file passed to it
+
+    :param position: position of the local file arg, counting self
+    :type position: int
+    :param name: name of the local file arg
+    :type name: str
+    """
+    def getBytes(args, kwargs, result):
+        localPath = kwargs.get(name)
+        if localPath is None and len(args) > position:
+            localPath = args[position]
+        return os.path.getsize(localPath)
+    return getBytes
+
+
+def returnedBytes(args, kwargs, result):
+    return result
+
+
+def getPartRanges(objectSize, partSize):
+    """splits an object into parts
+
+    :return: the part number, offset and length of each part
+    :rtype: list
+    """
+    return [
+        (partNumber, offset, min(partSize, objectSize - offset))
+        for partNumber, offset in enumerate(
+            range(0, objectSize, partSize), start=1)
+    ]
+
+
+def getPartsEtag(partDigests):
+    """
+    :param partDigests: md5 digests of the parts of an object
+    :type partDigests: list
+    :return: the etag the object gets when it's uploaded in these parts, a
+             plain md5 for a single part
+    :rtype: str
+    """
+    if not partDigests:
+        return hashlib.md5().hexdigest()
+    if len(partDigests) == 1:
+        return partDigests[0].hex()
+    combined = hashlib.md5(b"".join(partDigests)).hexdigest()
+    return f"{combined}-{len(partDigests)}"
+
+
+def getPartExecutor():
+    """
+    :return: the thread pool that moves the parts of every object, shared
+             so that no more than constants.MAX_PART_REQUESTS part requests
+             are in flight however many objects are moved at the same time
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _partExecutor
+    with _partExecutorLock:
+        if _partExecutor is None:
+            _partExecutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=constants.MAX_PART_REQUESTS,
+                thread_name_prefix="parts"
+            )
+        return _partExecutor
+
+
+def runParts(func, parts, parallelism):
+    """calls func with each part on the shared part executor, up to
+    parallelism parts at a time.  If a part fails the parts that haven't
+    started are cancelled and the error is raised once the running ones are
+    done.
+
+    :return: the results, in the same order as the parts
+    :rtype: list
+    """
+    if parallelism <= 1 or len(parts) <= 1:
+        return [func(part) for part in parts]
+    executor = getPartExecutor()
+    results = [None] * len(parts)
+    # future to the index of its part
+    pending = {}
+    nextPart = 0
+    try:
+        while nextPart < len(parts) or pending:
+            while nextPart < len(parts) and len(pending) < parallelism:
+                pending[executor.submit(func, parts[nextPart])] = nextPart
+                nextPart += 1
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for fut in done:
+                results[pending.pop(fut)] = fut.result()
+    except Exception:
+        for fut in pending:
+            fut.cancel()
+        concurrent.futures.wait(pending)
+        raise
+    return results
+
+
+def checkPartResponse(objectName, resp, offset, length, objectSize):
+    """checks that a ranged GET returned the part of the object that was
+    asked for, from an object of the expected size
+
+    :param resp: the response of the minio get_object
+    :type resp: urllib3.response.HTTPResponse
+    :raises ValueError: if the range or object size doesn't match
+    """
+    expected = f"bytes {offset}-{offset + length - 1}/{objectSize}"
+    contentRange = resp.headers.get("Content-Range")
+    if contentRange is not None and contentRange != expected:
+        msg = f"expected {expected} of {objectSize} of {objectName}, " + \
+            f"got {contentRange}, the object changed during the transfer"
+        raise ValueError(msg)
+
+
+def checkPartEtags(objectName, etags):
+    """checks that all the parts of an object came from the same version
+    of it
+
+    :param etags: etag of the object returned with each part
+    :type etags: list
+    :raises ValueError: if the etags differ
+    """
+    if len(set(etags)) > 1:
+        msg = f"{objectName} changed while it was being transferred, " + \
+            f"its parts have the etags: {sorted(set(etags))}"
+        raise ValueError(msg)
+
+
+def writeAt(fd, data, offset):
+    view = memoryview(data)
+    while len(view):
+        numWritten = os.pwrite(fd, view, offset)
+        view = view[numWritten:]
+        offset += numWritten
+
+
+def readAt(fd, length, offset):
+    chunks = []
+    numRead = 0
+    while numRead < length:
+        chunk = os.pread(fd, length - numRead, offset + numRead)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        numRead += len(chunk)
+    return b"".join(chunks)
+
+
+def objectAttributes(args, kwargs):
+    """trace span attributes for a method whose first arg is an object
+    name"""
+    objUtil = args[0]
+    attributes = {"objstore.host": objUtil.objStoreHost,
+                  "objstore.bucket": objUtil.objStoreBucket}
+    if len(args) > 1 and isinstance(args[1], str):
+        attributes["objstore.key"] = args[1]
+    return attributes
+
+
+class CopyRefusedError(Exception):
+    """raised when the object store refuses to do a server side copy of an
+    object, callers are expected to fall back to moving the data themselves
+    """
+
 
 class ObjectStoreUtil:
     def __init__(self, objStoreHost=None, objStoreUser=None,
-                 objStoreSecret=None, objStoreBucket=None, tmpfolder=None):
+                 objStoreSecret=None, objStoreBucket=None, tmpfolder=None,
+                 publicOnUpload=False, secure=None, partSize=None,
+                 partParallelism=None, objectCache=None):
         """[summary]
 
         :param objStoreHost: [if provided will use this as the object storage
@@ -33,12 +332,35 @@ class ObjectStoreUtil:
         :type objStoreUser: [type], optional
         :param objStoreSecret: [description], defaults to None
         :type objStoreSecret: [type], optional
+        :param publicOnUpload: when true objects uploaded with putObject are
+                               created with the public-read acl, saves a
+                               call to setPublicPermissions per object
+        :type publicOnUpload: bool, optional
+        :param secure: connect to the object store with https, defaults to
+                       constants.OBJ_STORE_SECURE
+        :type secure: bool, optional
+        :param partSize: size of the parts that getObject and putObject
+                         split large objects into, defaults to
+                         constants.TRANSFER_PART_SIZE
+        :type partSize: int, optional
+        :param partParallelism: number of parts of an object that are moved
+                                at the same time, defaults to
+                                constants.PART_PARALLELISM
+        :type partParallelism: int, optional
+        :param objectCache: when given getObject goes through this disk
+                            cache, and only downloads objects that changed
+        :type objectCache: objStoreCache.ObjectCache, optional
         """
         self.objStoreHost = objStoreHost
         self.objStoreUser = objStoreUser
         self.objStoreSecret = objStoreSecret
         self.objStoreBucket = objStoreBucket
         self.tmpfolder = tmpfolder
+        self.publicOnUpload = publicOnUpload
+        self.secure = secure
+        self.partSize = partSize
+        self.partParallelism = partParallelism
+        self.objectCache = objectCache
 
         if self.objStoreHost is None:
             self.objStoreHost = constants.OBJ_STORE_HOST
@@ -48,6 +370,12 @@ class ObjectStoreUtil:
             self.objStoreSecret = constants.OBJ_STORE_SECRET
         if self.objStoreBucket is None:
             self.objStoreBucket = constants.OBJ_STORE_BUCKET
+        if self.secure is None:
+            self.secure = constants.OBJ_STORE_SECURE
+        if self.partSize is None:
+            self.partSize = constants.TRANSFER_PART_SIZE
+        if self.partParallelism is None:
+            self.partParallelism = constants.PART_PARALLELISM
         # populate a temp folder variable.. if none is provided as an
         # arg or in a constants variable then just use the current
         # directory
@@ -58,29 +386,135 @@ class ObjectStoreUtil:
                 self.tmpfolder = os.path.dirname(__file__)
 
         LOGGER.debug(f"obj store host: {self.objStoreHost}")
-        self.minIoClient = minio.Minio(
-            self.objStoreHost,
-            self.objStoreUser,
-            self.objStoreSecret,
-        )
+        # clients are shared with any other ObjectStoreUtil that uses the same
+        # host and credentials, see objStoreClients.  The minio client is
+        # created the first time it's used, see the minIoClient property
+        self._minIoClient = None
         # minio doesn't provide access to ACL's for buckets and objects
         # so using boto when that is required.  Methods that use the boto
         # client will create the object only when called
         self.botoClient = None
-        self.botoSession = None
+        self.botoLock = threading.Lock()
+        # functions that get called when the object store throttles a
+        # request, boto retries these itself so they'd go unnoticed otherwise
+        self.throttleListeners = []
+        # signs presigned urls locally, created the first time it's needed
+        self.urlSigner = None
+
+    @property
+    def minIoClient(self):
+        """the minio client, created (and minio imported) on first use so
+        commands that don't need it start quicker
+        """
+        if self._minIoClient is None:
+            self._minIoClient = objStoreClients.getMinioClient(
+                self.objStoreHost,
+                self.objStoreUser,
+                self.objStoreSecret,
+                secure=self.secure,
+            )
+        return self._minIoClient
 
+    @objStoreMetrics.instrument(getBytes=localFileSize(2, "localPath"),
+                                getAttributes=objectAttributes)
     def getObject(self, filePath, localPath, bucketName=None):
+        """downloads an object to a local file.  The object is split into
+        parts of partSize bytes that are downloaded with ranged GETs,
+        partParallelism at a time, and written straight to their place in
+        the file.  The md5 of each part is calculated as it arrives, and the
+        etag they add up to is checked against the object's etag when the
+        object was uploaded with the same part layout.
+
+        :param filePath: name of the object
+        :type filePath: str
+        :param localPath: file to write the object to, it is only replaced
+                          once the whole object has been downloaded
+        :type localPath: str
+        :param bucketName: the bucket, defaults to the bucket this object was
+                           created with
+        :type bucketName: str, optional
+        :raises ValueError: if the object changes during the download or
+                            doesn't match its etag
+        """
         if not bucketName:
             bucketName = self.objStoreBucket
-        retVal = self.minIoClient.fget_object(
-            bucket_name=bucketName,
-            object_name=filePath,
-            file_path=localPath
+        if self.objectCache is not None:
+            self.objectCache.getObject(self, filePath, localPath, bucketName)
+            return
+        stat = self.minIoClient.stat_object(bucketName, filePath)
+        objectEtag = stat.etag.strip('"')
+        parts = getPartRanges(stat.size, self.partSize)
+
+        localDir = os.path.dirname(localPath)
+        if localDir:
+            os.makedirs(localDir, exist_ok=True)
+        tmpPath = localPath + ".part"
+        fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, stat.size)
+            results = runParts(
+                lambda part: self.downloadPart(
+                    bucketName, filePath, stat.size, part, fd),
+                parts,
+                self.partParallelism,
+            )
+        except Exception:
+            os.close(fd)
+            os.remove(tmpPath)
+            raise
+        os.close(fd)
+
+        etags = [objectEtag] + [etag for _, etag in results]
+        calculated = getPartsEtag([digest for digest, _ in results])
+        try:
+            checkPartEtags(filePath, etags)
+            if calculated != objectEtag and len(parts) <= 1 \
+                    and not objStoreDiff.isMultipartEtag(objectEtag):
+                msg = f"downloaded {filePath} has the md5 {calculated}, " + \
+                    f"the object's etag is {objectEtag}"
+                raise ValueError(msg)
+        except ValueError:
+            os.remove(tmpPath)
+            raise
+        os.replace(tmpPath, localPath)
+        LOGGER.debug(f"downloaded {filePath} in {len(parts)} parts")
+
+    def downloadPart(self, bucketName, objectName, objectSize, part, fd):
+        """downloads a part of an object into its place in an open file
+
+        :param part: the part number, offset and length of the part
+        :type part: tuple
+        :param fd: file descriptor of the file to write to
+        :type fd: int
+        :return: the md5 digest of the part, and the etag of the object it
+                 came from
+        :rtype: tuple
+        """
+        _, offset, length = part
+        resp = self.minIoClient.get_object(
+            bucketName, objectName, offset=offset, length=length
         )
-        #retDict = self.getObjAsDict(retVal)
-        #LOGGER.debug(f"object get response: {retDict}")
+        md5 = hashlib.md5()
+        position = offset
+        try:
+            checkPartResponse(objectName, resp, offset, length, objectSize)
+            etag = resp.headers.get("ETag", "").strip('"')
+            for chunk in resp.stream(READ_SIZE):
+                md5.update(chunk)
+                writeAt(fd, chunk, position)
+                position += len(chunk)
+        finally:
+            resp.close()
+            resp.release_conn()
+        if position - offset != length:
+            msg = f"got {position - offset} bytes of {objectName} at " + \
+                f"{offset}, expected {length}"
+            raise ValueError(msg)
+        return md5.digest(), etag
 
-    def putObject(self, destPath, localPath, bucketName=None):
+    @objStoreMetrics.instrument(getBytes=localFileSize(2, "localPath"),
+                                getAttributes=objectAttributes)
+    def putObject(self, destPath, localPath, bucketName=None, public=None):
         """just a wrapper method around the minio fput.  Makes it a
         little easier to call.
 
@@ -92,20 +526,420 @@ class ObjectStoreUtil:
         :type destPath:
         :param bucketName: [description], defaults to None
         :type bucketName: [type], optional
+        :param public: upload the object with the public-read acl, defaults
+                       to the publicOnUpload setting of this object
+        :type public: bool, optional
         """
         if not bucketName:
             bucketName = self.objStoreBucket
+        if public is None:
+            public = self.publicOnUpload
+
+        objectSize = os.path.getsize(localPath)
+        if objectSize > self.partSize:
+            aclArgs = {}
+            if public:
+                aclArgs["ACL"] = "public-read"
+            self.uploadParts(destPath, localPath, bucketName, objectSize,
+                             aclArgs)
+            return
 
-        retVal = self.minIoClient.fput_object(
+        metadata = None
+        if public:
+            # sets the acl as part of the upload instead of with a separate
+            # put_object_acl call
+            metadata = {"x-amz-acl": "public-read"}
+        self.minIoClient.fput_object(
             bucket_name=bucketName,
             object_name=destPath,
-            file_path=localPath
+            file_path=localPath,
+            metadata=metadata
         )
         #retDict = self.getObjAsDict(retVal)
         #LOGGER.debug(f'object store returned: {retDict}')
 
+    def uploadParts(self, destPath, localPath, bucketName, objectSize,
+                    aclArgs):
+        """multipart upload of a local file, partParallelism parts at a
+        time.  Each part is sent with its md5 so the object store checks it,
+        and the etag of the finished object is checked against the md5s of
+        the parts.  The upload is aborted if any part fails.
+
+        :param destPath: name of the object to create
+        :type destPath: str
+        :param localPath: the file to upload
+        :type localPath: str
+        :param bucketName: bucket to create the object in
+        :type bucketName: str
+        :param objectSize: size of the file
+        :type objectSize: int
+        :param aclArgs: acl arguments for create_multipart_upload
+        :type aclArgs: dict
+        :raises ValueError: if the file needs more than MAX_UPLOAD_PARTS
+                            parts, or the etag of the object doesn't match,
+                            in which case the object is deleted
+        """
+        parts = getPartRanges(objectSize, self.partSize)
+        if len(parts) > MAX_UPLOAD_PARTS:
+            msg = f"{localPath} is {objectSize} bytes, which needs more " + \
+                f"than {MAX_UPLOAD_PARTS} parts of {self.partSize} bytes"
+            raise ValueError(msg)
+        self.createBotoClient()
+        mpu = self.botoClient.create_multipart_upload(
+            Bucket=bucketName, Key=destPath, **aclArgs
+        )
+        uploadId = mpu["UploadId"]
+
+        def uploadPart(part):
+            partNumber, offset, length = part
+            data = readAt(fd, length, offset)
+            digest = hashlib.md5(data).digest()
+            resp = self.botoClient.upload_part(
+                Bucket=bucketName,
+                Key=destPath,
+                UploadId=uploadId,
+                PartNumber=partNumber,
+                Body=data,
+                ContentMD5=base64.b64encode(digest).decode("ascii"),
+            )
+            return resp["ETag"], digest
+
+        fd = os.open(localPath, os.O_RDONLY)
+        try:
+            results = runParts(uploadPart, parts, self.partParallelism)
+            resp = self.botoClient.complete_multipart_upload(
+                Bucket=bucketName,
+                Key=destPath,
+                UploadId=uploadId,
+                MultipartUpload={"Parts": [
+                    {"ETag": etag, "PartNumber": partNumber}
+                    for (partNumber, _, _), (etag, _) in zip(parts, results)
+                ]},
+            )
+        except Exception:
+            LOGGER.warning(f"aborting multipart upload of {destPath}")
+            self.botoClient.abort_multipart_upload(
+                Bucket=bucketName, Key=destPath, UploadId=uploadId
+            )
+            raise
+        finally:
+            os.close(fd)
+        self.checkUploadEtag(
+            bucketName, destPath, resp["ETag"],
+            getPartsEtag([digest for _, digest in results])
+        )
+        LOGGER.debug(f"uploaded {destPath} in {len(parts)} parts")
 
+    def checkUploadEtag(self, bucketName, objectName, etag, expected):
+        """checks the etag of an object that was just uploaded against the
+        one calculated from the md5s of what was sent.  An object that
+        doesn't match is deleted, so a bad copy isn't left looking complete
+        and is moved again.
 
+        :param etag: etag the object store returned for the new object
+        :type etag: str
+        :param expected: etag calculated from the parts that were sent
+        :type expected: str
+        :raises ValueError: if the etags don't match
+        """
+        if etag.strip('"') == expected:
+            return
+        LOGGER.warning(f"deleting {objectName}, its etag {etag} doesn't "
+                       + "match the upload")
+        self.botoClient.delete_object(Bucket=bucketName, Key=objectName)
+        msg = f"uploaded {objectName} had the etag {etag}, expected " + \
+            f"{expected}"
+        raise ValueError(msg)
+
+    @objStoreMetrics.instrument(getBytes=returnedBytes)
+    def streamObject(self, srcUtil, srcObject, destObject=None,
+                     destBucket=None, bufferPool=None, public=None,
+                     objectSize=None, partSize=None, partDigests=None):
+        """copies an object from the bucket of another ObjectStoreUtil into
+        this one without writing it to disk.  The body of the source object
+        is read into a buffer from the pool, and each part (a full buffer by
+        default) is sent as a part of a multipart upload.  Objects that fit
+        in a single part are uploaded with a single put.  Objects larger than
+        two parts are streamed partParallelism parts at a time
+        (streamPartsParallel).  The md5 of every part is sent with it and
+        the etag of the new object is checked against them.
+
+        :param srcUtil: the ObjectStoreUtil of the bucket the object is read
+                        from
+        :type srcUtil: ObjectStoreUtil
+        :param srcObject: name of the object in the source bucket
+        :type srcObject: str
+        :param destObject: name of the new object, defaults to srcObject
+        :type destObject: str, optional
+        :param destBucket: bucket to write to, defaults to the bucket of this
+                           object
+        :type destBucket: str, optional
+        :param bufferPool: the buffers to stream through, defaults to a new
+                           pool with a single buffer
+        :type bufferPool: streamBuffers.BufferPool, optional
+        :param public: create the object with the public-read acl, defaults
+                       to the publicOnUpload setting of this object
+        :type public: bool, optional
+        :param objectSize: size of the source object if it's known, lets
+                           large objects go straight to the parallel parts
+        :type objectSize: int, optional
+        :param partSize: size of the parts to upload, at most the size of
+                         the buffers (the default).  Using the part size of
+                         the source object gives the new object the same
+                         etag
+        :type partSize: int, optional
+        :param partDigests: list the md5 digest of each part is added to, in
+                            part order, lets the caller check the object
+                            against the source without downloading it
+                            (objStoreVerify.ObjectVerifier.verify)
+        :type partDigests: list, optional
+        :raises ValueError: if the object needs more than MAX_UPLOAD_PARTS
+                            parts, or the etag of the new object doesn't
+                            match the parts
+        :return: the number of bytes copied
+        :rtype: int
+        """
+        if destObject is None:
+            destObject = srcObject
+        if destBucket is None:
+            destBucket = self.objStoreBucket
+        if bufferPool is None:
+            bufferPool = streamBuffers.BufferPool(
+                memoryBudget=streamBuffers.DEFAULT_PART_SIZE
+            )
+        if public is None:
+            public = self.publicOnUpload
+        aclArgs = {}
+        if public:
+            aclArgs["ACL"] = "public-read"
+        if not partSize or partSize > bufferPool.bufferSize:
+            partSize = bufferPool.bufferSize
+        if partDigests is None:
+            partDigests = []
+        self.createBotoClient()
+
+        def isParallel(size):
+            return self.partParallelism > 1 and size > partSize * 2
+
+        if objectSize is not None and isParallel(objectSize):
+            return self.streamPartsParallel(
+                srcUtil, srcObject, objectSize, destObject, destBucket,
+                bufferPool, aclArgs, partSize, partDigests
+            )
+        resp = srcUtil.minIoClient.get_object(
+            srcUtil.objStoreBucket, srcObject
+        )
+        try:
+            objectSize = int(resp.headers.get("Content-Length", 0))
+            if objectSize > partSize * MAX_UPLOAD_PARTS:
+                msg = (
+                    f"{srcObject} is {objectSize} bytes, which needs more "
+                    + f"than {MAX_UPLOAD_PARTS} parts of {partSize} bytes"
+                )
+                raise ValueError(msg)
+            if isParallel(objectSize):
+                # drops the connection, only the bytes in flight are wasted
+                resp.close()
+                resp.release_conn()
+                return self.streamPartsParallel(
+                    srcUtil, srcObject, objectSize, destObject, destBucket,
+                    bufferPool, aclArgs, partSize, partDigests
+                )
+
+            with bufferPool.buffer() as buf:
+                part = memoryview(buf)[:partSize]
+                numBytes = streamBuffers.fillBuffer(resp, part)
+                if numBytes < partSize:
+                    digest = hashlib.md5(part[:numBytes]).digest()
+                    putResp = self.botoClient.put_object(
+                        Bucket=destBucket,
+                        Key=destObject,
+                        Body=streamBuffers.BufferReader(part, numBytes),
+                        ContentMD5=base64.b64encode(digest).decode("ascii"),
+                        **aclArgs
+                    )
+                    self.checkUploadEtag(destBucket, destObject,
+                                         putResp["ETag"], digest.hex())
+                    partDigests.append(digest)
+                    return numBytes
+                return self.streamParts(
+                    resp, part, numBytes, destObject, destBucket, aclArgs,
+                    partDigests
+                )
+        finally:
+            resp.close()
+            resp.release_conn()
+
+    def streamParts(self, stream, buf, numBytes, destObject, destBucket,
+                    aclArgs, partDigests):
+        """multipart upload of a stream, reusing the same buffer for every
+        part.  The md5 of each part is sent with it, and the etag of the new
+        object is checked against them.  The upload is aborted if any part
+        fails.
+
+        :param stream: the stream to upload the rest of
+        :type stream: io.IOBase
+        :param buf: buffer that holds the first part of the stream, the
+                    size of a part
+        :type buf: memoryview
+        :param numBytes: number of bytes of the first part in the buffer
+        :type numBytes: int
+        :param destObject: name of the object to create
+        :type destObject: str
+        :param destBucket: bucket to create the object in
+        :type destBucket: str
+        :param aclArgs: acl arguments for create_multipart_upload
+        :type aclArgs: dict
+        :param partDigests: list the md5 digest of each part is added to
+        :type partDigests: list
+        :raises ValueError: if the etag of the new object doesn't match the
+                            parts
+        :return: the number of bytes uploaded
+        :rtype: int
+        """
+        mpu = self.botoClient.create_multipart_upload(
+            Bucket=destBucket, Key=destObject, **aclArgs
+        )
+        uploadId = mpu["UploadId"]
+        parts = []
+        digests = []
+        totalBytes = 0
+        try:
+            while numBytes:
+                partNumber = len(parts) + 1
+                digest = hashlib.md5(buf[:numBytes]).digest()
+                resp = self.botoClient.upload_part(
+                    Bucket=destBucket,
+                    Key=destObject,
+                    UploadId=uploadId,
+                    PartNumber=partNumber,
+                    Body=streamBuffers.BufferReader(buf, numBytes),
+                    ContentMD5=base64.b64encode(digest).decode("ascii"),
+                )
+                parts.append({"ETag": resp["ETag"], "PartNumber": partNumber})
+                digests.append(digest)
+                totalBytes += numBytes
+                numBytes = streamBuffers.fillBuffer(stream, buf)
+            resp = self.botoClient.complete_multipart_upload(
+                Bucket=destBucket,
+                Key=destObject,
+                UploadId=uploadId,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            LOGGER.warning(f"aborting multipart upload of {destObject}")
+            self.botoClient.abort_multipart_upload(
+                Bucket=destBucket, Key=destObject, UploadId=uploadId
+            )
+            raise
+        calculated = getPartsEtag(digests)
+        if len(digests) == 1:
+            calculated = f"{hashlib.md5(digests[0]).hexdigest()}-1"
+        self.checkUploadEtag(destBucket, destObject, resp["ETag"], calculated)
+        partDigests.extend(digests)
+        LOGGER.debug(f"streamed {destObject} in {len(parts)} parts")
+        return totalBytes
+
+    def streamPartsParallel(self, srcUtil, srcObject, objectSize,
+                            destObject, destBucket, bufferPool, aclArgs,
+                            partSize, partDigests):
+        """multipart upload of an object from another bucket, with each part
+        read with a ranged GET into a buffer from the pool and uploaded on
+        its own thread, partParallelism parts at a time.  The md5 of each
+        part is sent with it, and the etag of the new object is checked
+        against them.  The upload is aborted if any part fails or the
+        source object changes part way through.
+
+        :param srcUtil: the ObjectStoreUtil of the bucket the object is read
+                        from
+        :type srcUtil: ObjectStoreUtil
+        :param srcObject: name of the object in the source bucket
+        :type srcObject: str
+        :param objectSize: size of the source object
+        :type objectSize: int
+        :param destObject: name of the object to create
+        :type destObject: str
+        :param destBucket: bucket to create the object in
+        :type destBucket: str
+        :param bufferPool: the buffers to stream through
+        :type bufferPool: streamBuffers.BufferPool
+        :param aclArgs: acl arguments for create_multipart_upload
+        :type aclArgs: dict
+        :param partSize: size of the parts, at most the size of the buffers
+        :type partSize: int
+        :param partDigests: list the md5 digest of each part is added to
+        :type partDigests: list
+        :raises ValueError: if the object needs more than MAX_UPLOAD_PARTS
+                            parts or changes during the transfer
+        :return: the number of bytes uploaded
+        :rtype: int
+        """
+        parts = getPartRanges(objectSize, partSize)
+        if len(parts) > MAX_UPLOAD_PARTS:
+            msg = f"{srcObject} is {objectSize} bytes, which needs more " + \
+                f"than {MAX_UPLOAD_PARTS} parts of {partSize} bytes"
+            raise ValueError(msg)
+        mpu = self.botoClient.create_multipart_upload(
+            Bucket=destBucket, Key=destObject, **aclArgs
+        )
+        uploadId = mpu["UploadId"]
+
+        def streamPart(part):
+            partNumber, offset, length = part
+            with bufferPool.buffer() as buf:
+                resp = srcUtil.minIoClient.get_object(
+                    srcUtil.objStoreBucket, srcObject, offset=offset,
+                    length=length
+                )
+                try:
+                    checkPartResponse(srcObject, resp, offset, length,
+                                      objectSize)
+                    srcEtag = resp.headers.get("ETag", "").strip('"')
+                    numBytes = streamBuffers.fillBuffer(resp, buf)
+                finally:
+                    resp.close()
+                    resp.release_conn()
+                if numBytes != length:
+                    msg = f"got {numBytes} bytes of {srcObject} at " + \
+                        f"{offset}, expected {length}"
+                    raise ValueError(msg)
+                digest = hashlib.md5(memoryview(buf)[:numBytes]).digest()
+                resp = self.botoClient.upload_part(
+                    Bucket=destBucket,
+                    Key=destObject,
+                    UploadId=uploadId,
+                    PartNumber=partNumber,
+                    Body=streamBuffers.BufferReader(buf, numBytes),
+                    ContentMD5=base64.b64encode(digest).decode("ascii"),
+                )
+            return resp["ETag"], digest, srcEtag
+
+        try:
+            results = runParts(streamPart, parts, self.partParallelism)
+            checkPartEtags(srcObject, [srcEtag for _, _, srcEtag in results])
+            resp = self.botoClient.complete_multipart_upload(
+                Bucket=destBucket,
+                Key=destObject,
+                UploadId=uploadId,
+                MultipartUpload={"Parts": [
+                    {"ETag": etag, "PartNumber": partNumber}
+                    for (partNumber, _, _), (etag, _, _) in zip(parts, results)
+                ]},
+            )
+        except Exception:
+            LOGGER.warning(f"aborting multipart upload of {destObject}")
+            self.botoClient.abort_multipart_upload(
+                Bucket=destBucket, Key=destObject, UploadId=uploadId
+            )
+            raise
+        digests = [digest for _, digest, _ in results]
+        self.checkUploadEtag(destBucket, destObject, resp["ETag"],
+                             getPartsEtag(digests))
+        partDigests.extend(digests)
+        LOGGER.debug(f"streamed {destObject} in {len(parts)} parallel parts")
+        return objectSize
+
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
     def listObjects(self, inDir=None, recursive=True, returnFileNamesOnly=False):
         """lists the objects in the object store.  Run's recursive, if
         inDir arg is provided only lists objects that fall under that
@@ -115,20 +949,85 @@ class ObjectStoreUtil:
                       if no value is provided will list all objects in the
                       bucket
         :type inDir: str
-        :return: list of the object names in the bucket
-        :rtype: list
+        :param returnFileNamesOnly: return the object names in a compact
+                                    key set instead of the minio objects,
+                                    see listObjectPages for a listing that
+                                    doesn't hold the whole bucket
+        :type returnFileNamesOnly: bool
+        :return: the minio objects, or a set of the object names in the
+                 bucket in sorted order
+        :rtype: iterable, compactKeys.CompactKeySet
         """
         objects = self.minIoClient.list_objects(
             self.objStoreBucket, recursive=recursive, prefix=inDir
         )
         retVal = objects
         if returnFileNamesOnly:
-            retVal = []
-            for obj in objects:
-                retVal.append(obj.object_name)
+            retVal = compactKeys.CompactKeySet.fromKeys(
+                obj.object_name for obj in objects)
 
         return retVal
 
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
+    def listObjectPages(self, prefix=None, startAfter=None,
+                        pageSize=LIST_PAGE_SIZE):
+        """lists the objects in the bucket one page (list request) at a
+        time, so a listing of millions of objects can be processed without
+        holding all of it in memory
+
+        :param prefix: only list the objects whose names start with this
+        :type prefix: str, optional
+        :param startAfter: only list the objects with names after this key
+        :type startAfter: str, optional
+        :param pageSize: number of objects asked for per request, at most
+                         LIST_PAGE_SIZE
+        :type pageSize: int, optional
+        :yield: the objects of a page, in sorted order
+        :rtype: list of compactKeys.ObjectRecord
+        """
+        self.createBotoClient()
+        listArgs = {"Bucket": self.objStoreBucket}
+        if prefix:
+            listArgs["Prefix"] = prefix
+        if startAfter:
+            listArgs["StartAfter"] = startAfter
+        paginator = self.botoClient.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            PaginationConfig={"PageSize": min(pageSize, LIST_PAGE_SIZE)},
+            **listArgs
+        ):
+            yield [
+                compactKeys.ObjectRecord(
+                    obj["Key"], obj["Size"], obj["ETag"].strip('"'),
+                    obj["LastModified"].timestamp()
+                )
+                for obj in page.get("Contents", [])
+            ]
+
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
+    def listObjectRange(self, startAfter=None, endKey=None):
+        """lists the objects in the bucket whose names fall in the range
+        startAfter < name <= endKey.  Object stores return keys in sorted
+        order so the listing starts at startAfter and stops as soon as a key
+        past endKey is seen.
+
+        :param startAfter: objects with names after this key are listed, if
+                           not provided starts at the beginning of the bucket
+        :type startAfter: str, optional
+        :param endKey: last key to include in the listing, if not provided
+                       lists to the end of the bucket
+        :type endKey: str, optional
+        :yield: the minio objects in the range
+        :rtype: minio.datatypes.Object
+        """
+        objects = self.minIoClient.list_objects(
+            self.objStoreBucket, recursive=True, start_after=startAfter
+        )
+        for obj in objects:
+            if endKey is not None and obj.object_name > endKey:
+                break
+            yield obj
+
     def logObjectProperties(self, inObject):
         """write to the log the properties / values of the specified
         object
@@ -159,6 +1058,7 @@ class ObjectStoreUtil:
 
         return retDict
 
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
     def statObject(self, objectName):
         """runs stat on an object in the object store, returns the stat object
 
@@ -179,32 +1079,215 @@ class ObjectStoreUtil:
         client id:      constants.OBJ_STORE_USER
         client secret:  constants.OBJ_STORE_SECRET
         s3 host:        constants.OBJ_STORE_HOST
+
+        Safe to call from several threads, the client is only created once.
         """
         if objStoreUser is None:
             objStoreUser = self.objStoreUser
         if objectStoreSecret is None:
-            objStoreSecret = self.objStoreSecret
+            objectStoreSecret = self.objStoreSecret
         if objStoreHost is None:
             objStoreHost = self.objStoreHost
 
-        if self.botoSession is None:
-            self.botoSession = boto3.session.Session()
-
-        # aws_access_key_id - A specific AWS access key ID.
-        # aws_secret_access_key - A specific AWS secret access key.
-        # region_name - The AWS Region where you want to create new
-        #               connections.
-        # profile_name - The profile to use when creating your session.
-
-        if self.botoClient is None:
-            self.botoClient = self.botoSession.client(
-                service_name="s3",
-                aws_access_key_id=objStoreUser,
-                aws_secret_access_key=objStoreSecret,
-                endpoint_url=f"https://{objStoreHost}",
+        if self.botoClient is not None:
+            return
+        with self.botoLock:
+            if self.botoClient is None:
+                botoClient = objStoreClients.getBotoClient(
+                    objStoreHost, objStoreUser, objectStoreSecret,
+                    secure=self.secure
+                )
+                watchThrottles(botoClient, self)
+                objStoreMetrics.watchBotoClient(botoClient)
+                self.botoClient = botoClient
+
+    def addThrottleListener(self, listener):
+        """registers a function that is called without any arguments every
+        time the object store throttles one of our requests
+
+        :param listener: the function to call
+        :type listener: callable
+        """
+        self.throttleListeners.append(listener)
+
+    def removeThrottleListener(self, listener):
+        """stops calling a function added with addThrottleListener
+
+        :param listener: the function
+        :type listener: callable
+        """
+        if listener in self.throttleListeners:
+            self.throttleListeners.remove(listener)
+
+    @objStoreMetrics.instrument(getBytes=returnedBytes,
+                                getAttributes=objectAttributes)
+    def copyObject(self, srcObject, srcBucket, destObject=None,
+                   destBucket=None, objectSize=None, public=True):
+        """Copies an object from one bucket to another using a server side
+        copy, so the data never leaves the object store.  Objects that are
+        larger than MAX_SINGLE_COPY_SIZE are copied in parts.
+
+        The copy is run with the credentials of this object, so the account
+        needs read access to the source bucket.
+
+        :param srcObject: name of the object in the source bucket
+        :type srcObject: str
+        :param srcBucket: the bucket that the object is copied from
+        :type srcBucket: str
+        :param destObject: name of the object in the destination bucket,
+                           defaults to the source object name
+        :type destObject: str, optional
+        :param destBucket: the bucket the object is copied to, defaults to the
+                           bucket this object was created with
+        :type destBucket: str, optional
+        :param objectSize: size of the source object in bytes, if not provided
+                           it will be retrieved with a head request
+        :type objectSize: int, optional
+        :param public: when true the copied object is created with the
+                       public-read acl, saves setting it with a second call
+        :type public: bool, optional
+        :raises CopyRefusedError: if the object store will not do the copy
+        :return: the number of bytes copied
+        :rtype: int
+        """
+        if destObject is None:
+            destObject = srcObject
+        if destBucket is None:
+            destBucket = self.objStoreBucket
+        self.createBotoClient()
+        try:
+            if objectSize is None:
+                head = self.botoClient.head_object(
+                    Bucket=srcBucket, Key=srcObject
+                )
+                objectSize = head["ContentLength"]
+
+            if objectSize <= MAX_SINGLE_COPY_SIZE:
+                copyArgs = {}
+                if public:
+                    copyArgs["ACL"] = "public-read"
+                resp = self.botoClient.copy_object(
+                    Bucket=destBucket,
+                    Key=destObject,
+                    CopySource={"Bucket": srcBucket, "Key": srcObject},
+                    **copyArgs
+                )
+                LOGGER.debug(f"copy resp: {resp}")
+            else:
+                self.multipartCopy(srcObject, srcBucket, destObject,
+                                   destBucket, objectSize, public)
+        except botocore.exceptions.ClientError as err:
+            if isCopyRefused(err):
+                errCode = err.response.get("Error", {}).get("Code")
+                msg = (
+                    f"server side copy of {srcBucket}/{srcObject} refused "
+                    + f"with the error code: {errCode}"
+                )
+                raise CopyRefusedError(msg) from err
+            raise
+        return objectSize
+
+    def multipartCopy(self, srcObject, srcBucket, destObject, destBucket,
+                      objectSize, public=True):
+        """Copies an object that is too large for a single CopyObject request
+        by creating a multipart upload and populating each part with an
+        UploadPartCopy request, partParallelism parts at a time.  If any of
+        the parts fail the upload is aborted so there are no orphaned parts
+        left in the bucket.
+
+        :param srcObject: name of the object in the source bucket
+        :type srcObject: str
+        :param srcBucket: the bucket that the object is copied from
+        :type srcBucket: str
+        :param destObject: name of the object in the destination bucket
+        :type destObject: str
+        :param destBucket: the bucket the object is copied to
+        :type destBucket: str
+        :param objectSize: size of the source object in bytes
+        :type objectSize: int
+        :param public: create the new object with the public-read acl
+        :type public: bool, optional
+        """
+        self.createBotoClient()
+        createArgs = {}
+        if public:
+            createArgs["ACL"] = "public-read"
+        mpu = self.botoClient.create_multipart_upload(
+            Bucket=destBucket, Key=destObject, **createArgs
+        )
+        uploadId = mpu["UploadId"]
+
+        def copyPart(part):
+            partNumber, offset, length = part
+            resp = self.botoClient.upload_part_copy(
+                Bucket=destBucket,
+                Key=destObject,
+                UploadId=uploadId,
+                PartNumber=partNumber,
+                CopySource={"Bucket": srcBucket, "Key": srcObject},
+                CopySourceRange=f"bytes={offset}-{offset + length - 1}",
             )
+            return {
+                "ETag": resp["CopyPartResult"]["ETag"],
+                "PartNumber": partNumber
+            }
+
+        try:
+            parts = runParts(copyPart,
+                             getPartRanges(objectSize, COPY_PART_SIZE),
+                             self.partParallelism)
+            self.botoClient.complete_multipart_upload(
+                Bucket=destBucket,
+                Key=destObject,
+                UploadId=uploadId,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            LOGGER.warning(f"aborting multipart copy of {srcObject}")
+            self.botoClient.abort_multipart_upload(
+                Bucket=destBucket, Key=destObject, UploadId=uploadId
+            )
+            raise
+        LOGGER.debug(f"copied {srcObject} in {len(parts)} parts")
+
+    @objStoreMetrics.instrument()
+    def deleteObjects(self, objectNames, bucketName=None):
+        """deletes up to MAX_DELETE_BATCH objects with a single S3
+        multi-object delete request
 
-    def getPublicPermission(self, objectName, objStoreBucket):
+        :param objectNames: names of the objects to delete
+        :type objectNames: list
+        :param bucketName: the bucket, defaults to the bucket this object was
+                           created with
+        :type bucketName: str, optional
+        :raises ValueError: if there are more than MAX_DELETE_BATCH names
+        :return: the names of the objects that were deleted, and a dict of
+                 the names that could not be deleted to the error code
+        :rtype: tuple
+        """
+        if len(objectNames) > MAX_DELETE_BATCH:
+            msg = f"can only delete {MAX_DELETE_BATCH} objects per " + \
+                f"request, got {len(objectNames)}"
+            raise ValueError(msg)
+        if bucketName is None:
+            bucketName = self.objStoreBucket
+        self.createBotoClient()
+        resp = self.botoClient.delete_objects(
+            Bucket=bucketName,
+            Delete={
+                "Objects": [{"Key": name} for name in objectNames],
+                "Quiet": False,
+            },
+        )
+        deleted = [obj["Key"] for obj in resp.get("Deleted", [])]
+        errors = {err["Key"]: err.get("Code")
+                  for err in resp.get("Errors", [])}
+        LOGGER.debug(f"deleted {len(deleted)} objects from {bucketName}, "
+                     + f"errors: {len(errors)}")
+        return deleted, errors
+
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
+    def getPublicPermission(self, objectName, objStoreBucket=None):
         """uses the boto3 module to communicate with the S3 service and retrieve
         the ACL's.  Parses the acl and return the permission that is associated
         with public access.
@@ -270,6 +1353,7 @@ class ObjectStoreUtil:
                 permission = grants["Permission"]
         return permission
 
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
     def setPublicPermissions(self, objectName, objStoreBucket=None):
         """Sets the input object that exists in object store to be public
         Read.
@@ -300,6 +1384,7 @@ class ObjectStoreUtil:
         )
         LOGGER.debug(f"resp: {resp}")
 
+    @objStoreMetrics.instrument(getAttributes=objectAttributes)
     def getPresignedUrl(self, objectName, objectBucket=None):
         """
         Gets the name of an object and returns the presigned url
@@ -317,6 +1402,34 @@ class ObjectStoreUtil:
         )
         return presignUrl
 
+    @objStoreMetrics.instrument()
+    def getPresignedUrls(self, objectNames, objectBucket=None,
+                         expires=objStorePresign.DEFAULT_EXPIRY):
+        """
+        Presigns GET urls for a list of objects locally, see objStorePresign.
+        Urls are cached so asking for the same objects again is cheap.
+
+        :param objectNames: object names / keys in the object store
+        :type objectNames: list
+        :param objectBucket: the bucket, defaults to the bucket this object
+                             was created with
+        :type objectBucket: str, optional
+        :param expires: seconds the urls have to stay valid for
+        :type expires: int, optional
+        :return: the urls, in the same order as objectNames
+        :rtype: list
+        """
+        if objectBucket is None:
+            objectBucket = self.objStoreBucket
+        if self.urlSigner is None:
+            self.urlSigner = objStorePresign.UrlSigner(
+                self.objStoreHost,
+                self.objStoreUser,
+                self.objStoreSecret,
+                secure=self.secure,
+            )
+        return self.urlSigner.presignUrls(objectBucket, objectNames, expires)
+
     def testPutPerms(self):
         objFile = "ajunk.txt"
         # uploads a file
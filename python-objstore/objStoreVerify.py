@@ -0,0 +1,364 @@
+"""Checks that an object that was moved between buckets arrived intact.
+
+The size and etag of the source and destination objects are compared
+first, which only needs a HEAD request for each.  The etags can only be
+compared directly when both objects were uploaded the same way though: a
+server side copy of a large object or a streamed upload is split into
+different parts than the original upload, and the etag of a multipart
+object is the md5 of the md5s of its parts, not the md5 of the content.
+
+Streamed objects are uploaded in the part layout of the source object, and
+the md5 of each part is calculated as it is sent (objStoreUtil
+streamObject).  Those md5s give the etag of the content that was read from
+the source, so they are checked against the source etag without any
+download.
+
+Otherwise, when the etags can't be compared (a server side copy, or a source
+part size larger than the stream buffers) the destination object is
+downloaded and its etag is recalculated using the same part layout as the
+source object.  As that costs a full download it is only done for a
+deterministic sample of the objects, or for all of them with the "full"
+policy.  The other
+objects only have their sizes compared, they get the SIZE_ONLY status
+rather than MATCH so they aren't treated as verified (cleanupTestBucket
+won't delete them from the source).  So do sampled objects whose source
+was uploaded with a part size that can't be worked out, as their etag
+can't be recalculated.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+
+import objStoreDiff
+
+LOGGER = logging.getLogger(__name__)
+
+# check sizes / etags and recalculate etags for a sample of the objects
+SAMPLE = "sample"
+# recalculate etags for every object whose etag can't be compared directly
+FULL = "full"
+# don't verify
+OFF = "off"
+POLICIES = [SAMPLE, FULL, OFF]
+
+# how an object was verified
+METHOD_ETAG = "etag"
+METHOD_CHECKSUM = "checksum"
+METHOD_SIZE = "size"
+
+# status of a check
+MATCH = "match"
+MISMATCH = "mismatch"
+# the sizes match but the etags couldn't be compared and the object wasn't
+# picked for a checksum (or its etag couldn't be recalculated), it isn't
+# known to be intact
+SIZE_ONLY = "size-only"
+
+# part sizes that are tried when the object store won't report the part
+# size of a multipart object, the defaults of the common s3 clients and of
+# this repo's own copy / stream code
+COMMON_PART_SIZES = [
+    5 * 1024 ** 2,
+    8 * 1024 ** 2,
+    15 * 1024 ** 2,
+    16 * 1024 ** 2,
+    64 * 1024 ** 2,
+    512 * 1024 ** 2,
+]
+
+READ_SIZE = 1024 ** 2
+
+# etag and destEtag are the etags of the source and destination objects that
+# matched, None unless the status is MATCH
+VerifyResult = collections.namedtuple(
+    "VerifyResult", ["key", "status", "method", "detail", "etag", "destEtag"],
+    defaults=(None,)
+)
+
+
+class VerificationError(Exception):
+    """the destination object doesn't match the source object"""
+
+
+class EtagCalculator:
+    """calculates the etag that an upload with the given part size would
+    get, from the content fed to it in any size pieces
+    """
+
+    def __init__(self, partSize=None):
+        """[summary]
+
+        :param partSize: size of the parts of the upload, None for an object
+                         that was uploaded in a single request
+        :type partSize: int, optional
+        """
+        self.partSize = partSize
+        self.partDigests = []
+        self.md5 = hashlib.md5()
+        self.partBytes = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = len(view)
+            if self.partSize:
+                take = min(take, self.partSize - self.partBytes)
+            self.md5.update(view[:take])
+            self.partBytes += take
+            view = view[take:]
+            if self.partSize and self.partBytes == self.partSize:
+                self.partDigests.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.partBytes = 0
+
+    def getEtag(self):
+        """
+        :return: the etag, <md5>-<number of parts> when a part size was
+                 given
+        :rtype: str
+        """
+        if not self.partSize:
+            return self.md5.hexdigest()
+        digests = list(self.partDigests)
+        if self.partBytes or not digests:
+            digests.append(self.md5.digest())
+        combined = hashlib.md5(b"".join(digests)).hexdigest()
+        return f"{combined}-{len(digests)}"
+
+
+def getPartCount(etag):
+    """
+    :return: the number of parts in a multipart etag, None for a single
+             part etag
+    :rtype: int
+    """
+    if not objStoreDiff.isMultipartEtag(etag):
+        return None
+    return int(etag.rsplit("-", 1)[1])
+
+
+def isSampled(key, sampleRate):
+    """deterministic sample of the object names, the same objects are
+    picked on every run
+
+    :param key: name of the object
+    :type key: str
+    :param sampleRate: fraction of the objects to pick, 0 to 1
+    :type sampleRate: float
+    :rtype: bool
+    """
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") < sampleRate * 2 ** 64
+
+
+class ObjectVerifier:
+    def __init__(self, srcObjStoreUtil, destObjStoreUtil, policy=SAMPLE,
+                 sampleRate=0.05):
+        """[summary]
+
+        :param srcObjStoreUtil: util for the bucket the objects came from
+        :type srcObjStoreUtil: objStoreUtil.ObjectStoreUtil
+        :param destObjStoreUtil: util for the bucket the objects went to
+        :type destObjStoreUtil: objStoreUtil.ObjectStoreUtil
+        :param policy: one of SAMPLE, FULL or OFF
+        :type policy: str, optional
+        :param sampleRate: fraction of the objects that are downloaded to
+                           recalculate the etag with the SAMPLE policy
+        :type sampleRate: float, optional
+        """
+        if policy not in POLICIES:
+            msg = f"unknown verification policy: {policy}, expecting one " + \
+                f"of {POLICIES}"
+            raise ValueError(msg)
+        self.srcObjStoreUtil = srcObjStoreUtil
+        self.destObjStoreUtil = destObjStoreUtil
+        self.policy = policy
+        self.sampleRate = sampleRate
+        self.counts = collections.Counter()
+        self.countsLock = threading.Lock()
+
+    def isEnabled(self):
+        return self.policy != OFF
+
+    def headObject(self, objUtil, key, **kwargs):
+        objUtil.createBotoClient()
+        return objUtil.botoClient.head_object(
+            Bucket=objUtil.objStoreBucket, Key=key, **kwargs
+        )
+
+    def getPartSizes(self, key, size, partCount):
+        """works out the part size the source object was uploaded with.
+        Asks the object store for the size of the first part, and when it
+        doesn't support that, returns the common part sizes that would give
+        the right number of parts.
+
+        :return: the possible part sizes
+        :rtype: list
+        """
+        try:
+            head = self.headObject(self.srcObjStoreUtil, key, PartNumber=1)
+            partSize = head["ContentLength"]
+            if partSize < size or partCount == 1:
+                return [partSize]
+        except Exception as err:
+            LOGGER.debug(f"unable to get the part size of {key}: {err}")
+        candidates = COMMON_PART_SIZES + [
+            # the size evenly split, rounded up to the next MiB
+            -(-size // partCount // 1024 ** 2) * 1024 ** 2,
+        ]
+        return sorted(set(
+            partSize for partSize in candidates
+            if partSize and -(-size // partSize) == partCount
+        ))
+
+    def calculateEtags(self, key, partSizes):
+        """downloads the destination object and calculates its etag for each
+        of the part sizes in one pass
+
+        :return: the etags
+        :rtype: list
+        """
+        calculators = [EtagCalculator(partSize) for partSize in partSizes]
+        self.destObjStoreUtil.createBotoClient()
+        resp = self.destObjStoreUtil.botoClient.get_object(
+            Bucket=self.destObjStoreUtil.objStoreBucket, Key=key
+        )
+        for chunk in resp["Body"].iter_chunks(READ_SIZE):
+            for calculator in calculators:
+                calculator.update(chunk)
+        return [calculator.getEtag() for calculator in calculators]
+
+    def verify(self, key, partDigests=None):
+        """checks the destination object against the source object
+
+        :param key: name of the object
+        :type key: str
+        :param partDigests: md5 digests of the parts the object was uploaded
+                            in, when it was just streamed
+        :type partDigests: list, optional
+        :return: the result of the check
+        :rtype: VerifyResult
+        """
+        src = self.headObject(self.srcObjStoreUtil, key)
+        dest = self.headObject(self.destObjStoreUtil, key)
+        result = self.compareHeads(key, src["ContentLength"], src["ETag"],
+                                   dest["ContentLength"], dest["ETag"])
+        if partDigests and (result is None or result.status == SIZE_ONLY):
+            result = self.verifyDigests(key, src["ETag"], partDigests,
+                                        dest["ETag"]) or result
+        if result is None:
+            result = self.verifyChecksum(
+                key, src["ContentLength"], objStoreDiff.normalizeEtag(
+                    src["ETag"]), dest["ETag"]
+            )
+        self.recordResult(result)
+        return result
+
+    def compareHeads(self, key, srcSize, srcEtag, destSize, destEtag):
+        """checks the sizes and etags of the source and destination objects,
+        lets callers that get the HEADs some other way (objStoreAsync) share
+        the checks
+
+        :return: the result of the check, None when the destination object
+                 needs to be downloaded to recalculate its etag
+        :rtype: VerifyResult
+        """
+        srcEtag = objStoreDiff.normalizeEtag(srcEtag)
+        destEtag = objStoreDiff.normalizeEtag(destEtag)
+        if srcSize != destSize:
+            return VerifyResult(key, MISMATCH, METHOD_SIZE,
+                                f"size {destSize} != {srcSize}", None)
+        if srcEtag == destEtag:
+            return VerifyResult(key, MATCH, METHOD_ETAG, srcEtag, srcEtag,
+                                destEtag)
+        if not objStoreDiff.isMultipartEtag(srcEtag) and \
+                not objStoreDiff.isMultipartEtag(destEtag):
+            # both are plain md5s of the content
+            return VerifyResult(key, MISMATCH, METHOD_ETAG,
+                                f"etag {destEtag} != {srcEtag}", None)
+        if self.policy == FULL or isSampled(key, self.sampleRate):
+            return None
+        return VerifyResult(key, SIZE_ONLY, METHOD_SIZE,
+                            "etags not comparable, not sampled", None)
+
+    def verifyDigests(self, key, srcEtag, partDigests, destEtag=None):
+        """checks the source etag against the md5s of the parts an object
+        was streamed in, which only works when it was streamed in the part
+        layout of the source
+
+        :param srcEtag: etag of the source object
+        :type srcEtag: str
+        :param partDigests: md5 digests of the parts, in order
+        :type partDigests: list
+        :param destEtag: etag of the destination object, recorded with a
+                         match
+        :type destEtag: str, optional
+        :return: a match, or None when the etag can't be worked out from the
+                 parts
+        :rtype: VerifyResult
+        """
+        srcEtag = objStoreDiff.normalizeEtag(srcEtag)
+        partCount = getPartCount(srcEtag)
+        if partCount is None and len(partDigests) == 1:
+            etag = partDigests[0].hex()
+        elif partCount == len(partDigests):
+            combined = hashlib.md5(b"".join(partDigests)).hexdigest()
+            etag = f"{combined}-{partCount}"
+        else:
+            return None
+        if etag != srcEtag:
+            # could be the same number of parts in a different layout, left
+            # to the checksum
+            return None
+        return VerifyResult(key, MATCH, METHOD_CHECKSUM, srcEtag, srcEtag,
+                            objStoreDiff.normalizeEtag(destEtag))
+
+    def recordResult(self, result):
+        with self.countsLock:
+            self.counts[(result.method, result.status)] += 1
+
+    def verifyChecksum(self, key, size, srcEtag, destEtag=None):
+        """recalculates the etag of the destination object with the part
+        layout of the source object
+
+        :param destEtag: etag of the destination object, recorded with a
+                         match
+        :type destEtag: str, optional
+        :return: the result of the check, SIZE_ONLY when the part size of
+                 the source can't be worked out, so its etag can't be
+                 recalculated
+        :rtype: VerifyResult
+        """
+        partCount = getPartCount(srcEtag)
+        partSizes = [None]
+        if partCount is not None:
+            partSizes = self.getPartSizes(key, size, partCount)
+        if not partSizes:
+            return VerifyResult(key, SIZE_ONLY, METHOD_SIZE,
+                                f"no known part size gives {partCount} parts",
+                                None)
+        etags = self.calculateEtags(key, partSizes)
+        if srcEtag in etags:
+            return VerifyResult(key, MATCH, METHOD_CHECKSUM, srcEtag, srcEtag,
+                                objStoreDiff.normalizeEtag(destEtag))
+        return VerifyResult(key, MISMATCH, METHOD_CHECKSUM,
+                            f"calculated {etags} != {srcEtag}", None)
+
+    def getCounts(self):
+        """
+        :return: the number of results by method and status, for example
+                 {"etag match": 10, "size size-only": 2}
+        :rtype: dict
+        """
+        with self.countsLock:
+            return {
+                f"{method} {status}": count
+                for (method, status), count in sorted(self.counts.items())
+            }
+
+    def getStatusMessage(self):
+        return ", ".join(
+            f"{name}: {count}" for name, count in self.getCounts().items()
+        )
@@ -0,0 +1,259 @@
+"""Single command line entry point for the object store scripts.
+
+    python objstore.py presign names.txt --expires 3600
+    python objstore.py stat x002y012x011y021.201901.10x10.m3d.7z
+    python objstore.py index --box 48.5 -124.0 49.5 -122.5 --start 2019-01
+    python objstore.py consolidate --engine asyncio
+    python objstore.py publish
+    python objstore.py recreate-index --from-bucket --publish
+
+Each command checks the environment variables it needs before it starts
+(instead of constants needing all of them), and only imports the modules it
+uses.  presign, stat and index don't load boto3 or minio at all: urls are
+signed locally (objStorePresign) and a stat is a HEAD request on a presigned
+url, so they start in a few tens of milliseconds.  The other commands run
+the existing scripts with the rest of the command line, boto3 / minio are
+imported the first time a client is created (see lazyModules).
+"""
+
+import argparse
+import json
+import logging
+import os
+import runpy
+import sys
+import time
+
+import constants
+import objStorePresign
+
+LOGGER = logging.getLogger(__name__)
+
+# test bucket settings the scripts read, the test bucket is on OBJ_STORE_HOST
+TST_BUCKET_VARS = ['OBJ_STORE_TST_BUCKET', 'OBJ_STORE_TST_SECRET',
+                   'OBJ_STORE_TST_USER']
+# credentials needed to sign urls, the bucket can be given on the command
+# line instead
+SIGNING_VARS = ['OBJ_STORE_HOST', 'OBJ_STORE_USER', 'OBJ_STORE_SECRET']
+
+# commands that run one of the scripts with the rest of the command line,
+# the module and the environment variables it needs
+SCRIPTS = {
+    'consolidate': ('consolidate_objstores',
+                    constants.PROD_BUCKET_VARS + TST_BUCKET_VARS
+                    + ['INDEX_FILE', 'TMP_FOLDER']),
+    'shards': ('consolidateShards',
+               constants.PROD_BUCKET_VARS + TST_BUCKET_VARS
+               + ['INDEX_FILE', 'TMP_FOLDER']),
+    'publish': ('publishObjectStore',
+                constants.PROD_BUCKET_VARS + ['TMP_FOLDER']),
+    'recreate-index': ('recreateIndex',
+                       constants.PROD_BUCKET_VARS + TST_BUCKET_VARS
+                       + ['INDEX_FILE', 'TMP_FOLDER']),
+    'cleanup': ('cleanupTestBucket',
+                constants.PROD_BUCKET_VARS + TST_BUCKET_VARS
+                + ['TMP_FOLDER']),
+    'cache': ('objStoreCache', []),
+}
+
+INDEX_FILE_NAME = 'wrf_fileindex_v2.npz'
+
+
+def getSigner():
+    return objStorePresign.UrlSigner(
+        constants.OBJ_STORE_HOST, constants.OBJ_STORE_USER,
+        constants.OBJ_STORE_SECRET, secure=constants.OBJ_STORE_SECURE)
+
+
+def statObject(signer, bucket, objectName):
+    """gets the properties of an object with a HEAD request on a presigned
+    url, without loading an object store sdk
+
+    :param signer: signs the request
+    :type signer: objStorePresign.UrlSigner
+    :raises urllib.error.HTTPError: if the object store refuses the request,
+                                    404 for an object that doesn't exist
+    :return: the name, size, etag, last modified time and content type of
+             the object
+    :rtype: dict
+    """
+    import ssl
+    import urllib.request
+
+    url = signer.presignUrls(bucket, [objectName], expires=60,
+                             method="HEAD")[0]
+    context = None
+    if url.startswith("https"):
+        import certifi
+
+        context = ssl.create_default_context(
+            cafile=os.environ.get("SSL_CERT_FILE") or certifi.where())
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=60, context=context) as resp:
+        headers = resp.headers
+    return {
+        "name": objectName,
+        "size": int(headers.get("Content-Length", 0)),
+        "etag": headers.get("ETag", "").strip('"'),
+        "last_modified": headers.get("Last-Modified"),
+        "content_type": headers.get("Content-Type"),
+    }
+
+
+def runPresign(args):
+    namesFh = sys.stdin if args.names == '-' else open(args.names)
+    with namesFh:
+        objectNames = [line.strip() for line in namesFh if line.strip()]
+    start = time.perf_counter()
+    urls = getSigner().presignUrls(
+        args.bucket or constants.OBJ_STORE_BUCKET, objectNames,
+        expires=args.expires)
+    sys.stdout.write("".join(url + "\n" for url in urls))
+    LOGGER.info(f"signed {len(urls)} urls in "
+                + f"{(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+def runStat(args):
+    import urllib.error
+
+    signer = getSigner()
+    bucket = args.bucket or constants.OBJ_STORE_BUCKET
+    failed = 0
+    for objectName in args.names:
+        try:
+            print(json.dumps(statObject(signer, bucket, objectName)))
+        except urllib.error.HTTPError as err:
+            LOGGER.error(f"unable to stat {objectName}: {err.code} "
+                         + f"{err.reason}")
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+
+def runIndex(args):
+    import wrfIndex
+
+    indexFile = args.index_file or os.path.join(constants.TMP_FOLDER,
+                                                INDEX_FILE_NAME)
+    index = wrfIndex.WRFIndex.load(indexFile)
+    if args.grid:
+        names = index.queryGrid(*args.grid, start=args.start, end=args.end)
+    else:
+        names = index.query(*args.box, start=args.start, end=args.end)
+    sys.stdout.write("".join(name + "\n" for name in names))
+    LOGGER.info(f"{len(names)} files")
+
+
+def runScript(command, scriptArgs):
+    """runs one of the scripts as if it was started on its own
+
+    :param command: the command, a key of SCRIPTS
+    :type command: str
+    :param scriptArgs: the arguments for the script
+    :type scriptArgs: list
+    """
+    module, _ = SCRIPTS[command]
+    sys.argv = [f"objstore.py {command}"] + scriptArgs
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def getRequiredVars(command, args=None):
+    """
+    :param command: the command that is being run
+    :type command: str
+    :param args: the parsed arguments of presign, stat and index
+    :type args: argparse.Namespace, optional
+    :return: the environment variables the command needs, with the options
+             it was given
+    :rtype: list
+    """
+    if command in SCRIPTS:
+        required = list(SCRIPTS[command][1])
+        if command == 'cache' and 'OBJECT_CACHE_DIR' not in os.environ:
+            required.append('TMP_FOLDER')
+        return required
+    if command in ('presign', 'stat'):
+        return SIGNING_VARS + ([] if args.bucket else ['OBJ_STORE_BUCKET'])
+    if command == 'index':
+        return [] if args.index_file else ['TMP_FOLDER']
+    return []
+
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        prog='objstore.py',
+        description='object store tasks for the WRF data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    presignParser = subparsers.add_parser(
+        'presign', help='write a presigned url for each object name read '
+                        'from a file (or stdin), one per line')
+    presignParser.add_argument('names', nargs='?', default='-',
+                               help='file with one object name per line')
+    presignParser.add_argument('--expires', type=int,
+                               default=objStorePresign.DEFAULT_EXPIRY,
+                               help='seconds the urls stay valid for')
+    presignParser.add_argument('--bucket', default=None,
+                               help='defaults to OBJ_STORE_BUCKET')
+
+    statParser = subparsers.add_parser(
+        'stat', help='write the size, etag and last modified time of '
+                     'objects as json, one per line')
+    statParser.add_argument('names', nargs='+', help='object names')
+    statParser.add_argument('--bucket', default=None,
+                            help='defaults to OBJ_STORE_BUCKET')
+
+    indexParser = subparsers.add_parser(
+        'index', help='list the files in the binary index that cover an '
+                      'area and a date range')
+    area = indexParser.add_mutually_exclusive_group(required=True)
+    area.add_argument('--box', nargs=4, type=float,
+                      metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'))
+    area.add_argument('--grid', nargs=4, type=int,
+                      metavar=('MIN_I', 'MIN_J', 'MAX_I', 'MAX_J'))
+    indexParser.add_argument('--start', default=None,
+                             help='first date, for example 2019-01')
+    indexParser.add_argument('--end', default=None, help='last date')
+    indexParser.add_argument('--index-file', default=None,
+                             help=f'defaults to TMP_FOLDER/{INDEX_FILE_NAME}')
+
+    # only listed here for the help, main hands their arguments straight to
+    # the script
+    for command, (module, _) in SCRIPTS.items():
+        subparsers.add_parser(
+            command, add_help=False,
+            help=f'run {module}.py, see objstore.py {command} --help')
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = getParser()
+    if argv and argv[0] in SCRIPTS:
+        command = argv[0]
+        try:
+            constants.require(*getRequiredVars(command))
+        except constants.MissingConfigError as err:
+            parser.error(f"{command}: {err}")
+        runScript(command, argv[1:])
+        return
+
+    args = parser.parse_args(argv)
+    try:
+        constants.require(*getRequiredVars(args.command, args))
+    except constants.MissingConfigError as err:
+        parser.error(f"{args.command}: {err}")
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.command == 'presign':
+        runPresign(args)
+    elif args.command == 'stat':
+        runStat(args)
+    elif args.command == 'index':
+        runIndex(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,220 @@
+"""Makes every object in a bucket public / read.
+
+The bucket is listed once through the bucket inventory, objects that the
+inventory already knows are public are skipped, and the rest are checked and
+published on a bounded pool of threads, or with the asyncio engine
+(objStoreAsync).
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
 import logging
+import time
 
+import constants
+import objStoreAsync
+import objStoreClients
+import objStoreInventory
+import objStoreMetrics
 import objStoreUtil
 
 LOGGER = logging.getLogger()
 
+DEFAULT_WORKERS = 16
+# how often (in objects) progress is written to the log
+PROGRESS_INTERVAL = 500
+
+
+class BulkPublisher:
+    def __init__(self, objUtil=None, inventory=None,
+                 maxWorkers=DEFAULT_WORKERS, checkFirst=True):
+        """[summary]
+
+        :param objUtil: used to talk to the bucket, defaults to a
+                        ObjectStoreUtil for the OBJ_STORE_BUCKET bucket
+        :type objUtil: objStoreUtil.ObjectStoreUtil, optional
+        :param inventory: inventory of the bucket, used to list the bucket
+                          and remember which objects are public
+        :type inventory: objStoreInventory.BucketInventory, optional
+        :param maxWorkers: number of objects published at the same time
+        :type maxWorkers: int, optional
+        :param checkFirst: get the acl of each object before setting it,
+                           when false the acl is set on every object which
+                           saves a round trip on buckets that are mostly
+                           private
+        :type checkFirst: bool, optional
+        """
+        self.objUtil = objUtil
+        if self.objUtil is None:
+            self.objUtil = objStoreUtil.ObjectStoreUtil()
+        self.inventory = inventory
+        if self.inventory is None:
+            self.inventory = objStoreInventory.BucketInventory(self.objUtil)
+        self.maxWorkers = maxWorkers
+        self.checkFirst = checkFirst
+
+        self.checked = 0
+        self.published = 0
+        self.alreadyPublic = 0
+        self.failed = []
+
+    def publishObject(self, objectName):
+        """makes a single object public if it isn't already
+
+        :param objectName: name of the object to publish
+        :type objectName: str
+        :return: true if the acl was changed, false if it was already public
+        :rtype: bool
+        """
+        if self.checkFirst:
+            pubPerms = self.objUtil.getPublicPermission(objectName)
+            if pubPerms is not None:
+                LOGGER.debug(f"already public: {objectName}")
+                return False
+        LOGGER.debug(f"making the object: {objectName} public")
+        self.objUtil.setPublicPermissions(objectName)
+        return True
+
+    def publishAll(self, limit=None):
+        """publishes all the objects in the bucket that are not known to be
+        public
+
+        :param limit: only publish this many objects, used for testing
+        :type limit: int, optional
+        :return: names of the objects that could not be published
+        :rtype: list
+        """
+        self.objUtil.createBotoClient()
+        objectNames = (
+            record.object_name for record in self.inventory.listNotPublic()
+        )
+        objectNames = itertools.islice(objectNames, limit)
+        start = time.time()
+        # objects that have been published but not yet recorded in the
+        # inventory, written in batches
+        publicObjects = []
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.maxWorkers
+        ) as executor:
+            futures = {}
+
+            def submit(objectName):
+                fut = executor.submit(self.publishObject, objectName)
+                futures[fut] = objectName
+
+            for objectName in itertools.islice(objectNames, self.maxWorkers):
+                submit(objectName)
+
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for fut in done:
+                    objectName = futures.pop(fut)
+                    self.checked += 1
+                    try:
+                        changed = fut.result()
+                    except Exception as err:
+                        LOGGER.error(f"unable to publish {objectName}: {err}")
+                        self.failed.append(objectName)
+                        continue
+                    if changed:
+                        self.published += 1
+                    else:
+                        self.alreadyPublic += 1
+                    publicObjects.append(objectName)
+                    if not self.checked % PROGRESS_INTERVAL:
+                        self.logProgress(start)
+                if len(publicObjects) >= PROGRESS_INTERVAL:
+                    self.inventory.markPublic(publicObjects)
+                    publicObjects = []
+                for objectName in itertools.islice(objectNames, len(done)):
+                    submit(objectName)
+
+        self.inventory.markPublic(publicObjects)
+        self.logProgress(start)
+        LOGGER.info(f"connection stats: {objStoreClients.getStats()}")
+        return self.failed
+
+    def publishAllAio(self, limit=None):
+        """publishAll on the asyncio engine, maxWorkers is the number of
+        objects in flight
+
+        :param limit: only publish this many objects, used for testing
+        :type limit: int, optional
+        :return: names of the objects that could not be published
+        :rtype: list
+        """
+        return asyncio.run(self.publishAllCoro(limit))
+
+    async def publishObjectCoro(self, store, objectName):
+        """the asyncio version of publishObject"""
+        if self.checkFirst:
+            pubPerms = await store.getPublicPermission(objectName)
+            if pubPerms is not None:
+                LOGGER.debug(f"already public: {objectName}")
+                return False
+        LOGGER.debug(f"making the object: {objectName} public")
+        await store.setPublicPermissions(objectName)
+        return True
+
+    async def publishAllCoro(self, limit=None):
+        store = objStoreAsync.AsyncObjectStore(
+            objStoreHost=self.objUtil.objStoreHost,
+            objStoreUser=self.objUtil.objStoreUser,
+            objStoreSecret=self.objUtil.objStoreSecret,
+            objStoreBucket=self.objUtil.objStoreBucket,
+            secure=self.objUtil.secure,
+            maxConcurrency=self.maxWorkers,
+        )
+        objectNames = (
+            record.object_name for record in self.inventory.listNotPublic()
+        )
+        objectNames = itertools.islice(objectNames, limit)
+        start = time.time()
+        publicObjects = []
+
+        async def publish(objectName):
+            try:
+                changed = await self.publishObjectCoro(store, objectName)
+            except Exception as err:
+                LOGGER.error(f"unable to publish {objectName}: {err}")
+                self.failed.append(objectName)
+                changed = None
+            self.checked += 1
+            if changed is not None:
+                if changed:
+                    self.published += 1
+                else:
+                    self.alreadyPublic += 1
+                publicObjects.append(objectName)
+            if not self.checked % PROGRESS_INTERVAL:
+                self.logProgress(start)
+            if len(publicObjects) >= PROGRESS_INTERVAL:
+                self.inventory.markPublic(publicObjects)
+                publicObjects.clear()
+
+        async with store:
+            await objStoreAsync.forEach(
+                objStoreAsync.iterInExecutor(objectNames, PROGRESS_INTERVAL),
+                publish, self.maxWorkers
+            )
+
+        self.inventory.markPublic(publicObjects)
+        self.logProgress(start)
+        return self.failed
+
+    def logProgress(self, start):
+        elapsed = max(time.time() - start, 0.001)
+        LOGGER.info(
+            f"checked: {self.checked}, published: {self.published}, "
+            + f"already public: {self.alreadyPublic}, failed: "
+            + f"{len(self.failed)}, {self.checked / elapsed:.1f} objects/s"
+        )
+
 
 if __name__ == "__main__":
     """script will:
@@ -12,6 +223,21 @@ if __name__ == "__main__":
     3. get a list of the objects
     4. for each object identify if its public and if not make it public
     """
+    parser = argparse.ArgumentParser(
+        description="make all the objects in OBJ_STORE_BUCKET public"
+    )
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of objects to publish at the same time,"
+                        + f" defaults to {DEFAULT_WORKERS} with threads or "
+                        + "ASYNC_MAX_CONCURRENCY with asyncio")
+    parser.add_argument("--engine", choices=objStoreAsync.ENGINES,
+                        default=constants.OBJ_STORE_ENGINE,
+                        help="publish on a pool of threads, or with asyncio")
+    parser.add_argument("--no-check", action="store_true",
+                        help="set the acl without checking it first")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="only publish this many objects")
+    args = parser.parse_args()
 
     # LOGGER.setLevel(logging.DEBUG)
     LOGGER.setLevel(logging.INFO)
@@ -25,27 +251,22 @@ if __name__ == "__main__":
     LOGGER.addHandler(hndlr)
     LOGGER.debug("test")
 
-    objUtil = objStoreUtil.ObjectStoreUtil()
-    objList = objUtil.listObjects()
-
-    cnt = 1
-    for obj in objList:
-        objStoreObjDict = objUtil.getObjAsDict(obj)
-        LOGGER.info(f"checking object: {objStoreObjDict['object_name']}")
-        LOGGER.debug(f"objStoreObjDict: {objStoreObjDict}")
-        pubPerms = objUtil.getPublicPermission(objStoreObjDict["object_name"])
-        if pubPerms is None:
-            LOGGER.info(
-                "making the object: "
-                + f"{objStoreObjDict['object_name']} public"
-            )
-            objUtil.setPublicPermissions(objStoreObjDict["object_name"])
-        # Testing... limit the number of iterations
-        if cnt > 3:
-            raise
-        cnt += 1
-    # pub.statObject(constants.TEST_OBJ_NAME)
-    # pubPermission = pub.getPublicPermission(constants.TEST_OBJ_NAME)
-    # pub.setPublicPermissions(constants.TEST_OBJ_NAME)
-
-    # objUtil.testPutPerms()
+    objStoreMetrics.startFromConfig(
+        constants.METRICS_PORT, constants.METRICS_FILE,
+        constants.METRICS_INTERVAL
+    )
+    workers = args.workers
+    if workers is None:
+        workers = DEFAULT_WORKERS
+        if args.engine == objStoreAsync.ENGINE_ASYNCIO:
+            workers = constants.ASYNC_MAX_CONCURRENCY
+    objStoreClients.setPoolSize(workers)
+    publisher = BulkPublisher(
+        maxWorkers=workers, checkFirst=not args.no_check
+    )
+    if args.engine == objStoreAsync.ENGINE_ASYNCIO:
+        publisher.publishAllAio(limit=args.limit)
+    else:
+        publisher.publishAll(limit=args.limit)
+    if constants.METRICS_FILE:
+        objStoreMetrics.writeSnapshot(constants.METRICS_FILE)
@@ -6,13 +6,57 @@ Seeing as we are not spanning multiple buckets we are also going to simplify
 the structure of the index file.
 """
 
+import argparse
 import constants
+import csv
+import csvPipeline
+import json
 import os
+import objStoreCache
+import objStoreInventory
 import objStoreUtil
 import logging
+import re
+import wrfGrid
+import wrfIndex
 
 LOGGER = logging.getLogger()
 
+# columns of the simplified (v2) index, the v2 csv doesn't have a header so
+# they are written in this order
+V2_COLUMNS = ['filename', 'I0', 'J0', 'I1', 'J1', 'date', 'LAT0', 'LON0',
+              'LAT1', 'LON1']
+
+# WRF object names look like x002y012x011y021.201901.10x10.m3d.7z, the
+# grid extents of the tile followed by the year and month
+WRF_OBJECT_NAME = re.compile(
+    r'^x(\d{3})y(\d{3})x(\d{3})y(\d{3})\.(\d{6})\.')
+
+
+def parseObjectName(objectName):
+    """extracts the index columns that can be derived from the name of a WRF
+    object
+
+    :param objectName: the name of the object in object storage
+    :type objectName: str
+    :return: dict with the filename, I0, J0, I1, J1 and date columns, None
+             if the object isn't a WRF file
+    :rtype: dict
+    """
+    match = WRF_OBJECT_NAME.match(objectName)
+    if not match:
+        return None
+    i0, j0, i1, j1, date = match.groups()
+    return {
+        'filename': objectName,
+        'I0': str(int(i0)),
+        'J0': str(int(j0)),
+        'I1': str(int(i1)),
+        'J1': str(int(j1)),
+        'date': date
+    }
+
+
 class CreateIndex:
 
     def __init__(self):
@@ -21,15 +65,39 @@ class CreateIndex:
         self.csvFile = r'oldWRFIndexFile.csv'
         self.oldWrfFile = os.path.join(self.tmpFolder, constants.INDEX_FILE)
         self.newWrfFile = os.path.join(self.tmpFolder, 'wrf_fileindex_v2.csv')
-
+        # binary version of the new index, see wrfIndex
+        self.newWrfIndexFile = os.path.join(self.tmpFolder,
+                                            'wrf_fileindex_v2.npz')
+        # remembers how far into the bucket listing the last build got
+        self.buildStateFile = os.path.join(self.tmpFolder,
+                                           'wrf_fileindex_v2.state.json')
+        # lat / lon of the WRF grid cells, used for tiles that aren't in the
+        # old index
+        self.domainFile = os.path.join(self.tmpFolder, constants.DOMAIN_FILE)
+        # the old index and the domain file are only downloaded again when
+        # they change
+        self.objectCache = objStoreCache.ObjectCache()
 
         self.objStrUtil = objStoreUtil.ObjectStoreUtil(
             objStoreHost=constants.OBJ_STORE_HOST,
             objStoreUser=constants.OBJ_STORE_TST_USER,
             objStoreSecret=constants.OBJ_STORE_TST_SECRET,
             objStoreBucket=constants.OBJ_STORE_TST_BUCKET,
-            tmpfolder=self.tmpFolder
+            tmpfolder=self.tmpFolder,
+            objectCache=self.objectCache
         )
+        # the consolidated bucket that the index is built from and published
+        # to
+        self.prodObjStrUtil = objStoreUtil.ObjectStoreUtil(
+            objStoreHost=constants.OBJ_STORE_HOST,
+            objStoreUser=constants.OBJ_STORE_USER,
+            objStoreSecret=constants.OBJ_STORE_SECRET,
+            objStoreBucket=constants.OBJ_STORE_BUCKET,
+            tmpfolder=self.tmpFolder,
+            objectCache=self.objectCache
+        )
+        self.prodInventory = objStoreInventory.BucketInventory(
+            self.prodObjStrUtil)
         self.getWRFIndexFile()
 
     def getWRFIndexFile(self):
@@ -42,11 +110,12 @@ class CreateIndex:
         contents of the file.
         """
         LOGGER.info("checking on cached version of existing index file")
-        if not os.path.exists(self.csvFile):
-            csvFile = os.path.join(self.tmpFolder, os.path.basename(self.csvFile))
-            oldWrfFile = os.path.basename(self.oldWrfFile)
-            LOGGER.info(f'retrieving the index file: {oldWrfFile}')
-            self.objStrUtil.getObject(oldWrfFile, csvFile)
+        csvFile = os.path.join(self.tmpFolder, os.path.basename(self.csvFile))
+        oldWrfFile = os.path.basename(self.oldWrfFile)
+        # goes through the object cache, which checks the cached copy with a
+        # conditional GET and only downloads the index if it changed
+        LOGGER.info(f'retrieving the index file: {oldWrfFile}')
+        self.objStrUtil.getObject(oldWrfFile, csvFile)
 
     def reCreate(self):
         """deletes existing new wrf file,
@@ -56,24 +125,211 @@ class CreateIndex:
             LOGGER.info("deleting existing new WRF file")
             os.remove(self.newWrfFile)
 
-        columns2Copy = ['filename', 'I0','J0','I1','J1','date','LAT0','LON0',
-                        'LAT1','LON1']
+        csvPipeline.projectColumns(self.oldWrfFile, self.newWrfFile,
+                                   V2_COLUMNS)
+
+        LOGGER.info(f"writing the binary index: {self.newWrfIndexFile}")
+        index = wrfIndex.WRFIndex.fromCsv(self.oldWrfFile)
+        index.save(self.newWrfIndexFile)
 
-        with open(self.newWrfFile, 'w') as fhWrite:
-            with open(self.oldWrfFile, 'r') as fhRead:
-                header = fhRead.readline().strip().split(',')
-                positions = []
-                colCnt = 0
-                for columnName in header:
-                    if columnName in columns2Copy:
-                        positions.append(colCnt)
-                    colCnt += 1
+    def readNewIndex(self):
+        """reads the rows of the last v2 index that was built, falls back to
+        the rows of the old index file that getWRFIndexFile downloaded if
+        there isn't one
 
-                for line in fhRead:
-                    inElems = line.strip().split(',')
-                    outElems = [inElems[i] for i in positions]
-                    outLine = ','.join(outElems) + '\n'
-                    fhWrite.write(outLine)
+        :return: dict of filename to row dict
+        :rtype: dict
+        """
+        rows = {}
+        oldCsvFile = os.path.join(self.tmpFolder,
+                                  os.path.basename(self.csvFile))
+        if os.path.exists(self.newWrfFile):
+            with open(self.newWrfFile, 'r', newline='') as fh:
+                for values in csv.reader(fh):
+                    row = dict(zip(V2_COLUMNS, values))
+                    rows[row['filename']] = row
+        elif os.path.exists(oldCsvFile):
+            with open(oldCsvFile, 'r', newline='') as fh:
+                for oldRow in csv.DictReader(fh):
+                    row = {name: oldRow[name] for name in V2_COLUMNS}
+                    rows[row['filename']] = row
+        return rows
+
+    def getTileExtents(self, rows):
+        """the object names only have the grid extents of a tile, the lat /
+        lon extents are copied from other rows for the same tile
+
+        :param rows: the existing index rows
+        :type rows: iterable
+        :return: dict of (I0, J0, I1, J1) to (LAT0, LON0, LAT1, LON1)
+        :rtype: dict
+        """
+        extents = {}
+        for row in rows:
+            if not row['LAT0']:
+                continue
+            tile = (row['I0'], row['J0'], row['I1'], row['J1'])
+            extents[tile] = (row['LAT0'], row['LON0'], row['LAT1'],
+                             row['LON1'])
+        return extents
+
+    def getGridLocator(self):
+        """downloads the domain file from the consolidated bucket if there
+        isn't a local copy and loads it
+
+        :return: the grid locator, None if the domain file isn't available
+        :rtype: wrfGrid.GridLocator
+        """
+        LOGGER.info(f"retrieving the domain file: {constants.DOMAIN_FILE}")
+        try:
+            self.prodObjStrUtil.getObject(constants.DOMAIN_FILE,
+                                          self.domainFile)
+        except Exception as err:
+            LOGGER.warning(f"unable to get the domain file: {err}")
+            if not os.path.exists(self.domainFile):
+                return None
+        return wrfGrid.GridLocator.load(self.domainFile)
+
+    def fillTileExtents(self, rows):
+        """sets the lat / lon extents of rows for tiles that weren't in the
+        existing index from the lat / lon of the corner cells of the tile
+
+        :param rows: the index rows that don't have lat / lon extents
+        :type rows: list
+        """
+        locator = self.getGridLocator()
+        if locator is None or not rows:
+            return
+        corners = [('I0', 'J0', 'LAT0', 'LON0'), ('I1', 'J1', 'LAT1', 'LON1')]
+        for iName, jName, latName, lonName in corners:
+            iValues = [int(row[iName]) for row in rows]
+            jValues = [int(row[jName]) for row in rows]
+            lats, lons = locator.cellLatLon(iValues, jValues)
+            for row, lat, lon in zip(rows, lats, lons):
+                row[latName] = '' if lat != lat else str(round(lat, 6))
+                row[lonName] = '' if lon != lon else str(round(lon, 6))
+        for row in rows:
+            if not (row['LAT0'] and row['LAT1']):
+                row['LAT0'] = row['LON0'] = row['LAT1'] = row['LON1'] = ''
+        LOGGER.info(f"located {len(rows)} new tiles on the WRF grid")
+
+    def readBuildState(self):
+        if not os.path.exists(self.buildStateFile) or \
+                not os.path.exists(self.newWrfFile):
+            return {'watermark': 0}
+        with open(self.buildStateFile, 'r') as fh:
+            return json.load(fh)
+
+    def writeAtomic(self, destFile, writeFunc):
+        """writes a file through a temporary file that is renamed into
+        place, so readers never see a partially written file
+
+        :param destFile: the file to write
+        :type destFile: str
+        :param writeFunc: called with the path to the temporary file
+        :type writeFunc: function
+        """
+        # keeps the extension, numpy adds .npz to names without it
+        root, ext = os.path.splitext(destFile)
+        tmpFile = root + '.tmp' + ext
+        writeFunc(tmpFile)
+        os.replace(tmpFile, destFile)
+
+    def buildFromBucket(self, force=False):
+        """builds the v2 index from the inventory of the consolidated bucket
+        instead of the old index file.  The index columns are parsed from the
+        object names, only the objects that were added or changed since the
+        last build are parsed, and rows for objects that have been removed
+        from the bucket are dropped.
+
+        :param force: re-list the whole bucket and parse every object
+        :type force: bool, optional
+        :return: the index rows, keyed by filename
+        :rtype: dict
+        """
+        rows = self.readNewIndex()
+        extents = self.getTileExtents(rows.values())
+        watermark = self.readBuildState()['watermark']
+        if force:
+            watermark = 0
+        LOGGER.info(f"existing index rows: {len(rows)}, watermark: "
+                    f"{watermark}")
+        self.prodInventory.refresh(force=force)
+
+        newRows = {}
+        newest = watermark
+        parsed = 0
+        for record in self.prodInventory.listObjectRange():
+            newest = max(newest, record.last_modified or 0)
+            existing = rows.get(record.object_name)
+            if existing is not None and \
+                    (record.last_modified or 0) <= watermark:
+                newRows[record.object_name] = existing
+                continue
+            row = parseObjectName(record.object_name)
+            if row is None:
+                continue
+            tile = (row['I0'], row['J0'], row['I1'], row['J1'])
+            latLon = extents.get(tile, ('', '', '', ''))
+            row.update(zip(['LAT0', 'LON0', 'LAT1', 'LON1'], latLon))
+            if existing is not None and existing['LAT0'] and not row['LAT0']:
+                row.update({name: existing[name] for name in
+                            ['LAT0', 'LON0', 'LAT1', 'LON1']})
+            newRows[record.object_name] = row
+            parsed += 1
+        self.fillTileExtents(
+            [row for row in newRows.values() if not row['LAT0']])
+        removed = len(set(rows) - set(newRows))
+        LOGGER.info(f"parsed {parsed} new or changed objects, removed "
+                    f"{removed} rows, index rows: {len(newRows)}")
+
+        self.writeIndex(newRows)
+        self.writeAtomic(
+            self.buildStateFile,
+            lambda tmpFile: self.writeJson(tmpFile, {'watermark': newest}))
+        return newRows
+
+    def writeJson(self, jsonFile, data):
+        with open(jsonFile, 'w') as fh:
+            json.dump(data, fh)
+
+    def writeCsv(self, csvFile, rows):
+        with open(csvFile, 'w', newline='') as fh:
+            writer = csv.writer(fh, lineterminator='\n')
+            for row in rows:
+                writer.writerow([row[name] for name in V2_COLUMNS])
+
+    def writeIndex(self, rows):
+        """writes the csv and binary versions of the v2 index, tiles whose
+        lat / lon extents aren't known are left out of the binary index
+
+        :param rows: the index rows, keyed by filename
+        :type rows: dict
+        """
+        sortedRows = [rows[name] for name in sorted(rows)]
+        self.writeAtomic(self.newWrfFile,
+                         lambda tmpFile: self.writeCsv(tmpFile, sortedRows))
+
+        located = [row for row in sortedRows if row['LAT0']]
+        if len(located) != len(sortedRows):
+            LOGGER.warning(f"{len(sortedRows) - len(located)} rows don't "
+                           "have lat / lon extents")
+        index = wrfIndex.WRFIndex.fromRows(located)
+        self.writeAtomic(self.newWrfIndexFile, index.save)
+
+    def publish(self):
+        """uploads the v2 index files to the consolidated bucket.  Each
+        object is replaced in a single put so readers get either the old or
+        the new version, the binary index is put first so the csv is never
+        newer than it.
+        """
+        for indexFile in [self.newWrfIndexFile, self.newWrfFile]:
+            if not os.path.exists(indexFile):
+                continue
+            objectName = os.path.basename(indexFile)
+            LOGGER.info(f"publishing {objectName} to "
+                        f"{self.prodObjStrUtil.objStoreBucket}")
+            self.prodObjStrUtil.putObject(objectName, indexFile, public=True)
 
 
 
@@ -96,7 +352,26 @@ if __name__ == '__main__':
     urllibLog = logging.getLogger('urllib3.connectionpool')
     urllibLog.setLevel(logging.INFO)
 
+    parser = argparse.ArgumentParser(
+        description='creates the simplified WRF index file')
+    parser.add_argument(
+        '--from-bucket', action='store_true',
+        help='build the index from the objects in the bucket instead of '
+             'the old index file')
+    parser.add_argument(
+        '--full', action='store_true',
+        help='with --from-bucket, re-list and parse every object instead '
+             'of just the ones that changed since the last build')
+    parser.add_argument(
+        '--publish', action='store_true',
+        help='upload the new index files to the bucket')
+    args = parser.parse_args()
+
     # --
     ci = CreateIndex()
-    ci.getWRFIndexFile()
-    ci.reCreate()
+    if args.from_bucket:
+        ci.buildFromBucket(force=args.full)
+    else:
+        ci.reCreate()
+    if args.publish:
+        ci.publish()
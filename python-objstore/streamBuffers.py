@@ -0,0 +1,143 @@
+"""Fixed size, reusable in memory buffers used to stream objects from one
+bucket to another without writing them to disk.
+
+The pool never allocates more than memoryBudget bytes of buffers.  Threads
+that ask for a buffer when they have all been handed out wait until one is
+released, so the memory used by the transfers stays the same no matter how
+many threads are moving data.
+"""
+
+import contextlib
+import io
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# S3 requires every part of a multipart upload except the last to be at
+# least 5MB
+MIN_PART_SIZE = 5 * 1024 ** 2
+DEFAULT_PART_SIZE = 16 * 1024 ** 2
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+
+class BufferPool:
+    def __init__(self, bufferSize=DEFAULT_PART_SIZE,
+                 memoryBudget=DEFAULT_MEMORY_BUDGET):
+        """[summary]
+
+        :param bufferSize: size in bytes of each buffer, this is also the
+                           part size of the multipart uploads
+        :type bufferSize: int, optional
+        :param memoryBudget: total number of bytes the buffers can use
+        :type memoryBudget: int, optional
+        :raises ValueError: if the buffer size is smaller than the minimum
+                            part size of a multipart upload
+        """
+        if bufferSize < MIN_PART_SIZE:
+            msg = (
+                f"buffer size of {bufferSize} is smaller than the minimum "
+                + f"multipart upload part size: {MIN_PART_SIZE}"
+            )
+            raise ValueError(msg)
+        self.bufferSize = bufferSize
+        self.maxBuffers = max(1, memoryBudget // bufferSize)
+        # buffers are created when they are first needed, and then reused
+        self.free = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        LOGGER.debug(
+            f"buffer pool: {self.maxBuffers} buffers of {bufferSize} bytes"
+        )
+
+    def acquire(self):
+        """gets a buffer from the pool, blocks if they are all in use
+
+        :return: a buffer of bufferSize bytes
+        :rtype: bytearray
+        """
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.maxBuffers:
+                self.created += 1
+                return bytearray(self.bufferSize)
+        return self.free.get()
+
+    def release(self, buf):
+        """returns a buffer to the pool
+
+        :param buf: a buffer that was returned by acquire
+        :type buf: bytearray
+        """
+        self.free.put(buf)
+
+    @contextlib.contextmanager
+    def buffer(self):
+        """context manager that acquires a buffer and releases it when done
+        """
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+
+def fillBuffer(stream, buf):
+    """reads from a stream until the buffer is full or the stream ends
+
+    :param stream: file like object that supports readinto, for example the
+                   response returned by minio's get_object
+    :type stream: io.IOBase
+    :param buf: the buffer to read into
+    :type buf: bytearray
+    :return: the number of bytes read, less than the size of the buffer
+             means the stream has ended
+    :rtype: int
+    """
+    view = memoryview(buf)
+    filled = 0
+    while filled < len(buf):
+        numRead = stream.readinto(view[filled:])
+        if not numRead:
+            break
+        filled += numRead
+    return filled
+
+
+class BufferReader(io.RawIOBase):
+    """read only, seekable file like object over part of a buffer, lets boto
+    upload from a buffer without copying it into a new bytes object
+    """
+
+    def __init__(self, buf, length):
+        self.view = memoryview(buf)[:length]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        numBytes = min(len(b), len(self.view) - self.position)
+        b[:numBytes] = self.view[self.position:self.position + numBytes]
+        self.position += numBytes
+        return numBytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = len(self.view) + offset
+        self.position = max(0, min(self.position, len(self.view)))
+        return self.position
+
+    def tell(self):
+        return self.position
@@ -0,0 +1,276 @@
+"""Keeps the prod bucket in sync with the test bucket.
+
+Runs the consolidation in a loop.  Every cycle lists the source bucket one
+inventory shard at a time and compares the newest last modified time and
+the number of objects in each shard with a checkpoint of the last cycle
+that moved that shard.  Only the shards that changed are diffed and moved,
+the destination isn't listed again (its inventory is kept current as files
+are moved), so a cycle where nothing changed costs one list request per
+thousand source objects.  S3 has no cheaper way to find out what changed.
+
+Between cycles the daemon sleeps for the interval plus or minus some
+jitter, so several shards don't list the bucket in lock step.  The time
+since the last cycle that finished without failures (the lag) is served as
+json on /health, which returns a 503 when the lag is too large.
+"""
+
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+import objStoreDiff
+import objStoreInventory
+
+LOGGER = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "sync_checkpoint"
+
+STARTING = "starting"
+OK = "ok"
+LAGGING = "lagging"
+
+
+class SyncDaemon:
+    def __init__(self, consolidator, moveFiles=None, interval=300, jitter=0.2,
+                 maxLag=None, checkpointFile=None):
+        """[summary]
+
+        :param consolidator: does the diffing and moving, its shard limits
+                             the keys the daemon looks at
+        :type consolidator: consolidate_objstores.ConsolidateStorage
+        :param moveFiles: the method of the consolidator that moves a list
+                          of files, defaults to moveFilesAsync
+        :type moveFiles: callable, optional
+        :param interval: seconds between the start of one cycle and the next
+        :type interval: float, optional
+        :param jitter: fraction of the interval that is randomly added or
+                       taken away from each sleep
+        :type jitter: float, optional
+        :param maxLag: lag in seconds after which /health reports an error,
+                       defaults to three intervals
+        :type maxLag: float, optional
+        :param checkpointFile: json file with the state of each shard at the
+                               last cycle that moved it, defaults to
+                               sync_checkpoint.json in the consolidator's
+                               tmp folder
+        :type checkpointFile: str, optional
+        """
+        self.consolidator = consolidator
+        self.moveFiles = moveFiles or consolidator.moveFilesAsync
+        self.interval = interval
+        self.jitter = jitter
+        self.maxLag = maxLag or interval * 3
+        self.checkpointFile = checkpointFile
+        if self.checkpointFile is None:
+            self.checkpointFile = os.path.join(
+                consolidator.srcObjStoreUtil.tmpfolder,
+                consolidator.shard.getFileName(CHECKPOINT_PREFIX, "json"),
+            )
+        self.checkpoint = self.readCheckpoint()
+        self.stopEvent = threading.Event()
+
+        # the source inventory shards that fall in the consolidator's shard
+        keyRange = consolidator.shard.getKeyRange()
+        self.keyRanges = consolidator.srcInventory.keyRanges
+        if keyRange is not None:
+            self.keyRanges = [
+                inventoryRange for inventoryRange in self.keyRanges
+                if objStoreInventory.rangesOverlap(inventoryRange, keyRange)
+            ]
+
+        self.started = time.time()
+        self.cycles = 0
+        self.lastSuccess = None
+        self.lastCycle = None
+
+    def readCheckpoint(self):
+        """
+        :return: dict of "startAfter|endKey" to [newest, object count]
+        :rtype: dict
+        """
+        if not os.path.exists(self.checkpointFile):
+            return {}
+        with open(self.checkpointFile) as fh:
+            return json.load(fh)
+
+    def writeCheckpoint(self):
+        tmpFile = self.checkpointFile + ".tmp"
+        with open(tmpFile, "w") as fh:
+            json.dump(self.checkpoint, fh)
+        os.replace(tmpFile, self.checkpointFile)
+
+    def getShardState(self, keyRange):
+        shard = self.consolidator.srcInventory.getShard(keyRange)
+        if shard is None:
+            return None
+        return [shard[1], shard[2]]
+
+    def listSource(self):
+        """lists every source shard on a pool of threads
+
+        :return: the key ranges whose state differs from the checkpoint
+        :rtype: list
+        """
+        inventory = self.consolidator.srcInventory
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=objStoreDiff.DEFAULT_LIST_WORKERS
+        ) as executor:
+            list(executor.map(inventory.refreshShard, self.keyRanges))
+        return [
+            keyRange for keyRange in self.keyRanges
+            if self.checkpoint.get(getRangeName(keyRange))
+            != self.getShardState(keyRange)
+        ]
+
+    def runCycle(self):
+        """lists the source, moves the files in the shards that changed and
+        checkpoints the shards where every file was moved
+
+        :return: summary of the cycle
+        :rtype: dict
+        """
+        started = time.time()
+        changed = self.listSource()
+        files = []
+        for keyRange in changed:
+            files.extend(self.consolidator.getFilesToMove(keyRange))
+
+        failed = []
+        if files:
+            LOGGER.info(f"{len(files)} files to move in {len(changed)} "
+                        "changed shards")
+            failed = self.moveFiles(files=files)
+
+        # the longest a moved file took to show up in the destination
+        delays = []
+        for srcFile in set(files) - set(failed):
+            record = self.consolidator.srcInventory.getObject(srcFile)
+            if record is not None and record.last_modified:
+                delays.append(time.time() - record.last_modified)
+
+        failedFiles = set(failed)
+        for keyRange in changed:
+            startAfter, endKey = keyRange
+            if any((startAfter is None or srcFile > startAfter)
+                   and (endKey is None or srcFile <= endKey)
+                   for srcFile in failedFiles):
+                # the failed files are retried on the next cycle
+                continue
+            self.checkpoint[getRangeName(keyRange)] = \
+                self.getShardState(keyRange)
+        self.writeCheckpoint()
+
+        self.cycles += 1
+        if not failed:
+            self.lastSuccess = started
+        self.lastCycle = {
+            "started": started,
+            "duration": time.time() - started,
+            "changed_shards": len(changed),
+            "moved": len(files) - len(failed),
+            "failed": len(failed),
+            "max_delay": max(delays) if delays else None,
+        }
+        LOGGER.info(f"sync cycle {self.cycles}: {self.lastCycle}")
+        return self.lastCycle
+
+    def getLag(self):
+        """
+        :return: seconds since the start of the last cycle that finished
+                 without failures, None before the first one
+        :rtype: float
+        """
+        if self.lastSuccess is None:
+            return None
+        return time.time() - self.lastSuccess
+
+    def getHealth(self):
+        """
+        :return: the status, lag and last cycle of the daemon
+        :rtype: dict
+        """
+        lag = self.getLag()
+        status = OK
+        if lag is None:
+            status = STARTING
+            if time.time() - self.started > self.maxLag:
+                status = LAGGING
+        elif lag > self.maxLag:
+            status = LAGGING
+        return {
+            "status": status,
+            "lag_seconds": lag,
+            "max_lag_seconds": self.maxLag,
+            "cycles": self.cycles,
+            "last_cycle": self.lastCycle,
+        }
+
+    def getSleepTime(self, cycleDuration):
+        sleep = self.interval * random.uniform(1 - self.jitter,
+                                               1 + self.jitter)
+        return max(0, sleep - cycleDuration)
+
+    def run(self, maxCycles=None):
+        """runs cycles until stop() is called or the process gets a SIGTERM,
+        a cycle that raises is logged and retried on the next cycle
+
+        :param maxCycles: stop after this many cycles
+        :type maxCycles: int, optional
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        while not self.stopEvent.is_set():
+            start = time.time()
+            try:
+                self.runCycle()
+            except Exception:
+                LOGGER.exception("sync cycle failed")
+            if maxCycles is not None and self.cycles >= maxCycles:
+                break
+            self.stopEvent.wait(self.getSleepTime(time.time() - start))
+        LOGGER.info("sync stopped")
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def startHealthServer(self, port, host="0.0.0.0"):
+        """serves the health of the daemon as json on /health from a
+        background thread
+
+        :return: the server
+        :rtype: http.server.ThreadingHTTPServer
+        """
+        daemon = self
+
+        class HealthHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self.path.startswith("/health"):
+                    self.send_error(404)
+                    return
+                health = daemon.getHealth()
+                body = json.dumps(health).encode("utf-8")
+                self.send_response(503 if health["status"] == LAGGING
+                                   else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format % args)
+
+        server = http.server.ThreadingHTTPServer((host, port), HealthHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        LOGGER.info(f"serving health on port {server.server_address[1]}")
+        return server
+
+
+def getRangeName(keyRange):
+    startAfter, endKey = keyRange
+    return f"{startAfter or ''}|{endKey or ''}"
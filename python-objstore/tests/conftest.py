@@ -0,0 +1,82 @@
+"""Settings and fixtures shared by the tests.
+
+The settings are set before any of the modules are imported, so the tests
+never talk to a real bucket.  Tests that need a bucket get one from a moto
+server started for the session.
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def getFreePort():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+MOTO_HOST = f"localhost:{getFreePort()}"
+os.environ.update({
+    "OBJ_STORE_HOST": MOTO_HOST,
+    "OBJ_STORE_USER": "testing",
+    "OBJ_STORE_SECRET": "testing",
+    "OBJ_STORE_BUCKET": "prod",
+    "OBJ_STORE_TST_HOST": MOTO_HOST,
+    "OBJ_STORE_TST_USER": "testing",
+    "OBJ_STORE_TST_SECRET": "testing",
+    "OBJ_STORE_TST_BUCKET": "tst",
+    "OBJ_STORE_SECURE": "false",
+    "TEST_OBJ_NAME": "test.txt",
+    "INDEX_FILE": "wrf_fileindex.csv",
+    "TMP_FOLDER": tempfile.mkdtemp(),
+    "AWS_DEFAULT_REGION": "us-east-1",
+})
+
+
+@pytest.fixture(scope="session")
+def motoServer():
+    motoServer = pytest.importorskip("moto.server")
+    host, port = MOTO_HOST.split(":")
+    server = motoServer.ThreadedMotoServer(ip_address=host, port=int(port),
+                                           verbose=False)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def s3Client(motoServer):
+    import boto3
+
+    return boto3.client(
+        "s3",
+        endpoint_url=f"http://{MOTO_HOST}",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        region_name="us-east-1",
+    )
+
+
+@pytest.fixture
+def makeBucket(s3Client, tmp_path):
+    """creates an empty bucket with a new name
+
+    :return: a function that takes the start of the bucket name and returns
+             an ObjectStoreUtil for the new bucket
+    """
+    import objStoreUtil
+
+    def makeBucket(prefix):
+        bucket = f"{prefix}-{uuid.uuid4().hex[:12]}"
+        s3Client.create_bucket(Bucket=bucket)
+        return objStoreUtil.ObjectStoreUtil(objStoreBucket=bucket,
+                                            tmpfolder=str(tmp_path))
+
+    return makeBucket
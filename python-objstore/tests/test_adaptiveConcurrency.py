@@ -0,0 +1,84 @@
+import adaptiveConcurrency
+
+MB = 1024 * 1024
+
+
+def completeRound(controller, latency, numBytes=MB):
+    for _ in range(controller.getWindow()):
+        controller.recordSuccess(latency, numBytes)
+
+
+def test_windowStartsInsideTheLimits():
+    assert adaptiveConcurrency.AdaptiveConcurrency(
+        initial=100, maximum=8).getWindow() == 8
+    assert adaptiveConcurrency.AdaptiveConcurrency(
+        initial=0, minimum=2).getWindow() == 2
+
+
+def test_growsWhileLatencyHolds():
+    controller = adaptiveConcurrency.AdaptiveConcurrency(initial=2,
+                                                         maximum=5)
+    for window in [3, 4, 5, 5]:
+        completeRound(controller, 0.1)
+        assert controller.getWindow() == window
+
+
+def test_shrinksWhenLatencyClimbs():
+    controller = adaptiveConcurrency.AdaptiveConcurrency(initial=4)
+    completeRound(controller, 0.1)
+    assert controller.getWindow() == 5
+    completeRound(controller, 0.3)
+    assert controller.getWindow() == 4
+    # still slower than the best round, but within the factor
+    completeRound(controller, 0.15)
+    assert controller.getWindow() == 5
+
+
+def test_latencyIsPerMB():
+    controller = adaptiveConcurrency.AdaptiveConcurrency(initial=4)
+    completeRound(controller, 0.1, MB)
+    # ten times the latency for ten times the bytes isn't congestion
+    completeRound(controller, 1.0, 10 * MB)
+    assert controller.getWindow() == 6
+    # small files count as MIN_LATENCY_BYTES
+    completeRound(controller, 0.1, 0)
+    assert controller.getWindow() == 7
+
+
+def test_throttleHalvesTheWindowOncePerRound():
+    controller = adaptiveConcurrency.AdaptiveConcurrency(initial=16,
+                                                         minimum=3)
+    for _ in range(5):
+        controller.recordThrottle()
+    assert controller.getWindow() == 8
+    assert controller.throttles == 5
+    # the round with the throttle doesn't grow the window
+    completeRound(controller, 0.1)
+    assert controller.getWindow() == 8
+    controller.recordThrottle()
+    assert controller.getWindow() == 4
+    completeRound(controller, 0.1)
+    controller.recordThrottle()
+    assert controller.getWindow() == 3
+
+
+def test_errorsDontChangeTheWindow():
+    controller = adaptiveConcurrency.AdaptiveConcurrency(initial=4)
+    controller.recordError()
+    assert controller.errors == 1
+    assert controller.getWindow() == 4
+
+
+def test_throughput(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(adaptiveConcurrency.time, "time", lambda: now[0])
+    controller = adaptiveConcurrency.AdaptiveConcurrency()
+    assert controller.getThroughput() == 0.0
+    controller.recordSuccess(0.1, 10 * MB)
+    now[0] += 5
+    controller.recordSuccess(0.1, 10 * MB)
+    assert controller.getThroughput() == 4 * MB
+    assert "throughput: 4.0 MB/s" in controller.getStatusMessage()
+    # transfers older than the window are dropped
+    now[0] += adaptiveConcurrency.THROUGHPUT_WINDOW_SECONDS + 1
+    assert controller.getThroughput() == 0.0
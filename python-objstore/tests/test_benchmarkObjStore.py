@@ -0,0 +1,101 @@
+import logging
+import random
+
+import pytest
+
+import benchmarkObjStore
+import constants
+
+# the settings the benchmark changes, put back after each test
+BENCHMARK_ENV = [
+    "OBJ_STORE_HOST", "OBJ_STORE_USER", "OBJ_STORE_SECRET",
+    "OBJ_STORE_BUCKET", "OBJ_STORE_TST_HOST", "OBJ_STORE_TST_USER",
+    "OBJ_STORE_TST_SECRET", "OBJ_STORE_TST_BUCKET", "OBJ_STORE_SECURE",
+    "TMP_FOLDER", "INDEX_FILE", "TEST_OBJ_NAME",
+]
+
+
+@pytest.fixture
+def benchmark(motoServer, monkeypatch, tmp_path):
+    import os
+
+    for name in BENCHMARK_ENV:
+        monkeypatch.setenv(name, os.environ.get(name, ""))
+    monkeypatch.setattr(constants, "OBJ_STORE_BUCKET",
+                        constants.OBJ_STORE_BUCKET)
+    monkeypatch.setattr(constants, "TMP_FOLDER", constants.TMP_FOLDER)
+    return benchmarkObjStore.Benchmark(
+        constants.OBJ_STORE_HOST, str(tmp_path), numObjects=6,
+        sizeSpec="uniform:1KB:4KB", concurrencyLevels=[1, 4], seed=1)
+
+
+def test_parsesSizes():
+    assert benchmarkObjStore.parseSize("512") == 512
+    assert benchmarkObjStore.parseSize("2KB") == 2048
+    assert benchmarkObjStore.parseSize(" 1.5mb ") == int(1.5 * 1024 ** 2)
+    assert benchmarkObjStore.parseSize("1GB") == 1024 ** 3
+
+
+def test_sizeFunctions():
+    rand = random.Random(0)
+    fixed = benchmarkObjStore.getSizeFunction("fixed:1KB", rand)
+    assert {fixed() for _ in range(10)} == {1024}
+    uniform = benchmarkObjStore.getSizeFunction("uniform:1KB:2KB", rand)
+    assert all(1024 <= uniform() <= 2048 for _ in range(100))
+    lognormal = benchmarkObjStore.getSizeFunction("lognormal:1MB:0.5", rand)
+    assert all(lognormal() > 0 for _ in range(100))
+    for spec in ["fixed", "uniform:1KB", "normal:1MB:1"]:
+        with pytest.raises(ValueError):
+            benchmarkObjStore.getSizeFunction(spec, rand)
+
+
+def test_namesLookLikeWRFFiles():
+    names = benchmarkObjStore.getWRFNames(50, random.Random(0))
+    assert len(names) == 50
+    assert names == sorted(set(names))
+    assert all(name.endswith(".10x10.m3d.7z") for name in names)
+    assert names == benchmarkObjStore.getWRFNames(50, random.Random(0))
+
+
+def test_percentiles():
+    assert benchmarkObjStore.percentile([], 50) is None
+    values = list(range(101))
+    assert benchmarkObjStore.percentile(values, 50) == 50
+    assert benchmarkObjStore.percentile(values, 99) == 99
+    assert benchmarkObjStore.percentile(reversed(values), 100) == 100
+
+
+def test_comparesRuns(caplog):
+    previous = {"results": [
+        {"operation": "get", "concurrency": 1, "objects_per_sec": 10.0},
+        {"operation": "put", "concurrency": 1, "objects_per_sec": 0},
+    ]}
+    current = {"results": [
+        {"operation": "get", "concurrency": 1, "objects_per_sec": 15.0},
+        {"operation": "put", "concurrency": 1, "objects_per_sec": 5.0},
+        {"operation": "acl", "concurrency": 1, "objects_per_sec": 5.0},
+    ]}
+    with caplog.at_level(logging.INFO, logger=benchmarkObjStore.__name__):
+        benchmarkObjStore.compareResults(previous, current)
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == 2
+    assert "+50.0%" in messages[0]
+    assert "+0.0%" in messages[1]
+
+
+def test_timesEveryOperation(benchmark):
+    results = benchmark.run(benchmarkObjStore.OPERATIONS)
+    assert [(result["operation"], result["concurrency"])
+            for result in results] == [
+        (operation, concurrency)
+        for operation in benchmarkObjStore.OPERATIONS
+        for concurrency in [1, 4]
+    ]
+    totalBytes = sum(benchmark.objectSizes.values())
+    for result in results:
+        assert result["errors"] == 0, result
+        assert result["objects"] == 6, result
+        assert result["peak_rss_mb"] > 0
+        if result["operation"] in ("get", "put", "move"):
+            assert result["bytes"] == totalBytes, result
+            assert result["p50_ms"] <= result["p99_ms"]
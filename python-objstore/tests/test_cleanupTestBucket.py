@@ -0,0 +1,101 @@
+import json
+
+import cleanupTestBucket
+import objStoreInventory
+import objStoreVerify
+import transferJournal
+
+
+def putObject(s3Client, objUtil, key, body):
+    resp = s3Client.put_object(Bucket=objUtil.objStoreBucket, Key=key,
+                               Body=body)
+    return resp["ETag"].strip('"')
+
+
+def makeCleanup(tmp_path, srcUtil, destUtil, journals, **kwargs):
+    return cleanupTestBucket.SourceCleanup(
+        srcUtil, destUtil,
+        objStoreInventory.BucketInventory(srcUtil, dbFolder=str(tmp_path)),
+        journals, reportDir=str(tmp_path), **kwargs)
+
+
+def setUpBuckets(s3Client, makeBucket, tmp_path):
+    """copies the same objects into two buckets and journals them, with
+    the ones that shouldn't be deleted changed or verified by size
+
+    :return: the source util, destination util and journals
+    """
+    srcUtil = makeBucket("src")
+    destUtil = makeBucket("dest")
+    journals = [
+        transferJournal.TransferJournal(str(tmp_path / f"journal{i}.jsonl"))
+        for i in range(2)
+    ]
+    for i, key in enumerate(["a", "b", "c", "d", "e", "f", "g", "h"]):
+        etag = putObject(s3Client, srcUtil, key, key.encode() * 10)
+        putObject(s3Client, destUtil, key, key.encode() * 10)
+        method = objStoreVerify.METHOD_SIZE if key == "b" else \
+            objStoreVerify.METHOD_ETAG
+        journals[i % 2].record(key, transferJournal.VERIFIED, etag=etag,
+                               destEtag=etag, method=method)
+    # verified by an older version that didn't record the etags
+    journals[0].record("c", transferJournal.VERIFIED)
+    putObject(s3Client, destUtil, "d", b"changed in the destination")
+    putObject(s3Client, srcUtil, "e", b"changed in the source")
+    s3Client.delete_object(Bucket=destUtil.objStoreBucket, Key="f")
+    journals[0].record("g", transferJournal.COPIED)
+    return srcUtil, destUtil, journals
+
+
+def test_candidatesAreVerifiedByContent(s3Client, makeBucket, tmp_path):
+    srcUtil, destUtil, journals = setUpBuckets(s3Client, makeBucket,
+                                               tmp_path)
+    cleanup = makeCleanup(tmp_path, srcUtil, destUtil, journals)
+    candidates = list(cleanup.getCandidates())
+    assert [tombstone["key"] for tombstone in candidates] == \
+        ["a", "b", "c", "d", "e", "f", "h"]
+    skipped = [tombstone["key"] for tombstone in candidates
+               if tombstone.get("status") == cleanupTestBucket.SKIPPED]
+    assert skipped == ["b", "c"]
+
+
+def test_checkSkipsObjectsThatChanged(s3Client, makeBucket, tmp_path):
+    srcUtil, destUtil, journals = setUpBuckets(s3Client, makeBucket,
+                                               tmp_path)
+    cleanup = makeCleanup(tmp_path, srcUtil, destUtil, journals)
+    batch = [tombstone for tombstone in cleanup.getCandidates()
+             if "status" not in tombstone]
+    checked = cleanup.checkBatch(batch, None)
+    assert [tombstone["key"] for tombstone in checked] == ["a", "h"]
+    # only the range after startAfter is listed
+    assert cleanup.checkBatch(batch[-1:], batch[-2]["key"]) == batch[-1:]
+
+
+def test_deletesOnlyTheCheckedObjects(s3Client, makeBucket, tmp_path):
+    srcUtil, destUtil, journals = setUpBuckets(s3Client, makeBucket,
+                                               tmp_path)
+    cleanup = makeCleanup(tmp_path, srcUtil, destUtil, journals,
+                          batchSize=2)
+    counts = cleanup.run()
+    assert counts == {cleanupTestBucket.DELETED: 2,
+                      cleanupTestBucket.SKIPPED: 5}
+    remaining = s3Client.list_objects_v2(Bucket=srcUtil.objStoreBucket)
+    assert [obj["Key"] for obj in remaining["Contents"]] == \
+        ["b", "c", "d", "e", "f", "g"]
+    assert journals[0].getState("a") == transferJournal.SOURCE_DELETED
+    assert journals[1].getState("h") == transferJournal.SOURCE_DELETED
+    reportFile, = tmp_path.glob("tombstones.*.jsonl")
+    with open(reportFile) as fh:
+        tombstones = [json.loads(line) for line in fh]
+    assert len(tombstones) == 7
+
+
+def test_dryRunDeletesNothing(s3Client, makeBucket, tmp_path):
+    srcUtil, destUtil, journals = setUpBuckets(s3Client, makeBucket,
+                                               tmp_path)
+    cleanup = makeCleanup(tmp_path, srcUtil, destUtil, journals,
+                          dryRun=True)
+    assert cleanup.run() == {cleanupTestBucket.DRY_RUN: 2,
+                             cleanupTestBucket.SKIPPED: 5}
+    remaining = s3Client.list_objects_v2(Bucket=srcUtil.objStoreBucket)
+    assert remaining["KeyCount"] == 8
@@ -0,0 +1,74 @@
+import pytest
+
+import compactKeys
+
+MD5 = "0123456789abcdef0123456789abcdef"
+
+
+def makeKeys(count):
+    return [f"x{i // 12:03d}y000.{2000 + i % 12:04d}.m3d.7z"
+            for i in range(count)]
+
+
+def test_findsEveryKey():
+    keys = makeKeys(100)
+    keySet = compactKeys.CompactKeySet.fromKeys(keys, blockSize=8)
+    assert len(keySet) == 100
+    assert list(keySet) == keys
+    assert all(key in keySet for key in keys)
+    assert keySet[0] == keys[0]
+    assert keySet[37] == keys[37]
+    assert keySet[-1] == keys[-1]
+    assert "a" not in keySet
+    assert "zzz" not in keySet
+    assert keys[5] + "x" not in keySet
+    with pytest.raises(IndexError):
+        keySet[100]
+
+
+def test_keysHaveToBeSorted():
+    keySet = compactKeys.CompactKeySet()
+    keySet.add("b")
+    with pytest.raises(ValueError):
+        keySet.add("a")
+    with pytest.raises(ValueError):
+        keySet.add("b")
+
+
+def test_keepsTheRecords():
+    records = [
+        compactKeys.ObjectRecord("a", 10, MD5, 1600000000.0),
+        compactKeys.ObjectRecord("b", 20, f"{MD5}-3", 1600000001.0),
+        compactKeys.ObjectRecord("c", 0, "not-an-md5", 1600000002.0),
+        compactKeys.ObjectRecord("d", None, None, None),
+    ]
+    keySet = compactKeys.CompactKeySet.fromRecords(records, blockSize=2)
+    assert list(keySet.records()) == records
+    assert keySet.get("b") == records[1]
+    assert keySet.get("e") is None
+    # quoted etags are stored without the quotes
+    keySet.add("e", 1, f'"{MD5}"')
+    assert keySet.get("e").etag == MD5
+
+
+def test_missingEtagsArentKeptAsOtherEtags():
+    keySet = compactKeys.CompactKeySet()
+    for key in makeKeys(10):
+        keySet.add(key, 1)
+    assert keySet.otherEtags == {}
+    assert all(record.etag is None for record in keySet.records())
+
+
+def test_namesOnlySetHasNoMetadata():
+    keys = makeKeys(50)
+    keySet = compactKeys.CompactKeySet.fromKeys(keys)
+    assert len(keySet.sizes) == 0
+    assert len(keySet.partCounts) == 0
+    assert len(keySet.etagDigests) == 0
+    assert keySet.get(keys[3]) == compactKeys.ObjectRecord(keys[3])
+    assert keySet.getMemoryUsage() < \
+        compactKeys.CompactKeySet.fromRecords(
+            compactKeys.ObjectRecord(key, 1, MD5) for key in keys
+        ).getMemoryUsage()
+    with pytest.raises(ValueError):
+        keySet.add("zzz", 1)
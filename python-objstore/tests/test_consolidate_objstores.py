@@ -0,0 +1,67 @@
+import uuid
+
+import pytest
+
+import constants
+import consolidate_objstores
+import objStoreUtil
+
+ALL_USERS = "http://acs.amazonaws.com/groups/global/AllUsers"
+FILES = {f"x{i:03d}y002x{i + 9:03d}y011.201901.10x10.m3d.7z": bytes([i]) * i
+         for i in range(2, 42, 10)}
+
+
+@pytest.fixture
+def buckets(s3Client, monkeypatch, tmp_path):
+    """source bucket with the files in it and an empty destination"""
+    src = f"src-{uuid.uuid4().hex[:12]}"
+    dest = f"dest-{uuid.uuid4().hex[:12]}"
+    for bucket in (src, dest):
+        s3Client.create_bucket(Bucket=bucket)
+    for name, body in FILES.items():
+        s3Client.put_object(Bucket=src, Key=name, Body=body)
+    monkeypatch.setattr(constants, "OBJ_STORE_TST_BUCKET", src)
+    monkeypatch.setattr(constants, "OBJ_STORE_BUCKET", dest)
+    monkeypatch.setattr(constants, "TMP_FOLDER", str(tmp_path))
+    (tmp_path / constants.INDEX_FILE).write_text("")
+    return src, dest
+
+
+def isPublic(s3Client, bucket, key):
+    grants = s3Client.get_object_acl(Bucket=bucket, Key=key)["Grants"]
+    return any(grant["Grantee"].get("URI") == ALL_USERS
+               and grant["Permission"] == "READ" for grant in grants)
+
+
+def assertMoved(s3Client, dest):
+    for name, body in FILES.items():
+        resp = s3Client.get_object(Bucket=dest, Key=name)
+        assert resp["Body"].read() == body
+        assert isPublic(s3Client, dest, name)
+
+
+def test_movesWithServerSideCopies(s3Client, buckets):
+    src, dest = buckets
+    cons = consolidate_objstores.ConsolidateStorage()
+    assert cons.moveFilesAsync(maxConcurrency=2) == []
+    assert cons.serverSideCopy
+    assertMoved(s3Client, dest)
+
+
+def test_fallsBackToStreaming(s3Client, buckets, monkeypatch):
+    src, dest = buckets
+    copies = []
+
+    def copyObject(self, objectName, srcBucket, **kwargs):
+        copies.append(objectName)
+        msg = f"copy of {objectName} from {srcBucket} refused"
+        raise objStoreUtil.CopyRefusedError(msg)
+
+    monkeypatch.setattr(objStoreUtil.ObjectStoreUtil, "copyObject",
+                        copyObject)
+    cons = consolidate_objstores.ConsolidateStorage()
+    assert cons.moveFilesAsync(maxConcurrency=1) == []
+    # the first refusal turns the copies off for the rest of the run
+    assert not cons.serverSideCopy
+    assert len(copies) == 1
+    assertMoved(s3Client, dest)
@@ -0,0 +1,67 @@
+import csv
+import gzip
+import io
+
+import pytest
+
+import csvPipeline
+
+HEADER = ["filename", "I0", "J0", "I1", "J1", "note"]
+
+
+def writeSource(path, numRows, opener=open):
+    rows = [[f"x{i:03d}.m3d.7z", i, i + 1, i + 9, i + 10,
+             f"line one\nline two, {i}" if i % 7 == 0 else "plain"]
+            for i in range(numRows)]
+    with opener(str(path), "wt", newline="") as fh:
+        writer = csv.writer(fh, lineterminator="\n")
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    return rows
+
+
+def readRows(path, opener=open):
+    with opener(str(path), "rt", newline="") as fh:
+        return list(csv.reader(fh))
+
+
+def test_chunksEndOnWholeRecords():
+    text = 'a,1\nb,"two\nlines"\nc,3\nd,4\n'
+    chunks = list(csvPipeline.readChunks(io.StringIO(text), chunkRows=2))
+    assert chunks == ['a,1\nb,"two\nlines"\n', "c,3\nd,4\n"]
+    assert "".join(chunks) == text
+    assert csvPipeline.transformChunk(chunks[0], [1, 0]) == (
+        2, '1,a\n"two\nlines",b\n')
+
+
+def test_missingColumns():
+    assert csvPipeline.getPositions(HEADER, ["J0", "filename"]) == [2, 0]
+    with pytest.raises(ValueError):
+        csvPipeline.getPositions(HEADER, ["filename", "K0"])
+
+
+@pytest.mark.parametrize("maxWorkers", [1, 3])
+def test_keepsTheOrderOfTheRecords(tmp_path, maxWorkers):
+    rows = writeSource(tmp_path / "src.csv", 500)
+    columns = ["note", "filename", "I0"]
+    written = csvPipeline.projectColumns(
+        str(tmp_path / "src.csv"), str(tmp_path / "dest.csv"), columns,
+        header=True, chunkRows=7, maxWorkers=maxWorkers)
+    assert written == 500
+    assert readRows(tmp_path / "dest.csv") == [columns] + [
+        [row[5], row[0], str(row[1])] for row in rows]
+
+
+def test_compressedFiles(tmp_path):
+    rows = writeSource(tmp_path / "src.csv.gz", 50, gzip.open)
+    csvPipeline.projectColumns(
+        str(tmp_path / "src.csv.gz"), str(tmp_path / "dest.csv.gz"),
+        ["filename"], chunkRows=10, maxWorkers=2)
+    assert readRows(tmp_path / "dest.csv.gz", gzip.open) == [
+        [row[0]] for row in rows]
+
+
+def test_zstandardIsOptional(tmp_path, monkeypatch):
+    monkeypatch.setattr(csvPipeline, "zstandard", None)
+    with pytest.raises(ValueError):
+        csvPipeline.openCsv(str(tmp_path / "index.csv.zst"), "w")
@@ -0,0 +1,74 @@
+import gc
+import types
+
+import objStoreClients
+import objStoreMetrics
+import objStoreUtil
+
+
+def makeUtil(motoServer):
+    util = objStoreUtil.ObjectStoreUtil(objStoreBucket="shared")
+    util.createBotoClient()
+    return util
+
+
+def emitThrottle(botoClient):
+    """sends the event boto sends before retrying a throttled request"""
+    botoClient.meta.events.emit(
+        "needs-retry.s3.GetObject",
+        response=(types.SimpleNamespace(status_code=503),
+                  {"Error": {"Code": "SlowDown"}}),
+        endpoint=None, operation=None, attempts=100,
+        caught_exception=None, request_dict={},
+    )
+
+
+def test_clientsAreShared(motoServer):
+    first = makeUtil(motoServer)
+    second = makeUtil(motoServer)
+    assert first.botoClient is second.botoClient
+    assert first.minIoClient is second.minIoClient
+    other = objStoreClients.getBotoClient(first.objStoreHost, "other",
+                                          "secret", secure=False)
+    assert other is not first.botoClient
+
+
+def test_throttlesAreCountedOnce(motoServer):
+    utils = [makeUtil(motoServer) for _ in range(5)]
+    throttles = []
+    utils[0].addThrottleListener(lambda: throttles.append(1))
+    before = objStoreMetrics.REGISTRY.throttled["unknown"]
+    emitThrottle(utils[0].botoClient)
+    assert len(throttles) == 1
+    assert objStoreMetrics.REGISTRY.throttled["unknown"] == before + 1
+
+
+def test_listenerOnSeveralUtilsIsCalledOnce(motoServer):
+    first = makeUtil(motoServer)
+    second = makeUtil(motoServer)
+    throttles = []
+
+    def listener():
+        throttles.append(1)
+
+    first.addThrottleListener(listener)
+    second.addThrottleListener(listener)
+    emitThrottle(first.botoClient)
+    assert len(throttles) == 1
+
+    first.removeThrottleListener(listener)
+    second.removeThrottleListener(listener)
+    emitThrottle(first.botoClient)
+    assert len(throttles) == 1
+
+
+def test_unusedUtilsAreReleased(motoServer):
+    util = makeUtil(motoServer)
+    botoClient = util.botoClient
+    # utils other tests left in reference cycles
+    gc.collect()
+    before = len(objStoreUtil._clientUtils[botoClient])
+    for _ in range(10):
+        makeUtil(motoServer)
+    gc.collect()
+    assert len(objStoreUtil._clientUtils[botoClient]) == before
@@ -0,0 +1,102 @@
+import compactKeys
+import objStoreDiff
+from compactKeys import ObjectRecord
+from objStoreDiff import MISMATCH, MISSING, NEW
+
+MD5 = "0123456789abcdef0123456789abcdef"
+OTHER_MD5 = "fedcba9876543210fedcba9876543210"
+
+
+def diff(src, dest):
+    bucketDiff = objStoreDiff.BucketDiff(None, None)
+    return [(entry.key, entry.status)
+            for entry in bucketDiff.diffShard(src, dest)]
+
+
+def test_keyRangesCoverTheBucket():
+    assert objStoreDiff.getKeyRanges(["m", "c"]) == [
+        (None, "c"), ("c", "m"), ("m", None)]
+    assert objStoreDiff.getKeyRanges([]) == [(None, None)]
+    keyRanges = objStoreDiff.getKeyRanges()
+    assert len(keyRanges) == len(objStoreDiff.DEFAULT_SHARD_BOUNDARIES) + 1
+
+
+def test_clipsKeyRanges():
+    keyRanges = objStoreDiff.getKeyRanges(["c", "m", "t"])
+    assert objStoreDiff.clipKeyRanges(keyRanges, ("d", "p")) == [
+        ("d", "m"), ("m", "p")]
+    assert objStoreDiff.clipKeyRanges(keyRanges, (None, "c")) == [
+        (None, "c")]
+    assert objStoreDiff.clipKeyRanges(keyRanges, ("t", None)) == [
+        ("t", None)]
+    assert objStoreDiff.clipKeyRanges(keyRanges, (None, None)) == keyRanges
+
+
+def test_etags():
+    assert objStoreDiff.normalizeEtag(f'"{MD5}"') == MD5
+    assert objStoreDiff.normalizeEtag(None) is None
+    assert objStoreDiff.isMultipartEtag(f"{MD5}-3")
+    assert not objStoreDiff.isMultipartEtag(MD5)
+    assert not objStoreDiff.isMultipartEtag(None)
+
+
+def test_mergesTheListings():
+    src = [ObjectRecord("a", 1, MD5), ObjectRecord("b", 1, MD5),
+           ObjectRecord("d", 1, MD5), ObjectRecord("f", 1, MD5)]
+    dest = [ObjectRecord("b", 1, f'"{MD5}"'), ObjectRecord("c", 1, MD5),
+            ObjectRecord("e", 1, MD5), ObjectRecord("f", 1, MD5),
+            ObjectRecord("g", 1, MD5)]
+    assert diff(src, dest) == [("a", NEW), ("c", MISSING), ("d", NEW),
+                               ("e", MISSING), ("g", MISSING)]
+    assert diff(src, []) == [(record.object_name, NEW) for record in src]
+    assert diff([], dest) == [(record.object_name, MISSING)
+                              for record in dest]
+    # compact key sets are merged the same as lists
+    srcKeys = compactKeys.CompactKeySet.fromRecords(src)
+    destKeys = compactKeys.CompactKeySet.fromRecords(dest)
+    assert diff(srcKeys, destKeys) == diff(src, dest)
+
+
+def test_findsMismatches():
+    src = [ObjectRecord("size", 1, MD5), ObjectRecord("etag", 1, MD5),
+           ObjectRecord("multipart", 1, f"{MD5}-2"),
+           ObjectRecord("quoted", 1, f'"{MD5}"')]
+    dest = [ObjectRecord("size", 2, MD5), ObjectRecord("etag", 1, OTHER_MD5),
+            ObjectRecord("multipart", 1, OTHER_MD5),
+            ObjectRecord("quoted", 1, MD5)]
+    src.sort(key=lambda record: record.object_name)
+    dest.sort(key=lambda record: record.object_name)
+    # a multipart etag can't be compared with an md5, so only the size is
+    # compared
+    assert diff(src, dest) == [("etag", MISMATCH), ("size", MISMATCH)]
+
+
+def test_diffsTheBuckets(makeBucket, s3Client):
+    srcUtil = makeBucket("diff-src")
+    destUtil = makeBucket("diff-dest")
+    names = [f"x{i:03d}y000.2019{month:02d}.m3d.7z"
+             for i in range(0, 400, 40) for month in (1, 2)]
+    for name in names:
+        s3Client.put_object(Bucket=srcUtil.objStoreBucket, Key=name,
+                            Body=name.encode())
+    # the same, a different size, different content and an extra object
+    for name, body in [(names[0], names[0]), (names[1], "short"),
+                       (names[2], names[2].upper()), ("zzz", "z")]:
+        s3Client.put_object(Bucket=destUtil.objStoreBucket, Key=name,
+                            Body=body.encode())
+
+    bucketDiff = objStoreDiff.BucketDiff(srcUtil, destUtil, maxWorkers=2)
+    entries = list(bucketDiff.iterDiff())
+    # shards are returned as they finish, each in name order
+    assert sorted(entry.key for entry in entries) == names[1:] + ["zzz"]
+    statuses = {entry.key: entry.status for entry in entries}
+    assert statuses[names[1]] == MISMATCH
+    assert statuses[names[2]] == MISMATCH
+    assert statuses["zzz"] == MISSING
+    assert bucketDiff.counts == {NEW: len(names) - 3, MISMATCH: 2,
+                                 MISSING: 1}
+    assert all(entry.etag and '"' not in entry.etag for entry in entries)
+
+    bucketDiff = objStoreDiff.BucketDiff(srcUtil, destUtil,
+                                         keyRange=(None, names[3]))
+    assert [entry.key for entry in bucketDiff.iterDiff([NEW])] == [names[3]]
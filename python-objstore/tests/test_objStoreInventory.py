@@ -0,0 +1,192 @@
+import datetime
+import sqlite3
+import types
+
+import objStoreInventory
+
+BOUNDARIES = ["m"]
+LOW, HIGH = (None, "m"), ("m", None)
+
+
+class FakeBucket:
+    """lists a dict of objects and remembers the ranges it was asked for"""
+
+    def __init__(self, tmpfolder):
+        self.objStoreBucket = "fake"
+        self.tmpfolder = tmpfolder
+        self.objects = {}
+        self.listed = []
+
+    def put(self, name, etag, modified, size=1):
+        self.objects[name] = types.SimpleNamespace(
+            object_name=name, size=size, etag=f'"{etag}"',
+            last_modified=datetime.datetime.fromtimestamp(
+                modified, datetime.timezone.utc))
+
+    def listObjectRange(self, startAfter=None, endKey=None):
+        self.listed.append((startAfter, endKey))
+        for name in sorted(self.objects):
+            if (startAfter is None or name > startAfter) and \
+                    (endKey is None or name <= endKey):
+                yield self.objects[name]
+
+
+def makeInventory(tmp_path, ttl=60):
+    bucket = FakeBucket(str(tmp_path))
+    bucket.put("a", "e1", 100)
+    bucket.put("b", "e2", 200)
+    bucket.put("x", "e3", 300)
+    inventory = objStoreInventory.BucketInventory(bucket, ttl=ttl,
+                                                  boundaries=BOUNDARIES)
+    return bucket, inventory
+
+
+def names(records):
+    return [record.object_name for record in records]
+
+
+def test_rangeQueries():
+    assert objStoreInventory.rangeWhereClause(None, None) == ("", [])
+    assert objStoreInventory.rangeWhereClause("a", "b") == (
+        "WHERE key > ? AND key <= ?", ["a", "b"])
+    assert objStoreInventory.rangesOverlap((None, "m"), ("c", "d"))
+    assert objStoreInventory.rangesOverlap((None, None), ("c", "d"))
+    assert not objStoreInventory.rangesOverlap((None, "m"), ("m", None))
+    assert not objStoreInventory.rangesOverlap(("m", None), (None, "c"))
+
+
+def test_refreshesStaleShards(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(objStoreInventory.time, "time", lambda: now[0])
+    bucket, inventory = makeInventory(tmp_path)
+
+    assert inventory.refresh() == [LOW, HIGH]
+    assert names(inventory.listObjectRange()) == ["a", "b", "x"]
+    assert inventory.getObject("x").etag == "e3"
+    assert inventory.getShard(LOW) == (1000.0, 200, 2)
+
+    # nothing is listed while the shards are fresh
+    bucket.listed.clear()
+    now[0] += 30
+    assert inventory.refresh() == []
+    assert names(inventory.listObjectRange("b")) == ["x"]
+    assert bucket.listed == []
+
+    # stale shards are listed in full, only the changed ones are rewritten
+    now[0] += 60
+    bucket.put("c", "e4", 400)
+    assert inventory.refresh() == [LOW]
+    assert bucket.listed == [LOW, HIGH]
+    assert names(inventory.listObjectRange()) == ["a", "b", "c", "x"]
+    assert not inventory.isStale(HIGH)
+
+    # deletes are picked up by the count
+    del bucket.objects["a"]
+    assert inventory.refresh(force=True) == [LOW]
+    assert inventory.getObject("a") is None
+    inventory.close()
+
+
+def test_listingOnlyRefreshesItsShards(tmp_path):
+    bucket, inventory = makeInventory(tmp_path)
+    assert names(inventory.listObjectRange("m")) == ["x"]
+    assert bucket.listed == [HIGH]
+    assert inventory.getShard(LOW) is None
+    inventory.close()
+
+
+def test_publicFlagsSurviveUnlessOverwritten(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(objStoreInventory.time, "time", lambda: now[0])
+    bucket, inventory = makeInventory(tmp_path)
+    assert names(inventory.listNotPublic()) == ["a", "b", "x"]
+    inventory.markPublic(["a", "b"])
+    assert inventory.isPublic("a")
+    assert not inventory.isPublic("x")
+    assert not inventory.isPublic("missing")
+
+    now[0] += 120
+    bucket.put("b", "changed", 500)
+    assert inventory.refresh() == [LOW]
+    assert inventory.isPublic("a")
+    assert not inventory.isPublic("b")
+    assert names(inventory.listNotPublic()) == ["b", "x"]
+    inventory.close()
+
+
+def test_recordsOurOwnWrites(tmp_path):
+    bucket, inventory = makeInventory(tmp_path)
+    inventory.refresh()
+    inventory.recordObject("d", 5, '"e5"', lastModified=600, public=True)
+    assert inventory.getObject("d") == objStoreInventory.InventoryRecord(
+        "d", 5, "e5", 600)
+    assert inventory.isPublic("d")
+    inventory.removeObjects(["d", "a"])
+    assert names(inventory.listObjectRange()) == ["b", "x"]
+    inventory.close()
+
+
+def test_evictsOldShards(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(objStoreInventory.time, "time", lambda: now[0])
+    bucket, inventory = makeInventory(tmp_path, ttl=3600)
+    inventory.refreshShard(LOW)
+    now[0] += 100
+    inventory.refreshShard(HIGH)
+    now[0] += 10
+
+    inventory.evict(50)
+    assert inventory.getShard(LOW) is None
+    assert inventory.getShard(HIGH) is not None
+    assert names(inventory.iterRecords()) == ["x"]
+
+    # the evicted shard is listed again when it is used
+    bucket.listed.clear()
+    assert names(inventory.listObjectRange()) == ["a", "b", "x"]
+    assert bucket.listed == [LOW]
+    inventory.close()
+
+
+def test_pagesThroughLargeRanges(tmp_path, monkeypatch):
+    monkeypatch.setattr(objStoreInventory, "LIST_PAGE_SIZE", 2)
+    bucket, inventory = makeInventory(tmp_path)
+    for i in range(5):
+        bucket.put(f"k{i}", "e", 100)
+    assert names(inventory.listObjectRange()) == sorted(bucket.objects)
+    assert names(inventory.listObjectRange("b", "k3")) == [
+        "k0", "k1", "k2", "k3"]
+    inventory.close()
+
+
+def test_upgradesOldDatabases(tmp_path):
+    bucket = FakeBucket(str(tmp_path))
+    dbFile = tmp_path / "inventory_fake.sqlite"
+    conn = sqlite3.connect(str(dbFile))
+    conn.execute("CREATE TABLE objects (key TEXT PRIMARY KEY, size INTEGER, "
+                 "etag TEXT, last_modified REAL)")
+    conn.execute("INSERT INTO objects VALUES ('a', 1, 'e1', 100)")
+    conn.commit()
+    conn.close()
+
+    inventory = objStoreInventory.BucketInventory(bucket,
+                                                  boundaries=BOUNDARIES)
+    assert inventory.getObject("a").etag == "e1"
+    assert not inventory.isPublic("a")
+    inventory.markPublic(["a"])
+    assert inventory.isPublic("a")
+    inventory.close()
+
+
+def test_inventoriesABucket(makeBucket, s3Client):
+    objUtil = makeBucket("inventory")
+    for name in ["a.7z", "n.7z", "z.7z"]:
+        s3Client.put_object(Bucket=objUtil.objStoreBucket, Key=name,
+                            Body=name.encode())
+    inventory = objStoreInventory.BucketInventory(objUtil,
+                                                  boundaries=BOUNDARIES)
+    assert inventory.refresh() == [LOW, HIGH]
+    records = list(inventory.listObjectRange())
+    assert names(records) == ["a.7z", "n.7z", "z.7z"]
+    assert all(record.size == 4 for record in records)
+    assert all(len(record.etag) == 32 for record in records)
+    inventory.close()
@@ -0,0 +1,68 @@
+import datetime
+import urllib.parse
+
+import pytest
+
+import objStorePresign
+
+NOW = 1700000123.5
+WINDOW = objStorePresign.DEFAULT_CACHE_WINDOW
+
+
+def makeSigner(**kwargs):
+    return objStorePresign.UrlSigner(
+        "objects.example.com", "user", "secret",
+        cache=objStorePresign.PresignCache(), **kwargs)
+
+
+def getQuery(url):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+
+
+def test_windowedUrlsStayValidForTheExpiry():
+    signer = makeSigner()
+    signedAt, expires = signer.getWindow(3600, NOW)
+    assert signedAt % WINDOW == 0
+    assert signedAt <= NOW < signedAt + WINDOW
+    assert expires == 3600 + WINDOW
+    # valid for at least the expiry from any time in the window
+    assert signedAt + expires >= signedAt + WINDOW + 3600
+
+
+def test_urlsNearTheMaxExpiryAreSignedNow():
+    signer = makeSigner()
+    for expires in (objStorePresign.MAX_EXPIRY,
+                    objStorePresign.MAX_EXPIRY - WINDOW + 1):
+        assert not signer.isWindowed(expires)
+        assert signer.getWindow(expires, NOW) == (int(NOW), expires)
+        url = signer.presignUrls("bucket", ["a"], expires, now=NOW)[0]
+        assert int(getQuery(url)["X-Amz-Expires"]) <= \
+            objStorePresign.MAX_EXPIRY
+    assert signer.isWindowed(objStorePresign.MAX_EXPIRY - WINDOW)
+
+
+def test_urlsAreReusedWithinTheWindow():
+    signer = makeSigner()
+    first = signer.presignUrls("bucket", ["a/b.7z", "c"], 3600, now=NOW)
+    assert signer.presignUrls("bucket", ["c"], 3600, now=NOW + 1) == \
+        first[1:]
+    later = signer.presignUrls("bucket", ["a/b.7z"], 3600,
+                               now=NOW + WINDOW)
+    assert later[0] != first[0]
+    assert len(signer.cache) == 3
+
+
+def test_noWindowSignsEveryUrlNow():
+    signer = makeSigner(cacheWindow=0)
+    url = signer.presignUrls("bucket", ["a"], 3600, now=NOW)[0]
+    assert getQuery(url)["X-Amz-Expires"] == "3600"
+    assert objStorePresign.getExpiryTime(url) == \
+        datetime.datetime.fromtimestamp(int(NOW) + 3600,
+                                        datetime.timezone.utc)
+    assert len(signer.cache) == 0
+
+
+@pytest.mark.parametrize("expires", [0, objStorePresign.MAX_EXPIRY + 1])
+def test_rejectsExpiriesOutOfRange(expires):
+    with pytest.raises(ValueError):
+        makeSigner().presignUrls("bucket", ["a"], expires)
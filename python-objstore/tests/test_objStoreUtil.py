@@ -0,0 +1,58 @@
+import os
+
+import botocore.stub
+import pytest
+
+import objStoreAsync
+import objStoreUtil
+
+
+def test_copiesAnObject(s3Client, makeBucket):
+    srcUtil = makeBucket("src")
+    destUtil = makeBucket("dest")
+    s3Client.put_object(Bucket=srcUtil.objStoreBucket, Key="a/b.7z",
+                        Body=b"x" * 100)
+    assert destUtil.copyObject("a/b.7z", srcUtil.objStoreBucket) == 100
+    resp = s3Client.get_object(Bucket=destUtil.objStoreBucket, Key="a/b.7z")
+    assert resp["Body"].read() == b"x" * 100
+
+
+def test_copiesLargeObjectsInParts(s3Client, makeBucket, monkeypatch):
+    monkeypatch.setattr(objStoreUtil, "MAX_SINGLE_COPY_SIZE", 6 * 1024 ** 2)
+    monkeypatch.setattr(objStoreUtil, "COPY_PART_SIZE", 5 * 1024 ** 2)
+    srcUtil = makeBucket("src")
+    destUtil = makeBucket("dest")
+    body = os.urandom(11 * 1024 ** 2)
+    s3Client.put_object(Bucket=srcUtil.objStoreBucket, Key="big",
+                        Body=body)
+    destUtil.copyObject("big", srcUtil.objStoreBucket)
+    resp = s3Client.get_object(Bucket=destUtil.objStoreBucket, Key="big")
+    assert resp["Body"].read() == body
+    assert resp["ETag"].strip('"').endswith("-3")
+
+
+def test_forbiddenHeadIsARefusedCopy(makeBucket):
+    destUtil = makeBucket("dest")
+    destUtil.createBotoClient()
+    with botocore.stub.Stubber(destUtil.botoClient) as stubber:
+        # a HEAD response has no body, so the code is only the status
+        stubber.add_client_error("head_object", service_error_code="403",
+                                 http_status_code=403)
+        with pytest.raises(objStoreUtil.CopyRefusedError):
+            destUtil.copyObject("a", "src")
+
+
+def test_missingSourceIsNotARefusedCopy(makeBucket):
+    srcUtil = makeBucket("src")
+    destUtil = makeBucket("dest")
+    with pytest.raises(objStoreUtil.botocore.exceptions.ClientError) as err:
+        destUtil.copyObject("missing", srcUtil.objStoreBucket)
+    assert not isinstance(err.value, objStoreUtil.CopyRefusedError)
+
+
+def test_asyncForbiddenHeadIsARefusedCopy():
+    err = objStoreAsync.parseError(403, b"", "a")
+    assert err.code == "403"
+    assert objStoreAsync.isCopyRefused(err)
+    assert not objStoreAsync.isCopyRefused(
+        objStoreAsync.parseError(404, b"", "a"))
@@ -0,0 +1,144 @@
+import hashlib
+import os
+
+import pytest
+
+import objStoreVerify
+
+PART_SIZE = 5 * 1024 ** 2
+
+
+def putMultipart(s3Client, bucket, key, body, partSize=PART_SIZE):
+    upload = s3Client.create_multipart_upload(Bucket=bucket, Key=key)
+    parts = []
+    for offset in range(0, len(body), partSize):
+        resp = s3Client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload["UploadId"],
+            PartNumber=len(parts) + 1, Body=body[offset:offset + partSize])
+        parts.append({"ETag": resp["ETag"], "PartNumber": len(parts) + 1})
+    s3Client.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload["UploadId"],
+        MultipartUpload={"Parts": parts})
+
+
+@pytest.fixture
+def buckets(makeBucket):
+    return makeBucket("src"), makeBucket("dest")
+
+
+def putBoth(s3Client, buckets, key, srcBody, destBody=None):
+    srcUtil, destUtil = buckets
+    s3Client.put_object(Bucket=srcUtil.objStoreBucket, Key=key,
+                        Body=srcBody)
+    s3Client.put_object(Bucket=destUtil.objStoreBucket, Key=key,
+                        Body=srcBody if destBody is None else destBody)
+
+
+def test_comparesEtags(s3Client, buckets):
+    putBoth(s3Client, buckets, "same", b"abc")
+    putBoth(s3Client, buckets, "changed", b"abc", b"abd")
+    putBoth(s3Client, buckets, "truncated", b"abc", b"ab")
+    verifier = objStoreVerify.ObjectVerifier(*buckets)
+
+    result = verifier.verify("same")
+    assert (result.status, result.method) == \
+        (objStoreVerify.MATCH, objStoreVerify.METHOD_ETAG)
+    assert result.etag == result.destEtag == hashlib.md5(b"abc").hexdigest()
+    result = verifier.verify("changed")
+    assert (result.status, result.method) == \
+        (objStoreVerify.MISMATCH, objStoreVerify.METHOD_ETAG)
+    result = verifier.verify("truncated")
+    assert (result.status, result.method) == \
+        (objStoreVerify.MISMATCH, objStoreVerify.METHOD_SIZE)
+    assert verifier.getCounts() == {"etag match": 1, "etag mismatch": 1,
+                                    "size mismatch": 1}
+
+
+def test_samplePolicyOnlyChecksTheSizeOfUnsampledObjects(s3Client,
+                                                         buckets):
+    srcUtil, destUtil = buckets
+    body = os.urandom(11 * 1024 ** 2)
+    putMultipart(s3Client, srcUtil.objStoreBucket, "big", body)
+    s3Client.put_object(Bucket=destUtil.objStoreBucket, Key="big",
+                        Body=body)
+
+    verifier = objStoreVerify.ObjectVerifier(*buckets, sampleRate=0)
+    assert verifier.verify("big").status == objStoreVerify.SIZE_ONLY
+    verifier = objStoreVerify.ObjectVerifier(*buckets, sampleRate=1)
+    result = verifier.verify("big")
+    assert (result.status, result.method) == \
+        (objStoreVerify.MATCH, objStoreVerify.METHOD_CHECKSUM)
+    assert result.etag.endswith("-3")
+
+
+def test_fullPolicyFindsChangedContent(s3Client, buckets):
+    srcUtil, destUtil = buckets
+    body = os.urandom(11 * 1024 ** 2)
+    putMultipart(s3Client, srcUtil.objStoreBucket, "big", body)
+    s3Client.put_object(Bucket=destUtil.objStoreBucket, Key="big",
+                        Body=body[:-1] + b"x")
+
+    verifier = objStoreVerify.ObjectVerifier(*buckets,
+                                             policy=objStoreVerify.FULL)
+    result = verifier.verify("big")
+    assert (result.status, result.method) == \
+        (objStoreVerify.MISMATCH, objStoreVerify.METHOD_CHECKSUM)
+
+
+def test_unknownPartSizeIsSizeOnly(s3Client, buckets, monkeypatch):
+    srcUtil, destUtil = buckets
+    body = os.urandom(11 * 1024 ** 2)
+    putMultipart(s3Client, srcUtil.objStoreBucket, "big", body)
+    s3Client.put_object(Bucket=destUtil.objStoreBucket, Key="big",
+                        Body=body)
+    verifier = objStoreVerify.ObjectVerifier(*buckets,
+                                             policy=objStoreVerify.FULL)
+    monkeypatch.setattr(verifier, "getPartSizes",
+                        lambda key, size, partCount: [])
+    result = verifier.verify("big")
+    assert (result.status, result.method) == \
+        (objStoreVerify.SIZE_ONLY, objStoreVerify.METHOD_SIZE)
+
+
+def test_streamedPartDigestsVerifyWithoutADownload(s3Client, buckets):
+    srcUtil, destUtil = buckets
+    body = os.urandom(11 * 1024 ** 2)
+    putMultipart(s3Client, srcUtil.objStoreBucket, "big", body)
+    s3Client.put_object(Bucket=destUtil.objStoreBucket, Key="big",
+                        Body=body)
+    digests = [hashlib.md5(body[offset:offset + PART_SIZE]).digest()
+               for offset in range(0, len(body), PART_SIZE)]
+
+    verifier = objStoreVerify.ObjectVerifier(*buckets, sampleRate=0)
+    result = verifier.verify("big", partDigests=digests)
+    assert (result.status, result.method) == \
+        (objStoreVerify.MATCH, objStoreVerify.METHOD_CHECKSUM)
+    # digests of other content don't verify it
+    result = verifier.verify("big", partDigests=digests[::-1])
+    assert result.status == objStoreVerify.SIZE_ONLY
+
+
+def test_etagCalculatorMatchesMultipartEtags():
+    body = os.urandom(2 * PART_SIZE + 10)
+    calculator = objStoreVerify.EtagCalculator(PART_SIZE)
+    for offset in range(0, len(body), 1000 * 1000):
+        calculator.update(body[offset:offset + 1000 * 1000])
+    digests = [hashlib.md5(body[offset:offset + PART_SIZE]).digest()
+               for offset in range(0, len(body), PART_SIZE)]
+    assert calculator.getEtag() == \
+        f"{hashlib.md5(b''.join(digests)).hexdigest()}-3"
+
+
+def test_sampleIsDeterministic():
+    keys = [f"file{i}" for i in range(1000)]
+    sampled = [key for key in keys if objStoreVerify.isSampled(key, 0.1)]
+    assert 50 < len(sampled) < 150
+    assert sampled == [key for key in keys
+                       if objStoreVerify.isSampled(key, 0.1)]
+    assert not any(objStoreVerify.isSampled(key, 0) for key in keys)
+    assert all(objStoreVerify.isSampled(key, 1) for key in keys)
+
+
+def test_rejectsUnknownPolicies(buckets):
+    with pytest.raises(ValueError):
+        objStoreVerify.ObjectVerifier(*buckets, policy="sometimes")
@@ -0,0 +1,61 @@
+import transferJournal
+
+
+def makeJournal(tmp_path):
+    return transferJournal.TransferJournal(str(tmp_path / "journal.jsonl"))
+
+
+def test_replaysTheLatestState(tmp_path):
+    journal = makeJournal(tmp_path)
+    journal.record("a", transferJournal.QUEUED)
+    journal.record("a", transferJournal.COPIED)
+    journal.record("b", transferJournal.QUEUED)
+    journal.record("b", transferJournal.FAILED, error="boom")
+    journal.record("c", transferJournal.UNVERIFIED)
+    journal.close()
+
+    journal = makeJournal(tmp_path)
+    assert journal.getState("a") == transferJournal.COPIED
+    assert journal.getState("b") == transferJournal.FAILED
+    assert journal.getState("d") is None
+    assert not journal.isComplete("a")
+    assert journal.isComplete("c")
+    assert journal.getKeys(transferJournal.FAILED) == ["b"]
+    assert journal.getCounts() == {transferJournal.COPIED: 1,
+                                   transferJournal.FAILED: 1,
+                                   transferJournal.UNVERIFIED: 1}
+    journal.close()
+    # compacted to one line per object
+    with open(journal.journalFile) as fh:
+        assert len(fh.readlines()) == 3
+
+
+def test_verifiedDetailsSurviveCompaction(tmp_path):
+    journal = makeJournal(tmp_path)
+    journal.record("a", transferJournal.VERIFIED, etag="e1", destEtag="d1",
+                   method="etag", time=1)
+    journal.record("b", transferJournal.VERIFIED, etag="e2", destEtag="d2",
+                   method="checksum")
+    journal.record("b", transferJournal.MISMATCH)
+    journal.close()
+
+    for _ in range(2):
+        journal = makeJournal(tmp_path)
+        assert journal.getVerifiedDetails("a") == {
+            "etag": "e1", "destEtag": "d1", "method": "etag"}
+        # details are dropped once the object isn't verified any more
+        assert journal.getVerifiedDetails("b") == {}
+        journal.close()
+
+
+def test_ignoresAPartialLastLine(tmp_path):
+    journal = makeJournal(tmp_path)
+    journal.record("a", transferJournal.ACL_SET)
+    journal.close()
+    with open(journal.journalFile, "a") as fh:
+        fh.write('{"key": "b", "sta')
+
+    journal = makeJournal(tmp_path)
+    assert journal.getState("a") == transferJournal.ACL_SET
+    assert journal.getState("b") is None
+    journal.close()
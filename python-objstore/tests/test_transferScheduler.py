@@ -0,0 +1,98 @@
+import pytest
+
+import transferScheduler
+
+
+def wrfName(tile, month):
+    return f"x{tile:03d}y000x{tile + 9:03d}y009.{month}.10x10.m3d.7z"
+
+
+def schedule(policies, files, sizes=None, **kwargs):
+    getSize = sizes.get if sizes is not None else None
+    scheduler = transferScheduler.TransferScheduler(
+        transferScheduler.getPolicies(policies, kwargs.pop("dateRanges",
+                                                           None)),
+        getSize=getSize, **kwargs)
+    return list(scheduler.schedule(iter(files)))
+
+
+def test_monthsAndDateRanges():
+    assert transferScheduler.getObjectMonth(wrfName(2, 201901)) == 201901
+    assert transferScheduler.getObjectMonth("wrf_fileindex.csv") is None
+    assert transferScheduler.parseDateRanges(
+        "2021-2022, 201901-201906,2015,") == [
+        (202101, 202212), (201901, 201906), (201501, 201512)]
+    assert transferScheduler.parseDateRanges("202003") == [(202003, 202003)]
+    for value in ["19", "2019-20", "2020-2019", "x"]:
+        with pytest.raises(ValueError):
+            transferScheduler.parseDateRanges(value)
+
+
+def test_unknownPolicy():
+    assert transferScheduler.getPolicies("listing") == []
+    with pytest.raises(ValueError):
+        transferScheduler.getPolicies("largest-first,smallest-first")
+
+
+def test_listingOrderIsKept():
+    files = ["c", "a", "b"]
+    assert schedule("listing", files) == files
+
+
+def test_largestFirst():
+    sizes = {"a": 1, "b": 30, "c": 20, "d": 30, "e": None}
+    assert schedule("largest-first", sizes, sizes) == [
+        "b", "d", "c", "a", "e"]
+
+
+def test_recentFirst():
+    files = [wrfName(2, month) for month in (201901, 202005, 201712)]
+    files.append("wrf_fileindex.csv")
+    assert schedule("recent-first", files) == [files[1], files[0], files[2],
+                                               files[3]]
+    # the date ranges go first, in their order, then the rest newest first
+    dateRanges = transferScheduler.parseDateRanges("2017,2019")
+    assert schedule("recent-first", files, dateRanges=dateRanges) == [
+        files[2], files[0], files[1], files[3]]
+
+
+def test_fairAcrossTiles():
+    files = [wrfName(tile, month) for tile in (2, 12, 22)
+             for month in (201901, 201902)]
+    assert schedule("fair", files) == [files[0], files[2], files[4],
+                                       files[1], files[3], files[5]]
+
+
+def test_policiesBreakEachOthersTies():
+    files = [wrfName(2, 201901), wrfName(12, 202001), wrfName(22, 202001),
+             wrfName(32, 201901)]
+    sizes = dict(zip(files, [5, 1, 3, 9]))
+    assert schedule("recent-first,largest-first", files, sizes) == [
+        files[2], files[1], files[3], files[0]]
+
+
+def test_queueBoundsTheReordering():
+    sizes = {str(i): i for i in range(10)}
+    # only two files are held at the start, the queue grows to four
+    assert schedule("largest-first", sizes, sizes, queueSize=4,
+                    initialQueueSize=2) == [
+        "1", "3", "5", "6", "7", "8", "9", "4", "2", "0"]
+    # a queue of everything gives the exact order
+    assert schedule("largest-first", sizes, sizes, initialQueueSize=20) == [
+        str(i) for i in range(9, -1, -1)]
+
+
+def test_filesAreHandedOutBeforeTheListingEnds():
+    listed = []
+
+    def files():
+        for i in range(10):
+            listed.append(i)
+            yield str(i)
+
+    scheduler = transferScheduler.TransferScheduler(
+        [transferScheduler.LargestFirst()], getSize=int, initialQueueSize=3)
+    handedOut = scheduler.schedule(files())
+    assert next(handedOut) == "2"
+    assert len(listed) == 3
+    assert sorted(handedOut) == [str(i) for i in range(10) if i != 2]
@@ -0,0 +1,187 @@
+import collections
+import math
+import os
+import random
+
+import numpy
+import pytest
+
+import wrfGrid
+
+
+def getLatLon(i, j):
+    """a curved, rotated grid like the WRF domain, so the latitudes along a
+    row aren't in order
+    """
+    lat = 46 + 0.03 * j + 0.004 * i + 0.4 * math.sin(i / 60)
+    lon = -140 + 0.05 * i - 0.01 * j + 0.2 * math.cos(j / 50)
+    return lat, lon
+
+
+@pytest.fixture(scope="module")
+def domainFile(tmp_path_factory):
+    # the cells with an index of 0 are left out, like a real domain file
+    # that starts at 1
+    domainFile = tmp_path_factory.mktemp("domain") / "domaininfo_bcwrf.csv"
+    with open(domainFile, "w") as fh:
+        fh.write("domain info\nbc wrf\nI,J,LAT,LON\n")
+        for j in range(1, wrfGrid.MAX_J + 1):
+            for i in range(1, wrfGrid.MAX_I + 1):
+                lat, lon = getLatLon(i, j)
+                fh.write(f"{i},{j},{lat!r},{lon!r}\n")
+    return str(domainFile)
+
+
+@pytest.fixture(scope="module")
+def locator(domainFile):
+    return wrfGrid.GridLocator.load(domainFile)
+
+
+@pytest.fixture(scope="module")
+def backend(domainFile):
+    return BackendReference(domainFile)
+
+
+class BackendReference:
+    """the loops of DataService.calculateVars from the backend.  The domain
+    file is sorted by J, which the backend relies on to stop scanning once
+    it is past a row, so the lines are grouped by J here instead.
+    """
+
+    def __init__(self, domainFile):
+        self.rows = collections.defaultdict(list)
+        with open(domainFile) as fh:
+            for line in fh.readlines()[wrfGrid.DOMAIN_HEADER_LINES:]:
+                i, j, lat, lon = line.split(",")
+                self.rows[int(j)].append((int(i), float(lat), float(lon)))
+
+    def minimumJ(self, latitude, previousMinJ=2, previousMaxJ=wrfGrid.MAX_J,
+                 minI=2, maxI=wrfGrid.MAX_I):
+        minJ = 2
+        for jScan in range(previousMinJ, previousMaxJ + 1):
+            inDomain = True
+            for i, lat, _ in self.rows[jScan]:
+                if i < minI or i > maxI:
+                    continue
+                if lat >= latitude:
+                    inDomain = False
+                    break
+            if inDomain and jScan > minJ:
+                minJ = jScan
+        return minJ
+
+    def maximumJ(self, latitude, previousMinJ=2, previousMaxJ=wrfGrid.MAX_J,
+                 minI=2, maxI=wrfGrid.MAX_I):
+        maxJ = wrfGrid.MAX_J
+        for jScan in range(previousMinJ, previousMaxJ + 1):
+            inDomain = True
+            for i, lat, _ in self.rows[jScan]:
+                if i < minI or i > maxI:
+                    continue
+                if lat <= latitude:
+                    inDomain = False
+                    break
+            if inDomain and jScan < maxJ:
+                maxJ = jScan
+        return maxJ
+
+    def minimumI(self, longitude, maxJ):
+        minI = 2
+        previousLongitude = -200
+        for i, _, lon in self.rows[maxJ]:
+            if previousLongitude < lon < longitude:
+                previousLongitude = lon
+                minI = i
+        return minI
+
+    def maximumI(self, longitude, maxJ):
+        maxI = 2
+        previousLongitude = 200
+        for i, _, lon in self.rows[maxJ]:
+            if longitude < lon < previousLongitude:
+                previousLongitude = lon
+                maxI = i
+        return maxI
+
+    def locateBox(self, bottomLat, leftLon, topLat, rightLon):
+        minJ = self.minimumJ(bottomLat)
+        maxJ = self.maximumJ(topLat, minJ)
+        minI = self.minimumI(leftLon, minJ)
+        maxI = self.maximumI(rightLon, minJ)
+        minJ = self.minimumJ(bottomLat, minJ, maxJ, minI, maxI)
+        maxJ = self.maximumJ(topLat, minJ, maxJ, minI, maxI)
+        return minI, maxI, minJ, maxJ
+
+
+def getBoxes():
+    rand = random.Random(0)
+    boxes = []
+    for _ in range(40):
+        bottom = rand.uniform(45, 60)
+        left = rand.uniform(-142, -118)
+        boxes.append((bottom, left, bottom + rand.uniform(0.01, 4),
+                      left + rand.uniform(0.01, 6)))
+    # the whole domain, outside of it and upside down
+    boxes += [(40, -150, 70, -100), (10, 10, 11, 11), (55, -120, 50, -130)]
+    return boxes
+
+
+@pytest.mark.parametrize("box", getBoxes())
+def test_locatesBoxesLikeTheBackend(locator, backend, box):
+    assert locator.locateBox(*box) == backend.locateBox(*box)
+
+
+def test_locatesBatchesOfBoxes(locator, backend, monkeypatch):
+    monkeypatch.setattr(wrfGrid, "BATCH_SIZE", 7)
+    boxes = getBoxes()
+    assert [tuple(row) for row in locator.locateBoxes(boxes)] == [
+        backend.locateBox(*box) for box in boxes]
+
+
+def test_stepsMatchTheBackend(locator, backend):
+    for lat in [45.0, 50.3, 55.55, 70.0]:
+        assert locator.minimumJ(lat)[0] == backend.minimumJ(lat)
+        assert locator.maximumJ(lat, 100)[0] == backend.maximumJ(lat, 100)
+        assert locator.minimumJ(lat, 10, 300, 50, 60)[0] == \
+            backend.minimumJ(lat, 10, 300, 50, 60)
+    for lon in [-150.0, -130.2, -120.0, -100.0]:
+        for j in [2, 200, wrfGrid.MAX_J, wrfGrid.MAX_J + 1]:
+            assert locator.minimumI(lon, j)[0] == backend.minimumI(lon, j)
+            assert locator.maximumI(lon, j)[0] == backend.maximumI(lon, j)
+
+
+def test_findsTheNearestCells(locator):
+    rand = random.Random(1)
+    lats = [rand.uniform(47, 58) for _ in range(50)]
+    lons = [rand.uniform(-135, -120) for _ in range(50)]
+    iValues, jValues = locator.nearestCells(lats, lons)
+
+    grid = numpy.stack([locator.lat, locator.lon])
+    for n, (lat, lon) in enumerate(zip(lats, lons)):
+        distance = locator.distances(lat, lon, grid[0], grid[1])
+        j, i = numpy.unravel_index(distance.argmin(), distance.shape)
+        assert (iValues[n], jValues[n]) == (i, j)
+    assert locator.nearestCell(lats[0], lons[0]) == (iValues[0],
+                                                     jValues[0])
+
+    lat, lon = locator.cellLatLon([10, 0], [20, 0])
+    assert (lat[0], lon[0]) == pytest.approx(getLatLon(10, 20))
+    assert numpy.isnan(lat[1]) and numpy.isnan(lon[1])
+
+
+def test_cachesTheParsedDomain(domainFile, tmp_path, monkeypatch):
+    cacheFile = str(tmp_path / "domain.npy")
+    wrfGrid.GridLocator.load(domainFile, cacheFile)
+    assert os.path.exists(cacheFile)
+
+    def fromCsv(domainFile):
+        raise AssertionError("the cache should have been used")
+
+    monkeypatch.setattr(wrfGrid.GridLocator, "fromCsv", fromCsv)
+    locator = wrfGrid.GridLocator.load(domainFile, cacheFile)
+    assert isinstance(locator.lat, numpy.memmap)
+
+    # a newer domain file is parsed again
+    os.utime(cacheFile, (0, 0))
+    with pytest.raises(AssertionError):
+        wrfGrid.GridLocator.load(domainFile, cacheFile)
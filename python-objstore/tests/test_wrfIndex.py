@@ -0,0 +1,115 @@
+import csv
+import random
+
+import pytest
+
+import recreateIndex
+import wrfIndex
+
+HEADER = ["filename", "date", "I0", "J0", "I1", "J1", "LAT0", "LON0",
+          "LAT1", "LON1"]
+
+
+def makeRows(count, seed=1):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        i0 = rng.randrange(0, 300, 10)
+        j0 = rng.randrange(0, 300, 10)
+        lat0 = 45 + j0 / 30
+        lon0 = -135 + i0 / 20
+        rows.append({
+            "filename": f"x{i0:03d}y{j0:03d}.{i}.7z",
+            "date": f"{rng.randrange(2015, 2022)}{rng.randrange(1, 13):02d}",
+            "I0": str(i0), "J0": str(j0), "I1": str(i0 + 9),
+            "J1": str(j0 + 9),
+            "LAT0": str(lat0), "LON0": str(lon0),
+            "LAT1": str(lat0 + 0.3), "LON1": str(lon0 + 0.45),
+        })
+    return rows
+
+
+def bruteForce(rows, minLat, minLon, maxLat, maxLon, start, end):
+    start = wrfIndex.parseIndexDate(start)
+    end = wrfIndex.parseIndexDate(end)
+    return sorted(
+        row["filename"] for row in rows
+        if float(row["LAT0"]) <= maxLat and float(row["LAT1"]) >= minLat
+        and float(row["LON0"]) <= maxLon and float(row["LON1"]) >= minLon
+        and start <= wrfIndex.parseIndexDate(row["date"]) <= end
+    )
+
+
+def writeCsv(path, rows):
+    with open(path, "w", newline="") as fh:
+        writer = csv.DictWriter(fh, HEADER)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("197001", 0), ("1970-01-02", 1), ("19700201", 31),
+    ("1970-02-01 00:00:00", 31),
+])
+def test_parsesIndexDates(value, expected):
+    assert wrfIndex.parseIndexDate(value) == expected
+
+
+def test_queriesMatchAFullScan(tmp_path):
+    rows = makeRows(2000)
+    index = wrfIndex.WRFIndex.fromRows(rows)
+    indexFile = str(tmp_path / "index.npz")
+    index.save(indexFile)
+    loaded = wrfIndex.WRFIndex.load(indexFile)
+    rng = random.Random(2)
+    for _ in range(50):
+        minLat = rng.uniform(44, 56)
+        minLon = rng.uniform(-136, -120)
+        box = (minLat, minLon, minLat + rng.uniform(0, 3),
+               minLon + rng.uniform(0, 4))
+        dates = ("2016-01", "2019-06")
+        expected = bruteForce(rows, *box, *dates)
+        assert sorted(index.query(*box, *dates)) == expected
+        assert sorted(loaded.query(*box, *dates)) == expected
+
+
+def test_resultsAreInDateOrder():
+    index = wrfIndex.WRFIndex.fromRows(makeRows(500))
+    names = index.query(40, -140, 60, -110)
+    assert len(names) == 500
+    dates = list(index.columns["date"])
+    assert dates == sorted(dates)
+
+
+def test_skipsBadRows(tmp_path):
+    rows = makeRows(10)
+    rows[1].update(LAT0="", LON0="", LAT1="", LON1="")
+    rows[2]["date"] = "sometime"
+    rows[3]["I0"] = ""
+    rows[4]["LAT1"] = "nan"
+    index = wrfIndex.WRFIndex.fromRows(rows)
+    assert len(index) == 6
+    assert sorted(index.query(40, -140, 60, -110)) == \
+        sorted(row["filename"] for row in rows[:1] + rows[5:])
+
+
+def test_emptyIndexQueriesAsEmpty(tmp_path):
+    csvFile = str(tmp_path / "index.csv")
+    writeCsv(csvFile, [])
+    index = wrfIndex.WRFIndex.fromCsv(csvFile)
+    assert len(index) == 0
+    assert index.query(40, -140, 60, -110) == []
+    indexFile = str(tmp_path / "index.npz")
+    index.save(indexFile)
+    assert wrfIndex.WRFIndex.load(indexFile).query(
+        40, -140, 60, -110, "2019-01", "2019-02") == []
+
+
+def test_reCreateWithAHeaderOnlyIndex(tmp_path):
+    creator = recreateIndex.CreateIndex.__new__(recreateIndex.CreateIndex)
+    creator.oldWrfFile = str(tmp_path / "wrf_fileindex.csv")
+    creator.newWrfFile = str(tmp_path / "wrf_fileindex_v2.csv")
+    creator.newWrfIndexFile = str(tmp_path / "wrf_fileindex_v2.npz")
+    writeCsv(creator.oldWrfFile, [])
+    creator.reCreate()
+    assert len(wrfIndex.WRFIndex.load(creator.newWrfIndexFile)) == 0
@@ -0,0 +1,207 @@
+"""Write ahead journal of the state of each object that is moved by the
+consolidation script.
+
+Every change in the state of an object is appended to a json lines file.
+Writes are flushed and fsync'd in batches, so after a crash the last few
+state changes can be lost, in which case those objects are simply moved
+again.  When the journal is opened it is replayed to rebuild the latest
+state of every object and then compacted.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# states an object moves through, in order
+QUEUED = "queued"
+COPIED = "copied"
+ACL_SET = "acl-set"
+VERIFIED = "verified"
+# only the size was checked, the etags couldn't be compared and the object
+# wasn't sampled.  It isn't moved again, but isn't deleted from the source
+UNVERIFIED = "unverified"
+# the object in the destination didn't match the source, it gets moved again
+MISMATCH = "mismatch"
+# the object could not be moved after all the retries
+FAILED = "failed"
+# the object was verified and then deleted from the source bucket
+SOURCE_DELETED = "source-deleted"
+
+# states where the object does not need to be moved again
+COMPLETE_STATES = [ACL_SET, VERIFIED, UNVERIFIED, SOURCE_DELETED]
+
+# details of a verified record that are kept (and survive compaction), the
+# etags of the source and destination objects that matched and how they
+# were compared
+VERIFIED_DETAILS = ("etag", "destEtag", "method")
+
+# fsync after this many records or this many seconds, whichever comes first
+SYNC_EVERY_RECORDS = 100
+SYNC_EVERY_SECONDS = 5
+
+
+class TransferJournal:
+    def __init__(self, journalFile, syncEvery=SYNC_EVERY_RECORDS,
+                 syncInterval=SYNC_EVERY_SECONDS):
+        """[summary]
+
+        :param journalFile: path to the journal file, created if it doesn't
+                            exist
+        :type journalFile: str
+        :param syncEvery: number of records written between fsyncs
+        :type syncEvery: int, optional
+        :param syncInterval: max number of seconds between fsyncs
+        :type syncInterval: int, optional
+        """
+        self.journalFile = journalFile
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        self.lock = threading.Lock()
+        # latest state of each object, key is the object name
+        self.states = {}
+        # VERIFIED_DETAILS of the objects whose latest state is verified
+        self.verifiedDetails = {}
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+        self.replay()
+        self.compact()
+        self.fh = open(self.journalFile, "a")
+
+    def replay(self):
+        """reads the journal file and rebuilds the latest state of every
+        object.  A partially written last line (from a crash mid write) is
+        ignored.
+        """
+        if not os.path.exists(self.journalFile):
+            return
+        with open(self.journalFile, "r") as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    LOGGER.warning(f"skipping corrupt journal line: {line}")
+                    continue
+                self.setState(record)
+        LOGGER.info(
+            f"replayed {len(self.states)} objects from {self.journalFile}"
+        )
+
+    def setState(self, record):
+        key = record["key"]
+        self.states[key] = record["state"]
+        if record["state"] == VERIFIED:
+            self.verifiedDetails[key] = {
+                name: record[name] for name in VERIFIED_DETAILS
+                if record.get(name) is not None
+            }
+        else:
+            self.verifiedDetails.pop(key, None)
+
+    def compact(self):
+        """rewrites the journal so it only contains the latest state of each
+        object.  Written to a temp file that then replaces the journal so a
+        crash during the compaction doesn't lose the journal.
+        """
+        tmpFile = self.journalFile + ".tmp"
+        with open(tmpFile, "w") as fh:
+            for key, state in self.states.items():
+                record = {"key": key, "state": state}
+                record.update(self.verifiedDetails.get(key, {}))
+                fh.write(json.dumps(record) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpFile, self.journalFile)
+
+    def record(self, key, state, **details):
+        """appends a state change to the journal
+
+        :param key: name of the object
+        :type key: str
+        :param state: the new state of the object
+        :type state: str
+        :param details: any other values to store with the record, for
+                        example the error that caused a failure.  Only the
+                        VERIFIED_DETAILS of a verified record are kept when
+                        the journal is compacted
+        """
+        record = {"key": key, "state": state, "time": time.time()}
+        record.update(details)
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.fh.write(line)
+            self.setState(record)
+            self.unsynced += 1
+            if (
+                self.unsynced >= self.syncEvery
+                or time.time() - self.lastSync >= self.syncInterval
+            ):
+                self._sync()
+
+    def _sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.unsynced = 0
+        self.lastSync = time.time()
+
+    def sync(self):
+        """forces the buffered records to disk"""
+        with self.lock:
+            self._sync()
+
+    def getState(self, key):
+        """
+        :param key: name of the object
+        :type key: str
+        :return: the latest state of the object or None if it isn't in the
+                 journal
+        :rtype: str
+        """
+        return self.states.get(key)
+
+    def getVerifiedDetails(self, key):
+        """
+        :param key: name of the object
+        :type key: str
+        :return: the etags the object was verified with and the method,
+                 empty if it isn't verified or was verified by an older
+                 version that didn't record them
+        :rtype: dict
+        """
+        return self.verifiedDetails.get(key, {})
+
+    def isComplete(self, key):
+        """
+        :param key: name of the object
+        :type key: str
+        :return: true if the object doesn't need to be moved again
+        :rtype: bool
+        """
+        return self.states.get(key) in COMPLETE_STATES
+
+    def getKeys(self, state):
+        """
+        :param state: the state to look for
+        :type state: str
+        :return: names of the objects whose latest state is state
+        :rtype: list
+        """
+        return [key for key, value in self.states.items() if value == state]
+
+    def getCounts(self):
+        """
+        :return: the number of objects in each state
+        :rtype: dict
+        """
+        with self.lock:
+            return dict(collections.Counter(self.states.values()))
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.fh.close()
@@ -0,0 +1,224 @@
+"""Decides the order that the consolidation moves files in.
+
+The files come out of the bucket diff in listing order, so huge and tiny
+files are mixed at random and the last few huge files can keep a run going
+long after everything else is done.  The scheduler holds the next files in a
+bounded priority queue and hands them out in the order set by one or more
+policies:
+
+* listing      - the order of the bucket listing, nothing is queued
+* largest-first - largest files first, the small ones fill in the gaps at
+                 the end of the run so it finishes sooner
+* recent-first - WRF files by the month in their name, newest first.  Given
+                 date ranges, the files in the ranges go first (in the order
+                 of the ranges), then the rest newest first
+* fair         - round robin across the prefixes of the names (the WRF
+                 tile by default), every tile gets its nth file moved before
+                 any tile gets its n+1th
+
+Policies can be combined, "recent-first,largest-first" moves the largest
+files of the newest month first.  As the queue is bounded the order is only
+exact within the files in the queue.  The queue starts small so the first
+files are handed out as soon as the diff finds a few, and grows by a file
+for every file handed out until it reaches its full size, so the window the
+order is picked from widens as the run goes on.
+"""
+
+import heapq
+import itertools
+import logging
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+LISTING = "listing"
+LARGEST_FIRST = "largest-first"
+RECENT_FIRST = "recent-first"
+FAIR = "fair"
+POLICIES = [LISTING, LARGEST_FIRST, RECENT_FIRST, FAIR]
+
+DEFAULT_QUEUE_SIZE = 10000
+# number of files queued before the first one is handed out
+DEFAULT_INITIAL_QUEUE_SIZE = 100
+
+# the year and month after the tile in a WRF object name, for example
+# x002y012x011y021.201901.10x10.m3d.7z
+WRF_DATE = re.compile(r"^[^.]*\.(\d{6})")
+DATE_RANGE = re.compile(r"^(\d{4})(\d{2})?(?:-(\d{4})(\d{2})?)?$")
+
+
+def getObjectMonth(objectName):
+    """
+    :return: the year and month of a WRF object as YYYYMM, None for names
+             without a date
+    :rtype: int
+    """
+    match = WRF_DATE.match(objectName)
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def parseDateRanges(value):
+    """parses a comma separated list of years or months, and ranges of them,
+    for example "2021-2022,201901-201906,2015"
+
+    :param value: the date ranges
+    :type value: str
+    :raises ValueError: if a range isn't in one of the expected formats
+    :return: list of (first YYYYMM, last YYYYMM)
+    :rtype: list
+    """
+    dateRanges = []
+    for text in value.split(","):
+        text = text.strip()
+        if not text:
+            continue
+        match = DATE_RANGE.match(text)
+        if not match:
+            msg = f"unable to parse the date range: {text}, expected YYYY, " \
+                "YYYYMM or two of them separated by a -"
+            raise ValueError(msg)
+        startYear, startMonth, endYear, endMonth = match.groups()
+        if endYear is None:
+            endYear, endMonth = startYear, startMonth
+        start = int(startYear + (startMonth or "01"))
+        end = int(endYear + (endMonth or "12"))
+        if start > end:
+            raise ValueError(f"the date range {text} ends before it starts")
+        dateRanges.append((start, end))
+    return dateRanges
+
+
+class LargestFirst:
+    def getPriority(self, objectName, size):
+        return -(size or 0)
+
+
+class RecentFirst:
+    def __init__(self, dateRanges=None):
+        """[summary]
+
+        :param dateRanges: (first YYYYMM, last YYYYMM) of the months to move
+                           first, in order of importance
+        :type dateRanges: list, optional
+        """
+        self.dateRanges = dateRanges or []
+
+    def getPriority(self, objectName, size):
+        month = getObjectMonth(objectName)
+        if month is None:
+            # files without a date go last
+            return (len(self.dateRanges) + 1, 0)
+        for rank, (start, end) in enumerate(self.dateRanges):
+            if start <= month <= end:
+                return (rank, -month)
+        return (len(self.dateRanges), -month)
+
+
+class PrefixFairness:
+    def __init__(self, prefixLength=None):
+        """[summary]
+
+        :param prefixLength: number of characters of the names that make up
+                             the prefix, defaults to the part of the name
+                             before the first "."
+        :type prefixLength: int, optional
+        """
+        self.prefixLength = prefixLength
+        self.counts = {}
+
+    def getPrefix(self, objectName):
+        if self.prefixLength:
+            return objectName[:self.prefixLength]
+        return objectName.split(".", 1)[0]
+
+    def getPriority(self, objectName, size):
+        prefix = self.getPrefix(objectName)
+        count = self.counts.get(prefix, 0)
+        self.counts[prefix] = count + 1
+        return count
+
+
+def getPolicies(names, dateRanges=None):
+    """
+    :param names: comma separated policy names, in order of precedence
+    :type names: str
+    :param dateRanges: months that the recent-first policy moves first
+    :type dateRanges: list, optional
+    :raises ValueError: for an unknown policy
+    :return: the policies, an empty list for listing order
+    :rtype: list
+    """
+    policies = []
+    for name in names.split(","):
+        name = name.strip()
+        if name == LARGEST_FIRST:
+            policies.append(LargestFirst())
+        elif name == RECENT_FIRST:
+            policies.append(RecentFirst(dateRanges))
+        elif name == FAIR:
+            policies.append(PrefixFairness())
+        elif name != LISTING:
+            msg = f"unknown schedule policy: {name}, expected one of " \
+                f"{', '.join(POLICIES)}"
+            raise ValueError(msg)
+    return policies
+
+
+class TransferScheduler:
+    def __init__(self, policies, getSize=None, queueSize=DEFAULT_QUEUE_SIZE,
+                 initialQueueSize=DEFAULT_INITIAL_QUEUE_SIZE):
+        """[summary]
+
+        :param policies: the policies, the first one decides the order and
+                         the next ones break its ties
+        :type policies: list
+        :param getSize: returns the size of a file from its name, needed by
+                        largest-first
+        :type getSize: callable, optional
+        :param queueSize: max number of files held in the queue
+        :type queueSize: int, optional
+        :param initialQueueSize: number of files held in the queue at the
+                                 start, it grows by one for every file handed
+                                 out up to queueSize
+        :type initialQueueSize: int, optional
+        """
+        self.policies = policies
+        self.getSize = getSize
+        self.queueSize = max(1, queueSize)
+        self.initialQueueSize = max(1, min(initialQueueSize, self.queueSize))
+
+    def getPriority(self, objectName):
+        size = None
+        if self.getSize is not None:
+            size = self.getSize(objectName)
+        return tuple(policy.getPriority(objectName, size)
+                     for policy in self.policies)
+
+    def schedule(self, files):
+        """reorders the files, reading up to queueSize of them ahead (fewer
+        at the start, see initialQueueSize)
+
+        :param files: names of the files, in listing order
+        :type files: iterable
+        :yield: the names of the files in the order they should be moved
+        :rtype: str
+        """
+        if not self.policies:
+            yield from files
+            return
+        queue = []
+        queueSize = self.initialQueueSize
+        # ties are broken by listing order
+        counter = itertools.count()
+        for objectName in files:
+            heapq.heappush(
+                queue,
+                (self.getPriority(objectName), next(counter), objectName)
+            )
+            if len(queue) >= queueSize:
+                yield heapq.heappop(queue)[2]
+                queueSize = min(queueSize + 1, self.queueSize)
+        while queue:
+            yield heapq.heappop(queue)[2]
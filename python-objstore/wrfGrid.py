@@ -0,0 +1,347 @@
+"""Locates lat / lon coordinates on the WRF grid.
+
+The domain file (domaininfo_bcwrf.csv) lists the lat / lon of every I / J
+cell of the WRF grid.  The backend (DataService.calculateMinimumJ etc.)
+scans the whole file for every request to turn a bounding box into the
+grid indices of the files to download.  This module loads the domain file
+once into 2-D arrays indexed by [J, I], caches them as a .npy file that is
+memory mapped on the next load, and answers the same questions with numpy
+masks over the rows of the grid.
+
+    locator = wrfGrid.GridLocator.load('domaininfo_bcwrf.csv')
+    # bottom left lat, bottom left lon, top right lat, top right lon
+    minI, maxI, minJ, maxJ = locator.locateBox(48.5, -124.0, 49.5, -122.5)
+    i, j = locator.nearestCell(49.0, -123.0)
+"""
+
+import logging
+import os
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+# size of the grid, and the defaults the backend uses for the index range
+MAX_I = 476
+MAX_J = 425
+MIN_INDEX = 2
+
+# lines before the first I,J,LAT,LON row in the domain file
+DOMAIN_HEADER_LINES = 3
+
+# every COARSE_STEP'th cell is used to find the approximate nearest cell to
+# a point, which is then refined by searching the cells around it
+COARSE_STEP = 8
+
+# number of points / boxes that are compared to the grid at once, bounds
+# the memory used by the batch methods
+BATCH_SIZE = 1024
+
+
+def buildSparseTable(values, func, fill):
+    """builds a sparse table for range min / max queries along the rows
+    (I axis) of the grid.  Level k holds func over the 2 ** k cells that
+    start at each I, padded with fill so all the levels are the same shape.
+
+    :param values: 2-D array indexed by [J, I]
+    :type values: numpy.ndarray
+    :param func: numpy.maximum or numpy.minimum
+    :type func: numpy.ufunc
+    :param fill: value for the cells that have no data
+    :type fill: float
+    :return: 3-D array indexed by [k, J, I]
+    :rtype: numpy.ndarray
+    """
+    numI = values.shape[1]
+    levels = int(numpy.log2(numI)) + 1
+    table = numpy.full((levels,) + values.shape, fill)
+    table[0] = values
+    for k in range(1, levels):
+        half = 2 ** (k - 1)
+        width = numI - 2 ** k + 1
+        table[k, :, :width] = func(
+            table[k - 1, :, :width], table[k - 1, :, half:half + width])
+    return table
+
+
+class GridLocator:
+    def __init__(self, grid):
+        """[summary]
+
+        :param grid: array with the shape (2, J, I), the latitudes and
+                     longitudes of the cells, nan for cells that are not in
+                     the domain file
+        :type grid: numpy.ndarray
+        """
+        self.lat = grid[0]
+        self.lon = grid[1]
+        self.numJ, self.numI = self.lat.shape
+
+        missing = numpy.isnan(self.lat)
+        self.latMaxTable = buildSparseTable(
+            numpy.where(missing, -numpy.inf, self.lat), numpy.maximum,
+            -numpy.inf)
+        self.latMinTable = buildSparseTable(
+            numpy.where(missing, numpy.inf, self.lat), numpy.minimum,
+            numpy.inf)
+
+        self.coarseJ, self.coarseI = numpy.nonzero(
+            ~missing[::COARSE_STEP, ::COARSE_STEP])
+        self.coarseJ = self.coarseJ * COARSE_STEP
+        self.coarseI = self.coarseI * COARSE_STEP
+
+    @classmethod
+    def fromCsv(cls, domainFile):
+        """reads the domain file, each line after the header has the format
+        I,J,LAT,LON
+
+        :param domainFile: path to the domain file
+        :type domainFile: str
+        :return: array with the shape (2, J, I)
+        :rtype: numpy.ndarray
+        """
+        values = numpy.genfromtxt(
+            domainFile, delimiter=",", skip_header=DOMAIN_HEADER_LINES,
+            usecols=(0, 1, 2, 3), ndmin=2)
+        iValues = values[:, 0].astype(int)
+        jValues = values[:, 1].astype(int)
+        grid = numpy.full((2, jValues.max() + 1, iValues.max() + 1),
+                          numpy.nan)
+        grid[0, jValues, iValues] = values[:, 2]
+        grid[1, jValues, iValues] = values[:, 3]
+        LOGGER.info(f"read {len(values)} cells from {domainFile}")
+        return grid
+
+    @classmethod
+    def load(cls, domainFile, cacheFile=None):
+        """loads the grid, the parsed domain file is cached in a .npy file
+        next to it that is memory mapped instead of parsing the csv again
+
+        :param domainFile: path to the domain file
+        :type domainFile: str
+        :param cacheFile: path to the cache, defaults to the domain file with
+                          a .npy extension
+        :type cacheFile: str, optional
+        :return: the locator
+        :rtype: GridLocator
+        """
+        if cacheFile is None:
+            cacheFile = os.path.splitext(domainFile)[0] + ".npy"
+        if not os.path.exists(cacheFile) or \
+                os.path.getmtime(cacheFile) < os.path.getmtime(domainFile):
+            grid = cls.fromCsv(domainFile)
+            # written to a temp file first so a reader never maps a partial
+            # cache
+            tmpFile = cacheFile + ".tmp"
+            with open(tmpFile, "wb") as fh:
+                numpy.save(fh, grid)
+            os.replace(tmpFile, cacheFile)
+        return cls(numpy.load(cacheFile, mmap_mode="r"))
+
+    def rangeExtreme(self, table, func, fill, minI, maxI):
+        """for each row of the grid, the min or max latitude of the cells
+        between minI and maxI
+
+        :param minI: array of start indexes (inclusive)
+        :type minI: numpy.ndarray
+        :param maxI: array of end indexes (inclusive)
+        :type maxI: numpy.ndarray
+        :return: array with the shape (len(minI), J)
+        :rtype: numpy.ndarray
+        """
+        start = numpy.clip(minI, 0, self.numI - 1)
+        end = numpy.clip(maxI, -1, self.numI - 1)
+        length = numpy.maximum(end - start + 1, 1)
+        k = numpy.log2(length).astype(int)
+        rows = numpy.arange(self.numJ)[None, :]
+        values = func(
+            table[k[:, None], rows, start[:, None]],
+            table[k[:, None], rows, (end - 2 ** k + 1)[:, None]])
+        # an empty range has no cells, so no cell can be outside the bounds
+        return numpy.where((end < start)[:, None], fill, values)
+
+    def minimumJ(self, latitude, previousMinJ=MIN_INDEX,
+                 previousMaxJ=MAX_J, minI=MIN_INDEX, maxI=MAX_I):
+        """the largest J between previousMinJ and previousMaxJ where all the
+        cells between minI and maxI are south of the latitude, same as
+        DataService.calculateMinimumJ.  All the arguments can be arrays or
+        numbers.
+
+        :return: array of J indexes
+        :rtype: numpy.ndarray
+        """
+        latitude, previousMinJ, previousMaxJ, minI, maxI = \
+            numpy.broadcast_arrays(*numpy.atleast_1d(
+                latitude, previousMinJ, previousMaxJ, minI, maxI))
+        rowMax = self.rangeExtreme(self.latMaxTable, numpy.maximum,
+                                   -numpy.inf, minI, maxI)
+        jValues = numpy.arange(self.numJ)[None, :]
+        inDomain = (
+            (rowMax < latitude[:, None])
+            & (jValues >= previousMinJ[:, None])
+            & (jValues <= previousMaxJ[:, None])
+        )
+        return numpy.where(inDomain, jValues, MIN_INDEX).max(axis=1)
+
+    def maximumJ(self, latitude, previousMinJ=MIN_INDEX,
+                 previousMaxJ=MAX_J, minI=MIN_INDEX, maxI=MAX_I):
+        """the smallest J between previousMinJ and previousMaxJ where all the
+        cells between minI and maxI are north of the latitude, same as
+        DataService.calculateMaximumJ.  All the arguments can be arrays or
+        numbers.
+
+        :return: array of J indexes
+        :rtype: numpy.ndarray
+        """
+        latitude, previousMinJ, previousMaxJ, minI, maxI = \
+            numpy.broadcast_arrays(*numpy.atleast_1d(
+                latitude, previousMinJ, previousMaxJ, minI, maxI))
+        rowMin = self.rangeExtreme(self.latMinTable, numpy.minimum,
+                                   numpy.inf, minI, maxI)
+        jValues = numpy.arange(self.numJ)[None, :]
+        inDomain = (
+            (rowMin > latitude[:, None])
+            & (jValues >= previousMinJ[:, None])
+            & (jValues <= previousMaxJ[:, None])
+        )
+        return numpy.where(inDomain, jValues, MAX_J).min(axis=1)
+
+    def rowLongitudes(self, j):
+        rows = numpy.clip(j, 0, self.numJ - 1)
+        lon = self.lon[rows]
+        return numpy.where(((j >= 0) & (j < self.numJ))[:, None], lon,
+                           numpy.nan)
+
+    def minimumI(self, longitude, j):
+        """the I of the cell in row j with the largest longitude west of
+        the longitude, same as DataService.calculateMinimumI
+
+        :return: array of I indexes
+        :rtype: numpy.ndarray
+        """
+        longitude, j = numpy.broadcast_arrays(
+            *numpy.atleast_1d(longitude, j))
+        lon = self.rowLongitudes(j)
+        inside = (lon < longitude[:, None]) & (lon > -200)
+        iValues = numpy.where(inside, lon, -numpy.inf).argmax(axis=1)
+        return numpy.where(inside.any(axis=1), iValues, MIN_INDEX)
+
+    def maximumI(self, longitude, j):
+        """the I of the cell in row j with the smallest longitude east of
+        the longitude, same as DataService.calculateMaximumI (including
+        falling back to 2 when there isn't one)
+
+        :return: array of I indexes
+        :rtype: numpy.ndarray
+        """
+        longitude, j = numpy.broadcast_arrays(
+            *numpy.atleast_1d(longitude, j))
+        lon = self.rowLongitudes(j)
+        inside = (lon > longitude[:, None]) & (lon < 200)
+        iValues = numpy.where(inside, lon, numpy.inf).argmin(axis=1)
+        return numpy.where(inside.any(axis=1), iValues, MIN_INDEX)
+
+    def locateBoxes(self, boxes):
+        """converts lat / lon boxes into the grid indexes that cover them,
+        with the same steps as DataService.calculateVars
+
+        :param boxes: array with a row per box: bottom left lat, bottom left
+                      lon, top right lat, top right lon
+        :type boxes: numpy.ndarray
+        :return: array with a row per box: minI, maxI, minJ, maxJ
+        :rtype: numpy.ndarray
+        """
+        boxes = numpy.asarray(boxes, dtype=float).reshape(-1, 4)
+        results = numpy.empty((len(boxes), 4), dtype=int)
+        for start in range(0, len(boxes), BATCH_SIZE):
+            batch = boxes[start:start + BATCH_SIZE]
+            bottom, left, top, right = batch.T
+            minJ = self.minimumJ(bottom)
+            maxJ = self.maximumJ(top, minJ)
+            minI = self.minimumI(left, minJ)
+            maxI = self.maximumI(right, minJ)
+            minJ = self.minimumJ(bottom, minJ, maxJ, minI, maxI)
+            maxJ = self.maximumJ(top, minJ, maxJ, minI, maxI)
+            results[start:start + len(batch)] = numpy.stack(
+                [minI, maxI, minJ, maxJ], axis=1)
+        return results
+
+    def locateBox(self, bottomLat, leftLon, topLat, rightLon):
+        """single box version of locateBoxes
+
+        :return: minI, maxI, minJ, maxJ
+        :rtype: tuple
+        """
+        result = self.locateBoxes([[bottomLat, leftLon, topLat, rightLon]])
+        return tuple(int(value) for value in result[0])
+
+    def distances(self, lat, lon, cellLat, cellLon):
+        # flat earth distance, good enough to compare neighbouring cells
+        dx = (cellLon - lon) * numpy.cos(numpy.radians(lat))
+        distance = dx ** 2 + (cellLat - lat) ** 2
+        return numpy.where(numpy.isnan(distance), numpy.inf, distance)
+
+    def nearestCells(self, lats, lons):
+        """finds the grid cells closest to the points, first on a coarse
+        version of the grid and then among the cells around the closest
+        coarse cell
+
+        :param lats: latitudes of the points
+        :type lats: numpy.ndarray
+        :param lons: longitudes of the points
+        :type lons: numpy.ndarray
+        :return: arrays of the I and J indexes of the cells
+        :rtype: tuple
+        """
+        lats = numpy.asarray(lats, dtype=float).reshape(-1)
+        lons = numpy.asarray(lons, dtype=float).reshape(-1)
+        coarseLat = self.lat[self.coarseJ, self.coarseI]
+        coarseLon = self.lon[self.coarseJ, self.coarseI]
+        offsets = numpy.arange(-2 * COARSE_STEP, 2 * COARSE_STEP + 1)
+
+        iValues = numpy.empty(len(lats), dtype=int)
+        jValues = numpy.empty(len(lats), dtype=int)
+        for start in range(0, len(lats), BATCH_SIZE):
+            lat = lats[start:start + BATCH_SIZE, None]
+            lon = lons[start:start + BATCH_SIZE, None]
+            closest = self.distances(
+                lat, lon, coarseLat[None, :], coarseLon[None, :]
+            ).argmin(axis=1)
+
+            windowJ = numpy.clip(self.coarseJ[closest][:, None]
+                                 + offsets[None, :], 0, self.numJ - 1)
+            windowI = numpy.clip(self.coarseI[closest][:, None]
+                                 + offsets[None, :], 0, self.numI - 1)
+            cellJ = numpy.repeat(windowJ, len(offsets), axis=1)
+            cellI = numpy.tile(windowI, len(offsets))
+            closest = self.distances(
+                lat, lon, self.lat[cellJ, cellI], self.lon[cellJ, cellI]
+            ).argmin(axis=1)
+            rows = numpy.arange(len(closest))
+            iValues[start:start + len(lat)] = cellI[rows, closest]
+            jValues[start:start + len(lat)] = cellJ[rows, closest]
+        return iValues, jValues
+
+    def nearestCell(self, lat, lon):
+        """single point version of nearestCells
+
+        :return: I and J index of the cell
+        :rtype: tuple
+        """
+        iValues, jValues = self.nearestCells([lat], [lon])
+        return int(iValues[0]), int(jValues[0])
+
+    def cellLatLon(self, i, j):
+        """the lat / lon of grid cells
+
+        :return: arrays of latitudes and longitudes, nan for cells that are
+                 not in the domain
+        :rtype: tuple
+        """
+        i = numpy.asarray(i)
+        j = numpy.asarray(j)
+        inGrid = (i >= 0) & (i < self.numI) & (j >= 0) & (j < self.numJ)
+        i = numpy.clip(i, 0, self.numI - 1)
+        j = numpy.clip(j, 0, self.numJ - 1)
+        return (numpy.where(inGrid, self.lat[j, i], numpy.nan),
+                numpy.where(inGrid, self.lon[j, i], numpy.nan))
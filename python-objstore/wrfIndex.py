@@ -0,0 +1,364 @@
+"""Binary, spatially indexed version of the WRF file index.
+
+The csv index has to be scanned row by row to find the files that cover an
+area and a date range.  This module converts it into column arrays (sorted
+by date) that are saved in a numpy .npz file, along with two grid bucket
+lookups over the tile extents, one in lat / lon and one in I / J grid
+coordinates.  A query looks up the buckets that overlap the requested box,
+narrows the candidate rows to the date range with a binary search, and then
+does an exact overlap check on what's left.
+
+    index = wrfIndex.WRFIndex.load('wrf_fileindex_v2.npz')
+    index.query(48.5, -124.0, 49.5, -122.5, '2019-01-01', '2019-03-01')
+"""
+
+import csv
+import datetime
+import logging
+import math
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+# size of the lat / lon grid buckets in degrees and the I / J buckets in
+# grid cells (each WRF tile is 10 x 10 cells)
+LATLON_BUCKET_SIZE = 1.0
+GRID_BUCKET_SIZE = 10
+
+INT_COLUMNS = ["I0", "J0", "I1", "J1"]
+FLOAT_COLUMNS = ["LAT0", "LON0", "LAT1", "LON1"]
+
+
+def parseIndexDate(value):
+    """converts a date from the index file into the number of days since
+    1970-01-01.  Accepts YYYYMM, YYYYMMDD, YYYY-MM and YYYY-MM-DD, anything
+    after the date (a time) is ignored.  Dates that only have a month are
+    treated as the first day of the month.
+
+    :param value: the date string, or a datetime.date
+    :type value: str
+    :raises ValueError: if the date isn't in one of the expected formats
+    :return: days since the epoch
+    :rtype: int
+    """
+    if isinstance(value, datetime.date):
+        return (value - datetime.date(1970, 1, 1)).days
+    digits = value.strip()[:10].replace("-", "").replace("/", "")
+    if len(digits) == 6:
+        digits += "01"
+    if len(digits) != 8 or not digits.isdigit():
+        raise ValueError(f"unable to parse the index date: {value}")
+    date = datetime.date(int(digits[:4]), int(digits[4:6]), int(digits[6:]))
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+class GridBuckets:
+    """maps cells of a regular grid to the rows whose extents overlap them,
+    stored as compressed sparse rows: the rows for cell n are
+    rows[offsets[n]:offsets[n + 1]]
+    """
+
+    def __init__(self, origin, cellSize, shape, offsets, rows):
+        self.origin = origin
+        self.cellSize = cellSize
+        self.shape = shape
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def build(cls, x0, y0, x1, y1, cellSize):
+        """builds the buckets for the boxes described by the coordinate
+        arrays, boxes that span several cells are added to each of them
+
+        :return: the grid buckets, with no cells if there are no boxes
+        :rtype: GridBuckets
+        """
+        if not len(x0):
+            return cls(numpy.zeros(2), cellSize, numpy.zeros(2, numpy.int64),
+                       numpy.zeros(1, numpy.int64),
+                       numpy.empty(0, dtype=numpy.int32))
+        xMin = numpy.floor(min(x0.min(), x1.min()))
+        yMin = numpy.floor(min(y0.min(), y1.min()))
+        xMax = max(x0.max(), x1.max())
+        yMax = max(y0.max(), y1.max())
+        numX = int((xMax - xMin) // cellSize) + 1
+        numY = int((yMax - yMin) // cellSize) + 1
+
+        def toCell(values, low):
+            return ((values - low) // cellSize).astype(numpy.int64)
+
+        cellX0 = toCell(numpy.minimum(x0, x1), xMin)
+        cellX1 = toCell(numpy.maximum(x0, x1), xMin)
+        cellY0 = toCell(numpy.minimum(y0, y1), yMin)
+        cellY1 = toCell(numpy.maximum(y0, y1), yMin)
+
+        # expand every row into one entry per cell it covers
+        spanX = cellX1 - cellX0 + 1
+        spanY = cellY1 - cellY0 + 1
+        counts = spanX * spanY
+        rows = numpy.repeat(numpy.arange(len(x0)), counts)
+        firsts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        within = numpy.arange(len(rows)) - firsts
+        cells = (
+            (cellY0[rows] + within // spanX[rows]) * numX
+            + cellX0[rows] + within % spanX[rows]
+        )
+
+        # stable sort keeps the rows in each cell in row (date) order
+        order = numpy.argsort(cells, kind="stable")
+        offsets = numpy.searchsorted(
+            cells[order], numpy.arange(numX * numY + 1)
+        )
+        return cls(
+            numpy.array([xMin, yMin]),
+            cellSize,
+            numpy.array([numY, numX]),
+            offsets.astype(numpy.int64),
+            rows[order].astype(numpy.int32),
+        )
+
+    def candidates(self, xMin, yMin, xMax, yMax, firstRow=0, lastRow=None):
+        """
+        :param firstRow: only return rows >= this
+        :type firstRow: int, optional
+        :param lastRow: only return rows < this
+        :type lastRow: int, optional
+        :return: the rows in the buckets that overlap the box, sorted
+        :rtype: numpy.ndarray
+        """
+        numY, numX = self.shape
+        cellX0 = max(int((xMin - self.origin[0]) // self.cellSize), 0)
+        cellX1 = min(int((xMax - self.origin[0]) // self.cellSize), numX - 1)
+        cellY0 = max(int((yMin - self.origin[1]) // self.cellSize), 0)
+        cellY1 = min(int((yMax - self.origin[1]) // self.cellSize), numY - 1)
+        if cellX0 > cellX1 or cellY0 > cellY1:
+            return numpy.empty(0, dtype=numpy.int32)
+        if lastRow is None:
+            lastRow = numpy.iinfo(numpy.int32).max
+        slices = []
+        for cellY in range(cellY0, cellY1 + 1):
+            firstCell = cellY * numX + cellX0
+            for cell in range(firstCell, firstCell + cellX1 - cellX0 + 1):
+                cellRows = self.rows[self.offsets[cell]:self.offsets[cell + 1]]
+                # rows are sorted within each cell, so the row range can be
+                # cut out with a binary search
+                low, high = numpy.searchsorted(cellRows, [firstRow, lastRow])
+                slices.append(cellRows[low:high])
+        return numpy.unique(numpy.concatenate(slices))
+
+    def toArrays(self, prefix):
+        return {
+            f"{prefix}_origin": self.origin,
+            f"{prefix}_cellSize": numpy.array(self.cellSize),
+            f"{prefix}_shape": self.shape,
+            f"{prefix}_offsets": self.offsets,
+            f"{prefix}_rows": self.rows,
+        }
+
+    @classmethod
+    def fromArrays(cls, arrays, prefix):
+        return cls(
+            arrays[f"{prefix}_origin"],
+            arrays[f"{prefix}_cellSize"].item(),
+            arrays[f"{prefix}_shape"],
+            arrays[f"{prefix}_offsets"],
+            arrays[f"{prefix}_rows"],
+        )
+
+
+def parseRow(row):
+    """
+    :param row: dict keyed by the index column names
+    :type row: dict
+    :raises ValueError: if a value can't be parsed or a coordinate isn't a
+                        finite number
+    :return: the values of the row converted to the column types
+    :rtype: dict
+    """
+    parsed = {"filename": row["filename"], "date": parseIndexDate(row["date"])}
+    for name in INT_COLUMNS:
+        parsed[name] = int(row[name])
+    for name in FLOAT_COLUMNS:
+        parsed[name] = float(row[name])
+        if not math.isfinite(parsed[name]):
+            raise ValueError(f"{name} isn't a finite number: {row[name]}")
+    return parsed
+
+
+class WRFIndex:
+    def __init__(self, columns, latLonBuckets=None, gridBuckets=None):
+        """[summary]
+
+        :param columns: dict of column name to numpy array, has to include
+                        filename, date, I0, J0, I1, J1, LAT0, LON0, LAT1 and
+                        LON1, all sorted by date
+        :type columns: dict
+        :param latLonBuckets: lat / lon lookup, built if not provided
+        :type latLonBuckets: GridBuckets, optional
+        :param gridBuckets: I / J lookup, built if not provided
+        :type gridBuckets: GridBuckets, optional
+        """
+        self.columns = columns
+        self.latLonBuckets = latLonBuckets
+        if self.latLonBuckets is None:
+            self.latLonBuckets = GridBuckets.build(
+                columns["LON0"], columns["LAT0"],
+                columns["LON1"], columns["LAT1"], LATLON_BUCKET_SIZE
+            )
+        self.gridBuckets = gridBuckets
+        if self.gridBuckets is None:
+            self.gridBuckets = GridBuckets.build(
+                columns["I0"], columns["J0"],
+                columns["I1"], columns["J1"], GRID_BUCKET_SIZE
+            )
+
+    def __len__(self):
+        return len(self.columns["date"])
+
+    @classmethod
+    def fromRows(cls, rows):
+        """builds the index from dicts with the index columns.  Rows that
+        are missing a value or have one that can't be parsed (an empty
+        LAT / LON, a bad date) are logged and left out of the index.
+
+        :param rows: iterable of dicts keyed by the index column names
+        :type rows: iterable
+        :return: the index, empty if there are no usable rows
+        :rtype: WRFIndex
+        """
+        values = {name: [] for name in
+                  ["filename", "date"] + INT_COLUMNS + FLOAT_COLUMNS}
+        skipped = 0
+        for row in rows:
+            try:
+                parsed = parseRow(row)
+            except (KeyError, TypeError, ValueError) as err:
+                skipped += 1
+                LOGGER.debug(f"skipping index row {row}: {err!r}")
+                continue
+            for name, value in parsed.items():
+                values[name].append(value)
+        if skipped:
+            LOGGER.warning(f"skipped {skipped} index rows with missing or "
+                           + "bad values")
+
+        dates = numpy.array(values["date"], dtype=numpy.int32)
+        order = numpy.argsort(dates, kind="stable")
+        columns = {
+            "filename": numpy.array(values["filename"], dtype=bytes)[order],
+            "date": dates[order],
+        }
+        for name in INT_COLUMNS:
+            columns[name] = numpy.array(values[name], dtype=numpy.int16)[order]
+        for name in FLOAT_COLUMNS:
+            columns[name] = numpy.array(
+                values[name], dtype=numpy.float32)[order]
+        return cls(columns)
+
+    @classmethod
+    def fromCsv(cls, csvFile):
+        """builds the index from a csv index file with a header row
+
+        :param csvFile: path to the csv file
+        :type csvFile: str
+        :return: the index
+        :rtype: WRFIndex
+        """
+        with open(csvFile, "r", newline="") as fh:
+            index = cls.fromRows(csv.DictReader(fh))
+        LOGGER.info(f"built binary index with {len(index)} rows")
+        return index
+
+    def save(self, indexFile):
+        """writes the index to a .npz file
+
+        :param indexFile: path to write to
+        :type indexFile: str
+        """
+        arrays = dict(self.columns)
+        arrays.update(self.latLonBuckets.toArrays("latlon"))
+        arrays.update(self.gridBuckets.toArrays("grid"))
+        with open(indexFile, "wb") as fh:
+            numpy.savez(fh, **arrays)
+
+    @classmethod
+    def load(cls, indexFile):
+        """reads an index that was written by save
+
+        :param indexFile: path to the .npz file
+        :type indexFile: str
+        :return: the index
+        :rtype: WRFIndex
+        """
+        with numpy.load(indexFile) as arrays:
+            arrays = dict(arrays)
+        columns = {
+            name: arrays[name] for name in
+            ["filename", "date"] + INT_COLUMNS + FLOAT_COLUMNS
+        }
+        return cls(
+            columns,
+            GridBuckets.fromArrays(arrays, "latlon"),
+            GridBuckets.fromArrays(arrays, "grid"),
+        )
+
+    def dateRange(self, start=None, end=None):
+        """
+        :return: the first and last + 1 row whose date is between start and
+                 end (inclusive)
+        :rtype: tuple
+        """
+        dates = self.columns["date"]
+        first = 0
+        last = len(dates)
+        if start is not None:
+            first = numpy.searchsorted(dates, parseIndexDate(start), "left")
+        if end is not None:
+            last = numpy.searchsorted(dates, parseIndexDate(end), "right")
+        return first, last
+
+    def _select(self, buckets, start, end, names, box):
+        first, last = self.dateRange(start, end)
+        candidates = buckets.candidates(*box, first, last)
+        x0, y0, x1, y1 = [self.columns[name][candidates] for name in names]
+        xMin, yMin, xMax, yMax = box
+        overlaps = (
+            (numpy.minimum(x0, x1) <= xMax)
+            & (numpy.maximum(x0, x1) >= xMin)
+            & (numpy.minimum(y0, y1) <= yMax)
+            & (numpy.maximum(y0, y1) >= yMin)
+        )
+        return [
+            name.decode()
+            for name in self.columns["filename"][candidates[overlaps]]
+        ]
+
+    def query(self, minLat, minLon, maxLat, maxLon, start=None, end=None):
+        """finds the files whose tiles overlap a lat / lon box and whose date
+        falls between start and end
+
+        :param start: first date to include, any format accepted by
+                      parseIndexDate, defaults to no limit
+        :type start: str, optional
+        :param end: last date to include, defaults to no limit
+        :type end: str, optional
+        :return: the object names of the files, in date order
+        :rtype: list
+        """
+        return self._select(
+            self.latLonBuckets, start, end, ["LON0", "LAT0", "LON1", "LAT1"],
+            (minLon, minLat, maxLon, maxLat)
+        )
+
+    def queryGrid(self, minI, minJ, maxI, maxJ, start=None, end=None):
+        """finds the files whose tiles overlap a box of WRF grid cells and
+        whose date falls between start and end
+
+        :return: the object names of the files, in date order
+        :rtype: list
+        """
+        return self._select(
+            self.gridBuckets, start, end, ["I0", "J0", "I1", "J1"],
+            (minI, minJ, maxI, maxJ)
+        )